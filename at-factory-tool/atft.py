@@ -27,29 +27,181 @@ import os
 import sys
 import tempfile
 import threading
+import time
+import traceback
 
 from atftman import AtftManager
+from atftman import AuditCategory
+from atftman import GetPlatformModules
 from atftman import ProvisionStatus
+from consolebuffer import ConsoleBuffer
+from deviceactor import PRIORITY_CRITICAL
+from deviceactor import PRIORITY_MONITOR
+from deviceactor import PRIORITY_NORMAL
+from eventbus import EventBus
 from fastboot_exceptions import DeviceNotFoundException
 from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import FlashManifestFormatError
 from fastboot_exceptions import ProductAttributesFileFormatError
 from fastboot_exceptions import ProductNotSpecifiedException
+from fastbootrecord import RecordingController
+from fastbootrecord import SessionRecorder
+import lockprofiler
+from refreshpolicy import RefreshPolicy
+import tracer
+from tracer import Traced
+from workerpool import GetScheduler
+from workerpool import ScheduledTimer
+from workerpool import WorkerPool
 
 import wx
 
-if sys.platform.startswith('linux'):
-  from fastbootsh import FastbootDevice
-  from serialmapperlinux import SerialMapper
-elif sys.platform.startswith('win'):
-  from fastbootsubp import FastbootDevice
-  from serialmapperwin import SerialMapper
-
 
 # If this is set to True, no prerequisites would be checked against manual
 # operation, such as you can do key provisioning before fusing the vboot key.
 TEST_MODE = False
 
 
+# The user interface strings in each language, see Atft.GetLanguageIndex. They
+# are looked up when first used, see Atft.__getattr__.
+_STRINGS = {
+    'SORT_BY_LOCATION_TEXT': ('Sort by location', '按照位置排序'),
+    'SORT_BY_SERIAL_TEXT': ('Sort by serial', '按照序列号排序'),
+    'STATUS_REFRESH_INTERVAL': ('Refresh every %.1fs', '每%.1f秒刷新'),
+    # Top level menus
+    'MENU_APPLICATION': ('Application', '应用'),
+    'MENU_KEY_PROVISIONING': ('Key Provisioning', '密钥传输'),
+    'MENU_ATFA_DEVICE': ('ATFA Device', 'ATFA 管理'),
+    'MENU_AUDIT': ('Audit', '审计'),
+    'MENU_KEY_MANAGEMENT': ('Key Management', '密钥管理'),
+    # Second level menus
+    'MENU_CLEAR_COMMAND': ('Clear Command Output', '清空控制台'),
+    'MENU_SHOW_STATUS_BAR': ('Show Statusbar', '显示状态栏'),
+    'MENU_SHOW_TOOL_BAR': ('Show Toolbar', '显示工具栏'),
+    'MENU_CHOOSE_PRODUCT': ('Choose Product', '选择产品'),
+    'MENU_CHOOSE_FLASH_MANIFEST': ('Choose Flash Manifest', '选择烧写清单'),
+    'MENU_QUIT': ('quit', '退出'),
+    'MENU_MANUAL_FUSE_VBOOT': ('Fuse Bootloader Vboot Key', '烧录引导密钥'),
+    'MENU_MANUAL_FUSE_ATTR': ('Fuse Permanent Attributes', '烧录产品信息'),
+    'MENU_MANUAL_LOCK_AVB': ('Lock Android Verified Boot', '锁定AVB'),
+    'MENU_MANUAL_PROV': ('Provision Key', '传输密钥'),
+    'MENU_MANUAL_FLASH': ('Flash Images', '烧写镜像'),
+    'MENU_STORAGE': ('Storage Mode', 'U盘模式'),
+    'MENU_AUDIT_DEVICES': ('Audit Devices', '审计设备'),
+    'MENU_ATFA_STATUS': ('ATFA Status', '查询余量'),
+    'MENU_KEY_THRESHOLD': ('Key Warning Threshold', '密钥警告阈值'),
+    'MENU_REBOOT': ('Reboot', '重启'),
+    'MENU_SHUTDOWN': ('Shutdown', '关闭'),
+    'MENU_STOREKEY': ('Store Key Bundle', '存储密钥打包文件'),
+    'MENU_PROCESSKEY': ('Process Key Bundle', '处理密钥打包文件'),
+    # Toolbar icon names
+    'TOOLBAR_AUTO_PROVISION': ('Automatic Provision', '自动模式'),
+    # Title
+    'TITLE': (
+        'Google Android Things Factory Tool',
+        'Google Android Things 工厂程序'),
+    # Area titles
+    'TITLE_ATFA_DEV': ('Atfa Device', 'ATFA 设备'),
+    'TITLE_PRODUCT_NAME': ('Product:', '产品：'),
+    'TITLE_PRODUCT_NAME_NOTCHOSEN': ('Not Chosen', '未选择'),
+    'TITLE_KEYS_LEFT': ('Attestation Keys Left:', '剩余密钥:'),
+    'TITLE_TARGET_DEV': ('Target Devices', '目标设备'),
+    'TITLE_COMMAND_OUTPUT': ('Command Output', '控制台输出'),
+    # Field names
+    'FIELD_SERIAL_NUMBER': ('Serial Number', '序列号'),
+    'FIELD_USB_LOCATION': ('USB Location', '插入位置'),
+    'FIELD_STATUS': ('Status', '状态'),
+    # Dialogs
+    'DIALOG_CHANGE_THRESHOLD_TEXT': ('ATFA Key Warning Threshold:', '密钥警告阈值:'),
+    'DIALOG_CHANGE_THRESHOLD_TITLE': (
+        'Change ATFA Key Warning Threshold',
+        '更改密钥警告阈值'),
+    'DIALOG_LOW_KEY_TITLE': ('Low Key Alert', '密钥不足警告'),
+    'DIALOG_ALERT_TITLE': ('Alert', '警告'),
+    'DIALOG_CHOOSE_PRODUCT_ATTRIBUTE_FILE': (
+        'Choose Product Attributes File',
+        '选择产品文件'),
+    'DIALOG_CHOOSE_FLASH_MANIFEST_FILE': (
+        'Choose Flash Manifest File',
+        '选择烧写清单文件'),
+    # Buttons
+    'BUTTON_TARGET_DEV_TOGGLE_SORT': ('target_device_sort_button', '目标设备排序按钮'),
+    # Alerts
+    'ALERT_AUTO_PROV_NO_ATFA': (
+        'Cannot enter auto provision mode\nNo ATFA device available!',
+        '无法开启自动模式\n没有可用的ATFA设备！'),
+    'ALERT_AUTO_PROV_NO_PRODUCT': (
+        'Cannot enter auto provision mode\nNo product specified!',
+        '无法开启自动模式\n没有选择产品！'),
+    'ALERT_PROV_NO_SELECTED': (
+        "Can't Provision! No target device selected!",
+        '无法传输密钥！目标设备没有选择！'),
+    'ALERT_PROV_NO_ATFA': (
+        "Can't Provision! No Available ATFA device!",
+        '无法传输密钥！没有ATFA设备!'),
+    'ALERT_PROV_NO_KEYS': ("Can't Provision! No keys left!", '无法传输密钥！没有剩余密钥!'),
+    'ALERT_FUSE_NO_SELECTED': (
+        "Can't Fuse vboot key! No target device selected!",
+        '无法烧录！目标设备没有选择！'),
+    'ALERT_FUSE_NO_PRODUCT': (
+        "Can't Fuse vboot key! No product specified!",
+        '无法烧录！没有选择产品！'),
+    'ALERT_FUSE_PERM_NO_SELECTED': (
+        "Can't Fuse permanent attributes! No target device selected!",
+        '无法烧录产品信息！目标设备没有选择！'),
+    'ALERT_FUSE_PERM_NO_PRODUCT': (
+        "Can't Fuse permanent attributes! No product specified!",
+        '无法烧录产品信息！没有选择产品！'),
+    'ALERT_LOCKAVB_NO_SELECTED': (
+        "Can't Lock Android Verified Boot! No target device selected!",
+        '无法锁定AVB！目标设备没有选择！'),
+    'ALERT_FAIL_TO_CREATE_LOG': ('Failed to create log!', '无法创建日志文件！'),
+    'ALERT_FAIL_TO_PARSE_CONFIG': (
+        'Failed to find or parse config file!',
+        '无法找到或解析配置文件！'),
+    'ALERT_NO_DEVICE': ('No devices found!', '无设备！'),
+    'ALERT_CANNOT_OPEN_FILE': ('Can not open file: ', '无法打开文件: '),
+    'ALERT_PRODUCT_FILE_FORMAT_WRONG': (
+        'The format for the product attributes file is not correct!',
+        '产品文件格式不正确！'),
+    'ALERT_ATFA_UNPLUG': (
+        'ATFA device unplugged, exit auto mode!',
+        'ATFA设备拔出，退出自动模式！'),
+    'ALERT_NO_KEYS_LEFT_LEAVE_PROV': (
+        'No keys left! Leave auto provisioning mode!',
+        '没有剩余密钥，退出自动模式！'),
+    'ALERT_FUSE_VBOOT_FUSED': (
+        'Cannot fuse bootloader vboot key for device that is already fused!',
+        '无法烧录一个已经烧录过引导密钥的设备！'),
+    'ALERT_FUSE_PERM_ATTR_FUSED': (
+        'Cannot fuse permanent attributes for device that is not fused '
+        'bootloader vboot key or already fused permanent attributes!',
+        '无法烧录一个没有烧录过引导密钥或者已经烧录过产品信息的设备！'),
+    'ALERT_LOCKAVB_LOCKED': (
+        'Cannot lock android verified boot for device that is not fused '
+        'permanent attributes or already locked!',
+        '无法锁定一个没有烧录过产品信息或者已经锁定AVB的设备！'),
+    'ALERT_PROV_PROVED': (
+        'Cannot provision device that is not ready for provisioning or '
+        'already provisioned!',
+        '无法传输密钥给一个不在正确状态或者已经拥有密钥的设备！'),
+    'ALERT_AUDIT_NO_DEVICE': (
+        'Cannot audit! No target device available!',
+        '无法审计！没有目标设备！'),
+    'ALERT_FLASH_NO_SELECTED': (
+        "Can't Flash images! No target device selected!",
+        '无法烧写镜像！目标设备没有选择！'),
+    'ALERT_FLASH_NO_MANIFEST': (
+        "Can't Flash images! No flash manifest specified!",
+        '无法烧写镜像！没有选择烧写清单！'),
+    'ALERT_FLASH_MANIFEST_FORMAT_WRONG': (
+        'The format for the flash manifest file is not correct!',
+        '烧写清单文件格式不正确！'),
+}
+_STRINGS['TOOLBAR_ATFA_STATUS'] = _STRINGS['MENU_ATFA_STATUS']
+_STRINGS['TOOLBAR_CLEAR_COMMAND'] = _STRINGS['MENU_CLEAR_COMMAND']
+
+
 class AtftException(Exception):
   """The exception class to include device and operation information.
   """
@@ -118,7 +270,7 @@ class AtftLog(object):
     self.log_size = log_size
     self.log_file_number = log_file_number
     self.file_size_max = math.floor(self.log_size / self.log_file_number)
-    self.lock = threading.Lock()
+    self.lock = lockprofiler.Lock('AtftLog.lock')
 
     log_files = []
     for file_name in os.listdir(self.log_dir):
@@ -266,6 +418,54 @@ class Event(wx.PyCommandEvent):
     """
     return self._value
 
+
+class CommandOutput(wx.ListCtrl):
+  """The command output window showing the lines of a ConsoleBuffer.
+
+  A virtual list: only the visible rows are rendered, so the repaint cost
+  does not depend on the number of lines kept.
+  """
+
+  # The width of the only column, wider than the window to scroll long lines.
+  LINE_WIDTH = 2000
+
+  def __init__(self, parent, console, size):
+    """Create the command output window.
+
+    Args:
+      parent: The parent window.
+      console: The ConsoleBuffer with the lines to show.
+      size: The size of the window.
+    """
+    wx.ListCtrl.__init__(
+        self, parent, wx.ID_ANY, size=size,
+        style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_NO_HEADER |
+        wx.LC_SINGLE_SEL)
+    self.console = console
+    self.InsertColumn(0, '', width=self.LINE_WIDTH)
+
+  def OnGetItemText(self, item, column):
+    """Get the text of a visible row, called by wx.
+
+    Args:
+      item: The row index.
+      column: The column index.
+    Returns:
+      The line shown in the row.
+    """
+    return self.console.GetLine(item)
+
+  def ShowLines(self):
+    """Update the window after the lines changed and scroll to the end."""
+    count = len(self.console)
+    self.SetItemCount(count)
+    if count:
+      # The rows move up once the buffer is full, only the visible ones are
+      # actually redrawn.
+      self.RefreshItems(0, count - 1)
+      self.EnsureVisible(count - 1)
+
+
 class Atft(wx.Frame):
   """wxpython class to handle all GUI commands for the ATFA.
 
@@ -278,10 +478,27 @@ class Atft(wx.Frame):
   ID_TOOL_PROVISION = 1
   ID_TOOL_CLEAR = 2
 
+  # The interval in seconds to log the worker pool statistics.
+  WORKER_STATS_INTERVAL = 60
+
+  # The minimum interval in seconds between two batches of UI updates from
+  # the worker threads.
+  UI_UPDATE_INTERVAL = 0.1
+
+  FIELD_SERIAL_WIDTH = 200
+  FIELD_USB_WIDTH = 350
+  FIELD_STATUS_WIDTH = 240
+  DIALOG_LOW_KEY_TEXT = ''
+  DIALOG_ALERT_TEXT = ''
+
   def __init__(self):
 
     self.configs = self.ParseConfigFile()
 
+    if self.LOCK_PROFILE:
+      # Must be enabled before the locks are created.
+      lockprofiler.Enable()
+
     self.SetLanguage()
 
     self.TITLE += ' ' + self.ATFT_VERSION
@@ -292,6 +509,45 @@ class Atft(wx.Frame):
     # The target devices refresh timer object
     self.refresh_timer = None
 
+    # The policy choosing the interval between device list refreshes.
+    self.refresh_policy = RefreshPolicy(
+        self.DEVICE_REFRESH_INTERVAL, self.DEVICE_REFRESH_MAX_INTERVAL)
+
+    # The time the scheduled refresh is due.
+    self.refresh_due_time = None
+
+    # The devices and their status found by the last refresh, used to detect
+    # changes.
+    self.last_refresh_snapshot = None
+
+    # Lock to replace the refresh timer, so that only one timer is scheduled.
+    # Also guards the stats timer and closing.
+    self.refresh_timer_lock = threading.Lock()
+
+    # Set on close, no timer is scheduled after that.
+    self.closing = False
+
+    # The timer logging the worker statistics every WORKER_STATS_INTERVAL.
+    self.stats_timer = None
+
+    # The lines of the command output window, the oldest lines are moved to
+    # the log beyond CONSOLE_MAX_LINES.
+    self.console = ConsoleBuffer(
+        self.CONSOLE_MAX_LINES, self._SpillConsoleLines)
+
+    # The messages and device list changes from the worker threads are applied
+    # to the UI in batches, see _UiUpdateEventHandler. The event type is
+    # created here since the worker threads may post before the UI is built.
+    self.ui_update_event = wx.NewEventType()
+    self.event_bus = EventBus(self._SendUiUpdateEvent, self.UI_UPDATE_INTERVAL)
+
+    # The shared pool to run operations in the background.
+    self.worker_pool = WorkerPool(self.MAX_WORKERS, 'AtftWorker')
+
+    # Device list refresh has its own worker so that it is never starved by
+    # operations that are waiting for a device to reboot.
+    self.refresh_pool = WorkerPool(1, 'AtftRefresh')
+
     # The field to sort target devices
     self.sort_by = self.atft_manager.SORT_BY_LOCATION
 
@@ -309,26 +565,31 @@ class Atft(wx.Frame):
     # means that the refresh is paused. We would pause the refresh during each
     # fastboot command since on Windows, a fastboot device would disappear from
     # fastboot devices while a fastboot command is issued.
-    self.refresh_pause_lock = threading.Semaphore(value=0)
+    self.refresh_pause_lock = lockprofiler.Semaphore('refresh_pause_lock', 0)
 
     # 'fastboot devices' can only run sequentially, so we use this lock to check
     # if there's already a 'fastboot devices' command running. If so, we ignore
     # the second request.
-    self.listing_device_lock = threading.Lock()
+    self.listing_device_lock = lockprofiler.Lock('listing_device_lock')
 
     # To prevent low key alert to show by each provisioning.
     # We only show it once per auto provision.
     self.low_key_alert_shown = False
 
-    # Lock to make sure only one device is doing auto provisioning at one time.
-    self.auto_prov_lock = threading.Lock()
+    # Only one device is doing auto provisioning at one time, the other
+    # devices wait in the queue of this pool.
+    self.auto_prov_pool = WorkerPool(1, 'AtftAutoProv')
 
     # Lock for showing alert box
-    self.alert_lock = threading.Lock()
+    self.alert_lock = lockprofiler.Lock('alert_lock')
     # The key threshold, if the number of attestation key in the ATFA device
     # is lower than this number, an alert would appear.
     self.key_threshold = self.DEFAULT_KEY_THRESHOLD
 
+    if self.configs is not None:
+      # List the devices once while the UI is built, see _PrefetchDevices.
+      self._Submit(self.refresh_pool, self._PrefetchDevices)
+
     self.InitializeUI()
 
     if self.configs == None:
@@ -340,14 +601,30 @@ class Atft(wx.Frame):
     if not self.log.log_dir_file:
       self._SendAlertEvent(self.ALERT_FAIL_TO_CREATE_LOG)
 
-    self.StartRefreshingDevices()
+    if self.TRACE_FILE:
+      # Keeps only the latest TRACE_MAX_EVENTS events so that tracing can stay
+      # on in production.
+      tracer.Start(tracer.Tracer(self.TRACE_MAX_EVENTS))
+
+    # The first refresh runs after the prefetch, and not on the UI thread.
+    self._Submit(self.refresh_pool, self.StartRefreshingDevices)
     self.ChooseProduct(None)
+    self._ScheduleWorkerStats()
 
   def CreateAtftManager(self):
     """Create an AtftManager object.
 
     This function exists for test mocking.
     """
+    (FastbootDevice, SerialMapper) = GetPlatformModules()
+    FastbootDevice.SetTimeouts(self.FASTBOOT_TIMEOUTS)
+    if self.FASTBOOT_RECORD_FILE:
+      # Record the fastboot session to replay it in benchmarks.
+      controller = RecordingController(
+          FastbootDevice, SessionRecorder(self.FASTBOOT_RECORD_FILE))
+      return AtftManager(controller,
+                         controller.CreateSerialMapper(SerialMapper),
+                         self.configs)
     return AtftManager(FastbootDevice, SerialMapper, self.configs)
 
   def CreateAtftLog(self):
@@ -367,6 +644,7 @@ class Atft(wx.Frame):
     self.ATFT_VERSION = 'v0.0'
     self.COMPATIBLE_ATFA_VERSION = 'v0'
     self.DEVICE_REFRESH_INTERVAL = 1.0
+    self.DEVICE_REFRESH_MAX_INTERVAL = 16.0
     self.DEFAULT_KEY_THRESHOLD = 0
     self.LOG_DIR = None
     self.LOG_SIZE = 0
@@ -374,6 +652,16 @@ class Atft(wx.Frame):
     self.LANGUAGE = 'eng'
     self.REBOOT_TIMEOUT = 0
     self.PRODUCT_ATTRIBUTE_FILE_EXTENSION = '*.atpa'
+    self.FASTBOOT_TIMEOUTS = {}
+    self.MAX_WORKERS = 8
+    self.FLASH_MANIFEST_FILE_EXTENSION = '*.json'
+    self.SINGLE_REBOOT_FLOW = False
+    self.FASTBOOT_RECORD_FILE = None
+    self.TRACE_FILE = None
+    self.TRACE_MAX_EVENTS = 100000
+    self.LOCK_PROFILE = False
+    self.LOCK_PROFILE_TOP_N = 5
+    self.CONSOLE_MAX_LINES = 10000
 
     config_file_path = os.path.join(self._GetCurrentPath(), self.CONFIG_FILE)
     if not os.path.exists(config_file_path):
@@ -400,6 +688,82 @@ class Atft(wx.Frame):
     except (KeyError, ValueError):
       return None
 
+    # Optional per-operation deadlines in seconds for fastboot commands, e.g.
+    # {"getvar": "10", "reboot": "30"}.
+    if 'FASTBOOT_TIMEOUTS' in configs:
+      try:
+        self.FASTBOOT_TIMEOUTS = dict(
+            (str(operation), float(timeout))
+            for operation, timeout in configs['FASTBOOT_TIMEOUTS'].iteritems())
+      except (AttributeError, ValueError):
+        return None
+      fastboot_device = GetPlatformModules()[0]
+      if not set(self.FASTBOOT_TIMEOUTS).issubset(fastboot_device.timeouts):
+        return None
+
+    # Optional maximum number of operations running at the same time.
+    if 'MAX_WORKERS' in configs:
+      try:
+        self.MAX_WORKERS = max(1, int(configs['MAX_WORKERS']))
+      except ValueError:
+        return None
+
+    # Optional longest refresh interval while the device list does not
+    # change. DEVICE_REFRESH_INTERVAL is the interval while devices are
+    # changing.
+    if 'DEVICE_REFRESH_MAX_INTERVAL' in configs:
+      try:
+        self.DEVICE_REFRESH_MAX_INTERVAL = float(
+            configs['DEVICE_REFRESH_MAX_INTERVAL'])
+      except ValueError:
+        return None
+
+    if 'FLASH_MANIFEST_FILE_EXTENSION' in configs:
+      self.FLASH_MANIFEST_FILE_EXTENSION = str(
+          configs['FLASH_MANIFEST_FILE_EXTENSION'])
+
+    # Optional automatic flow that does all the provision steps before one
+    # verification reboot, for bootloaders that report the fused state right
+    # away.
+    if 'SINGLE_REBOOT_FLOW' in configs:
+      self.SINGLE_REBOOT_FLOW = (
+          str(configs['SINGLE_REBOOT_FLOW']).lower() in ('1', 'true', 'yes'))
+
+    # Optional file to record all the fastboot commands to, see
+    # fastbootrecord.py.
+    if configs.get('FASTBOOT_RECORD_FILE'):
+      self.FASTBOOT_RECORD_FILE = str(configs['FASTBOOT_RECORD_FILE'])
+
+    # Optional trace file for Perfetto or about:tracing, see tracer.py. It is
+    # written every WORKER_STATS_INTERVAL and on exit. TRACE_MAX_EVENTS 0
+    # keeps all the events.
+    if configs.get('TRACE_FILE'):
+      self.TRACE_FILE = str(configs['TRACE_FILE'])
+    if 'TRACE_MAX_EVENTS' in configs:
+      try:
+        self.TRACE_MAX_EVENTS = max(0, int(configs['TRACE_MAX_EVENTS']))
+      except ValueError:
+        return None
+
+    # Optional lock contention profiling, the LOCK_PROFILE_TOP_N most
+    # contended locks are logged every WORKER_STATS_INTERVAL.
+    if 'LOCK_PROFILE' in configs:
+      self.LOCK_PROFILE = (
+          str(configs['LOCK_PROFILE']).lower() in ('1', 'true', 'yes'))
+    if 'LOCK_PROFILE_TOP_N' in configs:
+      try:
+        self.LOCK_PROFILE_TOP_N = max(1, int(configs['LOCK_PROFILE_TOP_N']))
+      except ValueError:
+        return None
+
+    # Optional number of lines kept in the command output window, the older
+    # lines are only in the log.
+    if 'CONSOLE_MAX_LINES' in configs:
+      try:
+        self.CONSOLE_MAX_LINES = max(1, int(configs['CONSOLE_MAX_LINES']))
+      except ValueError:
+        return None
+
     return configs
 
   def _StoreConfigToFile(self):
@@ -440,154 +804,22 @@ class Atft(wx.Frame):
     return index
 
   def SetLanguage(self):
-    """Set the string constants according to the language setting.
-    """
-    index = self.GetLanguageIndex()
-
-    self.SORT_BY_LOCATION_TEXT = ['Sort by location', '按照位置排序'][index]
-    self.SORT_BY_SERIAL_TEXT = ['Sort by serial', '按照序列号排序'][index]
-
-    # Top level menus
-    self.MENU_APPLICATION = ['Application', '应用'][index]
-    self.MENU_KEY_PROVISIONING = ['Key Provisioning', '密钥传输'][index]
-    self.MENU_ATFA_DEVICE = ['ATFA Device', 'ATFA 管理'][index]
-    self.MENU_AUDIT = ['Audit', '审计'][index]
-    self.MENU_KEY_MANAGEMENT = ['Key Management', '密钥管理'][index]
-
-    # Second level menus
-    self.MENU_CLEAR_COMMAND = ['Clear Command Output', '清空控制台'][index]
-    self.MENU_SHOW_STATUS_BAR = ['Show Statusbar', '显示状态栏'][index]
-    self.MENU_SHOW_TOOL_BAR = ['Show Toolbar', '显示工具栏'][index]
-    self.MENU_CHOOSE_PRODUCT = ['Choose Product', '选择产品'][index]
-    self.MENU_QUIT = ['quit', '退出'][index]
-
-    self.MENU_MANUAL_FUSE_VBOOT = ['Fuse Bootloader Vboot Key',
-                                   '烧录引导密钥'][index]
-    self.MENU_MANUAL_FUSE_ATTR = ['Fuse Permanent Attributes',
-                                  '烧录产品信息'][index]
-    self.MENU_MANUAL_LOCK_AVB = ['Lock Android Verified Boot', '锁定AVB'][index]
-    self.MENU_MANUAL_PROV = ['Provision Key', '传输密钥'][index]
-
-    self.MENU_STORAGE = ['Storage Mode', 'U盘模式'][index]
-
-    self.MENU_ATFA_STATUS = ['ATFA Status', '查询余量'][index]
-    self.MENU_KEY_THRESHOLD = ['Key Warning Threshold', '密钥警告阈值'][index]
-    self.MENU_REBOOT = ['Reboot', '重启'][index]
-    self.MENU_SHUTDOWN = ['Shutdown', '关闭'][index]
-
-    self.MENU_STOREKEY = ['Store Key Bundle', '存储密钥打包文件'][index]
-    self.MENU_PROCESSKEY = ['Process Key Bundle', '处理密钥打包文件'][index]
-
-    # Toolbar icon names
-    self.TOOLBAR_AUTO_PROVISION = ['Automatic Provision', '自动模式'][index]
-    self.TOOLBAR_ATFA_STATUS = self.MENU_ATFA_STATUS
-    self.TOOLBAR_CLEAR_COMMAND = self.MENU_CLEAR_COMMAND
-
-    # Title
-    self.TITLE = ['Google Android Things Factory Tool',
-                  'Google Android Things 工厂程序'][index]
-
-    # Area titles
-    self.TITLE_ATFA_DEV = ['Atfa Device', 'ATFA 设备'][index]
-    self.TITLE_PRODUCT_NAME = ['Product:', '产品：'][index]
-    self.TITLE_PRODUCT_NAME_NOTCHOSEN = ['Not Chosen', '未选择'][index]
-    self.TITLE_KEYS_LEFT = ['Attestation Keys Left:', '剩余密钥:'][index]
-    self.TITLE_TARGET_DEV = ['Target Devices', '目标设备'][index]
-    self.TITLE_COMMAND_OUTPUT = ['Command Output', '控制台输出'][index]
-
-    # Field names
-    self.FIELD_SERIAL_NUMBER = ['Serial Number', '序列号'][index]
-    self.FIELD_USB_LOCATION = ['USB Location', '插入位置'][index]
-    self.FIELD_STATUS = ['Status', '状态'][index]
-    self.FIELD_SERIAL_WIDTH = 200
-    self.FIELD_USB_WIDTH = 350
-    self.FIELD_STATUS_WIDTH = 240
-
-    # Dialogs
-    self.DIALOG_CHANGE_THRESHOLD_TEXT = ['ATFA Key Warning Threshold:',
-                                         '密钥警告阈值:'][index]
-    self.DIALOG_CHANGE_THRESHOLD_TITLE = ['Change ATFA Key Warning Threshold',
-                                          '更改密钥警告阈值'][index]
-    self.DIALOG_LOW_KEY_TEXT = ''
-    self.DIALOG_LOW_KEY_TITLE = ['Low Key Alert', '密钥不足警告'][index]
-    self.DIALOG_ALERT_TEXT = ''
-    self.DIALOG_ALERT_TITLE = ['Alert', '警告'][index]
-    self.DIALOG_CHOOSE_PRODUCT_ATTRIBUTE_FILE = [
-        'Choose Product Attributes File', '选择产品文件'][index]
-
-    # Buttons
-    self.BUTTON_TARGET_DEV_TOGGLE_SORT = ['target_device_sort_button',
-                                     '目标设备排序按钮'][index]
-
-    # Alerts
-    self.ALERT_AUTO_PROV_NO_ATFA = [
-        'Cannot enter auto provision mode\nNo ATFA device available!',
-        '无法开启自动模式\n没有可用的ATFA设备！'][index]
-    self.ALERT_AUTO_PROV_NO_PRODUCT = [
-        'Cannot enter auto provision mode\nNo product specified!',
-        '无法开启自动模式\n没有选择产品！'][index]
-    self.ALERT_PROV_NO_SELECTED = [
-        "Can't Provision! No target device selected!",
-        '无法传输密钥！目标设备没有选择！'][index]
-    self.ALERT_PROV_NO_ATFA = [
-        "Can't Provision! No Available ATFA device!",
-        '无法传输密钥！没有ATFA设备!'][index]
-    self.ALERT_PROV_NO_KEYS = [
-        "Can't Provision! No keys left!",
-        '无法传输密钥！没有剩余密钥!'][index]
-    self.ALERT_FUSE_NO_SELECTED = [
-        "Can't Fuse vboot key! No target device selected!",
-        '无法烧录！目标设备没有选择！'][index]
-    self.ALERT_FUSE_NO_PRODUCT = [
-        "Can't Fuse vboot key! No product specified!",
-        '无法烧录！没有选择产品！'][index]
-    self.ALERT_FUSE_PERM_NO_SELECTED = [
-        "Can't Fuse permanent attributes! No target device selected!",
-        '无法烧录产品信息！目标设备没有选择！'][index]
-    self.ALERT_FUSE_PERM_NO_PRODUCT = [
-        "Can't Fuse permanent attributes! No product specified!",
-        '无法烧录产品信息！没有选择产品！'][index]
-    self.ALERT_LOCKAVB_NO_SELECTED = [
-        "Can't Lock Android Verified Boot! No target device selected!",
-        '无法锁定AVB！目标设备没有选择！'][index]
-    self.ALERT_FAIL_TO_CREATE_LOG = [
-        'Failed to create log!',
-        '无法创建日志文件！'][index]
-    self.ALERT_FAIL_TO_PARSE_CONFIG = [
-        'Failed to find or parse config file!',
-        '无法找到或解析配置文件！'][index]
-    self.ALERT_NO_DEVICE = [
-        'No devices found!',
-        '无设备！'][index]
-    self.ALERT_CANNOT_OPEN_FILE = [
-        'Can not open file: ',
-        '无法打开文件: '][index]
-    self.ALERT_PRODUCT_FILE_FORMAT_WRONG = [
-        'The format for the product attributes file is not correct!',
-        '产品文件格式不正确！'][index]
-    self.ALERT_ATFA_UNPLUG = [
-        'ATFA device unplugged, exit auto mode!',
-        'ATFA设备拔出，退出自动模式！'][index]
-    self.ALERT_NO_KEYS_LEFT_LEAVE_PROV = [
-        'No keys left! Leave auto provisioning mode!',
-        '没有剩余密钥，退出自动模式！'][index]
-    self.ALERT_FUSE_VBOOT_FUSED = [
-        'Cannot fuse bootloader vboot key for device that is already fused!',
-        '无法烧录一个已经烧录过引导密钥的设备！'][index]
-    self.ALERT_FUSE_PERM_ATTR_FUSED = [
-        'Cannot fuse permanent attributes for device that is not fused '
-        'bootloader vboot key or already fused permanent attributes!',
-        '无法烧录一个没有烧录过引导密钥或者已经烧录过产品信息的设备！'][index]
-    self.ALERT_LOCKAVB_LOCKED = [
-        'Cannot lock android verified boot for device that is not fused '
-        'permanent attributes or already locked!',
-        '无法锁定一个没有烧录过产品信息或者已经锁定AVB的设备！'][index]
-    self.ALERT_PROV_PROVED = [
-        'Cannot provision device that is not ready for provisioning or '
-        'already provisioned!',
-        '无法传输密钥给一个不在正确状态或者已经拥有密钥的设备！'][index]
+    """Set the language of the string constants.
 
+    The strings are looked up in _STRINGS when they are first used, so only
+    the ones shown are built.
+    """
+    self.language_index = self.GetLanguageIndex()
 
+  def __getattr__(self, name):
+    # Only called for attributes not set yet, the string is cached on the
+    # object.
+    strings = _STRINGS.get(name)
+    if strings is None:
+      raise AttributeError(name)
+    value = strings[self.__dict__.get('language_index', 0)]
+    setattr(self, name, value)
+    return value
 
   def InitializeUI(self):
     """Initialize the application UI."""
@@ -651,10 +883,18 @@ class Atft(wx.Frame):
         wx.ID_ANY, self.MENU_CHOOSE_PRODUCT)
     self.Bind(wx.EVT_MENU, self.ChooseProduct, self.menu_choose_product)
 
+    menu_choose_flash_manifest = self.app_menu.Append(
+        wx.ID_ANY, self.MENU_CHOOSE_FLASH_MANIFEST)
+    self.Bind(wx.EVT_MENU, self.ChooseFlashManifest,
+              menu_choose_flash_manifest)
+
     menu_quit = self.app_menu.Append(wx.ID_EXIT, self.MENU_QUIT)
     self.Bind(wx.EVT_MENU, self.OnQuit, menu_quit)
 
     # Key Provision Menu Options
+    menu_manual_flash = self.provision_menu.Append(
+        wx.ID_ANY, self.MENU_MANUAL_FLASH)
+    self.Bind(wx.EVT_MENU, self.OnFlashImages, menu_manual_flash)
     menu_manual_fuse_vboot = self.provision_menu.Append(
         wx.ID_ANY, self.MENU_MANUAL_FUSE_VBOOT)
     self.Bind(wx.EVT_MENU, self.OnFuseVbootKey, menu_manual_fuse_vboot)
@@ -673,6 +913,10 @@ class Atft(wx.Frame):
     menu_storage = self.audit_menu.Append(wx.ID_ANY, self.MENU_STORAGE)
     self.Bind(wx.EVT_MENU, self.OnStorageMode, menu_storage)
 
+    menu_audit_devices = self.audit_menu.Append(
+        wx.ID_ANY, self.MENU_AUDIT_DEVICES)
+    self.Bind(wx.EVT_MENU, self.OnAuditDevices, menu_audit_devices)
+
     # ATFA Menu Options
     menu_atfa_status = self.atfa_menu.Append(wx.ID_ANY, self.MENU_ATFA_STATUS)
     self.Bind(wx.EVT_MENU, self.OnCheckATFAStatus, menu_atfa_status)
@@ -806,16 +1050,12 @@ class Atft(wx.Frame):
     self.vbox.Add(self.command_title_sizer, 0, wx.LEFT)
 
     # Command Output Window
-    self.cmd_output = wx.TextCtrl(
-        self.panel,
-        wx.ID_ANY,
-        size=(800, 190),
-        style=wx.TE_MULTILINE | wx.TE_READONLY | wx.HSCROLL)
+    self.cmd_output = CommandOutput(self.panel, self.console, (800, 190))
     self.vbox.Add(self.cmd_output, 0, wx.ALL | wx.EXPAND, 5)
 
     self.panel.SetSizer(self.vbox)
     self.toolbar.Realize()
-    self.statusbar = self.CreateStatusBar()
+    self.statusbar = self.CreateStatusBar(2)
     self.statusbar.SetStatusText('Ready')
     self.SetSize((800, 720))
     self.SetTitle(self.TITLE)
@@ -883,26 +1123,69 @@ class Atft(wx.Frame):
     Args:
       text: The text to be printed.
     """
-    msg = '[' + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '] '
-    msg += text + '\n'
-    self.PrintToWindow(self.cmd_output, msg, True)
+    self.PrintMessagesToCommandWindow([(datetime.now(), text)])
+
+  def PrintMessagesToCommandWindow(self, messages):
+    """Print a batch of messages to the command window in one update.
+
+    Args:
+      messages: The list of (datetime, text) to be printed, each message is
+        prefixed with its time.
+    """
+    lines = []
+    for (timestamp, text) in messages:
+      msg = '[' + timestamp.strftime('%Y-%m-%d %H:%M:%S') + '] ' + text
+      lines.extend(msg.splitlines())
+    self.console.Append(lines)
+    self.cmd_output.ShowLines()
+
+  def _SpillConsoleLines(self, lines):
+    """Keep the lines dropped from the command output window in the log.
+
+    Args:
+      lines: The lines dropped.
+    """
+    for line in lines:
+      self.log.Info('Console', line)
 
   def StartRefreshingDevices(self):
-    """Refreshing the device list by interval of DEVICE_REFRESH_INTERVAL.
+    """Refresh the device list and schedule the next refresh.
+
+    The device list is refreshed every DEVICE_REFRESH_INTERVAL while devices
+    are changing, rebooting or being operated on. The interval grows up to
+    DEVICE_REFRESH_MAX_INTERVAL while the station is idle.
     """
-    # If there's already a timer running, stop it first.
-    self.StopRefresh()
-    # Start a new timer.
-    self.refresh_timer = threading.Timer(self.DEVICE_REFRESH_INTERVAL,
-                                         self.StartRefreshingDevices)
-    self.refresh_timer.start()
+    # Refresh again soon if this refresh fails.
+    changed = True
+    try:
+      if self.refresh_pause_lock.acquire(False):
+        self.refresh_pause_lock.release()
+        self._SendDeviceListedEvent()
+        # An operation is running.
+      else:
+        # If refresh is not paused, refresh the devices.
+        self._ListDevices()
+        changed = self._UpdateRefreshSnapshot()
 
-    if self.refresh_pause_lock.acquire(False):
-      self.refresh_pause_lock.release()
-      self._SendDeviceListedEvent()
-    else:
-      # If refresh is not paused, refresh the devices.
-      self._ListDevices()
+      if self.auto_prov or self.atft_manager.HasPendingReboots():
+        # Devices are expected to show up any time.
+        changed = True
+    finally:
+      self._ScheduleRefresh(self.refresh_policy.NextInterval(changed))
+
+  def _PrefetchDevices(self):
+    """List the devices once before the first refresh.
+
+    Runs while the UI is built. A device is only added once it is listed
+    twice, so the devices already plugged in show up in the first refresh
+    instead of one DEVICE_REFRESH_INTERVAL later. A failure is reported by
+    the next refresh.
+    """
+    with self.listing_device_lock:
+      try:
+        self.atft_manager.ListDevices(self.sort_by)
+      except FastbootFailure:
+        pass
 
   def StopRefresh(self):
     """Stop the refresh timer if there's any.
@@ -912,13 +1195,64 @@ class Atft(wx.Frame):
       self.refresh_timer = None
       timer.cancel()
 
+  def _ScheduleRefresh(self, interval):
+    """Replace the refresh timer with one that refreshes after interval.
+
+    Args:
+      interval: The time in seconds until the next refresh.
+    """
+    with self.refresh_timer_lock:
+      if self.closing:
+        return
+      # If there's already a timer running, stop it first.
+      self.StopRefresh()
+      self.refresh_due_time = time.time() + interval
+      self.refresh_timer = ScheduledTimer(
+          interval, self._Submit,
+          [self.refresh_pool, self.StartRefreshingDevices])
+      self.refresh_timer.start()
+
+  def _BurstRefresh(self):
+    """Go back to the fast refresh interval because devices may change.
+
+    If the next refresh is further away than the fast interval, it is moved
+    forward.
+    """
+    self.refresh_policy.Burst()
+    interval = self.refresh_policy.GetInterval()
+    with self.refresh_timer_lock:
+      reschedule = (self.refresh_timer is not None and
+                    self.refresh_due_time - time.time() > interval)
+    if reschedule:
+      self._ScheduleRefresh(interval)
+
+  def _UpdateRefreshSnapshot(self):
+    """Store the devices found by the last refresh.
+
+    A new device is pending for one refresh before it is added, so the
+    pending devices are part of the snapshot.
+
+    Returns:
+      Whether the devices or their status changed since the previous refresh.
+    """
+    atfa_dev = self.atft_manager.atfa_dev
+    snapshot = (
+        atfa_dev.serial_number if atfa_dev else None,
+        [(target_dev.serial_number, target_dev.provision_status)
+         for target_dev in self.atft_manager.target_devs],
+        list(self.atft_manager.pending_serials))
+    changed = snapshot != self.last_refresh_snapshot
+    self.last_refresh_snapshot = snapshot
+    return changed
+
   def OnClearCommandWindow(self, event=None):
     """Clear the command window.
 
     Args:
       event: The triggering event.
     """
-    self.cmd_output.Clear()
+    self.console.Clear()
+    self.cmd_output.ShowLines()
 
   def OnListDevices(self, event=None):
     """List devices asynchronously.
@@ -939,6 +1273,14 @@ class Atft(wx.Frame):
     """
     self._CreateThread(self._SwitchStorageMode)
 
+  def OnAuditDevices(self, event):
+    """Audit the provision state of all target devices asynchronously.
+
+    Args:
+      event: The triggering event.
+    """
+    self._CreateThread(self._AuditDevices)
+
   def OnReboot(self, event):
     """Reboot ATFA device asynchronously.
 
@@ -1058,6 +1400,23 @@ class Atft(wx.Frame):
     """
     self._CreateThread(self._ShowATFAStatus)
 
+  def OnFlashImages(self, event):
+    """Flash the images in the flash manifest to the target devices
+    asynchronously.
+
+    Args:
+      event: The triggering event.
+    """
+    selected_serials = self._GetSelectedSerials()
+    if not selected_serials:
+      self._SendAlertEvent(self.ALERT_FLASH_NO_SELECTED)
+      return
+    if not self.atft_manager.flash_manifest:
+      self._SendAlertEvent(self.ALERT_FLASH_NO_MANIFEST)
+      return
+
+    self._CreateThread(self._FlashImages, selected_serials)
+
   def OnFuseVbootKey(self, event):
     """Fuse the vboot key to the target device asynchronously.
 
@@ -1183,6 +1542,39 @@ class Atft(wx.Frame):
     except ProductAttributesFileFormatError:
       self._SendAlertEvent(self.ALERT_PRODUCT_FILE_FORMAT_WRONG)
 
+  def ChooseFlashManifest(self, event):
+    """Ask user to choose the flash manifest file.
+
+    Args:
+      event: The triggering event.
+    """
+    message = self.DIALOG_CHOOSE_FLASH_MANIFEST_FILE
+    wildcard = self.FLASH_MANIFEST_FILE_EXTENSION
+    callback = self.ProcessFlashManifestFile
+    data = self.SelectFileArg(message, wildcard, callback)
+    event = Event(self.select_file_event, value=data)
+    wx.QueueEvent(self, event)
+
+  def ProcessFlashManifestFile(self, pathname):
+    """Process the selected flash manifest file.
+
+    Args:
+      pathname: The path for the flash manifest file to parse.
+    """
+    try:
+      with open(pathname, 'r') as manifest_file:
+        content = manifest_file.read()
+      self.atft_manager.ProcessFlashManifestFile(
+          content, os.path.dirname(pathname))
+      self.PrintToCommandWindow(
+          'Flash manifest: ' + ', '.join(
+              image.partition for image in self.atft_manager.flash_manifest))
+    except IOError:
+      self._SendAlertEvent(self.ALERT_CANNOT_OPEN_FILE + pathname)
+    except FlashManifestFormatError as e:
+      self._SendAlertEvent(
+          self.ALERT_FLASH_MANIFEST_FORMAT_WRONG + '\n' + str(e))
+
   def OnChangeKeyThreshold(self, event):
     """Change the threshold for low number of key warning.
 
@@ -1237,8 +1629,18 @@ class Atft(wx.Frame):
       event: The triggering event.
     """
     self._StoreConfigToFile()
-    # Stop the refresh timer on close.
+    # Stop the timers and the workers on close. The scheduler thread must not
+    # be left waiting while the interpreter shuts down.
+    with self.refresh_timer_lock:
+      self.closing = True
     self.StopRefresh()
+    if self.stats_timer:
+      self.stats_timer.cancel()
+      self.stats_timer = None
+    GetScheduler().Shutdown()
+    for pool in (self.worker_pool, self.refresh_pool, self.auto_prov_pool):
+      pool.Shutdown()
+    self._SaveTrace()
     self.Destroy()
 
   def _HandleAutoProv(self):
@@ -1253,7 +1655,13 @@ class Atft(wx.Frame):
           ):
         self.auto_dev_serials.append(target_dev.serial_number)
         target_dev.provision_status = ProvisionStatus.WAITING
-        self._CreateThread(self._HandleStateTransition, target_dev)
+        if (self.atft_manager.flash_manifest and
+            self.atft_manager.NeedsFlash(target_dev)):
+          # Devices are flashed in parallel before they queue for provisioning.
+          self._CreateThread(self._FlashThenProvision, target_dev)
+        else:
+          self._Submit(
+              self.auto_prov_pool, self._HandleStateTransition, target_dev)
 
 
   def _HandleKeysLeft(self):
@@ -1271,18 +1679,15 @@ class Atft(wx.Frame):
 
     self.keys_left_display.SetLabelText('')
 
-  def _CopyList(self, old_list):
-    """Copy a device list.
+  def _SnapshotList(self, devices):
+    """Take the snapshots of a device list.
 
     Args:
-      old_list: The original list
+      devices: The list of DeviceInfo objects.
     Returns:
-      The duplicate with all the public member copied.
+      The list of DeviceSnapshot objects.
     """
-    copy_list = []
-    for dev in old_list:
-      copy_list.append(dev.Copy())
-    return copy_list
+    return [dev.Snapshot() for dev in devices]
 
   def _HandleException(self, level, e, operation=None, target=None):
     """Handle the exception.
@@ -1298,11 +1703,7 @@ class Atft(wx.Frame):
       target: The DeviceInfo object associated with this exception.
     """
     atft_exception = AtftException(e, operation, target)
-    wx.QueueEvent(self,
-                  Event(
-                      self.exception_event,
-                      wx.ID_ANY,
-                      value=str(atft_exception)))
+    self.event_bus.PostMessage(str(atft_exception))
     self._LogException(level, atft_exception)
 
   def _LogException(self, level, atft_exception):
@@ -1325,18 +1726,12 @@ class Atft(wx.Frame):
     self.refresh_event = wx.NewEventType()
     self.refresh_event_bind = wx.PyEventBinder(self.refresh_event)
 
-    # Event for device listed.
-    self.dev_listed_event = wx.NewEventType()
-    self.dev_listed_event_bind = wx.PyEventBinder(self.dev_listed_event)
-    # Event when general exception happens.
-    self.exception_event = wx.NewEventType()
-    self.exception_event_bind = wx.PyEventBinder(self.exception_event)
+    # Event for applying the UI updates from the worker threads, the event
+    # type is created in __init__.
+    self.ui_update_event_bind = wx.PyEventBinder(self.ui_update_event)
     # Event for alert box.
     self.alert_event = wx.NewEventType()
     self.alert_event_bind = wx.PyEventBinder(self.alert_event)
-    # Event for general message to be printed in command window.
-    self.print_event = wx.NewEventType()
-    self.print_event_bind = wx.PyEventBinder(self.print_event)
     # Event for low key alert.
     self.low_key_alert_event = wx.NewEventType()
     self.low_key_alert_event_bind = wx.PyEventBinder(self.low_key_alert_event)
@@ -1345,10 +1740,8 @@ class Atft(wx.Frame):
     self.select_file_event_bind = wx.PyEventBinder(self.select_file_event)
 
     self.Bind(self.refresh_event_bind, self.OnListDevices)
-    self.Bind(self.dev_listed_event_bind, self._DeviceListedEventHandler)
-    self.Bind(self.exception_event_bind, self._PrintEventHandler)
+    self.Bind(self.ui_update_event_bind, self._UiUpdateEventHandler)
     self.Bind(self.alert_event_bind, self._AlertEventHandler)
-    self.Bind(self.print_event_bind, self._PrintEventHandler)
     self.Bind(self.low_key_alert_event_bind, self._LowKeyAlertEventHandler)
     self.Bind(self.select_file_event_bind, self._SelectFileEventHandler)
 
@@ -1364,23 +1757,45 @@ class Atft(wx.Frame):
     evt = Event(self.alert_event, wx.ID_ANY, msg)
     wx.QueueEvent(self, evt)
 
-  def _PrintEventHandler(self, event):
-    """The handler to handle the event to display a message in the cmd output.
+  def _SendUiUpdateEvent(self):
+    """Send an event to apply the UI updates posted to the event bus.
+
+    Called by the event bus once for each batch, from the posting thread.
+    """
+    wx.QueueEvent(self, Event(self.ui_update_event, wx.ID_ANY))
+
+  def _UiUpdateEventHandler(self, event):
+    """Apply the posted UI updates, at most once per UI_UPDATE_INTERVAL.
 
     Args:
-      event: The message to be displayed.
+      event: The event object.
     """
-    msg = str(event.GetValue())
-    self.PrintToCommandWindow(msg)
+    delay = self.event_bus.GetDelay()
+    if delay > 0:
+      # More updates may be posted until then, they are applied together.
+      wx.CallLater(int(math.ceil(delay * 1000)), self._ApplyUiUpdates)
+    else:
+      self._ApplyUiUpdates()
+
+  def _ApplyUiUpdates(self):
+    """Apply all the UI updates posted since the last batch.
+
+    The messages are printed with a single update of the command window and
+    any number of device list changes refresh the device list once.
+    """
+    (messages, device_listed) = self.event_bus.Flush()
+    if messages:
+      self.PrintMessagesToCommandWindow(messages)
+    if device_listed:
+      self._DeviceListedEventHandler(None)
 
   def _SendPrintEvent(self, msg):
-    """Send an event to print a message to the cmd output.
+    """Post a message to print to the cmd output.
 
     Args:
       msg: The message to be displayed.
     """
-    evt = Event(self.print_event, wx.ID_ANY, msg)
-    wx.QueueEvent(self, evt)
+    self.event_bus.PostMessage(msg)
 
   def _SendOperationStartEvent(self, operation, target=None):
     """Send an event to print an operation start message.
@@ -1411,9 +1826,9 @@ class Atft(wx.Frame):
     self.log.Info('OpSucceed', msg)
 
   def _SendDeviceListedEvent(self):
-    """Send an event to indicate device list is refreshed, need to refresh UI.
+    """Post that the device list is refreshed, need to refresh UI.
     """
-    wx.QueueEvent(self, Event(self.dev_listed_event))
+    self.event_bus.PostDeviceListed()
 
   def _SendLowKeyAlertEvent(self):
     """Send low key alert event.
@@ -1464,15 +1879,17 @@ class Atft(wx.Frame):
       self._HandleAutoProv()
 
     self.PrintToWindow(self.atfa_devs_output, atfa_message)
-    if self.last_target_list == self.atft_manager.target_devs:
+    self.statusbar.SetStatusText(
+        self.STATUS_REFRESH_INTERVAL % self.refresh_policy.GetInterval(), 1)
+    # The snapshots stay the same while the worker threads change the devices.
+    target_list = self._SnapshotList(self.atft_manager.target_devs)
+    if self.last_target_list == target_list:
       # Nothing changes, no need to refresh
       return
 
-    # Update the stored target list. Need to make a deep copy instead of copying
-    # the reference.
-    self.last_target_list = self._CopyList(self.atft_manager.target_devs)
+    self.last_target_list = target_list
     self.target_devs_output.DeleteAllItems()
-    for target_dev in self.atft_manager.target_devs:
+    for target_dev in target_list:
       provision_status_string = ProvisionStatus.ToString(
           target_dev.provision_status, self.GetLanguageIndex())
       # This is a utf-8 string, need to transfer to unicode.
@@ -1520,18 +1937,99 @@ class Atft(wx.Frame):
     self.low_key_dialog.ShowModal()
 
   def _CreateThread(self, target, *args):
-    """Create and start a thread.
+    """Run a function in the background on the shared worker pool.
 
     Args:
-      target: The function that the thread should run.
+      target: The function that the worker should run.
       *args: The arguments for the function
     Returns:
-      The thread object
+      The workerpool.Task object
     """
-    t = threading.Thread(target=target, args=args)
-    t.setDaemon(True)
-    t.start()
-    return t
+    # An operation changes the device status or reboots devices.
+    self._BurstRefresh()
+    return self._Submit(self.worker_pool, target, *args)
+
+  def _Submit(self, pool, target, *args):
+    """Run a function in the background, reporting unexpected exceptions.
+
+    Args:
+      pool: The WorkerPool to run the function on.
+      target: The function to run.
+      *args: The arguments for the function.
+    Returns:
+      The workerpool.Task object
+    """
+    return pool.Submit(self._RunReportingErrors, target, *args)
+
+  def _RunReportingErrors(self, target, *args):
+    """Run a function, printing and logging an exception it does not handle.
+
+    The results of the background tasks are never collected, so the exception
+    would be lost otherwise. It is printed like an uncaught exception in a
+    thread.
+
+    Args:
+      target: The function to run.
+      *args: The arguments for the function.
+    Returns:
+      The return value of the function, None if it raised an exception.
+    """
+    try:
+      return target(*args)
+    except Exception:  # pylint: disable=broad-except
+      traceback.print_exc()
+      # The prefetch runs before the log is created.
+      if getattr(self, 'log', None):
+        self.log.Error('UnexpectedException', traceback.format_exc())
+      return None
+
+  def _LogWorkerStats(self):
+    """Log the statistics of the worker pools periodically for monitoring."""
+    for pool in (self.worker_pool, self.auto_prov_pool, self.refresh_pool):
+      stats = pool.GetStats()
+      self.log.Info(
+          'WorkerStats',
+          '%s: queue %d, active %d/%d, completed %d, wait avg %.3fs max '
+          '%.3fs, run avg %.3fs' % (
+              pool.name, stats['queue_depth'], stats['active_workers'],
+              pool.max_workers, stats['completed'], stats['avg_wait'],
+              stats['max_wait'], stats['avg_run']))
+    command_stats = self.atft_manager.GetCommandStats()
+    for (priority, name) in ((PRIORITY_CRITICAL, 'critical'),
+                             (PRIORITY_NORMAL, 'normal'),
+                             (PRIORITY_MONITOR, 'monitor')):
+      wait = command_stats['wait'][priority]
+      self.log.Info(
+          'WorkerStats',
+          'Device commands %s: count %d, wait avg %.3fs max %.3fs' % (
+              name, wait['count'], wait['avg_wait'], wait['max_wait']))
+    self.log.Info('WorkerStats', 'Device commands coalesced: %d' %
+                  command_stats['coalesced'])
+    if lockprofiler.IsEnabled():
+      for line in lockprofiler.FormatReport(self.LOCK_PROFILE_TOP_N):
+        self.log.Info('LockStats', line)
+    # A long trace would delay the other timers of the scheduler thread.
+    self._Submit(self.worker_pool, self._SaveTrace)
+    self._ScheduleWorkerStats()
+
+  def _ScheduleWorkerStats(self):
+    """Log the worker statistics after WORKER_STATS_INTERVAL."""
+    with self.refresh_timer_lock:
+      if self.closing:
+        return
+      self.stats_timer = ScheduledTimer(
+          self.WORKER_STATS_INTERVAL, self._LogWorkerStats)
+      self.stats_timer.start()
+
+  def _SaveTrace(self):
+    """Write the timeline trace to TRACE_FILE if tracing is on."""
+    active_tracer = tracer.GetTracer()
+    if not active_tracer or not self.TRACE_FILE:
+      return
+    try:
+      active_tracer.Save(self.TRACE_FILE)
+    except (IOError, OSError) as e:
+      self.log.Error('Trace', 'Failed to save trace: ' + str(e))
 
   def _ListDevices(self):
     """List fastboot devices.
@@ -1550,7 +2048,7 @@ class Atft(wx.Frame):
         # 'Release the lock'.
         self.listing_device_lock.release()
 
-      wx.QueueEvent(self, Event(self.dev_listed_event, wx.ID_ANY))
+      self._SendDeviceListedEvent()
 
   def _CheckATFAStatus(self):
     """Get the attestation key status of the ATFA device.
@@ -1582,6 +2080,115 @@ class Atft(wx.Frame):
     self._SendOperationSucceedEvent(operation)
     return True
 
+  def _AuditDevices(self):
+    """Re-read the state of all target devices and write an audit report.
+
+    The report is written to LOG_DIR as a JSON file and a summary is printed
+    to the command output.
+    """
+    if not self.atft_manager.target_devs:
+      self._SendAlertEvent(self.ALERT_AUDIT_NO_DEVICE)
+      return
+    operation = 'Audit devices'
+    self._SendOperationStartEvent(operation)
+    self.PauseRefresh()
+    try:
+      report = self.atft_manager.AuditDevices()
+    finally:
+      self.ResumeRefresh()
+
+    summary = report.Summary()
+    msg = 'Audited %d devices in %.1f seconds: ' % (
+        len(report.results), report.duration)
+    msg += ', '.join(
+        category + ' ' + str(summary[category])
+        for category in AuditCategory.ALL if summary[category])
+    self._SendPrintEvent(msg)
+    self.log.Info('Audit', msg)
+
+    if self.LOG_DIR:
+      report_name = datetime.utcfromtimestamp(report.start_time).strftime(
+          'audit_%Y%m%d%H%M%S.json')
+      report_path = os.path.join(self.LOG_DIR, report_name)
+      try:
+        report.Write(report_path)
+      except IOError as e:
+        self._HandleException('E', e, operation)
+        return
+      self._SendPrintEvent('Audit report: ' + report_path)
+    self._SendOperationSucceedEvent(operation)
+
+  def _FlashImages(self, selected_serials):
+    """Flash the images in the flash manifest to the devices concurrently.
+
+    Args:
+      selected_serials: The list of serial numbers for the selected devices.
+    """
+    targets = []
+    for serial in selected_serials:
+      target = self.atft_manager.GetTargetDevice(serial)
+      if target:
+        targets.append(target)
+    if not targets:
+      return
+
+    operation = 'Flash images'
+    for target in targets:
+      self._SendOperationStartEvent(operation, target)
+    self.PauseRefresh()
+    try:
+      errors = self.atft_manager.FlashImages(
+          targets, progress_callback=self._FlashProgress)
+    finally:
+      self.ResumeRefresh()
+
+    for target in targets:
+      if target.serial_number in errors:
+        self._HandleException(
+            'E', errors[target.serial_number], operation, target)
+      else:
+        self._SendOperationSucceedEvent(operation, target)
+
+  def _FlashProgress(self, target, partition, done, total):
+    """Print the flash progress of a device.
+
+    Args:
+      target: The target device DeviceInfo object.
+      partition: The partition just flashed or skipped.
+      done: The number of partitions handled.
+      total: The number of partitions in the manifest.
+    """
+    self._SendPrintEvent(
+        '{%s} Flashed %s (%d/%d)' % (str(target), partition, done, total))
+
+  def _FlashThenProvision(self, target):
+    """Flash the images to a device and then queue it for provisioning.
+
+    Used in auto provisioning mode when a flash manifest is selected.
+
+    Args:
+      target: The target device DeviceInfo object.
+    """
+    operation = 'Flash images'
+    self._SendOperationStartEvent(operation, target)
+    self.PauseRefresh()
+    try:
+      self.atft_manager.FlashTarget(
+          target, progress_callback=self._FlashProgress)
+    except (DeviceNotFoundException, FastbootFailure,
+            FlashManifestFormatError) as e:
+      self._HandleException('E', e, operation, target)
+      # A failed status keeps auto provisioning from flashing it again.
+      target.provision_status = ProvisionStatus.FLASH_FAILED
+      self.auto_dev_serials.remove(target.serial_number)
+      return
+    finally:
+      self.ResumeRefresh()
+
+    self._SendOperationSucceedEvent(operation, target)
+    target.provision_status = ProvisionStatus.WAITING
+    self._Submit(self.auto_prov_pool, self._HandleStateTransition, target)
+
   def _ShowATFAStatus(self):
     """Show the attestation key status of the ATFA device.
     """
@@ -1639,6 +2246,26 @@ class Atft(wx.Frame):
     self._SendOperationSucceedEvent(operation, target)
 
     operation = 'Verify bootloader locked, rebooting'
+    if not self._RebootTarget(target, operation):
+      return
+
+    target = self.atft_manager.GetTargetDevice(serial)
+    if target and not target.provision_state.bootloader_locked:
+      target.provision_status = ProvisionStatus.FUSEVBOOT_FAILED
+      e = FastbootFailure('Status not updated.')
+      self._HandleException('E', e, operation)
+      return
+
+  def _RebootTarget(self, target, operation):
+    """Reboot a target device and wait until it reappears or times out.
+
+    Args:
+      target: The target device DeviceInfo object.
+      operation: The operation name to report.
+    Returns:
+      False if the reboot could not be started, True once the reboot
+      callback is called.
+    """
     self._SendOperationStartEvent(operation, target)
     success_msg = '{' + str(target) + '} ' + 'Reboot Succeed'
     timeout_msg = '{' + str(target) + '} ' + 'Reboot Failed! Timeout!'
@@ -1651,10 +2278,10 @@ class Atft(wx.Frame):
     def LambdaTimeoutCallback(msg=timeout_msg, lock=reboot_lock):
       self._RebootTimeoutCallback(msg, lock)
 
-    # Reboot the device to verify the bootloader is locked.
+    # Reboot the device to verify the provision state.
     try:
       target.provision_status = ProvisionStatus.REBOOT_ING
-      wx.QueueEvent(self, Event(self.dev_listed_event, wx.ID_ANY))
+      self._SendDeviceListedEvent()
 
       # Reboot would change device status, so we disable reading device status
       # during reboot.
@@ -1664,20 +2291,14 @@ class Atft(wx.Frame):
           LambdaTimeoutCallback)
     except FastbootFailure as e:
       self._HandleException('E', e, operation)
-      return
+      return False
     finally:
       self.listing_device_lock.release()
 
     # Wait until callback finishes. After the callback, reboot_lock would be
     # released.
     reboot_lock.acquire()
-
-    target = self.atft_manager.GetTargetDevice(serial)
-    if target and not target.provision_state.bootloader_locked:
-      target.provision_status = ProvisionStatus.FUSEVBOOT_FAILED
-      e = FastbootFailure('Status not updated.')
-      self._HandleException('E', e, operation)
-      return
+    return True
 
   def _RebootSuccessCallback(self, msg, lock):
     """The callback if reboot succeed.
@@ -1926,6 +2547,53 @@ class Atft(wx.Frame):
     self._SendOperationSucceedEvent(operation, target)
     self._CheckLowKeyAlert()
 
+  def _ProvisionAllTarget(self, target):
+    """Do all the provision steps on a target and verify them with a reboot.
+
+    Used instead of the step by step flow if SINGLE_REBOOT_FLOW is set.
+
+    Args:
+      target: The target device DeviceInfo object.
+    """
+    operation = 'Fuse, lock and provision'
+    serial = target.serial_number
+    self._SendOperationStartEvent(operation, target)
+    self.PauseRefresh()
+
+    try:
+      self.atft_manager.ProvisionAll(target)
+    except ProductNotSpecifiedException as e:
+      self._HandleException('W', e, operation, target)
+      return
+    except DeviceNotFoundException as e:
+      e.SetMsg('No Available ATFA!')
+      self._HandleException('W', e, operation, target)
+      return
+    except FastbootFailure as e:
+      self._HandleException('E', e, operation, target)
+      # If it fails during provisioning, one key might also be used.
+      self._CheckATFAStatus()
+      return
+    finally:
+      self.ResumeRefresh()
+
+    self._SendOperationSucceedEvent(operation, target)
+    self._CheckLowKeyAlert()
+
+    operation = 'Verify provision state, rebooting'
+    if not self._RebootTarget(target, operation):
+      return
+    target = self.atft_manager.GetTargetDevice(serial)
+    if not target:
+      return
+    try:
+      self.atft_manager.VerifyProvisionState(target)
+    except FastbootFailure as e:
+      self._HandleException('E', e, operation, target)
+      return
+    self._SendOperationSucceedEvent(operation, target)
+
+  @Traced()
   def _HandleStateTransition(self, target):
     """Handles the state transition for automatic key provisioning.
 
@@ -1936,7 +2604,6 @@ class Atft(wx.Frame):
     Args:
       target: The target device object.
     """
-    self.auto_prov_lock.acquire()
     serial = target.serial_number
     while not ProvisionStatus.isFailed(target.provision_status):
       target = self.atft_manager.GetTargetDevice(serial)
@@ -1946,6 +2613,11 @@ class Atft(wx.Frame):
       if not self.auto_prov:
         # Auto provision mode exited.
         break
+      if self.SINGLE_REBOOT_FLOW:
+        if not target.provision_state.provisioned:
+          self._ProvisionAllTarget(target)
+          self._CheckKeysLeftInAutoProv()
+        break
       if not target.provision_state.bootloader_locked:
         self._FuseVbootKeyTarget(target)
         continue
@@ -1957,14 +2629,17 @@ class Atft(wx.Frame):
         continue
       elif not target.provision_state.provisioned:
         self._ProvisionTarget(target)
-        if self.atft_manager.GetATFAKeysLeft() == 0:
-          # No keys left. If it's auto provisioning mode, exit.
-          self._SendAlertEvent(self.ALERT_NO_KEYS_LEFT_LEAVE_PROV)
-          self.toolbar.ToggleTool(self.ID_TOOL_PROVISION, False)
-          self.OnToggleAutoProv(None)
+        self._CheckKeysLeftInAutoProv()
       break
     self.auto_dev_serials.remove(serial)
-    self.auto_prov_lock.release()
+
+  def _CheckKeysLeftInAutoProv(self):
+    """Leave auto provisioning mode if no keys are left."""
+    if self.atft_manager.GetATFAKeysLeft() == 0:
+      # No keys left. If it's auto provisioning mode, exit.
+      self._SendAlertEvent(self.ALERT_NO_KEYS_LEFT_LEAVE_PROV)
+      self.toolbar.ToggleTool(self.ID_TOOL_PROVISION, False)
+      self.OnToggleAutoProv(None)
 
   def _ProcessKey(self):
     """Ask ATFA device to process the stored keybundle.
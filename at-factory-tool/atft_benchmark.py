@@ -0,0 +1,604 @@
+#!/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks for the AT-Factory-Tool manager.
+
+Usage:
+
+./atft_benchmark.py [-n ITERATIONS] [--recorded FILE] [--session FILE]
+    [--time-scale SCALE] [--devices COUNT] [--latency SECONDS]
+    [--key-pool-depth DEPTH] [--requests COUNT] [--ui-time SECONDS]
+    [BENCHMARK ...]
+
+Runs all benchmarks if none is specified.
+"""
+import argparse
+import json
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+import atftman
+from deviceactor import DeviceActor
+import eventbus
+import fastbootrecord
+from fastboot_exceptions import FastbootFailure
+import simdevice
+from workerpool import WorkerPool
+
+BOOTLOADER_STRING = atftman.BOOTLOADER_STRING
+
+
+def _Report(name, seconds, iterations):
+  """Print one benchmark result line.
+
+  Args:
+    name: The name of the measured operation.
+    seconds: Total time spent for all iterations.
+    iterations: Number of iterations measured.
+  """
+  print '%-48s %10.2f us/op' % (name, seconds * 1e6 / iterations)
+
+
+def _GenerateStateOutputs(count, seed=0):
+  """Generate 'at-attest-uuid' and 'at-vboot-state' outputs for a fleet.
+
+  The outputs follow the formats seen from the bootloaders: 'key: value' or
+  'key=value' lines, LF or CRLF line endings, and devices at every provision
+  step.
+
+  Args:
+    count: The number of devices.
+    seed: The random seed.
+  Returns:
+    A list of (at_attest_uuid, state_string) tuples.
+  """
+  rand = random.Random(seed)
+  outputs = []
+  for i in range(0, count):
+    step = rand.randint(0, 4)
+    separator = rand.choice([': ', '=', ':\t'])
+    newline = rand.choice(['\n', '\r\n'])
+    lines = [
+        ('bootloader-locked', int(step >= 1)),
+        ('bootloader-min-versions', '-1,0,3'),
+        ('avb-perm-attr-set', int(step >= 2)),
+        ('avb-locked', int(step >= 3)),
+        ('avb-unlock-disabled', 0),
+        ('avb-min-versions', '0:1,1:1,2:1,4097 :2,4098:2'),
+    ]
+    state_string = ''.join(
+        BOOTLOADER_STRING + key + separator + str(value) + newline
+        for (key, value) in lines)
+    state_string += 'OKAY [  0.002s]' + newline + 'finished. total time: 0.002s'
+    at_attest_uuid = '%08x-0000-0000-0000-000000000000' % i if step == 4 else ''
+    outputs.append((at_attest_uuid, state_string))
+  return outputs
+
+
+def _LegacyCheckProvisionStatus(at_attest_uuid, state_string):
+  """The per-line re.split parser used before ParseProvisionState."""
+  state = atftman.ProvisionState()
+  status = atftman.ProvisionStatus.IDLE
+  status_set = False
+  if at_attest_uuid and at_attest_uuid != 'NOT_PROVISIONED':
+    status = atftman.ProvisionStatus.PROVISION_SUCCESS
+    status_set = True
+    state.provisioned = True
+  state_map = {}
+  for line in state_string.splitlines():
+    if line.startswith(BOOTLOADER_STRING):
+      key_value = re.split(r':[\s]*|=', line.replace(BOOTLOADER_STRING, ''))
+      if len(key_value) == 2:
+        state_map[key_value[0]] = key_value[1]
+  if state_map.get('avb-locked') and state_map['avb-locked'] == '1':
+    if not status_set:
+      status = atftman.ProvisionStatus.LOCKAVB_SUCCESS
+      status_set = True
+    state.avb_locked = True
+  if (state_map.get('avb-perm-attr-set') and
+      state_map['avb-perm-attr-set'] == '1'):
+    if not status_set:
+      status = atftman.ProvisionStatus.FUSEATTR_SUCCESS
+      status_set = True
+    state.avb_perm_attr_set = True
+  if (state_map.get('bootloader-locked') and
+      state_map['bootloader-locked'] == '1'):
+    if not status_set:
+      status = atftman.ProvisionStatus.FUSEVBOOT_SUCCESS
+    state.bootloader_locked = True
+  return (status, state)
+
+
+def BenchParseState(args):
+  """Compare the per-line and the compiled batch provision state parsers."""
+  if args.recorded:
+    # A JSON list of [at_attest_uuid, state_string] pairs captured from a
+    # fleet.
+    with open(args.recorded, 'r') as recorded_file:
+      outputs = [tuple(pair) for pair in json.load(recorded_file)]
+    source = args.recorded
+  else:
+    outputs = _GenerateStateOutputs(64)
+    source = 'generated'
+  print 'parse_state: %d device outputs (%s)' % (len(outputs), source)
+
+  for (expected, actual) in zip(
+      [_LegacyCheckProvisionStatus(u, s) for (u, s) in outputs],
+      atftman.ParseProvisionStates(outputs)):
+    assert expected[0] == actual[0]
+    for field in atftman.ProvisionState.FIELDS:
+      assert getattr(expected[1], field) == getattr(actual[1], field)
+
+  iterations = max(1, args.iterations / len(outputs))
+  _Report('per-line parser, per device',
+          timeit.timeit(
+              lambda: [_LegacyCheckProvisionStatus(u, s) for (u, s) in outputs],
+              number=iterations),
+          iterations * len(outputs))
+  _Report('ParseProvisionStates, per device',
+          timeit.timeit(lambda: atftman.ParseProvisionStates(outputs),
+                        number=iterations),
+          iterations * len(outputs))
+
+
+def BenchReplay(args):
+  """Replay a recorded fastboot session through the provisioning flow.
+
+  The devices are listed from the session, then all the target devices run
+  the remaining provision steps in parallel, as in the single-reboot
+  automatic provisioning flow.
+  """
+  if not args.session:
+    print 'replay: skipped, no --session file given'
+    return
+  (records, locations) = fastbootrecord.LoadSession(args.session)
+  replay = fastbootrecord.ReplayController(records, locations,
+                                           args.time_scale)
+  manager = atftman.AtftManager(replay, replay.CreateSerialMapper(), None)
+  # The vboot key and the attributes are only written to temporary files
+  # whose content is not replayed.
+  manager.product_info = atftman.ProductInfo(
+      '0' * 32, 'replay', bytearray(1052), bytearray(1024))
+
+  start_time = time.time()
+  # A device is added once it is listed twice.
+  manager.ListDevices()
+  manager.ListDevices()
+  targets = manager.target_devs[:]
+  list_time = time.time() - start_time
+  pool = WorkerPool(max(1, len(targets)), 'ReplayWorker')
+  tasks = [pool.Submit(manager.ProvisionAll, target) for target in targets]
+  failures = 0
+  for task in tasks:
+    task.Wait()
+    try:
+      task.Result()
+    except (FastbootFailure, fastbootrecord.ReplayError) as e:
+      print 'replay: %s' % e
+      failures += 1
+  pool.Shutdown(wait=True)
+  total_time = time.time() - start_time
+
+  print 'replay: %d targets from %s, time scale %g' % (
+      len(targets), args.session, args.time_scale)
+  print '%-48s %10.3f s' % ('list devices', list_time)
+  print '%-48s %10.3f s' % ('provision all targets', total_time - list_time)
+  if targets and total_time:
+    print '%-48s %10.1f devices/min' % ('throughput',
+                                        len(targets) * 60.0 / total_time)
+  print '%-48s %10d' % ('failed targets', failures)
+  print '%-48s %10d' % ('recorded commands not replayed', replay.Remaining())
+
+
+def BenchSimulate(args):
+  """Provision simulated devices end to end with the test CA.
+
+  The devices run libatap and the ATFA runs the test CA of partner-tools, so
+  every handshake exchanges real protocol messages. All the target devices
+  are provisioned in parallel.
+  """
+  try:
+    ca = simdevice.TestCa(key_pool_depth=args.key_pool_depth)
+    fleet = simdevice.SimulatedFleet(ca=ca, command_latency=args.latency)
+    fleet.AddAtfa(keys_left=args.devices)
+    for _ in range(args.devices):
+      fleet.AddTarget(provisioned_to=3)
+  except (OSError, ImportError) as e:
+    print 'simulate: skipped, %s' % e
+    return
+  manager = atftman.AtftManager(fleet, fleet.CreateSerialMapper(), None)
+  manager.product_info = atftman.ProductInfo(
+      '0' * 32, 'simulated', bytearray(simdevice.PERM_ATTR_LEN),
+      bytearray(1024))
+
+  start_time = time.time()
+  # A device is added once it is listed twice.
+  manager.ListDevices()
+  manager.ListDevices()
+  targets = manager.target_devs[:]
+  list_time = time.time() - start_time
+  pool = WorkerPool(max(1, len(targets)), 'SimulateWorker')
+  tasks = [pool.Submit(manager.Provision, target) for target in targets]
+  failures = 0
+  for task in tasks:
+    task.Wait()
+    try:
+      task.Result()
+    except FastbootFailure as e:
+      print 'simulate: %s' % e
+      failures += 1
+  pool.Shutdown(wait=True)
+  total_time = time.time() - start_time
+  ca.Close()
+
+  print 'simulate: %d targets, %g s command latency, key pool depth %d' % (
+      len(targets), args.latency, args.key_pool_depth)
+  print '%-48s %10.3f s' % ('list devices', list_time)
+  print '%-48s %10.3f s' % ('provision all targets', total_time - list_time)
+  if targets and total_time:
+    print '%-48s %10.1f devices/min' % ('throughput',
+                                        len(targets) * 60.0 / total_time)
+  print '%-48s %10d' % ('failed targets', failures)
+
+
+def _CreateCaRequests(ca, target, count):
+  """Start sessions and get their CA Request messages from a target.
+
+  Args:
+    ca: The TestCa.
+    target: The SimulatedTarget.
+    count: The number of sessions.
+  Returns:
+    A list of (session, ca_request) tuples.
+  """
+  requests = []
+  for _ in range(count):
+    (session, target.staged) = ca.StartSession(simdevice.ALGORITHM_CURVE25519)
+    target.Oem('at-get-ca-request')
+    requests.append((session, target.staged))
+  return requests
+
+
+def BenchCaCrypto(args):
+  """Compare the test CA crypto modes at several request concurrencies.
+
+  The CA Request messages come from a simulated device. Each of the
+  concurrent client threads sends its share of the requests one at a time.
+  """
+  try:
+    ca = simdevice.TestCa()
+    target = simdevice.SimulatedFleet(ca=ca).AddTarget()
+  except (OSError, ImportError) as e:
+    print 'ca_crypto: skipped, %s' % e
+    return
+  ca.Close()
+  for mode in ('inline', 'thread', 'process'):
+    mode_ca = simdevice.TestCa(crypto_mode=mode)
+    for concurrency in (1, 4, 16):
+      requests = _CreateCaRequests(mode_ca, target, args.requests)
+
+      def Client(client_requests):
+        for (session, ca_request) in client_requests:
+          mode_ca.GetCaResponse(session, ca_request)  # pylint: disable=cell-var-from-loop
+
+      clients = [threading.Thread(target=Client,
+                                  args=(requests[i::concurrency],))
+                 for i in range(concurrency)]
+      start_time = time.time()
+      for client in clients:
+        client.start()
+      for client in clients:
+        client.join()
+      seconds = time.time() - start_time
+      print '%-48s %10.1f requests/s' % (
+          'ca_crypto %s, %d clients' % (mode, concurrency),
+          len(requests) / seconds)
+    mode_ca.Close()
+
+
+# The modules atft.py needs before the window shows up, except wx.
+_STARTUP_MODULES = ['atftman', 'fastbootrecord', 'lockprofiler',
+                    'refreshpolicy', 'tracer', 'workerpool']
+if sys.platform.startswith('win'):
+  _PLATFORM_MODULES = ['fastbootsubp', 'serialmapperwin']
+else:
+  _PLATFORM_MODULES = ['fastbootsh', 'serialmapperlinux']
+
+
+def _TimeImport(modules, runs=5):
+  """Time importing modules in fresh interpreters.
+
+  Args:
+    modules: The module names.
+    runs: The number of interpreters, the fastest one is reported.
+  Returns:
+    The import time in seconds.
+  """
+  script = ('import time\n'
+            'start = time.time()\n'
+            'import %s\n'
+            'print time.time() - start\n' % ', '.join(modules))
+  return min(
+      float(subprocess.check_output([sys.executable, '-c', script]))
+      for _ in range(runs))
+
+
+def BenchStartup(args):
+  """Time the startup steps of the AT-Factory-Tool before the first list.
+
+  The imports are timed in fresh interpreters, with the platform modules
+  imported eagerly as before and on first use. The time to list the devices
+  plugged in before the start compares the first listing after building the
+  UI with the first listing while building it. Building the UI is stood in
+  for by waiting --ui-time, the devices are simulated.
+  """
+  eager = _TimeImport(_STARTUP_MODULES + _PLATFORM_MODULES)
+  lazy = _TimeImport(_STARTUP_MODULES)
+  print '%-48s %10.1f ms' % ('import, platform modules eager', eager * 1e3)
+  print '%-48s %10.1f ms' % ('import, platform modules on first use',
+                             lazy * 1e3)
+
+  interval = 1.0
+  for prefetch in (False, True):
+    try:
+      fleet = simdevice.SimulatedFleet(command_latency=args.latency)
+      fleet.AddAtfa()
+      for _ in range(args.devices):
+        fleet.AddTarget()
+    except OSError as e:
+      print 'startup: skipped, %s' % e
+      return
+    manager = atftman.AtftManager(fleet, fleet.CreateSerialMapper(), None)
+    start_time = time.time()
+    if prefetch:
+      prefetch_thread = threading.Thread(target=manager.ListDevices)
+      prefetch_thread.start()
+      time.sleep(args.ui_time)
+      prefetch_thread.join()
+    else:
+      time.sleep(args.ui_time)
+      manager.ListDevices()
+      # A device is only added once it is listed twice.
+      time.sleep(interval)
+    manager.ListDevices()
+    seconds = time.time() - start_time
+    print '%-48s %10.3f s' % (
+        'first list, %s' % ('prefetched during the UI build' if prefetch
+                            else 'after the UI build'),
+        seconds)
+    if len(manager.target_devs) != args.devices:
+      print 'startup: %d of %d devices listed' % (len(manager.target_devs),
+                                                 args.devices)
+
+
+def BenchUiEvents(args):
+  """Count the UI updates while devices post their progress in parallel.
+
+  Every one of --devices threads posts a message and a device list change for
+  each provision step, --latency apart. Without batching every posted event
+  is one UI update. With the event bus, a stand-in for the UI thread applies
+  at most one batch per UI_UPDATE_INTERVAL.
+  """
+  steps = 8
+  interval = 0.1
+  wake = threading.Event()
+  bus = eventbus.EventBus(wake.set, interval)
+
+  def PostProgress():
+    for step in range(steps):
+      bus.PostMessage('step %d' % step)
+      bus.PostDeviceListed()
+      time.sleep(args.latency)
+
+  threads = [threading.Thread(target=PostProgress) for _ in range(args.devices)]
+  start_time = time.time()
+  for thread in threads:
+    thread.start()
+  batches = 0
+  messages = 0
+  refreshes = 0
+  while any(thread.is_alive() for thread in threads) or wake.is_set():
+    if not wake.wait(interval):
+      continue
+    wake.clear()
+    time.sleep(bus.GetDelay())
+    (batch, device_listed) = bus.Flush()
+    batches += 1
+    messages += len(batch)
+    refreshes += int(device_listed)
+  seconds = time.time() - start_time
+  assert messages == args.devices * steps
+
+  print 'ui_events: %d devices, %d steps, %.3f s' % (args.devices, steps,
+                                                     seconds)
+  print '%-48s %10d' % ('UI updates, one per event', 2 * messages)
+  print '%-48s %10d' % ('UI updates, batched', batches)
+  print '%-48s %10d' % ('device list refreshes, batched', refreshes)
+
+
+class _LegacyProvisionState(object):
+  """The provision state with one attribute per flag used before."""
+
+  def __init__(self):
+    self.bootloader_locked = False
+    self.avb_perm_attr_set = False
+    self.avb_locked = False
+    self.provisioned = False
+
+
+class _LegacyDeviceInfo(object):
+  """The dict based DeviceInfo, copied for every UI refresh before."""
+
+  def __init__(self, serial_number, location=None,
+               provision_status=atftman.ProvisionStatus.IDLE):
+    self._fastboot_device_controller = None
+    self.serial_number = serial_number
+    self.location = location
+    self.provision_status = provision_status
+    self.provision_state = _LegacyProvisionState()
+    self.keys_left = None
+    self._actor = DeviceActor(serial_number)
+
+  def Copy(self):
+    return _LegacyDeviceInfo(self.serial_number, self.location,
+                             self.provision_status)
+
+  def __eq__(self, other):
+    return (self.serial_number == other.serial_number and
+            self.location == other.location and
+            self.provision_status == other.provision_status)
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+
+def _ModelSize(device):
+  """The bytes used by a device and its provision state, without the actor."""
+  size = 0
+  for obj in (device, device.provision_state):
+    size += sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+      size += sys.getsizeof(obj.__dict__)
+  return size
+
+
+def BenchDeviceModel(args):
+  """Compare the device model used before with the slotted one.
+
+  Measures the memory per device and the time the UI takes on every refresh
+  to check whether the device list changed: copying every device and
+  comparing field by field before, taking and comparing snapshots now.
+  """
+  count = 1000
+  legacy_devices = [_LegacyDeviceInfo('serial%04d' % i, '1-%d.%d' % (i / 8, i))
+                    for i in range(count)]
+  devices = [atftman.DeviceInfo(None, 'serial%04d' % i, '1-%d.%d' % (i / 8, i))
+             for i in range(count)]
+  print 'device_model: %d devices' % count
+  print '%-48s %10d bytes' % ('dict based device and state, per device',
+                              _ModelSize(legacy_devices[0]))
+  print '%-48s %10d bytes' % ('slotted device and flags, per device',
+                              _ModelSize(devices[0]))
+  print '%-48s %10d bytes' % ('snapshot, per device',
+                              sys.getsizeof(devices[0].Snapshot()))
+
+  legacy_last = [device.Copy() for device in legacy_devices]
+  last = [device.Snapshot() for device in devices]
+  assert legacy_last == legacy_devices
+  assert last == [device.Snapshot() for device in devices]
+
+  iterations = max(1, args.iterations / count)
+  _Report('Copy and compare, per device',
+          timeit.timeit(
+              lambda: ([device.Copy() for device in legacy_devices] ==
+                       legacy_last),
+              number=iterations),
+          iterations * count)
+  _Report('Snapshot and compare, per device',
+          timeit.timeit(
+              lambda: [device.Snapshot() for device in devices] == last,
+              number=iterations),
+          iterations * count)
+
+
+_BENCHMARKS = {
+    'ca_crypto': BenchCaCrypto,
+    'device_model': BenchDeviceModel,
+    'parse_state': BenchParseState,
+    'replay': BenchReplay,
+    'simulate': BenchSimulate,
+    'startup': BenchStartup,
+    'ui_events': BenchUiEvents,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Microbenchmarks for the AT-Factory-Tool manager.')
+  parser.add_argument(
+      '-n',
+      '--iterations',
+      type=int,
+      default=10000,
+      dest='iterations',
+      help='Number of iterations per measured operation')
+  parser.add_argument(
+      '--recorded',
+      type=str,
+      default=None,
+      dest='recorded',
+      help='JSON file of recorded [at-attest-uuid, at-vboot-state] outputs')
+  parser.add_argument(
+      '--session',
+      type=str,
+      default=None,
+      dest='session',
+      help='Fastboot session file recorded with FASTBOOT_RECORD_FILE')
+  parser.add_argument(
+      '--time-scale',
+      type=float,
+      default=1.0,
+      dest='time_scale',
+      help='Factor for the recorded command durations, 0 to not wait')
+  parser.add_argument(
+      '--devices',
+      type=int,
+      default=100,
+      dest='devices',
+      help='Number of simulated target devices')
+  parser.add_argument(
+      '--latency',
+      type=float,
+      default=0.0,
+      dest='latency',
+      help='Time in seconds every simulated fastboot command takes')
+  parser.add_argument(
+      '--key-pool-depth',
+      type=int,
+      default=0,
+      dest='key_pool_depth',
+      help='Number of pre-generated test CA session keys per curve')
+  parser.add_argument(
+      '--requests',
+      type=int,
+      default=400,
+      dest='requests',
+      help='Number of CA Request messages per ca_crypto measurement')
+  parser.add_argument(
+      '--ui-time',
+      type=float,
+      default=0.5,
+      dest='ui_time',
+      help='Time in seconds standing for building the UI in startup')
+  parser.add_argument(
+      'benchmarks',
+      nargs='*',
+      help='Benchmarks to run: %s' % ', '.join(sorted(_BENCHMARKS.keys())))
+
+  args = parser.parse_args()
+  for name in args.benchmarks:
+    if name not in _BENCHMARKS:
+      parser.error('Unknown benchmark: %s' % name)
+  for name in args.benchmarks or sorted(_BENCHMARKS.keys()):
+    _BENCHMARKS[name](args)
+
+
+if __name__ == '__main__':
+  main()
@@ -17,12 +17,14 @@ import types
 import unittest
 
 import atft
+from atftman import DeviceSnapshot
 from atftman import ProvisionStatus
 from atftman import ProvisionState
 import fastboot_exceptions
 from mock import call
 from mock import MagicMock
 from mock import patch
+import workerpool
 import wx
 
 
@@ -36,12 +38,14 @@ class MockAtft(atft.Atft):
     self.CreateAtftLog = MagicMock()
     self.ParseConfigFile = self._MockParseConfig
     self._SendPrintEvent = MagicMock()
+    self.statusbar = MagicMock()
     atft.Atft.__init__(self)
 
   def _MockParseConfig(self):
     self.ATFT_VERSION = 'vTest'
     self.COMPATIBLE_ATFA_VERSION = 'v1'
     self.DEVICE_REFRESH_INTERVAL = 1.0
+    self.DEVICE_REFRESH_MAX_INTERVAL = 16.0
     self.DEFAULT_KEY_THRESHOLD = 0
     self.LOG_DIR = 'test_log_dir'
     self.LOG_SIZE = 1000
@@ -49,6 +53,12 @@ class MockAtft(atft.Atft):
     self.LANGUAGE = 'ENG'
     self.REBOOT_TIMEOUT = 1.0
     self.PRODUCT_ATTRIBUTE_FILE_EXTENSION = '*.atpa'
+    self.MAX_WORKERS = 8
+    self.SINGLE_REBOOT_FLOW = False
+    self.TRACE_FILE = None
+    self.TRACE_MAX_EVENTS = 0
+    self.LOCK_PROFILE = False
+    self.CONSOLE_MAX_LINES = 3
 
     return {}
 
@@ -69,9 +79,9 @@ class TestDeviceInfo(object):
   def __ne__(self, other):
     return not self.__eq__(other)
 
-  def Copy(self):
-    return TestDeviceInfo(self.serial_number, self.location,
-                          self.provision_status)
+  def Snapshot(self):
+    return DeviceSnapshot(self.serial_number, self.location,
+                          self.provision_status, self.provision_state.flags)
 
 
 class AtftTest(unittest.TestCase):
@@ -102,6 +112,19 @@ class AtftTest(unittest.TestCase):
   def DeleteAllItems(self):
     self.test_target_devs = []
 
+  # Test atft.SetLanguage
+  def testLanguageStrings(self):
+    mock_atft = MockAtft()
+    self.assertEqual('Alert', mock_atft.DIALOG_ALERT_TITLE)
+    self.assertIn('DIALOG_ALERT_TITLE', mock_atft.__dict__)
+    self.assertEqual(mock_atft.MENU_ATFA_STATUS, mock_atft.TOOLBAR_ATFA_STATUS)
+    self.assertEqual('Google Android Things Factory Tool vTest',
+                     mock_atft.TITLE)
+    mock_atft.language_index = 1
+    self.assertEqual(atft._STRINGS['MENU_QUIT'][1], mock_atft.MENU_QUIT)
+    with self.assertRaises(AttributeError):
+      getattr(mock_atft, 'NOT_A_STRING')
+
   # Test atft._DeviceListedEventHandler
   def testDeviceListedEventHandler(self):
     mock_atft = MockAtft()
@@ -206,10 +229,47 @@ class AtftTest(unittest.TestCase):
     mock_atft.PrintToWindow(mock_text_entry, self.TEST_TEXT2, True)
     self.assertEqual(self.TEST_TEXT + self.TEST_TEXT2, self.test_text_window)
 
+  # Test atft._SendDeviceListedEvent(), atft._ApplyUiUpdates()
+  @patch('wx.QueueEvent')
+  def testApplyUiUpdates(self, mock_queue_event):
+    mock_atft = MockAtft()
+    mock_atft.cmd_output = MagicMock()
+    mock_atft._DeviceListedEventHandler = MagicMock()
+    mock_atft._SendDeviceListedEvent()
+    mock_atft.event_bus.PostMessage(self.TEST_TEXT)
+    mock_atft._SendDeviceListedEvent()
+    mock_atft.event_bus.PostMessage(self.TEST_TEXT2)
+    mock_queue_event.assert_called_once()
+    mock_atft._ApplyUiUpdates()
+    mock_atft.cmd_output.ShowLines.assert_called_once()
+    mock_atft._DeviceListedEventHandler.assert_called_once()
+    self.assertEqual(2, len(mock_atft.console))
+    self.assertTrue(
+        mock_atft.console.GetLine(0).endswith('] ' + self.TEST_TEXT))
+    self.assertTrue(
+        mock_atft.console.GetLine(1).endswith('] ' + self.TEST_TEXT2))
+
+  # Test atft.PrintToCommandWindow(), atft.OnClearCommandWindow()
+  def testCommandWindowSpill(self):
+    mock_atft = MockAtft()
+    mock_atft.cmd_output = MagicMock()
+    mock_atft.PrintToCommandWindow(self.TEST_TEXT + '\n' + self.TEST_TEXT2)
+    mock_atft.PrintToCommandWindow(self.TEST_TEXT)
+    mock_atft.PrintToCommandWindow(self.TEST_TEXT2)
+    # Only CONSOLE_MAX_LINES lines are kept, the oldest line is in the log.
+    self.assertEqual(3, len(mock_atft.console))
+    self.assertEqual(self.TEST_TEXT2, mock_atft.console.GetLine(0))
+    mock_atft.log.Info.assert_called_once()
+    self.assertTrue(mock_atft.log.Info.call_args[0][1].endswith(
+        '] ' + self.TEST_TEXT))
+    mock_atft.OnClearCommandWindow()
+    self.assertEqual(0, len(mock_atft.console))
+    self.assertEqual(4, mock_atft.log.Info.call_count)
+
   # Test atft.StartRefreshingDevices(), atft.StopRefresh()
   # Test atft.PauseRefresh(), atft.ResumeRefresh()
 
-  @patch('threading.Timer')
+  @patch('atft.ScheduledTimer')
   @patch('wx.QueueEvent')
   def testStartRefreshingDevice(self, mock_queue_event, mock_timer):
     mock_atft = MockAtft()
@@ -226,7 +286,7 @@ class AtftTest(unittest.TestCase):
     mock_atft.StopRefresh()
     self.assertEqual(None, mock_atft.refresh_timer)
 
-  @patch('threading.Timer')
+  @patch('atft.ScheduledTimer')
   def testPauseResumeRefreshingDevice(self, mock_timer):
     mock_atft = MockAtft()
     mock_atft.StartRefreshingDevices = types.MethodType(
@@ -246,6 +306,91 @@ class AtftTest(unittest.TestCase):
     mock_atft._ListDevices.assert_called()
     mock_atft.StopRefresh()
 
+  @patch('atft.ScheduledTimer')
+  def testRefreshBackoffWhenIdle(self, mock_timer):
+    mock_atft = MockAtft()
+    # Only count the refresh timers, not the worker stats timer.
+    mock_timer.reset_mock()
+    mock_atft.StartRefreshingDevices = types.MethodType(
+        atft.Atft.StartRefreshingDevices, mock_atft, atft.Atft)
+    mock_atft._ListDevices = MagicMock()
+    mock_atft.atft_manager.HasPendingReboots.return_value = False
+    mock_atft.atft_manager.atfa_dev = None
+    mock_atft.atft_manager.target_devs = [
+        TestDeviceInfo(self.TEST_SERIAL1, self.TEST_LOCATION1,
+                       ProvisionStatus.IDLE)]
+    mock_atft.refresh_policy.idle_refreshes = 1
+
+    for _ in range(4):
+      mock_atft.StartRefreshingDevices()
+    intervals = [args[0][0] for args in mock_timer.call_args_list]
+    self.assertEqual([1.0, 1.0, 2.0, 4.0], intervals)
+
+    # A new device goes back to the fast interval.
+    mock_atft.atft_manager.target_devs.append(
+        TestDeviceInfo(self.TEST_SERIAL2, self.TEST_LOCATION2,
+                       ProvisionStatus.IDLE))
+    mock_atft.StartRefreshingDevices()
+    self.assertEqual(1.0, mock_timer.call_args[0][0])
+
+    # A rebooting device keeps the fast interval.
+    mock_atft.atft_manager.HasPendingReboots.return_value = True
+    for _ in range(3):
+      mock_atft.StartRefreshingDevices()
+    self.assertEqual(1.0, mock_timer.call_args[0][0])
+    mock_atft.StopRefresh()
+
+  @patch('atft.ScheduledTimer')
+  def testRefreshBurstOnPendingDevice(self, mock_timer):
+    mock_atft = MockAtft()
+    mock_atft.StartRefreshingDevices = types.MethodType(
+        atft.Atft.StartRefreshingDevices, mock_atft, atft.Atft)
+    mock_atft._ListDevices = MagicMock()
+    mock_atft.atft_manager.HasPendingReboots.return_value = False
+    mock_atft.atft_manager.atfa_dev = None
+    mock_atft.atft_manager.target_devs = []
+    mock_atft.atft_manager.pending_serials = []
+    mock_atft.refresh_policy.idle_refreshes = 1
+
+    for _ in range(4):
+      mock_atft.StartRefreshingDevices()
+    self.assertEqual(4.0, mock_timer.call_args[0][0])
+
+    # A device listed once is only pending, the next listing adds it.
+    mock_atft.atft_manager.pending_serials = [self.TEST_SERIAL1]
+    mock_atft.StartRefreshingDevices()
+    self.assertEqual(1.0, mock_timer.call_args[0][0])
+    mock_atft.StopRefresh()
+
+  @patch('atft.ScheduledTimer')
+  def testRefreshRescheduledOnError(self, mock_timer):
+    mock_atft = MockAtft()
+    # Only count the refresh timers, not the worker stats timer.
+    mock_timer.reset_mock()
+    mock_atft.StartRefreshingDevices = types.MethodType(
+        atft.Atft.StartRefreshingDevices, mock_atft, atft.Atft)
+    mock_atft._ListDevices = MagicMock(side_effect=ValueError('test'))
+
+    with self.assertRaises(ValueError):
+      mock_atft.StartRefreshingDevices()
+    self.assertEqual(1.0, mock_timer.call_args[0][0])
+    self.assertEqual(1, mock_timer.return_value.start.call_count)
+    mock_atft.StopRefresh()
+
+  @patch('atft.ScheduledTimer')
+  def testBurstRefreshOnOperation(self, mock_timer):
+    mock_atft = MockAtft()
+    mock_atft.worker_pool = MagicMock()
+    mock_atft.refresh_policy.idle_refreshes = 0
+    mock_atft.refresh_policy.NextInterval(False)
+    mock_atft._ScheduleRefresh(8.0)
+    self.assertEqual(8.0, mock_timer.call_args[0][0])
+
+    mock_atft._CreateThread(MagicMock())
+    self.assertEqual(1.0, mock_atft.refresh_policy.GetInterval())
+    self.assertEqual(1.0, mock_timer.call_args[0][0])
+    mock_atft.StopRefresh()
+
   # Test atft.OnToggleAutoProv
   def testOnEnterAutoProvNormal(self):
     mock_atft = MockAtft()
@@ -350,6 +495,49 @@ class AtftTest(unittest.TestCase):
     mock_atft.OnChangeKeyThreshold(None)
     self.assertEqual(2, mock_atft.key_threshold)
 
+  # Test atft.OnClose
+  @patch('atft.GetScheduler')
+  @patch('atft.ScheduledTimer')
+  def testOnClose(self, mock_timer, mock_get_scheduler):
+    mock_atft = MockAtft()
+    mock_atft._ScheduleWorkerStats()
+    stats_timer = mock_atft.stats_timer
+    mock_atft._StoreConfigToFile = MagicMock()
+    mock_atft.Destroy = MagicMock()
+    pools = [mock_atft.worker_pool, mock_atft.refresh_pool,
+             mock_atft.auto_prov_pool]
+    for pool in pools:
+      pool.Shutdown = MagicMock()
+    mock_atft.OnClose(None)
+    stats_timer.cancel.assert_called_once_with()
+    mock_get_scheduler.return_value.Shutdown.assert_called_once_with()
+    for pool in pools:
+      pool.Shutdown.assert_called_once_with()
+    mock_atft.Destroy.assert_called_once_with()
+    # A refresh still running does not schedule another one.
+    mock_timer.reset_mock()
+    mock_atft._ScheduleRefresh(1.0)
+    mock_atft._ScheduleWorkerStats()
+    mock_timer.assert_not_called()
+    self.assertEqual(None, mock_atft.refresh_timer)
+
+  # Test atft._LogWorkerStats
+  @patch('atft.ScheduledTimer')
+  def testLogWorkerStats(self, mock_timer):
+    mock_atft = MockAtft()
+    mock_atft.log = MagicMock()
+    mock_atft.worker_pool = MagicMock()
+    mock_atft.worker_pool.GetStats.return_value = (
+        mock_atft.refresh_pool.GetStats())
+    mock_atft._SaveTrace = MagicMock()
+    mock_atft._LogWorkerStats()
+    # The trace is written on a worker, not on the scheduler thread.
+    mock_atft._SaveTrace.assert_not_called()
+    mock_atft.worker_pool.Submit.assert_called_once_with(
+        mock_atft._RunReportingErrors, mock_atft._SaveTrace)
+    mock_timer.assert_called_with(
+        mock_atft.WORKER_STATS_INTERVAL, mock_atft._LogWorkerStats)
+
   # Test atft._HandleAutoProv
   def testHandleAutoProv(self):
     mock_atft = MockAtft()
@@ -360,11 +548,49 @@ class AtftTest(unittest.TestCase):
     mock_atft.atft_manager.target_devs = []
     mock_atft.atft_manager.target_devs.append(test_dev1)
     mock_atft.atft_manager.target_devs.append(test_dev2)
-    mock_atft._CreateThread = MagicMock()
+    mock_atft.atft_manager.flash_manifest = None
+    mock_atft.auto_prov_pool = MagicMock()
     mock_atft._HandleStateTransition = MagicMock()
     mock_atft._HandleAutoProv()
     self.assertEqual(test_dev2.provision_status, ProvisionStatus.WAITING)
-    self.assertEqual(1, mock_atft._CreateThread.call_count)
+    mock_atft.auto_prov_pool.Submit.assert_called_once_with(
+        mock_atft._RunReportingErrors, mock_atft._HandleStateTransition,
+        test_dev2)
+
+  def testHandleAutoProvFlash(self):
+    mock_atft = MockAtft()
+    test_dev1 = TestDeviceInfo(self.TEST_SERIAL1, self.TEST_LOCATION1,
+                               ProvisionStatus.IDLE)
+    test_dev2 = TestDeviceInfo(self.TEST_SERIAL2, self.TEST_LOCATION2,
+                               ProvisionStatus.IDLE)
+    mock_atft.atft_manager.target_devs = [test_dev1, test_dev2]
+    mock_atft.atft_manager.flash_manifest = [MagicMock()]
+    mock_atft.atft_manager.NeedsFlash.side_effect = (
+        lambda target: target == test_dev1)
+    mock_atft.auto_prov_pool = MagicMock()
+    mock_atft._CreateThread = MagicMock()
+    mock_atft._HandleAutoProv()
+    # Devices needing images are flashed before they queue for provisioning.
+    mock_atft._CreateThread.assert_called_once_with(
+        mock_atft._FlashThenProvision, test_dev1)
+    mock_atft.auto_prov_pool.Submit.assert_called_once_with(
+        mock_atft._RunReportingErrors, mock_atft._HandleStateTransition,
+        test_dev2)
+    self.assertEqual(test_dev1.provision_status, ProvisionStatus.WAITING)
+
+  # Test atft._RunReportingErrors
+  @patch('traceback.print_exc')
+  def testRunReportingErrors(self, mock_print_exc):
+    mock_atft = MockAtft()
+    mock_atft.log = MagicMock()
+    self.assertEqual(2, mock_atft._RunReportingErrors(lambda x: x + 1, 1))
+    mock_atft.log.Error.assert_not_called()
+    mock_target = MagicMock()
+    mock_target.side_effect = KeyError('unexpected')
+    self.assertIsNone(mock_atft._RunReportingErrors(mock_target))
+    mock_print_exc.assert_called_once()
+    mock_atft.log.Error.assert_called_once()
+    self.assertIn('KeyError', mock_atft.log.Error.call_args[0][1])
 
   # Test atft._HandleKeysLeft
   def MockGetKeysLeft(self, keys_left_array):
@@ -633,6 +859,65 @@ class AtftTest(unittest.TestCase):
     self.assertEqual(True, test_dev1.provision_state.avb_locked)
     self.assertEqual(True, test_dev1.provision_state.provisioned)
 
+  def testHandleStateTransitionSingleReboot(self):
+    mock_atft = MockAtft()
+    mock_atft.SINGLE_REBOOT_FLOW = True
+    test_dev1 = TestDeviceInfo(self.TEST_SERIAL1, self.TEST_LOCATION1,
+                               ProvisionStatus.WAITING)
+    mock_atft._FuseVbootKeyTarget = MagicMock()
+    mock_atft._ProvisionAllTarget = MagicMock()
+    mock_atft._ProvisionAllTarget.side_effect = (
+        lambda target=mock_atft, state=ProvisionStatus.PROVISION_SUCCESS:
+        self.MockStateChange(target, state))
+    mock_atft.auto_dev_serials = [self.TEST_SERIAL1]
+    mock_atft.auto_prov = True
+    mock_atft.atft_manager = MagicMock()
+    mock_atft.atft_manager.GetTargetDevice = MagicMock()
+    mock_atft.atft_manager.GetTargetDevice.return_value = test_dev1
+    mock_atft._HandleStateTransition(test_dev1)
+    self.assertEqual(ProvisionStatus.PROVISION_SUCCESS,
+                     test_dev1.provision_status)
+    mock_atft._ProvisionAllTarget.assert_called_once_with(test_dev1)
+    mock_atft._FuseVbootKeyTarget.assert_not_called()
+    self.assertEqual([], mock_atft.auto_dev_serials)
+
+  # Test atft._ProvisionAllTarget
+  @patch('wx.QueueEvent')
+  def testProvisionAllTarget(self, mock_queue_event):
+    mock_atft = MockAtft()
+    mock_atft.dev_listed_event = MagicMock()
+    mock_atft.PauseRefresh = MagicMock()
+    mock_atft.ResumeRefresh = MagicMock()
+    mock_atft._CheckLowKeyAlert = MagicMock()
+    mock_atft._HandleException = MagicMock()
+    test_dev1 = TestDeviceInfo(self.TEST_SERIAL1, self.TEST_LOCATION1,
+                               ProvisionStatus.WAITING)
+    self.device_map[self.TEST_SERIAL1] = test_dev1
+    mock_atft.atft_manager.GetTargetDevice.side_effect = (
+        self.MockGetTargetDevice)
+    mock_atft.atft_manager.Reboot.side_effect = self.MockReboot
+    mock_atft._ProvisionAllTarget(test_dev1)
+    mock_atft.atft_manager.ProvisionAll.assert_called_once_with(test_dev1)
+    mock_atft.atft_manager.Reboot.assert_called_once()
+    mock_atft.atft_manager.VerifyProvisionState.assert_called_once_with(
+        test_dev1)
+    mock_atft._HandleException.assert_not_called()
+
+  @patch('wx.QueueEvent')
+  def testProvisionAllTargetFail(self, mock_queue_event):
+    mock_atft = MockAtft()
+    mock_atft.PauseRefresh = MagicMock()
+    mock_atft.ResumeRefresh = MagicMock()
+    mock_atft._CheckATFAStatus = MagicMock()
+    mock_atft._HandleException = MagicMock()
+    test_dev1 = TestDeviceInfo(self.TEST_SERIAL1, self.TEST_LOCATION1,
+                               ProvisionStatus.WAITING)
+    mock_atft.atft_manager.ProvisionAll.side_effect = (
+        fastboot_exceptions.FastbootFailure(''))
+    mock_atft._ProvisionAllTarget(test_dev1)
+    mock_atft._HandleException.assert_called_once()
+    mock_atft.atft_manager.Reboot.assert_not_called()
+
   # Test atft._CheckATFAStatus
   def testCheckATFAStatus(self):
     mock_atft = MockAtft()
@@ -1201,5 +1486,10 @@ class AtftTest(unittest.TestCase):
     mock_atft._SendOperationSucceedEvent.assert_not_called()
 
 
+def tearDownModule():
+  # Each Atft schedules the worker stats on the shared scheduler.
+  workerpool.GetScheduler().Shutdown()
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,471 @@
+#!/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Command line provisioning without the graphical user interface.
+
+Usage:
+
+./atftcli.py PRODUCT_FILE [--manifest FILE] [-j CONCURRENCY] [--config FILE]
+    [--wait SECONDS] [--no-verify]
+
+Runs all the provision steps on the target devices: fuse the bootloader vboot
+key and the permanent attributes, lock the android verified boot and
+provision the attestation key, then reboot once to verify them. The manifest
+lists the serial numbers or USB locations of the devices to provision, one per
+line; all the target devices are provisioned without it.
+
+The progress is written to stdout as one JSON object per line, the last one is
+the summary. The exit status is 0 if all the devices are provisioned, 1 if
+some failed and 2 if provisioning could not start or stopped on an
+unexpected error. wx is never imported.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+from atftman import AtftManager
+from atftman import GetPlatformModules
+from atftman import ProvisionStatus
+from fastboot_exceptions import DeviceNotFoundException
+from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import ProductAttributesFileFormatError
+from fastboot_exceptions import ProductNotSpecifiedException
+import lockprofiler
+from workerpool import GetScheduler
+from workerpool import WorkerPool
+
+EXIT_SUCCESS = 0
+EXIT_FAILED_DEVICES = 1
+EXIT_ERROR = 2
+
+# The language index for the ProvisionStatus strings.
+_ENGLISH = 0
+
+
+def ReadManifest(content):
+  """Parse a device manifest.
+
+  Args:
+    content: The manifest, one serial number or USB location per line. Empty
+      lines and lines starting with '#' are ignored.
+  Returns:
+    The list of entries in the manifest order.
+  """
+  entries = []
+  for line in content.splitlines():
+    line = line.strip()
+    if line and not line.startswith('#') and line not in entries:
+      entries.append(line)
+  return entries
+
+
+def CreateController(timeouts=None):
+  """Import the fastboot controller and the serial mapper for the host.
+
+  Args:
+    timeouts: The deadlines in seconds for the fastboot commands by operation.
+  Returns:
+    A (fastboot controller, serial mapper class) tuple.
+  """
+  (FastbootDevice, SerialMapper) = GetPlatformModules()
+  if timeouts:
+    FastbootDevice.SetTimeouts(timeouts)
+  return (FastbootDevice, SerialMapper)
+
+
+class JsonLinesReporter(object):
+  """Writes one JSON object per event, thread safe."""
+
+  def __init__(self, output=None):
+    self._output = output or sys.stdout
+    self._lock = threading.Lock()
+
+  def Emit(self, event, **fields):
+    """Write one event.
+
+    Args:
+      event: The event name.
+      **fields: The event fields, must be JSON serializable.
+    """
+    fields['event'] = event
+    fields['time'] = datetime.now().isoformat()
+    line = json.dumps(fields, sort_keys=True)
+    with self._lock:
+      self._output.write(line + '\n')
+      self._output.flush()
+
+
+class BatchProvisioner(object):
+  """Provisions a batch of target devices with an AtftManager.
+
+  The device list is refreshed in the background, except while fastboot
+  operations run, the same way the GUI does it.
+  """
+
+  def __init__(self, atft_manager, reporter, concurrency=8, manifest=None,
+               refresh_interval=1.0, reboot_timeout=60.0, verify=True):
+    """Initialize the provisioner.
+
+    Args:
+      atft_manager: The AtftManager with the product selected.
+      reporter: The JsonLinesReporter.
+      concurrency: The number of devices provisioned at the same time.
+      manifest: The serial numbers or USB locations of the devices to
+        provision, None for all the target devices.
+      refresh_interval: The time in seconds between device list refreshes.
+      reboot_timeout: The time in seconds a device has to reappear after the
+        verification reboot.
+      verify: Whether to reboot the devices to verify the provision state.
+    """
+    self.atft_manager = atft_manager
+    self.reporter = reporter
+    self.concurrency = max(1, concurrency)
+    self.manifest = manifest
+    self.refresh_interval = refresh_interval
+    self.reboot_timeout = reboot_timeout
+    self.verify = verify
+    # Released while an operation runs, the refresh is skipped then.
+    self._refresh_pause_lock = lockprofiler.Semaphore('refresh_pause_lock', 0)
+    self._listing_device_lock = lockprofiler.Lock('listing_device_lock')
+    self._stop_refresh = threading.Event()
+    self._refresh_thread = None
+
+  def Run(self, wait):
+    """Find the devices, provision them and emit the summary.
+
+    Args:
+      wait: The maximum time in seconds to wait for the ATFA and the target
+        devices to show up.
+    Returns:
+      The exit status.
+    """
+    start_time = time.time()
+    targets = self._WaitForDevices(wait)
+    if not self.atft_manager.atfa_dev:
+      self.reporter.Emit('error', message='No ATFA device found')
+      return EXIT_ERROR
+    try:
+      self.atft_manager.CheckATFAStatus()
+    except (DeviceNotFoundException, FastbootFailure,
+            ProductNotSpecifiedException) as e:
+      self.reporter.Emit('error', message='ATFA status: ' + str(e))
+      return EXIT_ERROR
+    self.reporter.Emit(
+        'atfa', serial=self.atft_manager.atfa_dev.serial_number,
+        keys_left=self.atft_manager.GetATFAKeysLeft())
+
+    results = {}
+    missing = []
+    if self.manifest is not None:
+      found = set()
+      for target in targets:
+        found.add(target.serial_number)
+        found.add(target.location)
+      missing = [entry for entry in self.manifest if entry not in found]
+      for entry in missing:
+        self.reporter.Emit('device', serial=entry, result='missing')
+
+    self._StartRefresh()
+    pool = WorkerPool(self.concurrency, 'AtftCliWorker')
+    try:
+      tasks = [(target.serial_number,
+                pool.Submit(self._ProvisionTarget, target))
+               for target in targets]
+      for (serial, task) in tasks:
+        task.Wait()
+        try:
+          results[serial] = task.Result()
+        except Exception as e:  # pylint: disable=broad-except
+          # An unexpected error only fails its own device.
+          traceback.print_exc()
+          self.reporter.Emit('device', serial=serial, result='failed',
+                             error='Unexpected error: ' + str(e))
+          results[serial] = 'failed'
+    finally:
+      pool.Shutdown(wait=True)
+      self._StopRefresh()
+
+    try:
+      self.atft_manager.CheckATFAStatus()
+    except (DeviceNotFoundException, FastbootFailure,
+            ProductNotSpecifiedException):
+      pass
+    counts = dict((result, 0) for result in ('provisioned', 'skipped',
+                                             'failed'))
+    for result in results.itervalues():
+      counts[result] += 1
+    self.reporter.Emit(
+        'summary', devices=len(results), missing=len(missing),
+        keys_left=self.atft_manager.GetATFAKeysLeft(),
+        duration=round(time.time() - start_time, 3), **counts)
+    if counts['failed'] or missing:
+      return EXIT_FAILED_DEVICES
+    return EXIT_SUCCESS
+
+  def _WaitForDevices(self, wait):
+    """Refresh the device list until the devices to provision are found.
+
+    Without a manifest, the target list must stay the same for one refresh.
+
+    Args:
+      wait: The maximum time in seconds to wait.
+    Returns:
+      The list of target devices to provision.
+    """
+    deadline = time.time() + wait
+    last_serials = None
+    while True:
+      self._ListDevices()
+      targets = self._SelectTargets()
+      serials = [target.serial_number for target in targets]
+      if self.atft_manager.atfa_dev:
+        if self.manifest is not None:
+          if len(targets) == len(self.manifest):
+            break
+        elif serials and serials == last_serials:
+          break
+      last_serials = serials
+      if time.time() >= deadline:
+        break
+      time.sleep(self.refresh_interval)
+    for target in targets:
+      self.reporter.Emit('device', serial=target.serial_number,
+                         location=target.location, result='found')
+    return targets
+
+  def _SelectTargets(self):
+    targets = self.atft_manager.target_devs[:]
+    if self.manifest is None:
+      return targets
+    return [target for target in targets
+            if (target.serial_number in self.manifest or
+                target.location in self.manifest)]
+
+  def _ListDevices(self):
+    with self._listing_device_lock:
+      try:
+        self.atft_manager.ListDevices()
+      except FastbootFailure as e:
+        self.reporter.Emit('warning', message=str(e))
+
+  def _StartRefresh(self):
+    self._stop_refresh.clear()
+    self._refresh_thread = threading.Thread(
+        target=self._RefreshLoop, name='AtftCliRefresh')
+    self._refresh_thread.daemon = True
+    self._refresh_thread.start()
+
+  def _StopRefresh(self):
+    self._stop_refresh.set()
+    self._refresh_thread.join()
+
+  def _RefreshLoop(self):
+    # The reboot callbacks are only called from a device list refresh.
+    while not self._stop_refresh.wait(self.refresh_interval):
+      if self._refresh_pause_lock.acquire(False):
+        # An operation is running.
+        self._refresh_pause_lock.release()
+        continue
+      self._ListDevices()
+
+  def _Operation(self, func, *args):
+    """Run an AtftManager operation with the refresh paused."""
+    self._refresh_pause_lock.release()
+    try:
+      return func(*args)
+    finally:
+      self._refresh_pause_lock.acquire()
+
+  def _EmitStep(self, target, step):
+    self.reporter.Emit(
+        'step', serial=target.serial_number, step=step,
+        status=ProvisionStatus.ToString(target.provision_status, _ENGLISH))
+
+  def _ProvisionTarget(self, target):
+    """Provision one target device.
+
+    Args:
+      target: The target device DeviceInfo object.
+    Returns:
+      'provisioned', 'skipped' if the device was already provisioned or
+      'failed'.
+    """
+    serial = target.serial_number
+    state = target.provision_state
+    if (state.bootloader_locked and state.avb_perm_attr_set and
+        state.avb_locked and state.provisioned):
+      self.reporter.Emit('device', serial=serial, result='skipped')
+      return 'skipped'
+    step = 'Fuse, lock and provision'
+    try:
+      self.reporter.Emit('step', serial=serial, step=step, status='Started')
+      self._Operation(self.atft_manager.ProvisionAll, target)
+      self._EmitStep(target, step)
+      if self.verify:
+        step = 'Verify provision state, rebooting'
+        target = self._RebootTarget(target)
+        self._Operation(self.atft_manager.VerifyProvisionState, target)
+        self._EmitStep(target, step)
+    except (DeviceNotFoundException, FastbootFailure,
+            ProductNotSpecifiedException) as e:
+      self.reporter.Emit(
+          'device', serial=serial, result='failed', step=step, error=str(e),
+          status=ProvisionStatus.ToString(target.provision_status, _ENGLISH))
+      return 'failed'
+    self.reporter.Emit('device', serial=serial, result='provisioned')
+    return 'provisioned'
+
+  def _RebootTarget(self, target):
+    """Reboot a target device and wait until it reappears.
+
+    Args:
+      target: The target device DeviceInfo object.
+    Returns:
+      The DeviceInfo object of the device after the reboot.
+    Raises:
+      FastbootFailure: If the reboot fails or times out.
+    """
+    serial = target.serial_number
+    rebooted = threading.Event()
+    success = []
+
+    def SuccessCallback():
+      success.append(True)
+      rebooted.set()
+
+    with self._listing_device_lock:
+      self.atft_manager.Reboot(
+          target, self.reboot_timeout, SuccessCallback, rebooted.set)
+    rebooted.wait()
+    # The callbacks are called during a refresh, wait until it is done.
+    with self._listing_device_lock:
+      target = self.atft_manager.GetTargetDevice(serial)
+    if not success or not target:
+      raise FastbootFailure('Reboot timed out.')
+    return target
+
+
+def _LoadConfigs(config_path):
+  """Load the configuration file of the AT-Factory-Tool.
+
+  Returns:
+    The configuration map, empty if there is no file.
+  """
+  if not os.path.exists(config_path):
+    return {}
+  with open(config_path, 'r') as config_file:
+    return json.loads(config_file.read()) or {}
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+      description='Provision Android Things devices without the GUI.')
+  parser.add_argument('product', help='The product attributes file (.atpa)')
+  parser.add_argument(
+      '--manifest',
+      dest='manifest',
+      help='File listing the serial numbers or USB locations to provision')
+  parser.add_argument(
+      '-j',
+      '--concurrency',
+      type=int,
+      dest='concurrency',
+      help='Number of devices provisioned at the same time, MAX_WORKERS of '
+      'the configuration file by default')
+  parser.add_argument(
+      '--config',
+      dest='config',
+      default=os.path.join(
+          os.path.dirname(os.path.abspath(__file__)), 'config.json'),
+      help='The AT-Factory-Tool configuration file')
+  parser.add_argument(
+      '--wait',
+      type=float,
+      default=10.0,
+      dest='wait',
+      help='Maximum time in seconds to wait for the devices to show up')
+  parser.add_argument(
+      '--no-verify',
+      action='store_false',
+      dest='verify',
+      help='Do not reboot the devices to verify the provision state')
+  args = parser.parse_args(argv)
+  reporter = JsonLinesReporter()
+  try:
+    return _Run(args, reporter)
+  except Exception as e:  # pylint: disable=broad-except
+    traceback.print_exc()
+    reporter.Emit('error', message='Unexpected error: ' + str(e))
+    return EXIT_ERROR
+  finally:
+    # The reboot timers run on the scheduler thread, which must be stopped
+    # before the interpreter shuts down.
+    GetScheduler().Shutdown()
+
+
+def _Run(args, reporter):
+  """Provision the devices with the parsed command line arguments.
+
+  Args:
+    args: The argparse namespace.
+    reporter: The JsonLinesReporter.
+  Returns:
+    The exit status.
+  """
+  try:
+    configs = _LoadConfigs(args.config)
+    with open(args.product, 'r') as product_file:
+      product_content = product_file.read()
+    manifest = None
+    if args.manifest:
+      with open(args.manifest, 'r') as manifest_file:
+        manifest = ReadManifest(manifest_file.read())
+  except (IOError, ValueError) as e:
+    reporter.Emit('error', message=str(e))
+    return EXIT_ERROR
+
+  try:
+    timeouts = dict((str(operation), float(timeout)) for operation, timeout in
+                    configs.get('FASTBOOT_TIMEOUTS', {}).iteritems())
+    refresh_interval = float(configs.get('DEVICE_REFRESH_INTERVAL', 1.0))
+    reboot_timeout = float(configs.get('REBOOT_TIMEOUT', 60.0))
+    concurrency = args.concurrency or int(configs.get('MAX_WORKERS', 8))
+  except (AttributeError, ValueError):
+    reporter.Emit('error', message='Wrong configuration file format')
+    return EXIT_ERROR
+
+  (controller, serial_mapper) = CreateController(timeouts)
+  atft_manager = AtftManager(controller, serial_mapper, configs)
+  try:
+    atft_manager.ProcessProductAttributesFile(product_content)
+  except ProductAttributesFileFormatError as e:
+    reporter.Emit('error', message=str(e))
+    return EXIT_ERROR
+  reporter.Emit('product', name=atft_manager.product_info.product_name,
+                product_id=atft_manager.product_info.product_id)
+
+  provisioner = BatchProvisioner(
+      atft_manager, reporter, concurrency, manifest, refresh_interval,
+      reboot_timeout, args.verify)
+  return provisioner.Run(args.wait)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,195 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the command line provisioning.
+
+The provisioning tests use the simulated devices and are skipped if they are
+not available, see simdevice_unittest.py.
+"""
+import base64
+import json
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import atftcli
+import atftman
+from mock import patch
+import simdevice
+import workerpool
+
+try:
+  _LIBRARY = simdevice.AtapHostLibrary()
+  _CA = simdevice.TestCa()
+  _SKIP_REASON = None
+except (OSError, ImportError) as e:
+  _LIBRARY = None
+  _CA = None
+  _SKIP_REASON = 'Simulated devices not available: %s' % e
+
+
+class AtftCliTest(unittest.TestCase):
+
+  def setUp(self):
+    self.output = StringIO.StringIO()
+    self.reporter = atftcli.JsonLinesReporter(self.output)
+
+  def _GetEvents(self, event=None):
+    events = [json.loads(line) for line in self.output.getvalue().splitlines()]
+    return [e for e in events if event is None or e['event'] == event]
+
+  def _CreateProvisioner(self, targets=2, manifest=None, **kwargs):
+    self.fleet = simdevice.SimulatedFleet(_LIBRARY, _CA)
+    self.fleet.AddAtfa()
+    for _ in range(targets):
+      self.fleet.AddTarget(**kwargs)
+    manager = atftman.AtftManager(
+        self.fleet, self.fleet.CreateSerialMapper(), None)
+    manager.ProcessProductAttributesFile(json.dumps({
+        'productName': 'simulated',
+        'productPermanentAttribute': base64.standard_b64encode(
+            bytearray(simdevice.PERM_ATTR_LEN)),
+        'bootloaderPublicKey': base64.standard_b64encode(bytearray(1024))
+    }))
+    return atftcli.BatchProvisioner(
+        manager, self.reporter, concurrency=2, manifest=manifest,
+        refresh_interval=0.01, reboot_timeout=5)
+
+  # Test ReadManifest and JsonLinesReporter
+  def testReadManifest(self):
+    self.assertEqual(['serial1', '1-1.2'],
+                     atftcli.ReadManifest('# station 1\nserial1\n\n 1-1.2 \n'
+                                          'serial1\n'))
+
+  def testReporter(self):
+    self.reporter.Emit('device', serial='serial1', result='found')
+    [event] = self._GetEvents()
+    self.assertEqual('device', event['event'])
+    self.assertEqual('serial1', event['serial'])
+    self.assertIn('time', event)
+
+  def testNoGuiImports(self):
+    self.assertNotIn('wx', sys.modules)
+
+  # Test BatchProvisioner
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testProvisionAll(self):
+    provisioner = self._CreateProvisioner(targets=3)
+    self.assertEqual(atftcli.EXIT_SUCCESS, provisioner.Run(wait=5))
+    [summary] = self._GetEvents('summary')
+    self.assertEqual(3, summary['provisioned'])
+    self.assertEqual(0, summary['failed'])
+    self.assertEqual(997, summary['keys_left'])
+    for serial in self.fleet.ListDevices():
+      if not serial.startswith('ATFA'):
+        self.assertIsNotNone(self.fleet.GetDevice(serial).GetUuid())
+    steps = [e['step'] for e in self._GetEvents('step')]
+    self.assertIn('Verify provision state, rebooting', steps)
+
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testManifest(self):
+    provisioner = self._CreateProvisioner(targets=2)
+    serial = sorted(self.fleet.ListDevices())[-1]
+    provisioner.manifest = [serial, 'missing-serial']
+    self.assertEqual(atftcli.EXIT_FAILED_DEVICES, provisioner.Run(wait=0.1))
+    [summary] = self._GetEvents('summary')
+    self.assertEqual(1, summary['provisioned'])
+    self.assertEqual(1, summary['missing'])
+    provisioned = [e['serial'] for e in self._GetEvents('device')
+                   if e['result'] == 'provisioned']
+    self.assertEqual([serial], provisioned)
+
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testSkipProvisioned(self):
+    provisioner = self._CreateProvisioner(targets=1, provisioned_to=3)
+    self.assertEqual(atftcli.EXIT_SUCCESS, provisioner.Run(wait=5))
+    self.output.truncate(0)
+    self.assertEqual(atftcli.EXIT_SUCCESS, provisioner.Run(wait=5))
+    [summary] = self._GetEvents('summary')
+    self.assertEqual(1, summary['skipped'])
+    self.assertEqual(999, summary['keys_left'])
+
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testFailedStep(self):
+    # The device rejects permanent attributes of the wrong length.
+    provisioner = self._CreateProvisioner(targets=1)
+    provisioner.atft_manager.product_info.product_attributes = bytearray(10)
+    self.assertEqual(atftcli.EXIT_FAILED_DEVICES, provisioner.Run(wait=5))
+    [failure] = [e for e in self._GetEvents('device')
+                 if e['result'] == 'failed']
+    self.assertEqual('Fuse Permanent Attributes Failed', failure['status'])
+
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testNoAtfa(self):
+    provisioner = self._CreateProvisioner(targets=1)
+    self.fleet.Remove(
+        [s for s in self.fleet.ListDevices() if s.startswith('ATFA')][0])
+    self.assertEqual(atftcli.EXIT_ERROR, provisioner.Run(wait=0.05))
+    self.assertEqual(1, len(self._GetEvents('error')))
+
+  @unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+  def testUnexpectedError(self):
+    provisioner = self._CreateProvisioner(targets=2)
+    provision_target = provisioner._ProvisionTarget
+    broken_serial = [s for s in self.fleet.ListDevices()
+                     if not s.startswith('ATFA')][0]
+
+    def ProvisionTarget(target):
+      if target.serial_number == broken_serial:
+        raise KeyError('test')
+      return provision_target(target)
+
+    provisioner._ProvisionTarget = ProvisionTarget
+    self.assertEqual(atftcli.EXIT_FAILED_DEVICES, provisioner.Run(wait=5))
+    [failure] = [e for e in self._GetEvents('device')
+                 if e['result'] == 'failed']
+    self.assertEqual(broken_serial, failure['serial'])
+    [summary] = self._GetEvents('summary')
+    self.assertEqual(1, summary['failed'])
+    self.assertEqual(1, summary['provisioned'])
+
+  # Test main
+  def testMainProductFileMissing(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    stdout = sys.stdout
+    sys.stdout = self.output
+    try:
+      status = atftcli.main([os.path.join(temp_dir, 'missing.atpa'),
+                             '--config', os.path.join(temp_dir, 'none.json')])
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(atftcli.EXIT_ERROR, status)
+    self.assertEqual(1, len(self._GetEvents('error')))
+
+  def testMainUnexpectedError(self):
+    scheduler = workerpool.GetScheduler()
+    stdout = sys.stdout
+    sys.stdout = self.output
+    try:
+      with patch('atftcli._Run', side_effect=KeyError('test')):
+        status = atftcli.main(['product.atpa'])
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(atftcli.EXIT_ERROR, status)
+    self.assertEqual(1, len(self._GetEvents('error')))
+    self.assertTrue(scheduler.IsShutdown())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,21 +20,78 @@ This module provides the logical implementation of the graphical tool for
 managing the ATFA and AT communication.
 """
 import base64
+import collections
+import contextlib
+import csv
 from datetime import datetime
+import hashlib
 import json
 import os
 import re
+import sys
 import tempfile
 import threading
+import time
 import uuid
 
+from deviceactor import DeviceActor
+from deviceactor import GetPriority
+from deviceactor import Priority
+from deviceactor import PRIORITIES
+from deviceactor import PRIORITY_CRITICAL
+from deviceactor import PRIORITY_MONITOR
 from fastboot_exceptions import DeviceNotFoundException
 from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import FlashManifestFormatError
 from fastboot_exceptions import NoAlgorithmAvailableException
 from fastboot_exceptions import ProductAttributesFileFormatError
 from fastboot_exceptions import ProductNotSpecifiedException
+import lockprofiler
+from sparseimage import SparseImageCache
+from tracer import CATEGORY_COMMAND
+from tracer import GetTracer
+from tracer import Span
+from tracer import Traced
+from usbtopology import OrderByBus
+from usbtopology import TransferScheduler
+from workerpool import ScheduledTimer
+from workerpool import WorkerPool
 
 BOOTLOADER_STRING = '(bootloader) '
+# The value of 'at-attest-uuid' for a device without attestation key.
+# TODO(shanyu): We only need empty string here
+# NOT_PROVISIONED is for test purpose.
+NOT_PROVISIONED_UUID = 'NOT_PROVISIONED'
+
+# Matches one key-value line in the output of 'getvar at-vboot-state', either
+# '(bootloader) key: value' or '(bootloader) key=value'. Lines whose value
+# contains another separator (e.g. avb-min-versions) are skipped, same as
+# lines without separator.
+_STATE_LINE_PATTERN = re.compile(
+    r'^' + re.escape(BOOTLOADER_STRING) +
+    r'([^:=\r\n]*)(?::[^\S\r\n]*|=)([^:=\r\n]*)\r?$', re.MULTILINE)
+
+# The fastboot controller and the serial mapper for the host OS, see
+# GetPlatformModules.
+_platform_modules = None
+
+
+def GetPlatformModules():
+  """Import the fastboot controller and the serial mapper when first used.
+
+  Returns:
+    A (FastbootDevice, SerialMapper) tuple of classes for the host OS.
+  """
+  global _platform_modules
+  if _platform_modules is None:
+    if sys.platform.startswith('win'):
+      from fastbootsubp import FastbootDevice  # pylint: disable=g-import-not-at-top
+      from serialmapperwin import SerialMapper  # pylint: disable=g-import-not-at-top
+    else:
+      from fastbootsh import FastbootDevice  # pylint: disable=g-import-not-at-top
+      from serialmapperlinux import SerialMapper  # pylint: disable=g-import-not-at-top
+    _platform_modules = (FastbootDevice, SerialMapper)
+  return _platform_modules
 
 
 class EncryptionAlgorithm(object):
@@ -66,6 +123,8 @@ class ProvisionStatus(object):
   PROVISION_ING     = (50 + _PROCESSING)
   PROVISION_SUCCESS = (50 + _SUCCESS)
   PROVISION_FAILED  = ( + _FAILED)
+  FLASH_ING         = (60 + _PROCESSING)
+  FLASH_FAILED      = (60 + _FAILED)
 
   STRING_MAP = {
     IDLE              : ['Idle', '初始'],
@@ -85,7 +144,9 @@ class ProvisionStatus(object):
     LOCKAVB_FAILED    : ['Lock Android Verified Boot Failed', '锁定AVB失败'],
     PROVISION_ING     : ['Provisioning Attestation Key', '传输密钥中...'],
     PROVISION_SUCCESS : ['Attestation Key Provisioned', '传输密钥成功'],
-    PROVISION_FAILED  : ['Provision Attestation Key Failed', '传输密钥失败']
+    PROVISION_FAILED  : ['Provision Attestation Key Failed', '传输密钥失败'],
+    FLASH_ING         : ['Flashing Images...', '烧写镜像中...'],
+    FLASH_FAILED      : ['Flash Images Failed', '烧写镜像失败']
 
   }
 
@@ -106,12 +167,138 @@ class ProvisionStatus(object):
     return provision_status % 10 == ProvisionStatus._FAILED
 
 
+def _FlagProperty(bit):
+  """Create a boolean property for one bit of the flags attribute."""
+
+  def GetFlag(self):
+    return bool(self.flags & bit)
+
+  def SetFlag(self, value):
+    if value:
+      self.flags |= bit
+    else:
+      self.flags &= ~bit
+
+  return property(GetFlag, SetFlag)
+
+
 class ProvisionState(object):
-  """The provision state of the target device."""
-  bootloader_locked = False
-  avb_perm_attr_set = False
-  avb_locked = False
-  provisioned = False
+  """The provision state of the target device.
+
+  The states are packed into the bits of flags, FIELDS are their names in the
+  order of the bits.
+  """
+  FIELDS = ('bootloader_locked', 'avb_perm_attr_set', 'avb_locked',
+            'provisioned')
+  __slots__ = ('flags',)
+
+  BOOTLOADER_LOCKED = 1 << 0
+  AVB_PERM_ATTR_SET = 1 << 1
+  AVB_LOCKED = 1 << 2
+  PROVISIONED = 1 << 3
+
+  bootloader_locked = _FlagProperty(BOOTLOADER_LOCKED)
+  avb_perm_attr_set = _FlagProperty(AVB_PERM_ATTR_SET)
+  avb_locked = _FlagProperty(AVB_LOCKED)
+  provisioned = _FlagProperty(PROVISIONED)
+
+  def __init__(self, bootloader_locked=False, avb_perm_attr_set=False,
+               avb_locked=False, provisioned=False):
+    self.flags = (
+        (self.BOOTLOADER_LOCKED if bootloader_locked else 0) |
+        (self.AVB_PERM_ATTR_SET if avb_perm_attr_set else 0) |
+        (self.AVB_LOCKED if avb_locked else 0) |
+        (self.PROVISIONED if provisioned else 0))
+
+  @staticmethod
+  def FromFlags(flags):
+    """Create a provision state from the flags of another one.
+
+    Args:
+      flags: The packed states, e.g. DeviceSnapshot.provision_flags.
+    Returns:
+      The ProvisionState object.
+    """
+    state = ProvisionState()
+    state.flags = flags
+    return state
+
+  def __eq__(self, other):
+    return self.flags == other.flags
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  # Mutable, compared by value.
+  __hash__ = None
+
+
+def ParseStateString(state_string):
+  """Parse the string returned by 'at-vboot-state' to a key-value map.
+
+  Args:
+    state_string: The string returned by oem at-vboot-state command.
+
+  Returns:
+    A key-value map.
+  """
+  # The sh based controller returns a RunningCommand instead of a string.
+  return dict(_STATE_LINE_PATTERN.findall(str(state_string)))
+
+
+def ParseProvisionState(at_attest_uuid, state_string):
+  """Parse the provision status and state from the raw getvar outputs.
+
+  Args:
+    at_attest_uuid: The value of 'at-attest-uuid'.
+    state_string: The output of 'getvar at-vboot-state', could be empty.
+
+  Returns:
+    A (provision_status, ProvisionState) tuple. The status is the last
+    finished provision step.
+  """
+  provisioned = bool(at_attest_uuid) and at_attest_uuid != NOT_PROVISIONED_UUID
+  if state_string:
+    # state_string should be in format:
+    # (bootloader) bootloader-locked: 1
+    # (bootloader) bootloader-min-versions: -1,0,3
+    # (bootloader) avb-perm-attr-set: 1
+    # (bootloader) avb-locked: 0
+    # (bootloader) avb-unlock-disabled: 0
+    # (bootloader) avb-min-versions: 0:1,1:1,2:1,4097 :2,4098:2
+    state_map = ParseStateString(state_string)
+    state = ProvisionState(state_map.get('bootloader-locked') == '1',
+                           state_map.get('avb-perm-attr-set') == '1',
+                           state_map.get('avb-locked') == '1',
+                           provisioned)
+  else:
+    state = ProvisionState(provisioned=provisioned)
+
+  if state.provisioned:
+    status = ProvisionStatus.PROVISION_SUCCESS
+  elif state.avb_locked:
+    status = ProvisionStatus.LOCKAVB_SUCCESS
+  elif state.avb_perm_attr_set:
+    status = ProvisionStatus.FUSEATTR_SUCCESS
+  elif state.bootloader_locked:
+    status = ProvisionStatus.FUSEVBOOT_SUCCESS
+  else:
+    status = ProvisionStatus.IDLE
+  return (status, state)
+
+
+def ParseProvisionStates(raw_outputs):
+  """Parse the provision status and state for a batch of devices.
+
+  Args:
+    raw_outputs: An iterable of (at_attest_uuid, state_string) tuples.
+
+  Returns:
+    A list of (provision_status, ProvisionState) tuples in input order.
+  """
+  parse = ParseProvisionState
+  return [parse(at_attest_uuid, state_string)
+          for (at_attest_uuid, state_string) in raw_outputs]
 
 
 class ProductInfo(object):
@@ -130,6 +317,119 @@ class ProductInfo(object):
     self.vboot_key = vboot_key
 
 
+class FlashImage(object):
+  """An image to be flashed to a partition.
+
+  Attributes:
+    partition: The name of the partition.
+    file_path: The path of the image file.
+    digest: The hex SHA-256 digest of the image file.
+  """
+
+  # Read the image in 1MB blocks while hashing.
+  _HASH_BLOCK_SIZE = 1024 * 1024
+
+  def __init__(self, partition, file_path, digest=None):
+    self.partition = partition
+    self.file_path = file_path
+    self.digest = digest or FlashImage.HashFile(file_path)
+
+  @staticmethod
+  def HashFile(file_path):
+    """Compute the hex SHA-256 digest of a file.
+
+    Args:
+      file_path: The path of the file.
+    Returns:
+      The hex digest.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as image_file:
+      while True:
+        block = image_file.read(FlashImage._HASH_BLOCK_SIZE)
+        if not block:
+          break
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+class FlashRecord(object):
+  """Remembers which image was written to which partition of which device.
+
+  The record is a JSON file of the format:
+    {
+      "SERIAL": {"PARTITION": "SHA-256 HEX DIGEST", ...},
+      ...
+    }
+  """
+
+  def __init__(self, file_path=None):
+    """Load the record.
+
+    Args:
+      file_path: The path of the record file, None to keep it in memory only.
+    """
+    self.file_path = file_path
+    self._lock = threading.Lock()
+    self._record = {}
+    if file_path and os.path.exists(file_path):
+      try:
+        with open(file_path, 'r') as record_file:
+          self._record = json.load(record_file)
+      except ValueError:
+        # A broken record only means the images would be flashed again.
+        self._record = {}
+
+  def IsFlashed(self, serial, image):
+    """Check whether an image was already written to a device.
+
+    Args:
+      serial: The serial number of the device.
+      image: The FlashImage object.
+    Returns:
+      Whether the same image was recorded for the partition of the device.
+    """
+    with self._lock:
+      partitions = self._record.get(serial, {})
+      return partitions.get(image.partition) == image.digest
+
+  def Add(self, serial, image):
+    """Record that an image was written to a device and save the record.
+
+    Args:
+      serial: The serial number of the device.
+      image: The FlashImage object.
+    """
+    with self._lock:
+      self._record.setdefault(serial, {})[image.partition] = image.digest
+      if self.file_path:
+        with open(self.file_path, 'w') as record_file:
+          json.dump(self._record, record_file, sort_keys=True, indent=4)
+
+
+class DeviceSnapshot(collections.namedtuple(
+    'DeviceSnapshot',
+    ['serial_number', 'location', 'provision_status', 'provision_flags'])):
+  """An immutable copy of the public information about a device.
+
+  Taken with DeviceInfo.Snapshot(). It can be handed from the worker threads
+  to the UI thread as is, and snapshots compare as tuples.
+
+  Attributes:
+    serial_number: The serial number for the device.
+    location: The physical USB location for the device.
+    provision_status: The provision status.
+    provision_flags: The flags of the ProvisionState.
+  """
+  __slots__ = ()
+
+  def __str__(self):
+    if self.location:
+      return self.serial_number + ' at location: ' + self.location
+    else:
+      return self.serial_number
+
+
 class DeviceInfo(object):
   """The class to wrap the information about a fastboot device.
 
@@ -137,42 +437,107 @@ class DeviceInfo(object):
     serial_number: The serial number for the device.
     location: The physical USB location for the device.
   """
+  __slots__ = ('_fastboot_device_controller', 'serial_number', 'location',
+               'provision_status', 'provision_state', 'keys_left', '_actor')
 
   def __init__(self, _fastboot_device_controller, serial_number,
                location=None, provision_status=ProvisionStatus.IDLE,
-               provision_state=ProvisionState()):
+               provision_state=None):
     self._fastboot_device_controller = _fastboot_device_controller
     self.serial_number = serial_number
     self.location = location
     # The provision status and provision state is only meaningful for target
     # device.
     self.provision_status = provision_status
+    if provision_state is None:
+      provision_state = ProvisionState()
     self.provision_state = provision_state
     # The number of attestation keys left for the selected product. This
     # attribute is only meaning for ATFA device.
     self.keys_left = None
+    # Orders the commands to the device by the priority of the calling thread.
+    self._actor = DeviceActor(serial_number)
 
   def Copy(self):
     return DeviceInfo(None, self.serial_number, self.location,
                       self.provision_status)
 
+  def Snapshot(self):
+    """Take an immutable copy of the public information about the device.
+
+    Cheaper than Copy(), no DeviceActor is created.
+
+    Returns:
+      The DeviceSnapshot.
+    """
+    return DeviceSnapshot(self.serial_number, self.location,
+                          self.provision_status, self.provision_state.flags)
+
+  def Session(self, priority):
+    """Hold the device so that no other thread's command gets in between.
+
+    Args:
+      priority: The priority to get the device with.
+    Returns:
+      A context manager.
+    """
+    return self._actor.Session(priority)
+
+  def GetCommandStats(self):
+    return self._actor.GetStats()
+
+  def _CommandSpan(self, name, args, on_device=False):
+    # File paths are left out of the trace.
+    span_args = None
+    if args and name in ('Oem', 'GetVar', 'Flash'):
+      span_args = {'arg': args[0]}
+    return Span(name, CATEGORY_COMMAND, self.serial_number, span_args,
+                on_thread=not on_device, on_device=on_device)
+
+  def _RunTraced(self, name, func, *args):
+    with self._CommandSpan(name, args, on_device=True):
+      return func(*args)
+
+  def _Call(self, name, func, *args):
+    if GetTracer() is None:
+      return self._actor.Call(GetPriority(), func, *args)
+    # The thread span includes the wait for the device, the device span only
+    # the command itself.
+    with self._CommandSpan(name, args):
+      return self._actor.Call(GetPriority(), self._RunTraced, name, func,
+                              *args)
+
   def Reboot(self):
-    return self._fastboot_device_controller.Reboot()
+    return self._Call('Reboot', self._fastboot_device_controller.Reboot)
 
   def Oem(self, oem_command, err_to_out=False):
-    return self._fastboot_device_controller.Oem(oem_command, err_to_out)
+    return self._Call('Oem', self._fastboot_device_controller.Oem,
+                      oem_command, err_to_out)
 
   def Flash(self, partition, file_path):
-    return self._fastboot_device_controller.Flash(partition, file_path)
+    return self._Call('Flash', self._fastboot_device_controller.Flash,
+                      partition, file_path)
 
   def Upload(self, file_path):
-    return self._fastboot_device_controller.Upload(file_path)
+    return self._Call('Upload', self._fastboot_device_controller.Upload,
+                      file_path)
 
   def Download(self, file_path):
-    return self._fastboot_device_controller.Download(file_path)
+    return self._Call('Download', self._fastboot_device_controller.Download,
+                      file_path)
 
   def GetVar(self, var):
-    return self._fastboot_device_controller.GetVar(var)
+    if GetPriority() == PRIORITY_MONITOR:
+      # Identical status reads from several monitors are sent only once.
+      key = ('getvar', var)
+      if GetTracer() is None:
+        return self._actor.CallCoalesced(
+            key, self._fastboot_device_controller.GetVar, var)
+      with self._CommandSpan('GetVar', (var,)):
+        return self._actor.CallCoalesced(
+            key, self._RunTraced, 'GetVar',
+            self._fastboot_device_controller.GetVar, var)
+    return self._Call('GetVar', self._fastboot_device_controller.GetVar, var)
 
   def __eq__(self, other):
     return (self.serial_number == other.serial_number and
@@ -189,6 +554,155 @@ class DeviceInfo(object):
       return self.serial_number
 
 
+class AuditCategory(object):
+  """The categories of a device in a fleet audit report."""
+  # Attestation key provisioned.
+  PROVISIONED = 'provisioned'
+  # Android verified boot locked, attestation key not provisioned.
+  LOCKED = 'locked'
+  # Bootloader vboot key or permanent attributes fused, AVB not locked.
+  FUSED = 'fused'
+  # Nothing fused.
+  UNFUSED = 'unfused'
+  # The state read from the device differs from the last seen state.
+  MISMATCHED = 'mismatched'
+  # The device is rebooting and could not be checked.
+  REBOOTING = 'rebooting'
+  # The device did not answer within the audit timeout.
+  TIMEOUT = 'timeout'
+  # Reading the state from the device failed.
+  FAILED = 'failed'
+
+  ALL = [PROVISIONED, LOCKED, FUSED, UNFUSED, MISMATCHED, REBOOTING, TIMEOUT,
+         FAILED]
+
+  @staticmethod
+  def FromState(provision_state):
+    """Get the category for a provision state read from the device."""
+    if provision_state.provisioned:
+      return AuditCategory.PROVISIONED
+    if provision_state.avb_locked:
+      return AuditCategory.LOCKED
+    if (provision_state.bootloader_locked or
+        provision_state.avb_perm_attr_set):
+      return AuditCategory.FUSED
+    return AuditCategory.UNFUSED
+
+
+class AuditResult(object):
+  """The audit result for one target device.
+
+  Attributes:
+    serial_number: The serial number for the device.
+    location: The physical USB location for the device.
+    category: The AuditCategory for the device.
+    provision_state: The ProvisionState read from the device, None if it could
+      not be read.
+    expected_state: The last seen ProvisionState for the device.
+    error: The error message if the state could not be read.
+    duration: The time used to read the state in seconds, None if not read.
+  """
+
+  CSV_FIELDS = ['serial_number', 'location', 'category', 'bootloader_locked',
+                'avb_perm_attr_set', 'avb_locked', 'provisioned', 'error',
+                'duration']
+
+  def __init__(self, device, category, provision_state=None, error=None,
+               duration=None):
+    self.serial_number = device.serial_number
+    self.location = device.location
+    self.category = category
+    self.provision_state = provision_state
+    self.expected_state = device.provision_state
+    self.error = error
+    self.duration = duration
+
+  def ToDict(self):
+    """Convert the result to a dictionary with CSV_FIELDS as keys."""
+    result = {
+        'serial_number': self.serial_number,
+        'location': self.location,
+        'category': self.category,
+        'error': self.error,
+        'duration': self.duration
+    }
+    for field in ProvisionState.FIELDS:
+      if self.provision_state:
+        result[field] = getattr(self.provision_state, field)
+      else:
+        result[field] = None
+    return result
+
+
+class AuditReport(object):
+  """The consolidated result of a fleet audit.
+
+  Attributes:
+    results: The list of AuditResult objects.
+    start_time: The time when the audit started.
+    duration: The time the whole audit took in seconds.
+  """
+
+  def __init__(self, results, start_time, duration):
+    self.results = results
+    self.start_time = start_time
+    self.duration = duration
+
+  def Summary(self):
+    """Count the devices in each category.
+
+    Returns:
+      A map from AuditCategory to the number of devices.
+    """
+    summary = dict((category, 0) for category in AuditCategory.ALL)
+    for result in self.results:
+      summary[result.category] += 1
+    return summary
+
+  def WriteJson(self, file_path):
+    """Write the report as a JSON file.
+
+    Args:
+      file_path: The path of the report file.
+    """
+    report = {
+        'start_time': datetime.utcfromtimestamp(
+            self.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+        'duration': self.duration,
+        'summary': self.Summary(),
+        'devices': [result.ToDict() for result in self.results]
+    }
+    with open(file_path, 'w') as report_file:
+      json.dump(report, report_file, sort_keys=True, indent=4)
+
+  def WriteCsv(self, file_path):
+    """Write the report as a CSV file with one line per device.
+
+    Args:
+      file_path: The path of the report file.
+    """
+    with open(file_path, 'wb') as report_file:
+      writer = csv.DictWriter(report_file, AuditResult.CSV_FIELDS)
+      writer.writeheader()
+      for result in self.results:
+        writer.writerow(result.ToDict())
+
+  def Write(self, file_path):
+    """Write the report, the format is chosen by the file extension.
+
+    Args:
+      file_path: The path of the report file, ending with '.csv' or '.json'.
+    Raises:
+      ValueError: If the file extension is not supported.
+    """
+    if file_path.endswith('.csv'):
+      self.WriteCsv(file_path)
+    elif file_path.endswith('.json'):
+      self.WriteJson(file_path)
+    else:
+      raise ValueError('Unsupported audit report format: ' + file_path)
+
+
 class RebootCallback(object):
   """The class to handle reboot success and timeout callbacks."""
 
@@ -208,7 +722,8 @@ class RebootCallback(object):
     # Lock to make sure only one callback is called. (either success or timeout)
     # This lock can only be obtained once.
     self.lock = threading.Lock()
-    self.timer = threading.Timer(timeout, self._TimeoutCallback)
+    self.start_time = time.time()
+    self.timer = ScheduledTimer(timeout, self._TimeoutCallback)
     self.timer.start()
 
   def _TimeoutCallback(self):
@@ -266,6 +781,59 @@ class AtftManager(object):
       except ValueError:
         pass
 
+    # The number of devices checked in parallel during a fleet audit.
+    self.AUDIT_MAX_WORKERS = 8
+    if configs and 'AUDIT_MAX_WORKERS' in configs:
+      try:
+        self.AUDIT_MAX_WORKERS = max(1, int(configs['AUDIT_MAX_WORKERS']))
+      except ValueError:
+        pass
+
+    # The time allowed for reading the state of one device during an audit.
+    self.AUDIT_TIMEOUT = 10.0
+    if configs and 'AUDIT_TIMEOUT' in configs:
+      try:
+        self.AUDIT_TIMEOUT = float(configs['AUDIT_TIMEOUT'])
+      except ValueError:
+        pass
+
+    # The maximum concurrent data transfers on one USB hub and under one root
+    # hub port, 0 for no limit.
+    self.TRANSFER_MAX_PER_HUB = 2
+    if configs and 'TRANSFER_MAX_PER_HUB' in configs:
+      try:
+        self.TRANSFER_MAX_PER_HUB = int(configs['TRANSFER_MAX_PER_HUB'])
+      except ValueError:
+        pass
+    self.TRANSFER_MAX_PER_ROOT_PORT = 4
+    if configs and 'TRANSFER_MAX_PER_ROOT_PORT' in configs:
+      try:
+        self.TRANSFER_MAX_PER_ROOT_PORT = int(
+            configs['TRANSFER_MAX_PER_ROOT_PORT'])
+      except ValueError:
+        pass
+    self.transfer_scheduler = TransferScheduler(
+        self.TRANSFER_MAX_PER_HUB, self.TRANSFER_MAX_PER_ROOT_PORT)
+
+    # The number of devices flashed in parallel.
+    self.FLASH_MAX_WORKERS = 8
+    if configs and 'FLASH_MAX_WORKERS' in configs:
+      try:
+        self.FLASH_MAX_WORKERS = max(1, int(configs['FLASH_MAX_WORKERS']))
+      except ValueError:
+        pass
+    # The file recording the images written to each device, kept in memory
+    # only if not set.
+    self.FLASH_RECORD_FILE = None
+    if configs and 'FLASH_RECORD_FILE' in configs:
+      self.FLASH_RECORD_FILE = configs['FLASH_RECORD_FILE']
+    self.flash_record = FlashRecord(self.FLASH_RECORD_FILE)
+    # The directory to cache the sparse images converted from raw images.
+    self.SPARSE_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'atft_sparse')
+    if configs and 'SPARSE_CACHE_DIR' in configs:
+      self.SPARSE_CACHE_DIR = configs['SPARSE_CACHE_DIR']
+    self.sparse_cache = SparseImageCache(self.SPARSE_CACHE_DIR)
+
     # The serial numbers for the devices that are at least seen twice.
     self.stable_serials = []
     # The serail numbers for the devices that are only seen once.
@@ -278,6 +846,8 @@ class AtftManager(object):
     self.target_devs = []
     # The product information for the selected product.
     self.product_info = None
+    # The list of FlashImage objects from the selected flash manifest.
+    self.flash_manifest = None
      # The atfa device manager.
     self._atfa_dev_manager = AtfaDeviceManager(self)
     # The fastboot controller.
@@ -288,7 +858,7 @@ class AtftManager(object):
     # objects.
     self._reboot_callbacks = {}
 
-    self._atfa_reboot_lock = threading.Lock()
+    self._atfa_reboot_lock = lockprofiler.Lock('_atfa_reboot_lock')
 
   def GetATFAKeysLeft(self):
     if not self.atfa_dev:
@@ -315,6 +885,7 @@ class AtftManager(object):
   def ProcessATFAKey(self):
     return self._atfa_dev_manager.ProcessKey()
 
+  @Traced()
   def ListDevices(self, sort_by=SORT_BY_LOCATION):
     """Get device list.
 
@@ -326,7 +897,9 @@ class AtftManager(object):
     """
     # ListDevices returns a list of USBHandles
     device_serials = self._fastboot_device_controller.ListDevices()
-    self.UpdateDevices(device_serials)
+    # Reading the status of new devices must not delay other operations.
+    with Priority(PRIORITY_MONITOR):
+      self.UpdateDevices(device_serials)
     self._HandleRebootCallbacks()
     self._SortTargetDevices(sort_by)
 
@@ -442,9 +1015,18 @@ class AtftManager(object):
 
     # Create new device object for newly added devices.
     self._serial_mapper.refresh_serial_map()
+    failure = None
     for serial in new_targets:
       if serial not in common_serials:
-        self._CreateNewTargetDevice(serial)
+        try:
+          self._CreateNewTargetDevice(serial)
+        except FastbootFailure as e:
+          # A hung or broken device must not block adding the other devices,
+          # it would be retried in the next refresh.
+          if not failure:
+            failure = e
+    if failure:
+      raise failure
 
   def _CreateNewTargetDevice(self, serial, check_status=True):
     """Create a new target device object.
@@ -501,7 +1083,7 @@ class AtftManager(object):
           # SetOs include a rebooting process, but the device would not
           # disappear from the device list immediately after the command.
           # We would check if the ATFA reappear after ATFA_REBOOT_TIMEOUT.
-          timer = threading.Timer(
+          timer = ScheduledTimer(
               self.ATFA_REBOOT_TIMEOUT, self._CheckAtfaSetOs)
           timer.start()
         except FastbootFailure:
@@ -557,15 +1139,9 @@ class AtftManager(object):
     Returns:
       A key-value map.
     """
-    state_map = {}
-    lines = state_string.splitlines()
-    for line in lines:
-      if line.startswith(BOOTLOADER_STRING):
-        key_value = re.split(r':[\s]*|=', line.replace(BOOTLOADER_STRING, ''))
-        if len(key_value) == 2:
-          state_map[key_value[0]] = key_value[1]
-    return state_map
+    return ParseStateString(state_string)
 
+  @Traced()
   def CheckProvisionStatus(self, target_dev):
     """Check whether the target device has been provisioned.
 
@@ -575,48 +1151,160 @@ class AtftManager(object):
     at_attest_uuid = target_dev.GetVar('at-attest-uuid')
     state_string = target_dev.GetVar('at-vboot-state')
 
-    target_dev.provision_status = ProvisionStatus.IDLE
-    target_dev.provision_state = ProvisionState()
+    (target_dev.provision_status,
+     target_dev.provision_state) = ParseProvisionState(at_attest_uuid,
+                                                       state_string)
 
-    status_set = False
+  def _ReadProvisionState(self, target_dev):
+    """Read the provision status and state without updating the device.
 
-    # TODO(shanyu): We only need empty string here
-    # NOT_PROVISIONED is for test purpose.
-    if at_attest_uuid and at_attest_uuid != 'NOT_PROVISIONED':
-      target_dev.provision_status = ProvisionStatus.PROVISION_SUCCESS
-      status_set = True
-      target_dev.provision_state.provisioned = True
+    Args:
+      target_dev: The target device (DeviceInfo).
+    Returns:
+      A (provision_status, ProvisionState) tuple.
+    """
+    with Priority(PRIORITY_MONITOR):
+      at_attest_uuid = target_dev.GetVar('at-attest-uuid')
+      state_string = target_dev.GetVar('at-vboot-state')
+    return ParseProvisionState(at_attest_uuid, state_string)
+
+  @Traced()
+  def AuditDevices(self, targets=None):
+    """Re-read the provision state of the target devices concurrently.
+
+    At most AUDIT_MAX_WORKERS devices are read at the same time. A device that
+    does not answer within AUDIT_TIMEOUT seconds after its read started is
+    reported as TIMEOUT. So is a device whose read could not start because
+    the workers are still blocked by hung devices once every group of
+    AUDIT_MAX_WORKERS reads had its AUDIT_TIMEOUT. The stored status of the
+    devices is not changed, a device whose state differs from the last seen
+    one is reported as MISMATCHED.
 
-    # state_string should be in format:
-    # (bootloader) bootloader-locked: 1
-    # (bootloader) bootloader-min-versions: -1,0,3
-    # (bootloader) avb-perm-attr-set: 1
-    # (bootloader) avb-locked: 0
-    # (bootloader) avb-unlock-disabled: 0
-    # (bootloader) avb-min-versions: 0:1,1:1,2:1,4097 :2,4098:2
-    if not state_string:
-      return
-    state_map = self._ParseStateString(state_string)
-    if state_map.get('avb-locked') and state_map['avb-locked'] == '1':
-      if not status_set:
-        target_dev.provision_status = ProvisionStatus.LOCKAVB_SUCCESS
-        status_set = True
-      target_dev.provision_state.avb_locked = True
-
-    if (state_map.get('avb-perm-attr-set') and
-        state_map['avb-perm-attr-set'] == '1'):
-      if not status_set:
-        target_dev.provision_status = ProvisionStatus.FUSEATTR_SUCCESS
-        status_set = True
-      target_dev.provision_state.avb_perm_attr_set = True
-
-    if (state_map.get('bootloader-locked') and
-        state_map['bootloader-locked'] == '1'):
-      if not status_set:
-        target_dev.provision_status = ProvisionStatus.FUSEVBOOT_SUCCESS
-      target_dev.provision_state.bootloader_locked = True
+    Args:
+      targets: The target devices to audit, all target devices if None.
+    Returns:
+      An AuditReport with one result per device in the order of targets.
+    """
+    if targets is None:
+      targets = self.target_devs[:]
+    start_time = time.time()
+    results = []
+    to_read = []
+    for target in targets:
+      if target.provision_status == ProvisionStatus.REBOOT_ING:
+        results.append(AuditResult(target, AuditCategory.REBOOTING))
+        continue
+      results.append(None)
+      to_read.append((len(results) - 1, target))
+
+    if not to_read:
+      return AuditReport(results, start_time, time.time() - start_time)
+
+    workers = min(self.AUDIT_MAX_WORKERS, len(to_read))
+    pool = WorkerPool(workers, 'AuditWorker')
+    # The reads still queued after this are stuck behind hung devices.
+    start_deadline = start_time + self.AUDIT_TIMEOUT * (
+        (len(to_read) + workers - 1) / workers)
+    # Set once the audit returns, so that the reads starting later on do not
+    # touch the devices any more.
+    abandoned = threading.Event()
+    pending = []
+    # Spread the reads across the USB buses.
+    for (index, target) in OrderByBus(to_read, lambda entry: entry[1].location):
+      task = pool.Submit(self._AuditRead, target, abandoned)
+      pending.append((index, target, task))
+
+    try:
+      for (index, target, task) in pending:
+        if not task.WaitStarted(max(0, start_deadline - time.time())):
+          results[index] = AuditResult(
+              target, AuditCategory.TIMEOUT,
+              error='Not read in %.1f seconds, the audit workers are blocked'
+              % (start_deadline - start_time))
+          continue
+        remaining = self.AUDIT_TIMEOUT - (time.time() - task.start_time)
+        if not task.Wait(max(0, remaining)):
+          results[index] = AuditResult(
+              target, AuditCategory.TIMEOUT,
+              error='No response in %.1f seconds' % self.AUDIT_TIMEOUT)
+          continue
+        duration = task.end_time - task.start_time
+        try:
+          (_, provision_state) = task.Result()
+        except Exception as e:  # pylint: disable=broad-except
+          # One bad device must not lose the results of the others.
+          results[index] = AuditResult(
+              target, AuditCategory.FAILED, error=str(e), duration=duration)
+          continue
+        category = AuditCategory.FromState(provision_state)
+        if provision_state != target.provision_state:
+          category = AuditCategory.MISMATCHED
+        results[index] = AuditResult(target, category, provision_state,
+                                     duration=duration)
+    finally:
+      abandoned.set()
+      # Workers blocked on a hung device exit once the command returns.
+      pool.Shutdown()
+    return AuditReport(results, start_time, time.time() - start_time)
+
+  def _AuditRead(self, target, abandoned):
+    """Read the provision state of a device for an audit.
+
+    Args:
+      target: The target device.
+      abandoned: The event set once the audit no longer waits for the result.
+    Returns:
+      The (provision_status, ProvisionState) tuple, None if abandoned.
+    """
+    if abandoned.is_set():
+      return None
+    return self._ReadProvisionState(target)
+
+  def _Upload(self, device, file_path):
+    """Pull a file from a device once its USB hub allows another transfer.
+
+    Args:
+      device: The device to pull from.
+      file_path: The local file path to store the file.
+    """
+    with self._TransferSlot(device):
+      device.Upload(file_path)
 
+  def _Download(self, device, file_path):
+    """Push a file to a device once its USB hub allows another transfer.
 
+    Args:
+      device: The device to push to.
+      file_path: The local file path of the file.
+    """
+    with self._TransferSlot(device):
+      device.Download(file_path)
+
+  @contextlib.contextmanager
+  def _TransferSlot(self, device):
+    """Hold a device and then a USB transfer slot for it.
+
+    The device always comes before the slot, as in Provision which holds both
+    devices before TransferContent takes any slot. Taking the slot first could
+    deadlock against a provision waiting for that slot while holding the
+    device.
+
+    Args:
+      device: The DeviceInfo to transfer with.
+    Yields:
+      None, with the device and the slot held.
+    """
+    session = getattr(device, 'Session', None)
+    if session is None:
+      # Plain controllers without a location are only limited in total.
+      with self.transfer_scheduler.Transfer(None):
+        yield
+      return
+    with session(GetPriority()):
+      with self.transfer_scheduler.Transfer(device.location):
+        yield
+
+  @Traced()
   def TransferContent(self, src, dst):
     """Transfer content from a device to another device.
 
@@ -633,9 +1321,9 @@ class AtftManager(object):
     tmp_file_name = str(uuid.uuid1())
     file_path = os.path.join(tmp_folder, tmp_file_name)
     # pull file to local fs
-    src.Upload(file_path)
+    self._Upload(src, file_path)
     # push file to fastboot device
-    dst.Download(file_path)
+    self._Download(dst, file_path)
     # delete the temperate file afterwards
     if os.path.exists(file_path):
       os.remove(file_path)
@@ -643,6 +1331,150 @@ class AtftManager(object):
     if os.path.exists(tmp_folder):
       os.rmdir(tmp_folder)
 
+  def NeedsFlash(self, target, manifest=None):
+    """Check whether any image in the flash manifest is not on the device.
+
+    Args:
+      target: The target device.
+      manifest: The list of FlashImage objects, the selected manifest if None.
+    Returns:
+      Whether at least one partition needs to be flashed.
+    """
+    if manifest is None:
+      manifest = self.flash_manifest or []
+    for image in manifest:
+      if not self.flash_record.IsFlashed(target.serial_number, image):
+        return True
+    return False
+
+  def _GetMaxDownloadSize(self, target):
+    """Get the largest payload the device accepts in one download.
+
+    Args:
+      target: The target device.
+    Returns:
+      The size in bytes, None if the device does not tell.
+    """
+    try:
+      return int(str(target.GetVar('max-download-size')).strip(), 0)
+    except (FastbootFailure, TypeError, ValueError):
+      return None
+
+  @Traced()
+  def FlashTarget(self, target, manifest=None, progress_callback=None):
+    """Flash the images in a flash manifest to a target device.
+
+    Partitions whose image is recorded as already written to the device are
+    skipped. A raw image is sent as sparse images if that makes it smaller or
+    if it exceeds the max-download-size of the device. Each file is pushed
+    once the USB hub of the device allows another transfer.
+
+    Args:
+      target: The target device to be flashed.
+      manifest: The list of FlashImage objects, the selected manifest if None.
+      progress_callback: The function called with (target, partition, done,
+        total) after each partition is flashed or skipped.
+    Raises:
+      FlashManifestFormatError: If no manifest is selected.
+      FastbootFailure: If flashing a partition fails.
+    """
+    if manifest is None:
+      manifest = self.flash_manifest
+    if manifest is None:
+      raise FlashManifestFormatError('No flash manifest selected!')
+    # The flash is shown while it runs, but the provisioning status is kept.
+    previous_status = target.provision_status
+    try:
+      target.provision_status = ProvisionStatus.FLASH_ING
+      total = len(manifest)
+      max_download_size = None
+      max_download_size_read = False
+      for (done, image) in enumerate(manifest, 1):
+        if not self.flash_record.IsFlashed(target.serial_number, image):
+          if not max_download_size_read:
+            max_download_size = self._GetMaxDownloadSize(target)
+            max_download_size_read = True
+          try:
+            file_paths = self.sparse_cache.GetFlashFiles(
+                image.file_path, image.digest, max_download_size)
+          except (IOError, OSError, ValueError):
+            # Let fastboot handle the raw image if it cannot be converted.
+            file_paths = [image.file_path]
+          for file_path in file_paths:
+            with self._TransferSlot(target):
+              target.Flash(image.partition, file_path)
+          self.flash_record.Add(target.serial_number, image)
+        if progress_callback is not None:
+          progress_callback(target, image.partition, done, total)
+    finally:
+      target.provision_status = previous_status
+
+  @Traced()
+  def FlashImages(self, targets, manifest=None, progress_callback=None):
+    """Flash the images in a flash manifest to target devices concurrently.
+
+    At most FLASH_MAX_WORKERS devices are flashed at the same time, and the
+    devices are started in an order spread across the USB buses.
+
+    Args:
+      targets: The target devices to be flashed.
+      manifest: The list of FlashImage objects, the selected manifest if None.
+      progress_callback: Passed to FlashTarget.
+    Returns:
+      A map from the serial number to the exception for the devices that
+      failed. Empty if all succeeded.
+    """
+    if not targets:
+      return {}
+    pool = WorkerPool(min(self.FLASH_MAX_WORKERS, len(targets)), 'FlashWorker')
+    tasks = []
+    for target in OrderByBus(targets, lambda target: target.location):
+      tasks.append((target, pool.Submit(
+          self.FlashTarget, target, manifest, progress_callback)))
+    errors = {}
+    for (target, task) in tasks:
+      task.Wait()
+      try:
+        task.Result()
+      except Exception as e:  # pylint: disable=broad-except
+        errors[target.serial_number] = e
+    pool.Shutdown()
+    return errors
+
+  def GetCommandStats(self):
+    """Get the device command queue statistics of all devices for monitoring.
+
+    Returns:
+      A map with the total number of 'coalesced' commands and 'wait', a map
+      from priority to the 'count', 'avg_wait' and 'max_wait' in seconds of
+      the commands, combined over the ATFA and the target devices.
+    """
+    coalesced = 0
+    totals = dict((priority, [0, 0.0, 0.0]) for priority in PRIORITIES)
+    devices = self.target_devs[:]
+    if self.atfa_dev:
+      devices.append(self.atfa_dev)
+    for device in devices:
+      stats = device.GetCommandStats()
+      coalesced += stats['coalesced']
+      for (priority, wait) in stats['wait'].iteritems():
+        total = totals[priority]
+        total[0] += wait['count']
+        total[1] += wait['avg_wait'] * wait['count']
+        total[2] = max(total[2], wait['max_wait'])
+    return {
+        'coalesced': coalesced,
+        'wait': dict(
+            (priority, {'count': count,
+                        'avg_wait': total_wait / count if count else 0.0,
+                        'max_wait': max_wait})
+            for (priority, (count, total_wait, max_wait)) in totals.iteritems())
+    }
+
+  def HasPendingReboots(self):
+    """Whether any device is rebooting and waiting to come back."""
+    return bool(self._reboot_callbacks)
+
   def GetTargetDevice(self, serial):
     """Get the target DeviceInfo object according to the serial number.
 
@@ -657,6 +1489,7 @@ class AtftManager(object):
 
     return None
 
+  @Traced()
   def Provision(self, target):
     """Provision the key to the target device.
 
@@ -676,30 +1509,35 @@ class AtftManager(object):
       target.provision_status = ProvisionStatus.PROVISION_ING
       atfa = self.atfa_dev
       AtftManager.CheckDevice(atfa)
-      # Set the ATFA's time first.
-      self._atfa_dev_manager.SetTime()
-      algorithm_list = self._GetAlgorithmList(target)
-      algorithm = self._ChooseAlgorithm(algorithm_list)
-      # First half of the DH key exchange
-      atfa.Oem('atfa-start-provisioning ' + str(algorithm))
-      self.TransferContent(atfa, target)
-      # Second half of the DH key exchange
-      target.Oem('at-get-ca-request')
-      self.TransferContent(target, atfa)
-      # Encrypt and transfer key bundle
-      atfa.Oem('atfa-finish-provisioning')
-      self.TransferContent(atfa, target)
-      # Provision the key on device
-      target.Oem('at-set-ca-response')
-
-      # After a success provision, the status should be updated.
-      self.CheckProvisionStatus(target)
+      # Hold both devices for the whole handshake so that no status read or
+      # other operation gets in between its steps. The target is always
+      # taken before the ATFA so that concurrent handshakes can not deadlock.
+      with target.Session(PRIORITY_CRITICAL), atfa.Session(PRIORITY_CRITICAL):
+        # Set the ATFA's time first.
+        self._atfa_dev_manager.SetTime()
+        algorithm_list = self._GetAlgorithmList(target)
+        algorithm = self._ChooseAlgorithm(algorithm_list)
+        # First half of the DH key exchange
+        atfa.Oem('atfa-start-provisioning ' + str(algorithm))
+        self.TransferContent(atfa, target)
+        # Second half of the DH key exchange
+        target.Oem('at-get-ca-request')
+        self.TransferContent(target, atfa)
+        # Encrypt and transfer key bundle
+        atfa.Oem('atfa-finish-provisioning')
+        self.TransferContent(atfa, target)
+        # Provision the key on device
+        target.Oem('at-set-ca-response')
+
+        # After a success provision, the status should be updated.
+        self.CheckProvisionStatus(target)
       if not target.provision_state.provisioned:
         raise FastbootFailure('Status not updated.')
     except (FastbootFailure, DeviceNotFoundException) as e:
       target.provision_status = ProvisionStatus.PROVISION_FAILED
       raise e
 
+  @Traced()
   def FuseVbootKey(self, target):
     """Fuse the verified boot key to the target device.
 
@@ -717,7 +1555,7 @@ class AtftManager(object):
       temp_file.write(self.product_info.vboot_key)
       temp_file.close()
       temp_file_name = temp_file.name
-      target.Download(temp_file_name)
+      self._Download(target, temp_file_name)
       # Delete the temporary file.
       os.remove(temp_file_name)
       target.Oem('fuse at-bootloader-vboot-key')
@@ -734,6 +1572,7 @@ class AtftManager(object):
       target.provision_status = ProvisionStatus.FUSEVBOOT_FAILED
       raise e
 
+  @Traced()
   def FusePermAttr(self, target):
     """Fuse the permanent attributes to the target device.
 
@@ -749,7 +1588,7 @@ class AtftManager(object):
       temp_file.write(self.product_info.product_attributes)
       temp_file.close()
       temp_file_name = temp_file.name
-      target.Download(temp_file_name)
+      self._Download(target, temp_file_name)
       os.remove(temp_file_name)
       target.Oem('fuse at-perm-attr')
 
@@ -761,6 +1600,7 @@ class AtftManager(object):
       target.provision_status = ProvisionStatus.FUSEATTR_FAILED
       raise e
 
+  @Traced()
   def LockAvb(self, target):
     """Lock the android verified boot for the target.
 
@@ -777,6 +1617,58 @@ class AtftManager(object):
       target.provision_status = ProvisionStatus.LOCKAVB_FAILED
       raise e
 
+  @Traced()
+  def ProvisionAll(self, target):
+    """Run all the remaining provision steps without rebooting in between.
+
+    The bootloader vboot key and the permanent attributes are fused back to
+    back, the android verified boot is locked and the attestation key is
+    provisioned. Steps already done on the device are skipped. The result
+    should be verified with VerifyProvisionState after one reboot.
+
+    Args:
+      target: The target device.
+    Raises:
+      ProductNotSpecifiedException: If no product is selected.
+      DeviceNotFoundException: If the ATFA device is not available.
+      FastbootFailure: If any step fails. The status of the device is set to
+        the failed status of that step.
+    """
+    if not target.provision_state.bootloader_locked:
+      self.FuseVbootKey(target)
+    if not target.provision_state.avb_perm_attr_set:
+      self.FusePermAttr(target)
+    if not target.provision_state.avb_locked:
+      self.LockAvb(target)
+    if not target.provision_state.provisioned:
+      self.Provision(target)
+
+  @Traced()
+  def VerifyProvisionState(self, target):
+    """Verify that all the provision steps are in effect after a reboot.
+
+    Args:
+      target: The target device.
+    Raises:
+      FastbootFailure: If a step is not in effect. The status of the device is
+        set to the failed status of the first such step.
+    """
+    self.CheckProvisionStatus(target)
+    state = target.provision_state
+    for (done, failed_status, step) in (
+        (state.bootloader_locked, ProvisionStatus.FUSEVBOOT_FAILED,
+         'Bootloader vboot key'),
+        (state.avb_perm_attr_set, ProvisionStatus.FUSEATTR_FAILED,
+         'Permanent attributes'),
+        (state.avb_locked, ProvisionStatus.LOCKAVB_FAILED,
+         'Android verified boot lock'),
+        (state.provisioned, ProvisionStatus.PROVISION_FAILED,
+         'Attestation key')):
+      if not done:
+        target.provision_status = failed_status
+        raise FastbootFailure(step + ' not in effect after reboot.')
+
+  @Traced()
   def Reboot(self, target, timeout, success_callback, timeout_callback):
     """Reboot the target device.
 
@@ -831,6 +1723,12 @@ class AtftManager(object):
       An extended callback function.
     """
     def RebootCallbackFunc(callback=callback, serial=serial, success=success):
+      tracer = GetTracer()
+      if tracer:
+        tracer.AddSpan('Rebooting', CATEGORY_COMMAND,
+                       self._reboot_callbacks[serial].start_time, time.time(),
+                       serial, {'success': success}, on_thread=False,
+                       on_device=True)
       try:
         rebooting_dev = self.GetTargetDevice(serial)
         if rebooting_dev:
@@ -945,6 +1843,41 @@ class AtftManager(object):
     self.product_info = ProductInfo(product_id, product_name, attribute_array,
                                     vboot_key_array)
 
+  def ProcessFlashManifestFile(self, content, base_dir):
+    """Process the flash manifest file.
+
+    The file maps each partition to its image file, flashed in file order:
+      {
+        "PARTITION": "IMAGE FILE PATH",
+        ...
+      }
+    A relative image path is relative to base_dir. The SHA-256 digest of each
+    image is computed once here.
+
+    Args:
+      content: The content of the flash manifest file.
+      base_dir: The directory containing the manifest file.
+    Raises:
+      FlashManifestFormatError: When the file format is wrong.
+    """
+    try:
+      file_object = json.loads(
+          content, object_pairs_hook=collections.OrderedDict)
+    except ValueError:
+      raise FlashManifestFormatError('Wrong JSON format!')
+    if not isinstance(file_object, dict) or not file_object:
+      raise FlashManifestFormatError('No partition in flash manifest!')
+    manifest = []
+    for (partition, image_path) in file_object.iteritems():
+      if not partition or not isinstance(image_path, basestring):
+        raise FlashManifestFormatError(
+            'Wrong image entry for partition: ' + partition)
+      image_path = os.path.join(base_dir, image_path)
+      if not os.path.isfile(image_path):
+        raise FlashManifestFormatError('Image file not found: ' + image_path)
+      manifest.append(FlashImage(partition, image_path))
+    self.flash_manifest = manifest
+
   def _ByteToHex(self, byte_array):
     """Transform a byte array into a hex string."""
     return ''.join('{:02x}'.format(x) for x in byte_array)
@@ -1037,8 +1970,10 @@ class AtfaDeviceManager(object):
     AtftManager.CheckDevice(self.atft_manager.atfa_dev)
     # -1 means some error happens.
     self.atft_manager.atfa_dev.keys_left = -1
-    out = self.atft_manager.atfa_dev.Oem(
-        'num-keys ' + self.atft_manager.product_info.product_id, True)
+    # The key count query waits for any provisioning handshake on the ATFA.
+    with Priority(PRIORITY_MONITOR):
+      out = self.atft_manager.atfa_dev.Oem(
+          'num-keys ' + self.atft_manager.product_info.product_id, True)
     # Note: use splitlines instead of split('\n') to prevent '\r\n' problem on
     # windows.
     for line in out.splitlines():
@@ -14,16 +14,25 @@
 
 """Unit test for atft manager."""
 import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 import atftman
 
+from atftman import AuditCategory
 from atftman import EncryptionAlgorithm
 from atftman import ProductInfo
 from atftman import ProvisionState
 from atftman import ProvisionStatus
 from fastboot_exceptions import DeviceNotFoundException
 from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import FastbootTimeout
+from fastboot_exceptions import FlashManifestFormatError
 from fastboot_exceptions import NoAlgorithmAvailableException
 from fastboot_exceptions import ProductAttributesFileFormatError
 from fastboot_exceptions import ProductNotSpecifiedException
@@ -113,7 +122,7 @@ class AtftManTest(unittest.TestCase):
   def MockCreateInstantTimer(self, timeout, callback):
     return self.MockInstantTimer(timeout, callback)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
   def testListDevicesNormal(self, mock_list_devices, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
@@ -133,7 +142,27 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(True, atft_manager._atfa_reboot_lock.acquire(False))
     atft_manager._SetOs.assert_not_called()
 
-  @patch('threading.Timer')
+  @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
+  def testListDevicesTargetTimeout(self, mock_list_devices):
+    self.mock_serial_instance.get_location.return_value = self.TEST_LOCATION
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    def MockCheckProvisionStatus(target_dev):
+      if target_dev.serial_number == self.TEST_SERIAL:
+        raise FastbootTimeout('getvar', 10)
+    atft_manager.CheckProvisionStatus = MagicMock()
+    atft_manager.CheckProvisionStatus.side_effect = MockCheckProvisionStatus
+    mock_list_devices.return_value = [self.TEST_SERIAL, self.TEST_SERIAL2]
+    atft_manager.ListDevices()
+    with self.assertRaises(FastbootTimeout):
+      atft_manager.ListDevices()
+    # The hung device must not prevent the other device from being added.
+    self.assertEqual(1, len(atft_manager.target_devs))
+    self.assertEqual(self.TEST_SERIAL2,
+                     atft_manager.target_devs[0].serial_number)
+    self.assertEqual([self.TEST_SERIAL2], atft_manager.stable_serials)
+
+  @patch('atftman.ScheduledTimer')
   @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
   def testListDevicesNormalSetOs(self, mock_list_devices, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
@@ -150,7 +179,7 @@ class AtftManTest(unittest.TestCase):
         atft_manager.atfa_dev, 'Windows')
     self.assertEqual(atft_manager.atfa_dev.serial_number, self.ATFA_TEST_SERIAL)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
   def testListDevicesATFA(self, mock_list_devices, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
@@ -164,7 +193,7 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(atft_manager.atfa_dev.serial_number, self.ATFA_TEST_SERIAL)
     self.assertEqual(0, len(atft_manager.target_devs))
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
   def testListDevicesTarget(self, mock_list_devices, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
@@ -180,7 +209,7 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(atft_manager.target_devs[0].serial_number,
                      self.TEST_SERIAL)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   @patch('__main__.AtftManTest.FastbootDeviceTemplate.ListDevices')
   def testListDevicesMultipleTargets(self, mock_list_devices, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
@@ -198,7 +227,7 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(atft_manager.target_devs[1].serial_number,
                      self.TEST_SERIAL2)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesChangeNorm(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -219,7 +248,7 @@ class AtftManTest(unittest.TestCase):
                      self.TEST_SERIAL)
     self.assertEqual(2, mock_fastboot.call_count)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesChangeAdd(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -242,7 +271,7 @@ class AtftManTest(unittest.TestCase):
                      self.TEST_SERIAL)
     self.assertEqual(2, mock_fastboot.call_count)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesChangeAddATFA(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -265,7 +294,7 @@ class AtftManTest(unittest.TestCase):
                      self.TEST_SERIAL)
     self.assertEqual(2, mock_fastboot.call_count)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesChangeCommon(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -292,7 +321,7 @@ class AtftManTest(unittest.TestCase):
                      self.TEST_SERIAL2)
     self.assertEqual(3, mock_fastboot.call_count)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesChangeCommonATFA(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -320,7 +349,7 @@ class AtftManTest(unittest.TestCase):
                      self.TEST_SERIAL2)
     self.assertEqual(3, mock_fastboot.call_count)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesRemoveATFA(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -341,7 +370,7 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(atft_manager.target_devs[0].serial_number,
                      self.TEST_SERIAL)
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesRemoveDevice(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -360,7 +389,7 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(atft_manager.atfa_dev.serial_number, self.ATFA_TEST_SERIAL)
     self.assertEqual(0, len(atft_manager.target_devs))
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesPendingRemove(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -374,7 +403,7 @@ class AtftManTest(unittest.TestCase):
     # Just appear once, should not be in target device list.
     self.assertEqual(0, len(atft_manager.target_devs))
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesPendingAdd(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -394,7 +423,7 @@ class AtftManTest(unittest.TestCase):
     atft_manager.ListDevices()
     self.assertEqual(1, len(atft_manager.target_devs))
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesPendingTemp(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_fastboot = MagicMock()
@@ -422,7 +451,7 @@ class AtftManTest(unittest.TestCase):
       return self.serial_map[serial_lower]
     return None
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testListDevicesLocation(self, mock_create_timer):
     mock_create_timer.side_effect = self.MockCreateInstantTimer
     mock_serial_mapper = MagicMock()
@@ -582,6 +611,47 @@ class AtftManTest(unittest.TestCase):
     # we should have no temporary file at the end
     self.assertTrue(not files)
 
+  def testTransferContentTransferLimits(self):
+    self.configs['TRANSFER_MAX_PER_HUB'] = '1'
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    self.assertEqual(1, atft_manager.transfer_scheduler.max_per_hub)
+    self.assertEqual(4, atft_manager.transfer_scheduler.max_per_root_port)
+    atft_manager.transfer_scheduler = MagicMock()
+    src = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL, '1-1.1')
+    dst = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL2, '1-1.2')
+    atft_manager.TransferContent(src, dst)
+    atft_manager.transfer_scheduler.Transfer.assert_has_calls(
+        [call('1-1.1'), call().__enter__(), call().__exit__(None, None, None),
+         call('1-1.2'), call().__enter__(), call().__exit__(None, None, None)])
+
+  def testTransferSlotAfterDevice(self):
+    self.configs['TRANSFER_MAX_PER_HUB'] = '1'
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    held_controller = MagicMock()
+    other_controller = MagicMock()
+    held = atftman.DeviceInfo(held_controller, self.TEST_SERIAL, '1-1.1')
+    other = atftman.DeviceInfo(other_controller, self.TEST_SERIAL2, '1-1.2')
+    waiting = threading.Thread(
+        target=atft_manager._Download, args=(held, 'file'))
+    waiting.daemon = True
+    with held.Session(atftman.PRIORITY_CRITICAL):
+      waiting.start()
+      time.sleep(0.05)
+      # The download waiting for the held device must not hold the only slot.
+      passing = threading.Thread(
+          target=atft_manager._Download, args=(other, 'file'))
+      passing.daemon = True
+      passing.start()
+      passing.join(5)
+      self.assertFalse(passing.is_alive())
+      other_controller.Download.assert_called_once_with('file')
+      held_controller.Download.assert_not_called()
+    waiting.join(5)
+    self.assertFalse(waiting.is_alive())
+    held_controller.Download.assert_called_once_with('file')
+
   # Test AtftManager._ChooseAlgorithm
   def testChooseAlgorithm(self):
     atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
@@ -655,6 +725,39 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(test_device3, test_device1)
     self.assertNotEqual(test_device3, test_device2)
 
+  # Test DeviceInfo.Snapshot
+  def testDeviceInfoSnapshot(self):
+    test_device = atftman.DeviceInfo(None, self.TEST_SERIAL,
+                                     self.TEST_LOCATION)
+    snapshot = test_device.Snapshot()
+    self.assertEqual(snapshot, test_device.Snapshot())
+    self.assertEqual(str(test_device), str(snapshot))
+    test_device.provision_state.avb_locked = True
+    self.assertNotEqual(snapshot, test_device.Snapshot())
+    self.assertFalse(
+        ProvisionState.FromFlags(snapshot.provision_flags).avb_locked)
+    test_device.provision_status = ProvisionStatus.LOCKAVB_SUCCESS
+    self.assertEqual(ProvisionStatus.IDLE, snapshot.provision_status)
+    with self.assertRaises(AttributeError):
+      snapshot.provision_status = ProvisionStatus.LOCKAVB_SUCCESS
+    # Every device has its own provision state.
+    self.assertFalse(atftman.DeviceInfo(
+        None, self.TEST_SERIAL2).provision_state.avb_locked)
+
+  # Test ProvisionState flags
+  def testProvisionStateFlags(self):
+    state = ProvisionState(bootloader_locked=True, provisioned=True)
+    self.assertEqual(
+        [True, False, False, True],
+        [getattr(state, field) for field in ProvisionState.FIELDS])
+    state.provisioned = False
+    state.avb_locked = True
+    self.assertEqual(
+        ProvisionState(bootloader_locked=True, avb_locked=True), state)
+    self.assertNotEqual(ProvisionState(), state)
+    with self.assertRaises(AttributeError):
+      state.avb_unlock_disabled = True
+
   # Test AtfaDeviceManager.CheckStatus
   def testCheckStatus(self):
     atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
@@ -919,6 +1022,185 @@ class AtftManTest(unittest.TestCase):
     self.assertEqual(ProvisionStatus.PROVISION_SUCCESS,
                      mock_device.provision_status)
 
+  # Test atftman.ParseProvisionStates
+  def testParseProvisionStates(self):
+    state_all_set = (
+      '(bootloader) bootloader-locked: 1\r\n'
+      '(bootloader) bootloader-min-versions: -1,0,3\r\n'
+      '(bootloader) avb-perm-attr-set=1\r\n'
+      '(bootloader) avb-locked:\t1\r\n'
+      '(bootloader) avb-unlock-disabled: 0\r\n'
+      '(bootloader) avb-min-versions: 0:1,1:1,2:1,4097 :2,4098:2\r\n')
+    state_attr_set = (
+      '(bootloader) bootloader-locked: 1\n'
+      '(bootloader) avb-perm-attr-set: 1\n'
+      '(bootloader) avb-locked: 0\n')
+    results = atftman.ParseProvisionStates([
+        (self.TEST_UUID, state_all_set),
+        ('', state_attr_set),
+        ('NOT_PROVISIONED', ''),
+        ('', 'bootloader-locked: 1\n(bootloader) avb-locked:\n')])
+    self.assertEqual(4, len(results))
+    (status, state) = results[0]
+    self.assertEqual(ProvisionStatus.PROVISION_SUCCESS, status)
+    self.assertEqual(True, state.bootloader_locked)
+    self.assertEqual(True, state.avb_perm_attr_set)
+    self.assertEqual(True, state.avb_locked)
+    self.assertEqual(True, state.provisioned)
+    (status, state) = results[1]
+    self.assertEqual(ProvisionStatus.FUSEATTR_SUCCESS, status)
+    self.assertEqual(True, state.bootloader_locked)
+    self.assertEqual(True, state.avb_perm_attr_set)
+    self.assertEqual(False, state.avb_locked)
+    self.assertEqual(False, state.provisioned)
+    (status, state) = results[2]
+    self.assertEqual(ProvisionStatus.IDLE, status)
+    self.assertEqual(False, state.provisioned)
+    (status, state) = results[3]
+    self.assertEqual(ProvisionStatus.IDLE, status)
+    self.assertEqual(False, state.bootloader_locked)
+    self.assertEqual(False, state.avb_locked)
+
+  def testParseStateStringSkipMultipleSeparators(self):
+    state_map = atftman.ParseStateString(
+      '(bootloader) avb-locked: 1\n'
+      '(bootloader) avb-min-versions: 0:1,1:1\n'
+      '(bootloader) avb-unlock-disabled:\n'
+      'avb-perm-attr-set: 1\n')
+    self.assertEqual({'avb-locked': '1', 'avb-unlock-disabled': ''}, state_map)
+
+  # Test AtftManager.AuditDevices
+  def MockAuditDevice(self, serial, uuid, vboot_state):
+    mock_device = MagicMock()
+    mock_device.serial_number = serial
+    mock_device.location = 'location-' + serial
+    mock_device.provision_status = ProvisionStatus.IDLE
+    mock_device.provision_state = ProvisionState()
+    status_map = {'at-attest-uuid': uuid, 'at-vboot-state': vboot_state}
+    mock_device.GetVar.side_effect = lambda variable: status_map[variable]
+    return mock_device
+
+  def testAuditDevices(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    unfused = self.MockAuditDevice('s1', '', '(bootloader) avb-locked: 0\n')
+    provisioned = self.MockAuditDevice(
+        's2', self.TEST_UUID, '(bootloader) avb-locked: 1\n'
+        '(bootloader) avb-perm-attr-set: 1\n'
+        '(bootloader) bootloader-locked: 1\n')
+    provisioned.provision_status = ProvisionStatus.PROVISION_SUCCESS
+    provisioned.provision_state = ProvisionState(True, True, True, True)
+    mismatched = self.MockAuditDevice('s3', '', '(bootloader) avb-locked: 1\n')
+    rebooting = self.MockAuditDevice('s4', '', '')
+    rebooting.provision_status = ProvisionStatus.REBOOT_ING
+    failed = self.MockAuditDevice('s5', '', '')
+    failed.GetVar.side_effect = FastbootFailure('error')
+    atft_manager.target_devs = [
+        unfused, provisioned, mismatched, rebooting, failed]
+
+    report = atft_manager.AuditDevices()
+    self.assertEqual(
+        [AuditCategory.UNFUSED, AuditCategory.PROVISIONED,
+         AuditCategory.MISMATCHED, AuditCategory.REBOOTING,
+         AuditCategory.FAILED],
+        [result.category for result in report.results])
+    self.assertEqual(['s1', 's2', 's3', 's4', 's5'],
+                     [result.serial_number for result in report.results])
+    self.assertEqual('error', report.results[4].error)
+    self.assertTrue(report.results[2].provision_state.avb_locked)
+    rebooting.GetVar.assert_not_called()
+    # The audit must not change the stored device state.
+    self.assertEqual(ProvisionStatus.IDLE, mismatched.provision_status)
+    self.assertFalse(mismatched.provision_state.avb_locked)
+    summary = report.Summary()
+    self.assertEqual(1, summary[AuditCategory.UNFUSED])
+    self.assertEqual(0, summary[AuditCategory.LOCKED])
+
+  def testAuditDevicesTimeout(self):
+    self.configs['AUDIT_TIMEOUT'] = '0.05'
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    hang = threading.Event()
+    hung_device = self.MockAuditDevice('s1', '', '')
+    hung_device.GetVar.side_effect = lambda variable: hang.wait()
+    normal_device = self.MockAuditDevice('s2', '', '')
+    try:
+      report = atft_manager.AuditDevices([hung_device, normal_device])
+    finally:
+      hang.set()
+    self.assertEqual(AuditCategory.TIMEOUT, report.results[0].category)
+    self.assertEqual(AuditCategory.UNFUSED, report.results[1].category)
+
+  def testAuditDevicesTimeoutWorkersBlocked(self):
+    self.configs['AUDIT_TIMEOUT'] = '0.05'
+    self.configs['AUDIT_MAX_WORKERS'] = '1'
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    hang = threading.Event()
+    hung_device = self.MockAuditDevice('s1', '', '')
+    hung_device.GetVar.side_effect = lambda variable: hang.wait()
+    normal_device = self.MockAuditDevice('s2', '', '')
+    # The only worker is blocked by the hung device, the audit still returns.
+    report_holder = []
+    audit_thread = threading.Thread(
+        target=lambda: report_holder.append(
+            atft_manager.AuditDevices([hung_device, normal_device])))
+    audit_thread.start()
+    audit_thread.join(5)
+    try:
+      self.assertFalse(audit_thread.is_alive())
+    finally:
+      hang.set()
+    [report] = report_holder
+    self.assertEqual(AuditCategory.TIMEOUT, report.results[0].category)
+    self.assertEqual(AuditCategory.TIMEOUT, report.results[1].category)
+    self.assertIn('blocked', report.results[1].error)
+    # The read queued behind the hung device is dropped once it starts.
+    audit_thread.join()
+    time.sleep(0.05)
+    normal_device.GetVar.assert_not_called()
+
+  def testAuditDevicesUnexpectedError(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    broken_device = self.MockAuditDevice('s1', '', '')
+    broken_device.GetVar.side_effect = ValueError('unexpected output')
+    normal_device = self.MockAuditDevice(
+        's2', '', '(bootloader) avb-locked: 0\n')
+    shutdown = atftman.WorkerPool.Shutdown
+    with patch.object(atftman.WorkerPool, 'Shutdown', autospec=True,
+                      side_effect=shutdown) as mock_shutdown:
+      report = atft_manager.AuditDevices([broken_device, normal_device])
+    mock_shutdown.assert_called_once()
+    self.assertEqual(
+        [AuditCategory.FAILED, AuditCategory.UNFUSED],
+        [result.category for result in report.results])
+    self.assertEqual('unexpected output', report.results[0].error)
+
+  def testAuditReportWrite(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    report = atft_manager.AuditDevices(
+        [self.MockAuditDevice('s1', '', '(bootloader) avb-locked: 0\n')])
+    temp_dir = tempfile.mkdtemp()
+    try:
+      json_path = os.path.join(temp_dir, 'audit.json')
+      report.Write(json_path)
+      with open(json_path, 'r') as json_file:
+        content = json.load(json_file)
+      self.assertEqual('s1', content['devices'][0]['serial_number'])
+      self.assertEqual(1, content['summary'][AuditCategory.UNFUSED])
+      csv_path = os.path.join(temp_dir, 'audit.csv')
+      report.Write(csv_path)
+      with open(csv_path, 'r') as csv_file:
+        lines = csv_file.read().splitlines()
+      self.assertEqual(2, len(lines))
+      self.assertTrue(lines[1].startswith('s1,location-s1,unfused,'))
+      with self.assertRaises(ValueError):
+        report.Write(os.path.join(temp_dir, 'audit.txt'))
+    finally:
+      shutil.rmtree(temp_dir)
+
   # Test AtftManager.Provision
   def MockSetProvisionSuccess(self, target):
     target.provision_status = ProvisionStatus.PROVISION_SUCCESS
@@ -985,6 +1267,108 @@ class AtftManTest(unittest.TestCase):
     with self.assertRaises(FastbootFailure):
       atft_manager.Provision(mock_target)
 
+  def testProvisionHoldsDevices(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    target_controller = MagicMock()
+    target = atftman.DeviceInfo(target_controller, self.TEST_SERIAL)
+    atft_manager.atfa_dev = atftman.DeviceInfo(MagicMock(),
+                                               self.ATFA_TEST_SERIAL)
+    atft_manager._atfa_dev_manager = MagicMock()
+    atft_manager._GetAlgorithmList = MagicMock()
+    atft_manager._GetAlgorithmList.return_value = [
+        EncryptionAlgorithm.ALGORITHM_CURVE25519
+    ]
+    atft_manager.TransferContent = MagicMock()
+    atft_manager.CheckProvisionStatus = MagicMock()
+    atft_manager.CheckProvisionStatus.side_effect = self.MockSetProvisionSuccess
+    order = []
+    monitors = []
+
+    def MockOem(oem_command, err_to_out):
+      order.append(oem_command)
+      if oem_command == 'at-get-ca-request':
+        # A status read during the handshake waits until it is finished.
+        monitor = threading.Thread(
+            target=lambda: order.append(atft_manager._ReadProvisionState(
+                target)))
+        monitor.start()
+        monitors.append(monitor)
+        while target.GetCommandStats()['waiting'] < 1:
+          threading.Event().wait(0.001)
+
+    target_controller.Oem.side_effect = MockOem
+    target_controller.GetVar.return_value = ''
+    atft_manager.Provision(target)
+    monitors[0].join(5)
+    self.assertEqual(['at-get-ca-request', 'at-set-ca-response'], order[:2])
+    self.assertEqual(3, len(order))
+    self.assertEqual(
+        2, target.GetCommandStats()['wait'][atftman.PRIORITY_MONITOR]['count'])
+
+  # Test AtftManager.ProvisionAll
+  def testProvisionAll(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    steps = MagicMock()
+    atft_manager.FuseVbootKey = steps.FuseVbootKey
+    atft_manager.FusePermAttr = steps.FusePermAttr
+    atft_manager.LockAvb = steps.LockAvb
+    atft_manager.Provision = steps.Provision
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+    atft_manager.ProvisionAll(target)
+    steps.assert_has_calls(
+        [call.FuseVbootKey(target), call.FusePermAttr(target),
+         call.LockAvb(target), call.Provision(target)])
+
+  def testProvisionAllSkipStep(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    steps = MagicMock()
+    atft_manager.FuseVbootKey = steps.FuseVbootKey
+    atft_manager.FusePermAttr = steps.FusePermAttr
+    atft_manager.LockAvb = steps.LockAvb
+    atft_manager.Provision = steps.Provision
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+    target.provision_state.bootloader_locked = True
+    target.provision_state.avb_perm_attr_set = True
+    atft_manager.ProvisionAll(target)
+    self.assertEqual([call.LockAvb(target), call.Provision(target)],
+                     steps.mock_calls)
+
+  def testProvisionAllFail(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    atft_manager.FuseVbootKey = MagicMock()
+    atft_manager.FusePermAttr = MagicMock()
+    atft_manager.FusePermAttr.side_effect = FastbootFailure('')
+    atft_manager.LockAvb = MagicMock()
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+    with self.assertRaises(FastbootFailure):
+      atft_manager.ProvisionAll(target)
+    atft_manager.LockAvb.assert_not_called()
+
+  # Test AtftManager.VerifyProvisionState
+  def testVerifyProvisionState(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+
+    def MockCheckProvisionStatus(target, provisioned):
+      target.provision_state = ProvisionState(True, True, True, provisioned)
+
+    atft_manager.CheckProvisionStatus = MagicMock()
+    atft_manager.CheckProvisionStatus.side_effect = (
+        lambda target: MockCheckProvisionStatus(target, True))
+    atft_manager.VerifyProvisionState(target)
+
+    atft_manager.CheckProvisionStatus.side_effect = (
+        lambda target: MockCheckProvisionStatus(target, False))
+    with self.assertRaises(FastbootFailure):
+      atft_manager.VerifyProvisionState(target)
+    self.assertEqual(ProvisionStatus.PROVISION_FAILED,
+                     target.provision_status)
+
   # Test AtftManager.FuseVbootKey
   def MockSetFuseVbootSuccess(self, target):
     target.provision_status = ProvisionStatus.FUSEVBOOT_SUCCESS
@@ -1210,7 +1594,7 @@ class AtftManTest(unittest.TestCase):
     self.mock_timer_instance = self.MockTimer(interval, callback)
     return self.mock_timer_instance
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testRebootSuccess(self, mock_timer):
     self.mock_timer_instance = None
     atft_manager = atftman.AtftManager(
@@ -1252,7 +1636,7 @@ class AtftManTest(unittest.TestCase):
     mock_success.assert_called_once()
     mock_fail.assert_not_called()
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testRebootTimeout(self, mock_timer):
     self.mock_timer_instance = None
     atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
@@ -1282,7 +1666,7 @@ class AtftManTest(unittest.TestCase):
     mock_success.assert_not_called()
     mock_fail.assert_called_once()
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testRebootTimeoutBeforeRefresh(self, mock_timer):
     self.mock_timer_instance = None
     atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
@@ -1311,7 +1695,7 @@ class AtftManTest(unittest.TestCase):
     mock_success.assert_not_called()
     mock_fail.assert_called_once()
 
-  @patch('threading.Timer')
+  @patch('atftman.ScheduledTimer')
   def testRebootFailure(self, mock_timer):
     self.mock_timer_instance = None
     atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
@@ -1421,5 +1805,172 @@ class AtftManTest(unittest.TestCase):
     with self.assertRaises(ProductAttributesFileFormatError):
       atft_manager.ProcessProductAttributesFile(test_content)
 
+  # Test AtftManager.ProcessFlashManifestFile
+  def _CreateFlashImages(self):
+    image_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, image_dir)
+    for (name, data) in (('boot.img', 'boot'), ('system.img', 'system')):
+      with open(os.path.join(image_dir, name), 'wb') as image_file:
+        image_file.write(data)
+    return image_dir
+
+  def testProcessFlashManifestFile(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    image_dir = self._CreateFlashImages()
+    test_content = '{"system": "system.img", "boot": "boot.img"}'
+    atft_manager.ProcessFlashManifestFile(test_content, image_dir)
+    manifest = atft_manager.flash_manifest
+    self.assertEqual(['system', 'boot'],
+                     [image.partition for image in manifest])
+    self.assertEqual(os.path.join(image_dir, 'boot.img'), manifest[1].file_path)
+    self.assertEqual(
+        '4509beb0ab401d71fa4a5cd94a55c9a74f13332776ae4019c5bfc4c2005157ff',
+        manifest[1].digest)
+
+  def testProcessFlashManifestFileWrongJSON(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    with self.assertRaises(FlashManifestFormatError):
+      atft_manager.ProcessFlashManifestFile('{"boot": ', '.')
+    with self.assertRaises(FlashManifestFormatError):
+      atft_manager.ProcessFlashManifestFile('{}', '.')
+
+  def testProcessFlashManifestFileMissingImage(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    image_dir = self._CreateFlashImages()
+    with self.assertRaises(FlashManifestFormatError):
+      atft_manager.ProcessFlashManifestFile('{"vendor": "vendor.img"}',
+                                            image_dir)
+    self.assertEqual(None, atft_manager.flash_manifest)
+
+  # Test AtftManager.FlashTarget
+  def testFlashTarget(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    image_dir = self._CreateFlashImages()
+    atft_manager.ProcessFlashManifestFile(
+        '{"boot": "boot.img", "system": "system.img"}', image_dir)
+    atft_manager.transfer_scheduler = MagicMock()
+    mock_device = MagicMock()
+    target = atftman.DeviceInfo(mock_device, self.TEST_SERIAL, '1-1.1')
+    target.provision_status = ProvisionStatus.PROVISION_SUCCESS
+    flash_statuses = []
+    progress_callback = MagicMock(
+        side_effect=lambda *args: flash_statuses.append(
+            target.provision_status))
+    self.assertEqual(True, atft_manager.NeedsFlash(target))
+    atft_manager.FlashTarget(target, progress_callback=progress_callback)
+    mock_device.Flash.assert_has_calls(
+        [call('boot', os.path.join(image_dir, 'boot.img')),
+         call('system', os.path.join(image_dir, 'system.img'))])
+    atft_manager.transfer_scheduler.Transfer.assert_called_with('1-1.1')
+    progress_callback.assert_has_calls(
+        [call(target, 'boot', 1, 2), call(target, 'system', 2, 2)])
+    self.assertEqual([ProvisionStatus.FLASH_ING] * 2, flash_statuses)
+    # The provisioning status is kept once the images are flashed.
+    self.assertEqual(
+        ProvisionStatus.PROVISION_SUCCESS, target.provision_status)
+    self.assertEqual(False, atft_manager.NeedsFlash(target))
+
+    # Already written images are skipped.
+    mock_device.Flash.reset_mock()
+    atft_manager.FlashTarget(target)
+    mock_device.Flash.assert_not_called()
+
+    # A changed image is written again.
+    with open(os.path.join(image_dir, 'boot.img'), 'wb') as image_file:
+      image_file.write('new boot')
+    atft_manager.ProcessFlashManifestFile(
+        '{"boot": "boot.img", "system": "system.img"}', image_dir)
+    atft_manager.FlashTarget(target)
+    mock_device.Flash.assert_called_once_with(
+        'boot', os.path.join(image_dir, 'boot.img'))
+
+  def testFlashTargetFailure(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    image_dir = self._CreateFlashImages()
+    atft_manager.ProcessFlashManifestFile(
+        '{"boot": "boot.img", "system": "system.img"}', image_dir)
+    mock_device = MagicMock()
+    mock_device.Flash.side_effect = [None, FastbootFailure('')]
+    target = atftman.DeviceInfo(mock_device, self.TEST_SERIAL)
+    target.provision_status = ProvisionStatus.WAITING
+    with self.assertRaises(FastbootFailure):
+      atft_manager.FlashTarget(target)
+    self.assertEqual(ProvisionStatus.WAITING, target.provision_status)
+    # Only the failed partition needs to be flashed again.
+    mock_device.Flash.reset_mock()
+    mock_device.Flash.side_effect = None
+    atft_manager.FlashTarget(target)
+    mock_device.Flash.assert_called_once_with(
+        'system', os.path.join(image_dir, 'system.img'))
+
+  def testFlashTargetSparse(self):
+    image_dir = self._CreateFlashImages()
+    with open(os.path.join(image_dir, 'userdata.img'), 'wb') as image_file:
+      image_file.write('data' * 1024 + '\0' * 4096 * 1024)
+    self.configs['SPARSE_CACHE_DIR'] = os.path.join(image_dir, 'sparse')
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    atft_manager.ProcessFlashManifestFile(
+        '{"boot": "boot.img", "userdata": "userdata.img"}', image_dir)
+    mock_device = MagicMock()
+    mock_device.GetVar.return_value = '0x100000'
+    target = atftman.DeviceInfo(mock_device, self.TEST_SERIAL)
+    atft_manager.FlashTarget(target)
+    mock_device.GetVar.assert_called_once_with('max-download-size')
+    self.assertEqual(2, mock_device.Flash.call_count)
+    mock_device.Flash.assert_any_call(
+        'boot', os.path.join(image_dir, 'boot.img'))
+    (partition, file_path) = mock_device.Flash.call_args[0]
+    self.assertEqual('userdata', partition)
+    self.assertTrue(file_path.startswith(self.configs['SPARSE_CACHE_DIR']))
+    self.assertTrue(os.path.getsize(file_path) < 4096 * 2)
+
+  def testFlashTargetNoManifest(self):
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+    with self.assertRaises(FlashManifestFormatError):
+      atft_manager.FlashTarget(target)
+
+  def testFlashRecordPersist(self):
+    record_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, record_dir)
+    image_dir = self._CreateFlashImages()
+    self.configs['FLASH_RECORD_FILE'] = os.path.join(record_dir, 'record.json')
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    atft_manager.ProcessFlashManifestFile('{"boot": "boot.img"}', image_dir)
+    target = atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL)
+    atft_manager.FlashTarget(target)
+    new_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                      self.mock_serial_mapper, self.configs)
+    self.assertEqual(
+        False, new_manager.NeedsFlash(target, atft_manager.flash_manifest))
+
+  # Test AtftManager.FlashImages
+  def testFlashImages(self):
+    self.configs['FLASH_MAX_WORKERS'] = '2'
+    atft_manager = atftman.AtftManager(self.FastbootDeviceTemplate,
+                                       self.mock_serial_mapper, self.configs)
+    image_dir = self._CreateFlashImages()
+    atft_manager.ProcessFlashManifestFile('{"boot": "boot.img"}', image_dir)
+    good_device = MagicMock()
+    bad_device = MagicMock()
+    bad_device.Flash.side_effect = FastbootFailure('test')
+    targets = [atftman.DeviceInfo(good_device, self.TEST_SERIAL, '1-1'),
+               atftman.DeviceInfo(bad_device, self.TEST_SERIAL2, '2-1'),
+               atftman.DeviceInfo(MagicMock(), self.TEST_SERIAL3, '1-2')]
+    errors = atft_manager.FlashImages(targets)
+    self.assertEqual([self.TEST_SERIAL2], errors.keys())
+    for target in targets:
+      self.assertEqual(ProvisionStatus.IDLE, target.provision_status)
+    good_device.Flash.assert_called_once_with(
+        'boot', os.path.join(image_dir, 'boot.img'))
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,83 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded line buffer backing the command output window."""
+
+
+class ConsoleBuffer(object):
+  """A ring buffer keeping the latest max_lines lines of the command output.
+
+  The memory used does not grow with the number of lines printed. The lines
+  pushed out of the buffer, as well as the cleared lines, are passed to spill
+  so that they can be kept in the log instead. Not thread safe, only used
+  from the UI thread.
+  """
+
+  def __init__(self, max_lines, spill=None):
+    """Initialize the buffer.
+
+    Args:
+      max_lines: The maximum number of lines kept.
+      spill: The callback taking the list of lines dropped from the buffer.
+    """
+    self.max_lines = max(1, max_lines)
+    self.spill = spill
+    self._lines = [None] * self.max_lines
+    self._start = 0
+    self._count = 0
+
+  def __len__(self):
+    return self._count
+
+  def GetLine(self, index):
+    """Get a line, 0 being the oldest line kept.
+
+    Args:
+      index: The index of the line.
+    Returns:
+      The line.
+    Raises:
+      IndexError: If there is no such line.
+    """
+    if index < 0 or index >= self._count:
+      raise IndexError('Console line out of range: %d' % index)
+    return self._lines[(self._start + index) % self.max_lines]
+
+  def Append(self, lines):
+    """Append lines, dropping the oldest lines beyond max_lines.
+
+    Args:
+      lines: The list of lines to append.
+    """
+    spilled = []
+    for line in lines:
+      if self._count < self.max_lines:
+        self._lines[(self._start + self._count) % self.max_lines] = line
+        self._count += 1
+      else:
+        spilled.append(self._lines[self._start])
+        self._lines[self._start] = line
+        self._start = (self._start + 1) % self.max_lines
+    if spilled and self.spill:
+      self.spill(spilled)
+
+  def Clear(self):
+    """Remove all the lines."""
+    cleared = [self.GetLine(index) for index in range(self._count)]
+    self._lines = [None] * self.max_lines
+    self._start = 0
+    self._count = 0
+    if cleared and self.spill:
+      self.spill(cleared)
@@ -0,0 +1,64 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the bounded command output buffer."""
+import unittest
+
+import consolebuffer
+
+
+class ConsoleBufferTest(unittest.TestCase):
+
+  def setUp(self):
+    self.spilled = []
+    self.console = consolebuffer.ConsoleBuffer(3, self.spilled.extend)
+
+  def _GetLines(self):
+    return [self.console.GetLine(i) for i in range(len(self.console))]
+
+  # Test ConsoleBuffer.Append, ConsoleBuffer.GetLine
+  def testAppend(self):
+    self.console.Append(['line1', 'line2'])
+    self.assertEqual(['line1', 'line2'], self._GetLines())
+    self.assertEqual([], self.spilled)
+
+  def testWrapAround(self):
+    self.console.Append(['line1', 'line2'])
+    self.console.Append(['line3', 'line4'])
+    self.assertEqual(['line2', 'line3', 'line4'], self._GetLines())
+    self.console.Append(['line5', 'line6', 'line7', 'line8'])
+    self.assertEqual(['line6', 'line7', 'line8'], self._GetLines())
+    self.assertEqual(['line1', 'line2', 'line3', 'line4', 'line5'],
+                     self.spilled)
+
+  def testGetLineOutOfRange(self):
+    self.console.Append(['line1'])
+    with self.assertRaises(IndexError):
+      self.console.GetLine(1)
+    with self.assertRaises(IndexError):
+      self.console.GetLine(-1)
+
+  # Test ConsoleBuffer.Clear
+  def testClear(self):
+    self.console.Append(['line1', 'line2', 'line3', 'line4'])
+    self.console.Clear()
+    self.assertEqual(0, len(self.console))
+    self.assertEqual(['line1', 'line2', 'line3', 'line4'], self.spilled)
+    self.console.Append(['line5'])
+    self.assertEqual(['line5'], self._GetLines())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,242 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prioritized access to a fastboot device shared by several threads."""
+import heapq
+import itertools
+import threading
+import time
+
+# Commands of a provisioning handshake.
+PRIORITY_CRITICAL = 0
+# Commands of user operations.
+PRIORITY_NORMAL = 1
+# Status reads for refreshing and monitoring.
+PRIORITY_MONITOR = 2
+
+PRIORITIES = [PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_MONITOR]
+
+_thread_state = threading.local()
+
+
+def GetPriority():
+  """Get the priority of the commands issued by the current thread.
+
+  Returns:
+    The priority set by the innermost Priority context, PRIORITY_NORMAL if
+    none.
+  """
+  return getattr(_thread_state, 'priority', PRIORITY_NORMAL)
+
+
+class Priority(object):
+  """Context manager to set the priority of the commands of this thread."""
+
+  def __init__(self, priority):
+    self._priority = priority
+    self._saved = None
+
+  def __enter__(self):
+    self._saved = GetPriority()
+    _thread_state.priority = self._priority
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _thread_state.priority = self._saved
+
+
+class _WaitStats(object):
+  """Queue wait time statistics for one priority."""
+
+  def __init__(self):
+    self.count = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+
+  def Add(self, wait):
+    self.count += 1
+    self.total_wait += wait
+    self.max_wait = max(self.max_wait, wait)
+
+  def ToDict(self):
+    return {
+        'count': self.count,
+        'avg_wait': self.total_wait / self.count if self.count else 0.0,
+        'max_wait': self.max_wait
+    }
+
+
+class _PendingResult(object):
+  """The result of a command shared by coalesced callers."""
+
+  def __init__(self):
+    self._event = threading.Event()
+    self._result = None
+    self._error = None
+
+  def Set(self, result, error=None):
+    self._result = result
+    self._error = error
+    self._event.set()
+
+  def Get(self):
+    self._event.wait()
+    if self._error:
+      raise self._error
+    return self._result
+
+
+class DeviceActor(object):
+  """Serializes the commands to one device in priority order.
+
+  A thread holds the device for one command (Call) or for a sequence of
+  commands (Session). Waiting threads get the device by priority and then in
+  arrival order. Sessions are reentrant for the thread holding them.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self._condition = threading.Condition()
+    self._owner = None
+    self._depth = 0
+    self._waiting = []
+    self._sequence = itertools.count()
+    self._pending_results = {}
+    self._coalesced = 0
+    self._wait_stats = dict(
+        (priority, _WaitStats()) for priority in PRIORITIES)
+
+  def _Acquire(self, priority):
+    current = threading.current_thread()
+    with self._condition:
+      if self._owner is current:
+        self._depth += 1
+        return
+      entry = (priority, next(self._sequence), current)
+      heapq.heappush(self._waiting, entry)
+      start_time = time.time()
+      while self._owner is not None or self._waiting[0] is not entry:
+        self._condition.wait()
+      heapq.heappop(self._waiting)
+      self._owner = current
+      self._depth = 1
+      self._wait_stats[priority].Add(time.time() - start_time)
+
+  def _Release(self):
+    with self._condition:
+      self._depth -= 1
+      if not self._depth:
+        self._owner = None
+        self._condition.notify_all()
+
+  def HeldByCurrentThread(self):
+    """Whether the current thread holds a session on the device."""
+    return self._owner is threading.current_thread()
+
+  def Session(self, priority):
+    """Get a context manager holding the device for a sequence of commands.
+
+    Args:
+      priority: The priority to get the device with.
+    Returns:
+      The context manager.
+    """
+    return _Session(self, priority)
+
+  def Call(self, priority, func, *args):
+    """Run a command once the device is available.
+
+    Args:
+      priority: The priority to get the device with.
+      func: The function sending the command.
+      *args: The arguments for the function.
+    Returns:
+      The return value of the function.
+    """
+    self._Acquire(priority)
+    try:
+      return func(*args)
+    finally:
+      self._Release()
+
+  def CallCoalesced(self, key, func, *args):
+    """Run a monitoring command, sharing the result with identical commands.
+
+    If a command with the same key is already waiting or running, wait for
+    its result instead of sending the command again.
+
+    Args:
+      key: The key identifying identical commands.
+      func: The function sending the command.
+      *args: The arguments for the function.
+    Returns:
+      The return value of the function.
+    """
+    if self.HeldByCurrentThread():
+      return func(*args)
+    with self._condition:
+      pending = self._pending_results.get(key)
+      if pending:
+        self._coalesced += 1
+      else:
+        self._pending_results[key] = _PendingResult()
+    if pending:
+      return pending.Get()
+
+    result = None
+    error = None
+    try:
+      result = self.Call(PRIORITY_MONITOR, func, *args)
+      return result
+    except Exception as e:  # pylint: disable=broad-except
+      error = e
+      raise
+    finally:
+      with self._condition:
+        pending = self._pending_results.pop(key)
+      pending.Set(result, error)
+
+  def GetStats(self):
+    """Get the queue statistics for monitoring.
+
+    Returns:
+      A map with the number of 'waiting' threads, the number of 'coalesced'
+      commands and 'wait', a map from priority to the 'count', 'avg_wait'
+      and 'max_wait' in seconds of the commands and sessions.
+    """
+    with self._condition:
+      return {
+          'waiting': len(self._waiting),
+          'coalesced': self._coalesced,
+          'wait': dict((priority, stats.ToDict())
+                       for (priority, stats) in self._wait_stats.iteritems())
+      }
+
+
+class _Session(object):
+
+  def __init__(self, actor, priority):
+    self._actor = actor
+    self._priority = priority
+    self._priority_context = Priority(priority)
+
+  def __enter__(self):
+    self._actor._Acquire(self._priority)  # pylint: disable=protected-access
+    self._priority_context.__enter__()
+    return self._actor
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._priority_context.__exit__(exc_type, exc_value, traceback)
+    self._actor._Release()  # pylint: disable=protected-access
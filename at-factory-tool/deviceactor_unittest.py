@@ -0,0 +1,131 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the prioritized device command actor."""
+import threading
+import unittest
+
+import deviceactor
+from deviceactor import PRIORITY_CRITICAL
+from deviceactor import PRIORITY_MONITOR
+from deviceactor import PRIORITY_NORMAL
+
+
+class DeviceActorTest(unittest.TestCase):
+
+  def _WaitForWaiting(self, actor, number):
+    while actor.GetStats()['waiting'] < number:
+      threading.Event().wait(0.001)
+
+  def _StartCall(self, actor, priority, func, *args):
+    thread = threading.Thread(
+        target=actor.Call, args=(priority, func) + args)
+    thread.start()
+    return thread
+
+  # Test DeviceActor.Call
+  def testPriorityOrder(self):
+    actor = deviceactor.DeviceActor('test')
+    order = []
+    threads = []
+    with actor.Session(PRIORITY_NORMAL):
+      for (index, priority) in enumerate(
+          [PRIORITY_MONITOR, PRIORITY_NORMAL, PRIORITY_CRITICAL,
+           PRIORITY_NORMAL]):
+        threads.append(self._StartCall(actor, priority, order.append, index))
+        self._WaitForWaiting(actor, index + 1)
+    for thread in threads:
+      thread.join(5)
+    # Critical first, then normal in arrival order, monitoring last.
+    self.assertEqual([2, 1, 3, 0], order)
+
+  def testCallReturnsAndRaises(self):
+    actor = deviceactor.DeviceActor('test')
+    self.assertEqual(3, actor.Call(PRIORITY_NORMAL, lambda x: x + 1, 2))
+    with self.assertRaises(ValueError):
+      actor.Call(PRIORITY_NORMAL, int, 'x')
+    # The device is released after an error.
+    self.assertEqual(1, actor.Call(PRIORITY_NORMAL, int, '1'))
+
+  # Test DeviceActor.Session
+  def testSessionReentrant(self):
+    actor = deviceactor.DeviceActor('test')
+    with actor.Session(PRIORITY_CRITICAL):
+      self.assertEqual(PRIORITY_CRITICAL, deviceactor.GetPriority())
+      with actor.Session(PRIORITY_CRITICAL):
+        self.assertEqual(1, actor.Call(PRIORITY_MONITOR, int, '1'))
+      self.assertTrue(actor.HeldByCurrentThread())
+    self.assertFalse(actor.HeldByCurrentThread())
+    self.assertEqual(PRIORITY_NORMAL, deviceactor.GetPriority())
+
+  def testSessionBlocksOtherThreads(self):
+    actor = deviceactor.DeviceActor('test')
+    order = []
+    with actor.Session(PRIORITY_MONITOR):
+      thread = self._StartCall(actor, PRIORITY_CRITICAL, order.append, 'other')
+      self._WaitForWaiting(actor, 1)
+      order.append('session')
+    thread.join(5)
+    self.assertEqual(['session', 'other'], order)
+
+  # Test DeviceActor.CallCoalesced
+  def testCoalesce(self):
+    actor = deviceactor.DeviceActor('test')
+    calls = []
+    results = []
+
+    def GetVar(var):
+      calls.append(var)
+      return 'value-' + var
+
+    def Monitor():
+      results.append(actor.CallCoalesced(('getvar', 'a'), GetVar, 'a'))
+
+    with actor.Session(PRIORITY_NORMAL):
+      first = threading.Thread(target=Monitor)
+      first.start()
+      self._WaitForWaiting(actor, 1)
+      others = [threading.Thread(target=Monitor) for _ in range(3)]
+      for thread in others:
+        thread.start()
+      while actor.GetStats()['coalesced'] < 3:
+        threading.Event().wait(0.001)
+    for thread in [first] + others:
+      thread.join(5)
+    self.assertEqual(['a'], calls)
+    self.assertEqual(['value-a'] * 4, results)
+    # A later read is sent again.
+    actor.CallCoalesced(('getvar', 'a'), GetVar, 'a')
+    self.assertEqual(['a', 'a'], calls)
+
+  def testCoalesceError(self):
+    actor = deviceactor.DeviceActor('test')
+    with self.assertRaises(ValueError):
+      actor.CallCoalesced('key', int, 'x')
+    self.assertEqual(2, actor.CallCoalesced('key', int, '2'))
+
+  # Test DeviceActor.GetStats
+  def testStats(self):
+    actor = deviceactor.DeviceActor('test')
+    actor.Call(PRIORITY_CRITICAL, int, '1')
+    actor.Call(PRIORITY_CRITICAL, int, '1')
+    stats = actor.GetStats()
+    self.assertEqual(2, stats['wait'][PRIORITY_CRITICAL]['count'])
+    self.assertEqual(0, stats['wait'][PRIORITY_MONITOR]['count'])
+    self.assertEqual(0, stats['waiting'])
+
+
+if __name__ == '__main__':
+  unittest.main()
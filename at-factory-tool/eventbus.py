@@ -0,0 +1,100 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesced delivery of UI updates from the worker threads."""
+from datetime import datetime
+import threading
+import time
+
+
+class EventBus(object):
+  """Collects the UI updates posted by the worker threads into batches.
+
+  The worker threads post messages and device list changes at any rate. The
+  first update posted after a flush calls wake_up once, the UI thread then
+  waits for GetDelay() and applies everything collected so far with Flush().
+  This way the UI is updated at most once per interval no matter how many
+  devices are being provisioned, and any number of device list changes
+  between two batches results in a single device list refresh.
+  """
+
+  def __init__(self, wake_up, interval=0.1, clock=time.time):
+    """Initialize the event bus.
+
+    Args:
+      wake_up: The callback to schedule a flush on the UI thread. Called from
+        the posting thread, without holding any lock.
+      interval: The minimum interval in seconds between two batches.
+      clock: The function returning the current time in seconds.
+    """
+    self.wake_up = wake_up
+    self.interval = interval
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._messages = []
+    self._device_listed = False
+    self._scheduled = False
+    self._last_flush = None
+
+  def PostMessage(self, text):
+    """Post a message to print to the command window.
+
+    Args:
+      text: The message. The time it is posted at is kept with it.
+    """
+    with self._lock:
+      self._messages.append((datetime.now(), text))
+      wake_up = self._Schedule()
+    if wake_up:
+      self.wake_up()
+
+  def PostDeviceListed(self):
+    """Post that the device list changed and needs to be refreshed."""
+    with self._lock:
+      self._device_listed = True
+      wake_up = self._Schedule()
+    if wake_up:
+      self.wake_up()
+
+  def _Schedule(self):
+    # Must be called with self._lock held.
+    if self._scheduled:
+      return False
+    self._scheduled = True
+    return True
+
+  def GetDelay(self):
+    """Get the time in seconds to wait before the next flush."""
+    with self._lock:
+      if self._last_flush is None:
+        return 0
+      return max(0, self._last_flush + self.interval - self._clock())
+
+  def Flush(self):
+    """Take all the updates posted since the last flush.
+
+    Returns:
+      A tuple (messages, device_listed). messages is the list of
+      (datetime, text) posted in order, device_listed is whether the device
+      list changed.
+    """
+    with self._lock:
+      messages = self._messages
+      device_listed = self._device_listed
+      self._messages = []
+      self._device_listed = False
+      self._scheduled = False
+      self._last_flush = self._clock()
+    return (messages, device_listed)
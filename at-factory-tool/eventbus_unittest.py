@@ -0,0 +1,76 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the coalesced UI update delivery."""
+import threading
+import unittest
+
+import eventbus
+
+
+class EventBusTest(unittest.TestCase):
+
+  def setUp(self):
+    self.wake_ups = 0
+    self.now = 100.0
+    self.bus = eventbus.EventBus(self._WakeUp, 0.1, clock=lambda: self.now)
+
+  def _WakeUp(self):
+    self.wake_ups += 1
+
+  # Test EventBus.PostMessage, EventBus.PostDeviceListed, EventBus.Flush
+  def testCoalesce(self):
+    self.bus.PostMessage('message1')
+    self.bus.PostDeviceListed()
+    self.bus.PostMessage('message2')
+    self.bus.PostDeviceListed()
+    self.assertEqual(1, self.wake_ups)
+    (messages, device_listed) = self.bus.Flush()
+    self.assertEqual(['message1', 'message2'], [text for (_, text) in messages])
+    self.assertTrue(messages[0][0] <= messages[1][0])
+    self.assertTrue(device_listed)
+    self.assertEqual(([], False), self.bus.Flush())
+
+  def testWakeUpAfterFlush(self):
+    self.bus.PostDeviceListed()
+    self.bus.Flush()
+    self.bus.PostDeviceListed()
+    self.assertEqual(2, self.wake_ups)
+    self.assertEqual(([], True), self.bus.Flush())
+
+  def testConcurrentPosts(self):
+    def Post():
+      for _ in range(1000):
+        self.bus.PostMessage('message')
+    threads = [threading.Thread(target=Post) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(1, self.wake_ups)
+    self.assertEqual(4000, len(self.bus.Flush()[0]))
+
+  # Test EventBus.GetDelay
+  def testDelay(self):
+    self.assertEqual(0, self.bus.GetDelay())
+    self.bus.Flush()
+    self.now += 0.04
+    self.assertAlmostEqual(0.06, self.bus.GetDelay())
+    self.now += 0.5
+    self.assertEqual(0, self.bus.GetDelay())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -43,6 +43,16 @@ class FastbootFailure(Exception):
     return self.msg
 
 
+class FastbootTimeout(FastbootFailure):
+  """The fastboot command did not finish within its deadline."""
+
+  def __init__(self, operation, timeout):
+    FastbootFailure.__init__(
+        self, 'Fastboot %s timed out after %s seconds' % (operation, timeout))
+    self.operation = operation
+    self.timeout = timeout
+
+
 class ProductNotSpecifiedException(Exception):
 
   def __str__(self):
@@ -57,3 +67,13 @@ class ProductAttributesFileFormatError(Exception):
 
   def __str__(self):
     return self.msg
+
+
+class FlashManifestFormatError(Exception):
+
+  def __init__(self, msg):
+    Exception.__init__(self)
+    self.msg = msg
+
+  def __str__(self):
+    return self.msg
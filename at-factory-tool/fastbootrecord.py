@@ -0,0 +1,420 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Recording and replaying of fastboot sessions.
+
+A RecordingController wraps a fastboot device controller (fastbootsh or
+fastbootsubp) and writes every command with its arguments, output and
+duration to a session file, one JSON object per line. A ReplayController
+plays a session file back through AtftManager without any device, with the
+recorded or a scaled timing, so that real line captures can be turned into
+reproducible benchmarks.
+"""
+import base64
+import json
+import threading
+import time
+
+from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import FastbootTimeout
+
+SESSION_VERSION = 1
+
+# The serial number used for commands not sent to a single device.
+_HOST = ''
+
+# The arguments compared when matching a replayed command to a recorded one.
+# File paths differ between runs so they are not compared.
+_MATCHED_ARGS = {
+    'ListDevices': 0,
+    'Reboot': 0,
+    'Oem': 1,
+    'Flash': 1,
+    'Upload': 0,
+    'Download': 0,
+    'GetVar': 1,
+}
+
+
+def _Encode(value):
+  """Make a command output or argument JSON serializable without loss.
+
+  Outputs are byte strings that may not be valid UTF-8, so they are stored as
+  their latin-1 decoding.
+  """
+  if isinstance(value, str):
+    return value.decode('latin-1')
+  if isinstance(value, list):
+    return [_Encode(item) for item in value]
+  return value
+
+
+def _Decode(value):
+  if isinstance(value, unicode):
+    return value.encode('latin-1')
+  if isinstance(value, list):
+    return [_Decode(item) for item in value]
+  return value
+
+
+class ReplayError(Exception):
+  """A replayed command was not found in the recorded session."""
+
+  def __init__(self, serial, command, args):
+    Exception.__init__(self)
+    self.serial = serial
+    self.command = command
+    self.args = args
+
+  def __str__(self):
+    return 'No recorded %s %r for device %r' % (self.command, self.args,
+                                                 self.serial)
+
+
+class SessionRecorder(object):
+  """Writes the commands of a session to a file.
+
+  Each line is a JSON object with the keys:
+    s: The serial number of the device, '' for 'fastboot devices'.
+    c: The controller method name.
+    a: The arguments.
+    t: The start time in seconds since the recording started.
+    d: The duration in seconds.
+    o: The output of the command.
+    e: The error message if the command failed.
+    to: [operation, timeout] if the command timed out.
+    f: The base64 content of the file written by Upload.
+  Location lookups are written as {'s': serial, 'l': location}.
+  """
+
+  def __init__(self, file_path):
+    self._file = open(file_path, 'w')
+    self._lock = threading.Lock()
+    self._start_time = time.time()
+    self._locations = {}
+    self._Write({'v': SESSION_VERSION})
+
+  def _Write(self, record):
+    line = json.dumps(record, separators=(',', ':'), sort_keys=True)
+    with self._lock:
+      self._file.write(line + '\n')
+      self._file.flush()
+
+  def Record(self, serial, command, args, func):
+    """Run a command and record it.
+
+    Args:
+      serial: The serial number of the device, '' for host commands.
+      command: The controller method name.
+      args: The list of arguments.
+      func: The controller method.
+    Returns:
+      The output of the command.
+    Raises:
+      FastbootFailure: If the command fails, after recording the failure.
+    """
+    record = {'s': _Encode(serial), 'c': command, 'a': _Encode(list(args))}
+    start_time = time.time()
+    try:
+      output = func(*args)
+      record['o'] = _Encode(output)
+      if command == 'Upload':
+        with open(args[0], 'rb') as uploaded_file:
+          record['f'] = base64.b64encode(uploaded_file.read())
+      return output
+    except FastbootTimeout as e:
+      record['to'] = [e.operation, e.timeout]
+      raise
+    except FastbootFailure as e:
+      record['e'] = _Encode(e.msg)
+      raise
+    finally:
+      end_time = time.time()
+      record['t'] = round(start_time - self._start_time, 6)
+      record['d'] = round(end_time - start_time, 6)
+      self._Write(record)
+
+  def RecordLocation(self, serial, location):
+    """Record the USB location of a device the first time it is seen."""
+    with self._lock:
+      if self._locations.get(serial) == location:
+        return
+      self._locations[serial] = location
+    self._Write({'s': _Encode(serial), 'l': _Encode(location)})
+
+  def Close(self):
+    with self._lock:
+      self._file.close()
+
+
+class _RecordingDevice(object):
+  """A fastboot device whose commands are recorded."""
+
+  def __init__(self, device, recorder):
+    self._device = device
+    self._recorder = recorder
+    self.serial_number = device.serial_number
+
+  def _Record(self, command, *args):
+    return self._recorder.Record(self.serial_number, command, args,
+                                 getattr(self._device, command))
+
+  def Reboot(self):
+    return self._Record('Reboot')
+
+  def Oem(self, oem_command, err_to_out):
+    return self._Record('Oem', oem_command, err_to_out)
+
+  def Flash(self, partition, file_path):
+    return self._Record('Flash', partition, file_path)
+
+  def Upload(self, file_path):
+    return self._Record('Upload', file_path)
+
+  def Download(self, file_path):
+    return self._Record('Download', file_path)
+
+  def GetVar(self, var):
+    return self._Record('GetVar', var)
+
+  def GetHostOs(self):
+    return self._device.GetHostOs()
+
+  def Disconnect(self):
+    self._device.Disconnect()
+
+
+class RecordingController(object):
+  """A fastboot device controller recording all commands to a session file.
+
+  Used in place of the FastbootDevice class: calling it creates a device.
+  """
+
+  def __init__(self, controller, recorder):
+    """Initialize the controller.
+
+    Args:
+      controller: The fastboot device controller class to record.
+      recorder: The SessionRecorder object.
+    """
+    self._controller = controller
+    self._recorder = recorder
+
+  def __call__(self, serial_number):
+    return _RecordingDevice(self._controller(serial_number), self._recorder)
+
+  def ListDevices(self):
+    return self._recorder.Record(_HOST, 'ListDevices', [],
+                                 self._controller.ListDevices)
+
+  def GetHostOs(self):
+    return self._controller.GetHostOs()
+
+  def CreateSerialMapper(self, serial_mapper):
+    """Get a serial mapper factory recording the device locations.
+
+    Args:
+      serial_mapper: The serial mapper class to record.
+    Returns:
+      A callable creating the recording serial mapper.
+    """
+    return lambda: _RecordingSerialMapper(serial_mapper(), self._recorder)
+
+
+class _RecordingSerialMapper(object):
+
+  def __init__(self, serial_mapper, recorder):
+    self._serial_mapper = serial_mapper
+    self._recorder = recorder
+
+  def refresh_serial_map(self):
+    self._serial_mapper.refresh_serial_map()
+
+  def get_location(self, serial):
+    location = self._serial_mapper.get_location(serial)
+    self._recorder.RecordLocation(serial, location)
+    return location
+
+
+def LoadSession(file_path):
+  """Load a session file.
+
+  Args:
+    file_path: The path of the session file.
+  Returns:
+    The list of command records and the map from serial number to location.
+  Raises:
+    ValueError: If the file is not a session file of a supported version.
+  """
+  records = []
+  locations = {}
+  with open(file_path, 'r') as session_file:
+    header = json.loads(session_file.readline() or 'null')
+    if not isinstance(header, dict) or header.get('v') != SESSION_VERSION:
+      raise ValueError('Not a fastboot session file: ' + file_path)
+    for line in session_file:
+      if not line.strip():
+        continue
+      record = json.loads(line)
+      if 'l' in record:
+        locations[_Decode(record['s'])] = _Decode(record['l'])
+      else:
+        record['s'] = _Decode(record['s'])
+        record['a'] = _Decode(record['a'])
+        records.append(record)
+  return (records, locations)
+
+
+class _ReplayDevice(object):
+  """A fastboot device answering with the recorded outputs."""
+
+  def __init__(self, controller, serial_number):
+    self._controller = controller
+    self.serial_number = serial_number
+
+  def _Replay(self, command, *args):
+    return self._controller.Replay(self.serial_number, command, args)
+
+  def Reboot(self):
+    return self._Replay('Reboot')
+
+  def Oem(self, oem_command, err_to_out):
+    return self._Replay('Oem', oem_command, err_to_out)
+
+  def Flash(self, partition, file_path):
+    return self._Replay('Flash', partition, file_path)
+
+  def Upload(self, file_path):
+    return self._Replay('Upload', file_path)
+
+  def Download(self, file_path):
+    return self._Replay('Download', file_path)
+
+  def GetVar(self, var):
+    return self._Replay('GetVar', var)
+
+  def GetHostOs(self):
+    return self._controller.GetHostOs()
+
+  def Disconnect(self):
+    pass
+
+
+class ReplayController(object):
+  """A fastboot device controller playing back a recorded session.
+
+  The commands of each device are matched in order to the recorded commands
+  of the same device with the same name and arguments, ignoring file paths.
+  A command takes its recorded duration multiplied by time_scale. Once the
+  recorded 'fastboot devices' outputs are used up, the last one is repeated.
+
+  Used in place of the FastbootDevice class: calling it creates a device.
+  """
+
+  def __init__(self, records, locations=None, time_scale=1.0,
+               host_os='Linux'):
+    """Initialize the controller.
+
+    Args:
+      records: The list of command records from LoadSession.
+      locations: The map from serial number to USB location.
+      time_scale: The factor for the recorded durations, 0 to not wait.
+      host_os: The host OS reported to AtftManager.
+    """
+    self.time_scale = time_scale
+    self._host_os = host_os
+    self._locations = locations or {}
+    self._lock = threading.Lock()
+    self._queues = {}
+    self._last_devices = []
+    for record in records:
+      self._queues.setdefault(record['s'], []).append(record)
+
+  @staticmethod
+  def _Key(command, args):
+    return (command, list(args[:_MATCHED_ARGS.get(command, len(args))]))
+
+  def _Take(self, serial, command, args):
+    key = self._Key(command, args)
+    with self._lock:
+      queue = self._queues.get(serial, [])
+      for (index, record) in enumerate(queue):
+        if self._Key(record['c'], record['a']) == key:
+          return queue.pop(index)
+    return None
+
+  def Replay(self, serial, command, args):
+    """Play back one command.
+
+    Args:
+      serial: The serial number of the device, '' for host commands.
+      command: The controller method name.
+      args: The arguments of the command.
+    Returns:
+      The recorded output.
+    Raises:
+      ReplayError: If the command is not in the recorded session.
+      FastbootFailure: If the recorded command failed.
+    """
+    record = self._Take(serial, command, args)
+    if record is None:
+      raise ReplayError(serial, command, args)
+    if self.time_scale:
+      time.sleep(record['d'] * self.time_scale)
+    if 'f' in record:
+      with open(args[0], 'wb') as uploaded_file:
+        uploaded_file.write(base64.b64decode(record['f']))
+    if 'to' in record:
+      raise FastbootTimeout(*record['to'])
+    if 'e' in record:
+      raise FastbootFailure(_Decode(record['e']))
+    return _Decode(record.get('o'))
+
+  def Remaining(self):
+    """Get the number of recorded device commands not played back yet."""
+    with self._lock:
+      return sum(len(queue) for (serial, queue) in self._queues.iteritems()
+                 if serial != _HOST)
+
+  def __call__(self, serial_number):
+    return _ReplayDevice(self, serial_number)
+
+  def ListDevices(self):
+    try:
+      self._last_devices = self.Replay(_HOST, 'ListDevices', [])
+    except ReplayError:
+      if self.time_scale:
+        # Keep the polling loops of the caller from spinning.
+        time.sleep(0.01 * self.time_scale)
+    return list(self._last_devices)
+
+  def GetHostOs(self):
+    return self._host_os
+
+  def CreateSerialMapper(self):
+    """Get a serial mapper factory answering with the recorded locations."""
+    return lambda: _ReplaySerialMapper(self._locations)
+
+
+class _ReplaySerialMapper(object):
+
+  def __init__(self, locations):
+    self._locations = locations
+
+  def refresh_serial_map(self):
+    pass
+
+  def get_location(self, serial):
+    return self._locations.get(serial)
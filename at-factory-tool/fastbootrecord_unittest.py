@@ -0,0 +1,183 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for fastboot session recording and replay."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import atftman
+import fastbootrecord
+from fastboot_exceptions import FastbootFailure
+from fastboot_exceptions import FastbootTimeout
+
+from mock import patch
+
+
+class FakeFastbootDevice(object):
+  """A fastboot device controller with canned outputs."""
+
+  VARS = {
+      'at-attest-uuid': '',
+      'at-vboot-state': '(bootloader) bootloader-locked: 1\n'
+                        '(bootloader) avb-perm-attr-set: 0\n'
+  }
+
+  def __init__(self, serial_number):
+    self.serial_number = serial_number
+
+  @staticmethod
+  def ListDevices():
+    return ['ATFA1', 'TARGET1']
+
+  @staticmethod
+  def GetHostOs():
+    return 'Linux'
+
+  def Oem(self, oem_command, err_to_out):
+    if oem_command == 'fail':
+      raise FastbootFailure('FAILED \xff')
+    if oem_command == 'hang':
+      raise FastbootTimeout('oem', 10)
+    if oem_command == 'get-os':
+      return 'Linux'
+    return 'OKAY'
+
+  def Upload(self, file_path):
+    with open(file_path, 'wb') as upload_file:
+      upload_file.write('\x00message\xff')
+    return 'OKAY'
+
+  def Download(self, file_path):
+    return 'OKAY'
+
+  def GetVar(self, var):
+    return self.VARS[var]
+
+  def Disconnect(self):
+    pass
+
+
+class FakeSerialMapper(object):
+
+  def refresh_serial_map(self):
+    pass
+
+  def get_location(self, serial):
+    return {'ATFA1': '1-1', 'TARGET1': '1-2'}[serial]
+
+
+class FastbootRecordTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+    self.session_file = os.path.join(self.tmp_dir, 'session.jsonl')
+
+  def _Record(self, func):
+    recorder = fastbootrecord.SessionRecorder(self.session_file)
+    controller = fastbootrecord.RecordingController(FakeFastbootDevice,
+                                                    recorder)
+    func(controller)
+    recorder.Close()
+    return fastbootrecord.LoadSession(self.session_file)
+
+  # Test RecordingController and ReplayController
+  def testRecordReplayCommands(self):
+    upload_path = os.path.join(self.tmp_dir, 'upload')
+
+    def Run(controller):
+      device = controller('TARGET1')
+      device.Oem('get-os', True)
+      device.Upload(upload_path)
+      with self.assertRaises(FastbootFailure):
+        device.Oem('fail', True)
+      with self.assertRaises(FastbootTimeout):
+        device.Oem('hang', True)
+
+    (records, _) = self._Record(Run)
+    self.assertEqual(4, len(records))
+    replay = fastbootrecord.ReplayController(records, time_scale=0)
+    device = replay('TARGET1')
+    # A different file path still matches the recorded upload.
+    replay_path = os.path.join(self.tmp_dir, 'replayed')
+    self.assertEqual('OKAY', device.Upload(replay_path))
+    with open(replay_path, 'rb') as replayed_file:
+      self.assertEqual('\x00message\xff', replayed_file.read())
+    self.assertEqual('Linux', device.Oem('get-os', True))
+    with self.assertRaises(FastbootFailure) as context:
+      device.Oem('fail', True)
+    self.assertEqual('FAILED \xff', context.exception.msg)
+    with self.assertRaises(FastbootTimeout):
+      device.Oem('hang', True)
+    self.assertEqual(0, replay.Remaining())
+    # The recorded commands are used up.
+    with self.assertRaises(fastbootrecord.ReplayError):
+      device.Oem('get-os', True)
+
+  def testReplayUnknownDevice(self):
+    (records, _) = self._Record(lambda c: c('TARGET1').GetVar('at-attest-uuid'))
+    replay = fastbootrecord.ReplayController(records, time_scale=0)
+    with self.assertRaises(fastbootrecord.ReplayError):
+      replay('TARGET2').GetVar('at-attest-uuid')
+
+  def testReplayTimeScale(self):
+    records = [{'s': 'TARGET1', 'c': 'GetVar', 'a': ['x'], 't': 0, 'd': 2.0,
+                'o': 'y'}]
+    replay = fastbootrecord.ReplayController(records, time_scale=0.5)
+    with patch('time.sleep') as mock_sleep:
+      self.assertEqual('y', replay('TARGET1').GetVar('x'))
+    mock_sleep.assert_called_once_with(1.0)
+
+  def testLoadSessionWrongFile(self):
+    with open(self.session_file, 'w') as session_file:
+      session_file.write('{"other": 1}\n')
+    with self.assertRaises(ValueError):
+      fastbootrecord.LoadSession(self.session_file)
+
+  # Test replaying through AtftManager
+  def testReplayThroughManager(self):
+    recorder = fastbootrecord.SessionRecorder(self.session_file)
+    controller = fastbootrecord.RecordingController(FakeFastbootDevice,
+                                                    recorder)
+    manager = atftman.AtftManager(
+        controller, controller.CreateSerialMapper(FakeSerialMapper), None)
+    manager.ListDevices()
+    manager.ListDevices()
+    recorder.Close()
+    self.assertEqual(1, len(manager.target_devs))
+
+    (records, locations) = fastbootrecord.LoadSession(self.session_file)
+    replay = fastbootrecord.ReplayController(records, locations, time_scale=0)
+    replay_manager = atftman.AtftManager(
+        replay, replay.CreateSerialMapper(), None)
+    start_time = time.time()
+    replay_manager.ListDevices()
+    replay_manager.ListDevices()
+    self.assertTrue(time.time() - start_time < 5)
+    self.assertEqual('ATFA1', replay_manager.atfa_dev.serial_number)
+    self.assertEqual('1-1', replay_manager.atfa_dev.location)
+    target = replay_manager.target_devs[0]
+    self.assertEqual('TARGET1', target.serial_number)
+    self.assertEqual('1-2', target.location)
+    self.assertEqual(manager.target_devs[0].provision_status,
+                     target.provision_status)
+    self.assertEqual(0, replay.Remaining())
+
+
+if __name__ == '__main__':
+  unittest.main()
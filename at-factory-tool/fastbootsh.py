@@ -16,11 +16,16 @@
 
 """Fastboot Interface Implementation using sh library."""
 import os
+import signal
 import sys
 import threading
 
 import fastboot_exceptions
+from fastboottimeouts import DEFAULT_TIMEOUTS
+from fastboottimeouts import UpdateTimeouts
+import lockprofiler
 import sh
+from workerpool import ScheduledTimer
 
 
 def _GetCurrentPath():
@@ -33,6 +38,23 @@ def _GetCurrentPath():
   return path
 
 
+class _LazyCommand(object):
+  """A class attribute resolving an sh.Command the first time it is used.
+
+  Resolving the command looks up the executable, which is not needed to
+  import this module.
+  """
+
+  def __init__(self, path):
+    self._path = path
+    self._command = None
+
+  def __get__(self, instance, owner):
+    if self._command is None:
+      self._command = sh.Command(self._path)
+    return self._command
+
+
 class FastbootDevice(object):
   """An abstracted fastboot device object.
 
@@ -40,8 +62,65 @@ class FastbootDevice(object):
     serial_number: The serial number of the fastboot device.
   """
   current_path = _GetCurrentPath()
-  fastboot_command = sh.Command(os.path.join(current_path, 'fastboot'))
+  fastboot_command = _LazyCommand(os.path.join(current_path, 'fastboot'))
   HOST_OS = 'Linux'
+  timeouts = dict(DEFAULT_TIMEOUTS)
+
+  @staticmethod
+  def SetTimeouts(timeouts):
+    """Change the deadlines for fastboot commands.
+
+    Args:
+      timeouts: A map from operation name (one of DEFAULT_TIMEOUTS) to the
+        deadline in seconds. 0 disables the deadline for that operation.
+    Raises:
+      ValueError: If an operation is unknown or a deadline is not a number.
+    """
+    UpdateTimeouts(FastbootDevice.timeouts, timeouts)
+
+  @staticmethod
+  def _Run(operation, *args, **kwargs):
+    """Run a fastboot command, killing it after the deadline of operation.
+
+    sh only signals the fastboot process on _timeout. The command runs in its
+    own session instead, and the watchdog kills its whole process group.
+
+    Args:
+      operation: The name of the operation (one of DEFAULT_TIMEOUTS).
+      *args: The arguments for fastboot.
+      **kwargs: Other sh arguments.
+    Returns:
+      The output of the command.
+    Raises:
+      sh.ErrorReturnCode: If the command returns non-zero.
+      FastbootTimeout: If the command did not finish in time.
+    """
+    timeout = FastbootDevice.timeouts[operation]
+    running = FastbootDevice.fastboot_command(
+        *args, _bg=True, _bg_exc=False, _new_session=True, **kwargs)
+    expired = threading.Event()
+    watchdog = None
+    if timeout:
+      def _Expire():
+        expired.set()
+        try:
+          running.process.signal_group(signal.SIGKILL)
+        except OSError:
+          # The process already exited.
+          pass
+      # Runs on the shared scheduler thread instead of a thread per command.
+      watchdog = ScheduledTimer(timeout, _Expire)
+      watchdog.start()
+    try:
+      return running.wait()
+    except (sh.ErrorReturnCode, sh.SignalException):
+      # sh does not match its signal exceptions against ErrorReturnCode.
+      if expired.is_set():
+        raise fastboot_exceptions.FastbootTimeout(operation, timeout)
+      raise
+    finally:
+      if watchdog:
+        watchdog.cancel()
 
   @staticmethod
   def ListDevices():
@@ -51,7 +130,7 @@ class FastbootDevice(object):
       A list of serial numbers for all the fastboot devices.
     """
     try:
-      out = FastbootDevice.fastboot_command('devices')
+      out = FastbootDevice._Run('devices', 'devices')
       device_serial_numbers = out.replace('\tfastboot', '').rstrip().split('\n')
       # filter out empty string
       return filter(None, device_serial_numbers)
@@ -67,7 +146,7 @@ class FastbootDevice(object):
     self.serial_number = serial_number
     # Lock to make sure only one fastboot command can be issued to one device
     # at one time.
-    self._lock = threading.Lock()
+    self._lock = lockprofiler.Lock('FastbootDevice._lock')
 
   def Reboot(self):
     """Reboot the device into fastboot mode.
@@ -77,7 +156,7 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = self.fastboot_command('-s', self.serial_number, 'reboot-bootloader')
+      out = self._Run('reboot', '-s', self.serial_number, 'reboot-bootloader')
       return out
     except sh.ErrorReturnCode as e:
       raise fastboot_exceptions.FastbootFailure(e.stderr)
@@ -97,8 +176,8 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = self.fastboot_command(
-          '-s', self.serial_number, 'oem', oem_command, _err_to_out=err_to_out)
+      out = self._Run('oem', '-s', self.serial_number, 'oem', oem_command,
+                      _err_to_out=err_to_out)
       return out
     except sh.ErrorReturnCode as e:
       if err_to_out:
@@ -122,8 +201,8 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = self.fastboot_command(
-          '-s', self.serial_number, 'flash', partition, file_path)
+      out = self._Run(
+          'flash', '-s', self.serial_number, 'flash', partition, file_path)
       return out
     except sh.ErrorReturnCode as e:
       raise fastboot_exceptions.FastbootFailure(e.stderr)
@@ -143,8 +222,8 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = self.fastboot_command('-s', self.serial_number, 'get_staged',
-                                  file_path)
+      out = self._Run(
+          'get_staged', '-s', self.serial_number, 'get_staged', file_path)
       return out
     except sh.ErrorReturnCode as e:
       raise fastboot_exceptions.FastbootFailure(e.stderr)
@@ -164,7 +243,7 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = self.fastboot_command('-s', self.serial_number, 'stage', file_path)
+      out = self._Run('stage', '-s', self.serial_number, 'stage', file_path)
       return out
     except sh.ErrorReturnCode as e:
       raise fastboot_exceptions.FastbootFailure(e.stderr)
@@ -186,8 +265,8 @@ class FastbootDevice(object):
       self._lock.acquire()
       # Fastboot getvar command's output would be in stderr instead of stdout.
       # Need to redirect stderr to stdout.
-      out = self.fastboot_command(
-          '-s', self.serial_number, 'getvar', var, _err_to_out=True)
+      out = self._Run('getvar', '-s', self.serial_number, 'getvar', var,
+                      _err_to_out=True)
     except sh.ErrorReturnCode as e:
       # Since we redirected stderr, we should print stdout here.
       raise fastboot_exceptions.FastbootFailure(e.stdout)
@@ -13,12 +13,19 @@
 # limitations under the License.
 
 """Unit test for fastboot interface using sh library."""
+import os
+import shutil
+import signal
+import tempfile
+import time
 import unittest
 
 import fastboot_exceptions
 import fastbootsh
+from mock import ANY
 from mock import patch
 import sh
+import workerpool
 
 
 class FastbootShTest(unittest.TestCase):
@@ -36,23 +43,35 @@ class FastbootShTest(unittest.TestCase):
       pass
 
   def setUp(self):
-    pass
+    fastbootsh.FastbootDevice.timeouts = dict(fastbootsh.DEFAULT_TIMEOUTS)
+    timer_patcher = patch('fastbootsh.ScheduledTimer')
+    self.mock_timer = timer_patcher.start()
+    self.addCleanup(timer_patcher.stop)
+
+  def _AssertRun(self, mock_fastboot_commands, operation, *args, **kwargs):
+    kwargs.update(_bg=True, _bg_exc=False, _new_session=True)
+    mock_fastboot_commands.assert_called_once_with(*args, **kwargs)
+    mock_fastboot_commands.return_value.wait.assert_called_once_with()
+    self.mock_timer.assert_called_once_with(
+        fastbootsh.DEFAULT_TIMEOUTS[operation], ANY)
 
   # Test FastbootDevice.ListDevices
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testListDevicesOneDevice(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_SERIAL + '\tfastboot'
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_SERIAL + '\tfastboot')
     device_serial_numbers = fastbootsh.FastbootDevice.ListDevices()
-    mock_fastboot_commands.assert_called_once_with('devices')
+    self._AssertRun(mock_fastboot_commands, 'devices', 'devices')
     self.assertEqual(1, len(device_serial_numbers))
     self.assertEqual(self.TEST_SERIAL, device_serial_numbers[0])
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testListDevicesTwoDevices(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = (self.TEST_SERIAL + '\tfastboot\n' +
-                                           self.ATFA_TEST_SERIAL + '\tfastboot')
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_SERIAL + '\tfastboot\n' +
+        self.ATFA_TEST_SERIAL + '\tfastboot')
     device_serial_numbers = fastbootsh.FastbootDevice.ListDevices()
-    mock_fastboot_commands.assert_called_once_with('devices')
+    self._AssertRun(mock_fastboot_commands, 'devices', 'devices')
     self.assertEqual(2, len(device_serial_numbers))
     self.assertEqual(self.TEST_SERIAL, device_serial_numbers[0])
     self.assertEqual(self.ATFA_TEST_SERIAL, device_serial_numbers[1])
@@ -63,23 +82,23 @@ class FastbootShTest(unittest.TestCase):
     result = one_device
     for _ in range(0, 9):
       result += '\n' + one_device
-    mock_fastboot_commands.return_value = result
+    mock_fastboot_commands.return_value.wait.return_value = result
     device_serial_numbers = fastbootsh.FastbootDevice.ListDevices()
-    mock_fastboot_commands.assert_called_once_with('devices')
+    self._AssertRun(mock_fastboot_commands, 'devices', 'devices')
     self.assertEqual(10, len(device_serial_numbers))
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testListDevicesNone(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = ''
+    mock_fastboot_commands.return_value.wait.return_value = ''
     device_serial_numbers = fastbootsh.FastbootDevice.ListDevices()
-    mock_fastboot_commands.assert_called_once_with('devices')
+    self._AssertRun(mock_fastboot_commands, 'devices', 'devices')
     self.assertEqual(0, len(device_serial_numbers))
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testListDevicesFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stderr = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
       fastbootsh.FastbootDevice.ListDevices()
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
@@ -87,35 +106,33 @@ class FastbootShTest(unittest.TestCase):
   # Test FastbootDevice.Oem
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testOem(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_MESSAGE_SUCCESS)
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     message = device.Oem(command, False)
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'oem',
-                                                   command,
-                                                   _err_to_out=False)
+    self._AssertRun(
+        mock_fastboot_commands, 'oem', '-s', self.TEST_SERIAL, 'oem', command,
+        _err_to_out=False)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testOemErrToOut(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_MESSAGE_SUCCESS)
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     message = device.Oem(command, True)
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'oem',
-                                                   command,
-                                                   _err_to_out=True)
+    self._AssertRun(
+        mock_fastboot_commands, 'oem', '-s', self.TEST_SERIAL, 'oem', command,
+        _err_to_out=True)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testOemFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stderr = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
@@ -125,21 +142,21 @@ class FastbootShTest(unittest.TestCase):
   # Test FastbootDevice.Upload
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testUpload(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_MESSAGE_SUCCESS)
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     message = device.Upload(command)
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'get_staged',
-                                                   command)
+    self._AssertRun(
+        mock_fastboot_commands, 'get_staged', '-s', self.TEST_SERIAL,
+        'get_staged', command)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testUploadFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stderr = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
@@ -149,21 +166,21 @@ class FastbootShTest(unittest.TestCase):
   # Test FastbootDevice.Download
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testDownload(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_MESSAGE_SUCCESS)
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     message = device.Download(command)
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'stage',
-                                                   command)
+    self._AssertRun(
+        mock_fastboot_commands, 'stage', '-s', self.TEST_SERIAL, 'stage',
+        command)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testDownloadFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stderr = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     command = 'TEST COMMAND'
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
@@ -173,21 +190,20 @@ class FastbootShTest(unittest.TestCase):
   # Test FastbootDevice.GetVar
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testGetVar(self, mock_fastboot_commands):
-    mock_fastboot_commands.return_value = self.TEST_VAR + ': ' + 'abcd'
+    mock_fastboot_commands.return_value.wait.return_value = (
+        self.TEST_VAR + ': ' + 'abcd')
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     message = device.GetVar(self.TEST_VAR)
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'getvar',
-                                                   self.TEST_VAR,
-                                                   _err_to_out=True)
+    self._AssertRun(
+        mock_fastboot_commands, 'getvar', '-s', self.TEST_SERIAL, 'getvar',
+        self.TEST_VAR, _err_to_out=True)
     self.assertEqual('abcd', message)
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testGetVarFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stdout = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
       device.GetVar(self.TEST_VAR)
@@ -198,19 +214,74 @@ class FastbootShTest(unittest.TestCase):
   def testReboot(self, mock_fastboot_commands):
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     device.Reboot()
-    mock_fastboot_commands.assert_called_once_with('-s',
-                                                   self.TEST_SERIAL,
-                                                   'reboot-bootloader')
+    self._AssertRun(
+        mock_fastboot_commands, 'reboot', '-s', self.TEST_SERIAL,
+        'reboot-bootloader')
 
   @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
   def testRebootFailure(self, mock_fastboot_commands):
     mock_error = self.TestError()
     mock_error.stderr = self.TEST_MESSAGE_FAILURE
-    mock_fastboot_commands.side_effect = mock_error
+    mock_fastboot_commands.return_value.wait.side_effect = mock_error
     device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
     with self.assertRaises(fastboot_exceptions.FastbootFailure) as e:
       device.Reboot()
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
+  # Test FastbootDevice timeouts
+  @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
+  def testGetVarTimeout(self, mock_fastboot_commands):
+    running = mock_fastboot_commands.return_value
+    # The watchdog expires and fastboot dies from the signal.
+    self.mock_timer.return_value.start.side_effect = (
+        lambda: self.mock_timer.call_args[0][1]())
+    running.wait.side_effect = self.TestError()
+    device = fastbootsh.FastbootDevice(self.TEST_SERIAL)
+    with self.assertRaises(fastboot_exceptions.FastbootTimeout) as e:
+      device.GetVar(self.TEST_VAR)
+    self.assertEqual('getvar', e.exception.operation)
+    # The whole process group is killed, not only fastboot.
+    running.process.signal_group.assert_called_once_with(signal.SIGKILL)
+    # The device lock must be released after a timeout.
+    self.assertTrue(device._lock.acquire(False))
+
+  def testTimeoutKillsProcessGroup(self):
+    temp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_dir)
+    pid_file = os.path.join(temp_dir, 'pid')
+    # A fastboot stand-in whose child keeps running, like a hung USB write.
+    command = sh.Command('/bin/sh').bake(
+        '-c', 'sleep 30 & echo $! > %s; wait' % pid_file)
+    fastbootsh.FastbootDevice.SetTimeouts({'devices': 0.5})
+    self.mock_timer.side_effect = workerpool.ScheduledTimer
+    with patch('fastbootsh.FastbootDevice.fastboot_command', command,
+               create=True):
+      with self.assertRaises(fastboot_exceptions.FastbootTimeout):
+        fastbootsh.FastbootDevice.ListDevices()
+    with open(pid_file) as f:
+      child_pid = int(f.read())
+    deadline = time.time() + 5
+    while self._IsRunning(child_pid) and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertFalse(self._IsRunning(child_pid))
+
+  def _IsRunning(self, pid):
+    try:
+      with open('/proc/%d/stat' % pid) as f:
+        # A killed process not reaped yet is a zombie.
+        return f.read().split(')')[-1].split()[0] != 'Z'
+    except IOError:
+      return False
+
+  @patch('fastbootsh.FastbootDevice.fastboot_command', create=True)
+  def testSetTimeouts(self, mock_fastboot_commands):
+    mock_fastboot_commands.return_value.wait.return_value = ''
+    fastbootsh.FastbootDevice.SetTimeouts({'devices': '0'})
+    fastbootsh.FastbootDevice.ListDevices()
+    mock_fastboot_commands.return_value.wait.assert_called_once_with()
+    self.mock_timer.assert_not_called()
+    with self.assertRaises(ValueError):
+      fastbootsh.FastbootDevice.SetTimeouts({'getvar': 'abc'})
+
 if __name__ == '__main__':
   unittest.main()
@@ -15,11 +15,16 @@
 
 """Fastboot Interface Implementation using subprocess library."""
 import os
+import signal
 import subprocess
 import sys
 import threading
 
 import fastboot_exceptions
+from fastboottimeouts import DEFAULT_TIMEOUTS
+from fastboottimeouts import UpdateTimeouts
+import lockprofiler
+from workerpool import ScheduledTimer
 
 CREATE_NO_WINDOW = 0x08000000
 
@@ -34,6 +39,65 @@ def _GetCurrentPath():
   return path
 
 
+def _KillProcessTree(process):
+  """Kill a process together with all the processes it started.
+
+  Args:
+    process: The subprocess.Popen object to kill.
+  """
+  try:
+    if os.name == 'nt':
+      # GetVar runs fastboot through the shell, so the whole tree must go.
+      subprocess.call(
+          ['taskkill', '/F', '/T', '/PID', str(process.pid)],
+          creationflags=CREATE_NO_WINDOW)
+    else:
+      os.killpg(process.pid, signal.SIGKILL)
+  except OSError:
+    # The process already exited.
+    pass
+
+
+def _CheckOutput(args, operation, timeout, **kwargs):
+  """Run a command and return its stdout, killing it after the deadline.
+
+  Args:
+    args: The command line to run.
+    operation: The name of the operation, used in the timeout message.
+    timeout: The deadline in seconds, None or 0 to wait forever.
+    **kwargs: Other arguments for subprocess.Popen.
+  Returns:
+    The stdout of the command.
+  Raises:
+    subprocess.CalledProcessError: If the command returns non-zero.
+    FastbootTimeout: If the command did not finish in time. The command and
+      its child processes are killed.
+  """
+  if os.name != 'nt':
+    # Start a new process group so that the watchdog can kill all of it.
+    kwargs['preexec_fn'] = os.setsid
+  process = subprocess.Popen(args, stdout=subprocess.PIPE, **kwargs)
+  expired = threading.Event()
+  watchdog = None
+  if timeout:
+    def _Expire():
+      expired.set()
+      _KillProcessTree(process)
+    # Runs on the shared scheduler thread instead of a thread per command.
+    watchdog = ScheduledTimer(timeout, _Expire)
+    watchdog.start()
+  try:
+    out, _ = process.communicate()
+  finally:
+    if watchdog:
+      watchdog.cancel()
+  if expired.is_set():
+    raise fastboot_exceptions.FastbootTimeout(operation, timeout)
+  if process.returncode:
+    raise subprocess.CalledProcessError(process.returncode, args, output=out)
+  return out
+
+
 class FastbootDevice(object):
   """An abstracted fastboot device object.
 
@@ -44,6 +108,19 @@ class FastbootDevice(object):
   current_path = _GetCurrentPath()
   fastboot_command = os.path.join(current_path, 'fastboot.exe')
   HOST_OS = 'Windows'
+  timeouts = dict(DEFAULT_TIMEOUTS)
+
+  @staticmethod
+  def SetTimeouts(timeouts):
+    """Change the deadlines for fastboot commands.
+
+    Args:
+      timeouts: A map from operation name (one of DEFAULT_TIMEOUTS) to the
+        deadline in seconds. 0 disables the deadline for that operation.
+    Raises:
+      ValueError: If an operation is unknown or a deadline is not a number.
+    """
+    UpdateTimeouts(FastbootDevice.timeouts, timeouts)
 
   @staticmethod
   def ListDevices():
@@ -53,9 +130,9 @@ class FastbootDevice(object):
       A list of serial numbers for all the fastboot devices.
     """
     try:
-      out = subprocess.check_output(
-          [FastbootDevice.fastboot_command, 'devices'],
-          creationflags=CREATE_NO_WINDOW)
+      out = _CheckOutput(
+          [FastbootDevice.fastboot_command, 'devices'], 'devices',
+          FastbootDevice.timeouts['devices'], creationflags=CREATE_NO_WINDOW)
       device_serial_numbers = (out.replace('\tfastboot', '')
                                .rstrip().splitlines())
       # filter out empty string
@@ -72,7 +149,7 @@ class FastbootDevice(object):
     self.serial_number = serial_number
     # Lock to make sure only one fastboot command can be issued to one device
     # at one time.
-    self._lock = threading.Lock()
+    self._lock = lockprofiler.Lock('FastbootDevice._lock')
 
   def Reboot(self):
     """Reboot the device into fastboot mode.
@@ -82,9 +159,10 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      out = subprocess.check_output(
+      out = _CheckOutput(
           [FastbootDevice.fastboot_command, '-s', self.serial_number,
-           'reboot-bootloader'], creationflags=CREATE_NO_WINDOW)
+           'reboot-bootloader'], 'reboot', FastbootDevice.timeouts['reboot'],
+          creationflags=CREATE_NO_WINDOW)
       return out
     except subprocess.CalledProcessError as e:
       raise fastboot_exceptions.FastbootFailure(e.output)
@@ -106,11 +184,13 @@ class FastbootDevice(object):
       self._lock.acquire()
       # We need to redirect the output no matter err_to_out is set
       # So that FastbootFailure can catch the right error.
-      return subprocess.check_output(
+      return _CheckOutput(
           [
               FastbootDevice.fastboot_command, '-s', self.serial_number,
               'oem', oem_command
           ],
+          'oem',
+          FastbootDevice.timeouts['oem'],
           stderr=subprocess.STDOUT,
           creationflags=CREATE_NO_WINDOW)
     except subprocess.CalledProcessError as e:
@@ -131,11 +211,13 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      return subprocess.check_output(
+      return _CheckOutput(
           [
               FastbootDevice.fastboot_command, '-s', self.serial_number,
               'flash', partition, file_path
           ],
+          'flash',
+          FastbootDevice.timeouts['flash'],
           creationflags=CREATE_NO_WINDOW)
     except subprocess.CalledProcessError as e:
       raise fastboot_exceptions.FastbootFailure(e.output)
@@ -155,11 +237,13 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      return subprocess.check_output(
+      return _CheckOutput(
           [
               FastbootDevice.fastboot_command, '-s', self.serial_number,
               'get_staged', file_path
           ],
+          'get_staged',
+          FastbootDevice.timeouts['get_staged'],
           creationflags=CREATE_NO_WINDOW)
     except subprocess.CalledProcessError as e:
       raise fastboot_exceptions.FastbootFailure(e.output)
@@ -179,11 +263,13 @@ class FastbootDevice(object):
     """
     try:
       self._lock.acquire()
-      return subprocess.check_output(
+      return _CheckOutput(
           [
               FastbootDevice.fastboot_command, '-s', self.serial_number,
               'stage', file_path
           ],
+          'stage',
+          FastbootDevice.timeouts['stage'],
           creationflags=CREATE_NO_WINDOW)
     except subprocess.CalledProcessError as e:
       raise fastboot_exceptions.FastbootFailure(e.output)
@@ -207,11 +293,13 @@ class FastbootDevice(object):
       self._lock.acquire()
 
       # Need the shell=True flag for windows, otherwise it hangs.
-      out = subprocess.check_output(
+      out = _CheckOutput(
           [
               FastbootDevice.fastboot_command, '-s', self.serial_number,
               'getvar', var
           ],
+          'getvar',
+          FastbootDevice.timeouts['getvar'],
           stderr=subprocess.STDOUT,
           shell=True,
           creationflags=CREATE_NO_WINDOW)
@@ -13,12 +13,15 @@
 # limitations under the License.
 
 """Unit test for fastboot interface using subprocess library."""
+import os
 import subprocess
+import time
 import unittest
 
 import fastboot_exceptions
 import fastbootsubp
 from mock import patch
+import workerpool
 
 CREATE_NO_WINDOW = 0x08000000
 
@@ -40,40 +43,47 @@ class FastbootSubpTest(unittest.TestCase):
 
   def setUp(self):
     fastbootsubp.FastbootDevice.fastboot_command = 'fastboot'
+    fastbootsubp.FastbootDevice.timeouts = dict(fastbootsubp.DEFAULT_TIMEOUTS)
 
   # Test FastbootDevice.ListDevices
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesOneDevice(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = self.TEST_SERIAL + '\tfastboot'
     device_serial_numbers = fastbootsubp.FastbootDevice.ListDevices()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', 'devices'], creationflags=CREATE_NO_WINDOW)
+        ['fastboot', 'devices'], 'devices',
+        fastbootsubp.DEFAULT_TIMEOUTS['devices'],
+        creationflags=CREATE_NO_WINDOW)
     self.assertEqual(1, len(device_serial_numbers))
     self.assertEqual(self.TEST_SERIAL, device_serial_numbers[0])
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesTwoDevices(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = (self.TEST_SERIAL + '\tfastboot\n' +
                                            self.ATFA_TEST_SERIAL + '\tfastboot')
     device_serial_numbers = fastbootsubp.FastbootDevice.ListDevices()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', 'devices'], creationflags=CREATE_NO_WINDOW)
+        ['fastboot', 'devices'], 'devices',
+        fastbootsubp.DEFAULT_TIMEOUTS['devices'],
+        creationflags=CREATE_NO_WINDOW)
     self.assertEqual(2, len(device_serial_numbers))
     self.assertEqual(self.TEST_SERIAL, device_serial_numbers[0])
     self.assertEqual(self.ATFA_TEST_SERIAL, device_serial_numbers[1])
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesTwoDevicesCRLF(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = (self.TEST_SERIAL + '\tfastboot\r\n' +
                                            self.ATFA_TEST_SERIAL + '\tfastboot')
     device_serial_numbers = fastbootsubp.FastbootDevice.ListDevices()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', 'devices'], creationflags=CREATE_NO_WINDOW)
+        ['fastboot', 'devices'], 'devices',
+        fastbootsubp.DEFAULT_TIMEOUTS['devices'],
+        creationflags=CREATE_NO_WINDOW)
     self.assertEqual(2, len(device_serial_numbers))
     self.assertEqual(self.TEST_SERIAL, device_serial_numbers[0])
     self.assertEqual(self.ATFA_TEST_SERIAL, device_serial_numbers[1])
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesMultiDevices(self, mock_fastboot_commands):
     one_device = self.TEST_SERIAL + '\tfastboot'
     result = one_device
@@ -82,18 +92,22 @@ class FastbootSubpTest(unittest.TestCase):
     mock_fastboot_commands.return_value = result
     device_serial_numbers = fastbootsubp.FastbootDevice.ListDevices()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', 'devices'], creationflags=CREATE_NO_WINDOW)
+        ['fastboot', 'devices'], 'devices',
+        fastbootsubp.DEFAULT_TIMEOUTS['devices'],
+        creationflags=CREATE_NO_WINDOW)
     self.assertEqual(10, len(device_serial_numbers))
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesNone(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = ''
     device_serial_numbers = fastbootsubp.FastbootDevice.ListDevices()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', 'devices'], creationflags=CREATE_NO_WINDOW)
+        ['fastboot', 'devices'], 'devices',
+        fastbootsubp.DEFAULT_TIMEOUTS['devices'],
+        creationflags=CREATE_NO_WINDOW)
     self.assertEqual(0, len(device_serial_numbers))
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testListDevicesFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -103,31 +117,33 @@ class FastbootSubpTest(unittest.TestCase):
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
   # Test FastbootDevice.Oem
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testOem(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
     command = 'TEST COMMAND'
     device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
     message = device.Oem(command, False)
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', '-s', self.TEST_SERIAL, 'oem', command],
+        ['fastboot', '-s', self.TEST_SERIAL, 'oem', command], 'oem',
+        fastbootsubp.DEFAULT_TIMEOUTS['oem'],
         stderr=subprocess.STDOUT,
         creationflags=CREATE_NO_WINDOW)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testOemErrToOut(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
     command = 'TEST COMMAND'
     device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
     message = device.Oem(command, True)
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', '-s', self.TEST_SERIAL, 'oem', command],
+        ['fastboot', '-s', self.TEST_SERIAL, 'oem', command], 'oem',
+        fastbootsubp.DEFAULT_TIMEOUTS['oem'],
         stderr=subprocess.STDOUT,
         creationflags=CREATE_NO_WINDOW)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testOemFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -139,7 +155,7 @@ class FastbootSubpTest(unittest.TestCase):
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
   # Test FastbootDevice.Upload
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testUpload(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
     command = 'TEST COMMAND'
@@ -147,10 +163,11 @@ class FastbootSubpTest(unittest.TestCase):
     message = device.Upload(command)
     mock_fastboot_commands.assert_called_once_with(
         ['fastboot', '-s', self.TEST_SERIAL, 'get_staged', command],
+        'get_staged', fastbootsubp.DEFAULT_TIMEOUTS['get_staged'],
         creationflags=CREATE_NO_WINDOW)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testUploadFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -162,18 +179,19 @@ class FastbootSubpTest(unittest.TestCase):
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
   # Test FastbootDevice.Download
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testDownload(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = self.TEST_MESSAGE_SUCCESS
     command = 'TEST COMMAND'
     device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
     message = device.Download(command)
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', '-s', self.TEST_SERIAL, 'stage', command],
+        ['fastboot', '-s', self.TEST_SERIAL, 'stage', command], 'stage',
+        fastbootsubp.DEFAULT_TIMEOUTS['stage'],
         creationflags=CREATE_NO_WINDOW)
     self.assertEqual(self.TEST_MESSAGE_SUCCESS, message)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testDownloadFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -185,20 +203,21 @@ class FastbootSubpTest(unittest.TestCase):
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
   # Test FastbootDevice.GetVar
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testGetVar(self, mock_fastboot_commands):
     mock_fastboot_commands.return_value = (
         self.TEST_VAR + ': ' + self.TEST_MESSAGE)
     device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
     message = device.GetVar(self.TEST_VAR)
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', '-s', self.TEST_SERIAL, 'getvar', self.TEST_VAR],
+        ['fastboot', '-s', self.TEST_SERIAL, 'getvar', self.TEST_VAR], 'getvar',
+        fastbootsubp.DEFAULT_TIMEOUTS['getvar'],
         stderr=subprocess.STDOUT,
         shell=True,
         creationflags=CREATE_NO_WINDOW)
     self.assertEqual(self.TEST_MESSAGE, message)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testGetVarFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -209,15 +228,16 @@ class FastbootSubpTest(unittest.TestCase):
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
   # Test FastbootDevice.Reboot
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testGetVar(self, mock_fastboot_commands):
     device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
     message = device.Reboot()
     mock_fastboot_commands.assert_called_once_with(
-        ['fastboot', '-s', self.TEST_SERIAL, 'reboot-bootloader'],
+        ['fastboot', '-s', self.TEST_SERIAL, 'reboot-bootloader'], 'reboot',
+        fastbootsubp.DEFAULT_TIMEOUTS['reboot'],
         creationflags=CREATE_NO_WINDOW)
 
-  @patch('subprocess.check_output', create=True)
+  @patch('fastbootsubp._CheckOutput')
   def testGetVarFailure(self, mock_fastboot_commands):
     mock_error = TestError()
     mock_error.output = self.TEST_MESSAGE_FAILURE
@@ -227,5 +247,55 @@ class FastbootSubpTest(unittest.TestCase):
       device.Reboot()
     self.assertEqual(self.TEST_MESSAGE_FAILURE, str(e.exception))
 
+  # Test FastbootDevice.SetTimeouts
+  @patch('fastbootsubp._CheckOutput')
+  def testSetTimeouts(self, mock_fastboot_commands):
+    mock_fastboot_commands.return_value = ''
+    fastbootsubp.FastbootDevice.SetTimeouts({'devices': '2.5'})
+    fastbootsubp.FastbootDevice.ListDevices()
+    mock_fastboot_commands.assert_called_once_with(
+        ['fastboot', 'devices'], 'devices', 2.5,
+        creationflags=CREATE_NO_WINDOW)
+    with self.assertRaises(ValueError):
+      fastbootsubp.FastbootDevice.SetTimeouts({'unknown': '1'})
+
+  @patch('fastbootsubp._CheckOutput')
+  def testGetVarTimeout(self, mock_fastboot_commands):
+    mock_fastboot_commands.side_effect = fastboot_exceptions.FastbootTimeout(
+        'getvar', 10.0)
+    device = fastbootsubp.FastbootDevice(self.TEST_SERIAL)
+    with self.assertRaises(fastboot_exceptions.FastbootFailure):
+      device.GetVar(self.TEST_VAR)
+    # The device lock must be released after a timeout.
+    self.assertTrue(device._lock.acquire(False))
+
+  # Test _CheckOutput
+  @unittest.skipIf(os.name == 'nt', 'Uses POSIX commands')
+  def testCheckOutput(self):
+    self.assertEqual('test\n', fastbootsubp._CheckOutput(
+        ['echo', 'test'], 'echo', 5.0))
+    with self.assertRaises(subprocess.CalledProcessError) as e:
+      fastbootsubp._CheckOutput(['sh', '-c', 'echo fail; exit 3'], 'sh', 5.0)
+    self.assertEqual(3, e.exception.returncode)
+    self.assertEqual('fail\n', e.exception.output)
+
+  @unittest.skipIf(os.name == 'nt', 'Uses POSIX commands')
+  def testCheckOutputTimeout(self):
+    start = time.time()
+    with self.assertRaises(fastboot_exceptions.FastbootTimeout) as e:
+      # The child sleep must be killed too, otherwise it keeps stdout open.
+      fastbootsubp._CheckOutput(['sh', '-c', 'sleep 10; echo done'], 'sh', 0.2)
+    self.assertLess(time.time() - start, 5)
+    self.assertEqual('sh', e.exception.operation)
+
+  @unittest.skipIf(os.name == 'nt', 'Uses POSIX commands')
+  def testCheckOutputNoWatchdogThread(self):
+    # The watchdog is a call on the shared scheduler, not a thread.
+    with patch('threading.Timer') as mock_timer:
+      fastbootsubp._CheckOutput(['echo', 'test'], 'echo', 5.0)
+    mock_timer.assert_not_called()
+    # The call is cancelled once the command returns.
+    self.assertEqual(0, workerpool.GetScheduler().GetPendingCount())
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,43 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deadlines for the fastboot commands, shared by the fastboot controllers."""
+
+# The default deadline in seconds for each kind of fastboot command.
+DEFAULT_TIMEOUTS = {
+    'devices': 10.0,
+    'getvar': 10.0,
+    'oem': 60.0,
+    'stage': 60.0,
+    'get_staged': 60.0,
+    'reboot': 30.0,
+    'flash': 300.0
+}
+
+
+def UpdateTimeouts(timeouts, changes):
+  """Change the deadlines in a timeout map.
+
+  Args:
+    timeouts: The map from operation name to deadline to update.
+    changes: A map from operation name (one of DEFAULT_TIMEOUTS) to the
+      deadline in seconds. 0 disables the deadline for that operation.
+  Raises:
+    ValueError: If an operation is unknown or a deadline is not a number.
+  """
+  for operation, timeout in changes.iteritems():
+    if operation not in DEFAULT_TIMEOUTS:
+      raise ValueError('Unknown fastboot operation: ' + operation)
+    timeouts[operation] = float(timeout)
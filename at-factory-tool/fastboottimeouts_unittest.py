@@ -0,0 +1,43 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the fastboot command deadlines."""
+import unittest
+
+import fastboottimeouts
+
+
+class FastbootTimeoutsTest(unittest.TestCase):
+
+  # Test fastboottimeouts.UpdateTimeouts
+  def testUpdateTimeouts(self):
+    timeouts = dict(fastboottimeouts.DEFAULT_TIMEOUTS)
+    fastboottimeouts.UpdateTimeouts(timeouts, {'flash': '600', 'getvar': 0})
+    self.assertEqual(600.0, timeouts['flash'])
+    self.assertEqual(0.0, timeouts['getvar'])
+    self.assertEqual(fastboottimeouts.DEFAULT_TIMEOUTS['oem'], timeouts['oem'])
+
+  def testUpdateTimeoutsUnknownOperation(self):
+    timeouts = dict(fastboottimeouts.DEFAULT_TIMEOUTS)
+    with self.assertRaises(ValueError):
+      fastboottimeouts.UpdateTimeouts(timeouts, {'erase': 10})
+
+  def testUpdateTimeoutsNotNumber(self):
+    timeouts = dict(fastboottimeouts.DEFAULT_TIMEOUTS)
+    with self.assertRaises(ValueError):
+      fastboottimeouts.UpdateTimeouts(timeouts, {'getvar': 'abc'})
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,282 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Contention profiling for the locks shared between threads.
+
+Lock() and Semaphore() return plain threading primitives unless profiling is
+enabled before the lock is created. Profiled locks record how long threads
+wait to acquire them and how long they are held, where they are acquired,
+and which holder blocked a waiting thread. The statistics of all the locks
+with the same name are combined, e.g. the locks of all the devices.
+"""
+import os
+import sys
+import threading
+import time
+
+_enabled = False
+_registry_lock = threading.Lock()
+_stats = {}
+
+
+def Enable():
+  """Profile the locks created from now on."""
+  global _enabled
+  _enabled = True
+
+
+def Disable():
+  """Create plain locks from now on, the profiled locks are kept."""
+  global _enabled
+  _enabled = False
+
+
+def IsEnabled():
+  return _enabled
+
+
+def Lock(name):
+  """Create a lock, profiled if profiling is enabled.
+
+  Args:
+    name: The name to report the lock under.
+  Returns:
+    A threading.Lock or a ProfiledLock object.
+  """
+  if not _enabled:
+    return threading.Lock()
+  return ProfiledLock(threading.Lock(), name)
+
+
+def Semaphore(name, value=1):
+  """Create a semaphore, profiled if profiling is enabled.
+
+  Args:
+    name: The name to report the semaphore under.
+    value: The initial value of the semaphore.
+  Returns:
+    A threading.Semaphore or a ProfiledLock object.
+  """
+  if not _enabled:
+    return threading.Semaphore(value)
+  return ProfiledLock(threading.Semaphore(value), name)
+
+
+def _GetStats(name):
+  with _registry_lock:
+    if name not in _stats:
+      _stats[name] = _LockStats(name)
+    return _stats[name]
+
+
+def _CallSite(depth):
+  """Get 'file:line function' of a caller.
+
+  Args:
+    depth: The number of frames to go up from the caller of _CallSite.
+  Returns:
+    The call site string.
+  """
+  frame = sys._getframe(depth + 1)  # pylint: disable=protected-access
+  return '%s:%d %s' % (os.path.basename(frame.f_code.co_filename),
+                       frame.f_lineno, frame.f_code.co_name)
+
+
+class _LockStats(object):
+  """Combined statistics of the locks with one name."""
+
+  def __init__(self, name):
+    self.name = name
+    self._lock = threading.Lock()
+    self._Clear()
+
+  def _Clear(self):
+    self.acquisitions = 0
+    self.contended = 0
+    self.failed_tries = 0
+    self.total_wait = 0.0
+    self.max_wait = 0.0
+    self.holds = 0
+    self.total_hold = 0.0
+    self.max_hold = 0.0
+    # Maps the acquiring call site to [acquisitions, total wait].
+    self.sites = {}
+    # Maps 'thread at call site' of a holder to the number of times it made
+    # another thread wait or fail to acquire.
+    self.blockers = {}
+
+  def AddAcquire(self, site, wait, blocker):
+    with self._lock:
+      self.acquisitions += 1
+      site_stats = self.sites.setdefault(site, [0, 0.0])
+      site_stats[0] += 1
+      site_stats[1] += wait
+      if blocker is not None:
+        self.contended += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.blockers[blocker] = self.blockers.get(blocker, 0) + 1
+
+  def AddFailedTry(self, blocker):
+    with self._lock:
+      self.failed_tries += 1
+      if blocker is not None:
+        self.blockers[blocker] = self.blockers.get(blocker, 0) + 1
+
+  def AddHold(self, hold):
+    with self._lock:
+      self.holds += 1
+      self.total_hold += hold
+      self.max_hold = max(self.max_hold, hold)
+
+  def Reset(self):
+    with self._lock:
+      self._Clear()
+
+  def ToDict(self):
+    with self._lock:
+      top_site = None
+      if self.sites:
+        top_site = max(self.sites.iteritems(),
+                       key=lambda item: (item[1][1], item[1][0]))[0]
+      top_blocker = None
+      if self.blockers:
+        top_blocker = max(self.blockers.iteritems(),
+                          key=lambda item: item[1])[0]
+      return {
+          'name': self.name,
+          'acquisitions': self.acquisitions,
+          'contended': self.contended,
+          'failed_tries': self.failed_tries,
+          'total_wait': self.total_wait,
+          'max_wait': self.max_wait,
+          'avg_hold': self.total_hold / self.holds if self.holds else 0.0,
+          'max_hold': self.max_hold,
+          'top_site': top_site,
+          'top_blocker': top_blocker
+      }
+
+
+class ProfiledLock(object):
+  """A Lock or Semaphore recording its wait and hold times.
+
+  A semaphore may be released by a thread that did not acquire it, or
+  without being acquired at all. Such a release ends the oldest recorded
+  hold, if any.
+  """
+
+  def __init__(self, lock, name):
+    self._lock = lock
+    self.name = name
+    self._stats = _GetStats(name)
+    self._holds_lock = threading.Lock()
+    # The (thread ident, 'thread at call site', acquire time) of the holders.
+    self._holds = []
+
+  def _Blocker(self):
+    with self._holds_lock:
+      return self._holds[0][1] if self._holds else 'unknown'
+
+  def _Acquire(self, blocking, depth):
+    site = _CallSite(depth + 1)
+    blocker = None
+    wait = 0.0
+    if not self._lock.acquire(False):
+      blocker = self._Blocker()
+      if not blocking:
+        self._stats.AddFailedTry(blocker)
+        return False
+      start_time = time.time()
+      self._lock.acquire()
+      wait = time.time() - start_time
+    current = threading.current_thread()
+    with self._holds_lock:
+      self._holds.append(
+          (current.ident, '%s at %s' % (current.name, site), time.time()))
+    self._stats.AddAcquire(site, wait, blocker)
+    return True
+
+  def acquire(self, blocking=True):  # pylint: disable=invalid-name
+    return self._Acquire(blocking, 1)
+
+  def release(self):  # pylint: disable=invalid-name
+    ident = threading.current_thread().ident
+    hold = None
+    with self._holds_lock:
+      for (index, (holder, _, _)) in enumerate(self._holds):
+        if holder == ident:
+          hold = self._holds.pop(index)
+          break
+      else:
+        if self._holds:
+          hold = self._holds.pop(0)
+    if hold:
+      self._stats.AddHold(time.time() - hold[2])
+    self._lock.release()
+
+  def __enter__(self):
+    self._Acquire(True, 1)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+
+
+def GetReport(top_n=None):
+  """Get the statistics of the most contended locks.
+
+  Args:
+    top_n: The number of locks to report, None for all the locks.
+  Returns:
+    A list of maps with the 'name', 'acquisitions', 'contended' and
+    'failed_tries' counts, the 'total_wait' and 'max_wait' to acquire, the
+    'avg_hold' and 'max_hold' times in seconds, the 'top_site' with the most
+    wait and the 'top_blocker' holding the lock most often when another
+    thread could not get it. Sorted by total wait and failed tries.
+  """
+  with _registry_lock:
+    stats = _stats.values()
+  report = [lock_stats.ToDict() for lock_stats in stats]
+  report.sort(key=lambda entry: (entry['total_wait'], entry['failed_tries']),
+              reverse=True)
+  return report[:top_n] if top_n else report
+
+
+def FormatReport(top_n=None):
+  """Format the report of the most contended locks as log lines.
+
+  Args:
+    top_n: The number of locks to report, None for all the locks.
+  Returns:
+    A list of strings, one per lock.
+  """
+  lines = []
+  for entry in GetReport(top_n):
+    lines.append(
+        '%s: acquired %d, contended %d, failed tries %d, wait total %.3fs '
+        'max %.3fs, hold avg %.3fs max %.3fs, top site %s, top blocker %s' % (
+            entry['name'], entry['acquisitions'], entry['contended'],
+            entry['failed_tries'], entry['total_wait'], entry['max_wait'],
+            entry['avg_hold'], entry['max_hold'], entry['top_site'],
+            entry['top_blocker']))
+  return lines
+
+
+def Reset():
+  """Forget the statistics of all the locks."""
+  with _registry_lock:
+    stats = _stats.values()
+  for lock_stats in stats:
+    lock_stats.Reset()
@@ -0,0 +1,120 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the lock contention profiler."""
+import threading
+import unittest
+
+import lockprofiler
+
+
+class LockProfilerTest(unittest.TestCase):
+
+  def setUp(self):
+    lockprofiler.Enable()
+    lockprofiler.Reset()
+    self.addCleanup(lockprofiler.Disable)
+
+  def _GetEntry(self, name):
+    for entry in lockprofiler.GetReport():
+      if entry['name'] == name:
+        return entry
+    return None
+
+  # Test Lock and Semaphore
+  def testDisabled(self):
+    lockprofiler.Disable()
+    self.assertFalse(isinstance(lockprofiler.Lock('plain'),
+                                lockprofiler.ProfiledLock))
+    self.assertFalse(isinstance(lockprofiler.Semaphore('plain', 0),
+                                lockprofiler.ProfiledLock))
+
+  def testUncontended(self):
+    lock = lockprofiler.Lock('test_lock')
+    with lock:
+      pass
+    self.assertTrue(lock.acquire())
+    lock.release()
+    entry = self._GetEntry('test_lock')
+    self.assertEqual(2, entry['acquisitions'])
+    self.assertEqual(0, entry['contended'])
+    self.assertIn('lockprofiler_unittest.py', entry['top_site'])
+    self.assertIn('testUncontended', entry['top_site'])
+
+  def testContended(self):
+    lock = lockprofiler.Lock('test_lock')
+    acquired = threading.Event()
+    release = threading.Event()
+
+    def Holder():
+      with lock:
+        acquired.set()
+        release.wait()
+
+    holder = threading.Thread(target=Holder, name='HolderThread')
+    holder.start()
+    acquired.wait()
+    self.assertFalse(lock.acquire(False))
+    threading.Timer(0.05, release.set).start()
+    with lock:
+      pass
+    holder.join()
+
+    entry = self._GetEntry('test_lock')
+    self.assertEqual(2, entry['acquisitions'])
+    self.assertEqual(1, entry['contended'])
+    self.assertEqual(1, entry['failed_tries'])
+    self.assertTrue(entry['max_wait'] > 0.01)
+    self.assertTrue(entry['max_hold'] > 0.01)
+    self.assertIn('HolderThread at', entry['top_blocker'])
+    self.assertIn('Holder', entry['top_blocker'])
+
+  def testSemaphoreReleaseWithoutAcquire(self):
+    # Used as a flag: released to pause and acquired to resume.
+    semaphore = lockprofiler.Semaphore('test_semaphore', 0)
+    self.assertFalse(semaphore.acquire(False))
+    semaphore.release()
+    self.assertTrue(semaphore.acquire(False))
+    semaphore.release()
+    semaphore.release()
+    entry = self._GetEntry('test_semaphore')
+    self.assertEqual(1, entry['acquisitions'])
+    self.assertEqual(1, entry['failed_tries'])
+
+  def testCombinedByName(self):
+    for _ in range(3):
+      with lockprofiler.Lock('device_lock'):
+        pass
+    self.assertEqual(3, self._GetEntry('device_lock')['acquisitions'])
+
+  # Test GetReport and FormatReport
+  def testReportOrder(self):
+    busy = lockprofiler.Lock('busy_lock')
+    idle = lockprofiler.Lock('idle_lock')
+    with idle:
+      pass
+    busy.acquire()
+    threading.Timer(0.02, busy.release).start()
+    busy.acquire()
+    busy.release()
+    report = lockprofiler.GetReport(top_n=1)
+    self.assertEqual(['busy_lock'], [entry['name'] for entry in report])
+    lines = lockprofiler.FormatReport(top_n=1)
+    self.assertEqual(1, len(lines))
+    self.assertTrue(lines[0].startswith('busy_lock: acquired 2, contended 1'))
+
+
+if __name__ == '__main__':
+  unittest.main()
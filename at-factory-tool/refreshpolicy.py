@@ -0,0 +1,77 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive interval for refreshing the device list."""
+import threading
+
+
+class RefreshPolicy(object):
+  """Chooses the interval until the next device list refresh.
+
+  The device list is refreshed every min_interval while devices are changing.
+  Once the device list has not changed for idle_refreshes refreshes in a row,
+  the interval is multiplied by backoff after every refresh, up to
+  max_interval. A burst (a device plugged in, a reboot or an operator action)
+  brings the interval back to min_interval.
+  """
+
+  def __init__(self, min_interval, max_interval, idle_refreshes=10,
+               backoff=2.0):
+    """Initialize the policy.
+
+    Args:
+      min_interval: The interval in seconds while devices are changing.
+      max_interval: The longest interval in seconds when idle.
+      idle_refreshes: The number of refreshes without change before backing
+        off.
+      backoff: The factor to grow the interval by when idle.
+    """
+    self.min_interval = min_interval
+    self.max_interval = max(min_interval, max_interval)
+    self.idle_refreshes = idle_refreshes
+    self.backoff = backoff
+    self._lock = threading.Lock()
+    self._interval = min_interval
+    self._unchanged = 0
+
+  def GetInterval(self):
+    """Get the current refresh interval in seconds."""
+    with self._lock:
+      return self._interval
+
+  def Burst(self):
+    """Go back to the fast interval because devices are about to change."""
+    with self._lock:
+      self._interval = self.min_interval
+      self._unchanged = 0
+
+  def NextInterval(self, changed):
+    """Update the policy after a refresh.
+
+    Args:
+      changed: Whether the refresh found a change in the device list.
+    Returns:
+      The interval in seconds until the next refresh.
+    """
+    with self._lock:
+      if changed:
+        self._interval = self.min_interval
+        self._unchanged = 0
+      else:
+        self._unchanged += 1
+        if self._unchanged > self.idle_refreshes:
+          self._interval = min(self._interval * self.backoff,
+                               self.max_interval)
+      return self._interval
@@ -0,0 +1,56 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the adaptive device refresh policy."""
+import unittest
+
+import refreshpolicy
+
+
+class RefreshPolicyTest(unittest.TestCase):
+
+  # Test RefreshPolicy.NextInterval
+  def testBackoffWhenIdle(self):
+    policy = refreshpolicy.RefreshPolicy(1.0, 10.0, idle_refreshes=2)
+    intervals = [policy.NextInterval(False) for _ in range(7)]
+    self.assertEqual([1.0, 1.0, 2.0, 4.0, 8.0, 10.0, 10.0], intervals)
+    self.assertEqual(10.0, policy.GetInterval())
+
+  def testChangeResets(self):
+    policy = refreshpolicy.RefreshPolicy(1.0, 10.0, idle_refreshes=0)
+    self.assertEqual(2.0, policy.NextInterval(False))
+    self.assertEqual(4.0, policy.NextInterval(False))
+    self.assertEqual(1.0, policy.NextInterval(True))
+    self.assertEqual(2.0, policy.NextInterval(False))
+
+  def testMaxBelowMin(self):
+    policy = refreshpolicy.RefreshPolicy(1.0, 0.5, idle_refreshes=0)
+    self.assertEqual(1.0, policy.NextInterval(False))
+
+  # Test RefreshPolicy.Burst
+  def testBurst(self):
+    policy = refreshpolicy.RefreshPolicy(0.5, 8.0, idle_refreshes=1)
+    for _ in range(10):
+      policy.NextInterval(False)
+    self.assertEqual(8.0, policy.GetInterval())
+    policy.Burst()
+    self.assertEqual(0.5, policy.GetInterval())
+    # The idle count starts over after a burst.
+    self.assertEqual(0.5, policy.NextInterval(False))
+    self.assertEqual(1.0, policy.NextInterval(False))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,576 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulated Android Things devices and ATFA for hardware-free runs.
+
+A SimulatedFleet is used in place of the FastbootDevice class. Its target
+devices run the device side of the provisioning protocol in libatap, loaded
+through ctypes from atap/host/libatap_host.so ($ make -C ../atap/host), so the
+CA Request messages they send and the CA Response messages they accept are
+the real protocol messages. Its ATFA answers 'atfa-start-provisioning' and
+'atfa-finish-provisioning' with a CA, by default the test CA of
+partner-tools/provision-test.py.
+"""
+import ctypes
+import imp
+import os
+import sys
+import threading
+import time
+
+from fastboot_exceptions import FastbootFailure
+
+_TOOL_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARY_PATH = os.path.join(_TOOL_DIR, '..', 'atap', 'host',
+                            'libatap_host.so')
+PARTNER_TOOLS_DIR = os.path.join(_TOOL_DIR, '..', 'partner-tools')
+
+BOOTLOADER_STRING = '(bootloader) '
+PRODUCT_ID_LEN = 16
+SOC_GLOBAL_KEY_LEN = 16
+HEX_UUID_LEN = 32
+# The size of the AVB permanent attributes.
+PERM_ATTR_LEN = 1052
+
+ALGORITHM_P256 = 1
+ALGORITHM_CURVE25519 = 2
+OPERATION_ISSUE = 2
+OPERATION_ISSUE_ENCRYPTED = 3
+
+# The names of the AtapResult values.
+_ATAP_RESULTS = [
+    'OK', 'ERROR_IO', 'ERROR_OOM', 'ERROR_INVALID_INPUT',
+    'ERROR_UNSUPPORTED_ALGORITHM', 'ERROR_UNSUPPORTED_OPERATION',
+    'ERROR_CRYPTO', 'ERROR_STORAGE'
+]
+
+
+class AtapError(Exception):
+  """A libatap call failed."""
+
+  def __init__(self, function, result):
+    Exception.__init__(self)
+    self.function = function
+    self.result = result
+
+  def __str__(self):
+    name = (_ATAP_RESULTS[self.result] if self.result < len(_ATAP_RESULTS)
+            else str(self.result))
+    return '%s failed: ATAP_RESULT_%s' % (self.function, name)
+
+
+class AtapHostLibrary(object):
+  """The host build of libatap, loaded with ctypes."""
+
+  def __init__(self, library_path=None):
+    """Load the library.
+
+    Args:
+      library_path: The path of libatap_host.so, the one built in atap/host
+        if None.
+    Raises:
+      OSError: If the library can not be loaded.
+    """
+    self._lib = ctypes.CDLL(library_path or LIBRARY_PATH)
+    device_p = ctypes.c_void_p
+    buffer_p = ctypes.c_char_p
+    self._lib.atap_host_device_new.argtypes = [buffer_p, buffer_p]
+    self._lib.atap_host_device_new.restype = device_p
+    self._lib.atap_host_device_free.argtypes = [device_p]
+    self._lib.atap_host_device_free.restype = None
+    self._lib.atap_host_get_ca_request.argtypes = [
+        device_p, buffer_p, ctypes.c_uint32,
+        ctypes.POINTER(ctypes.POINTER(ctypes.c_uint8)),
+        ctypes.POINTER(ctypes.c_uint32)]
+    self._lib.atap_host_get_ca_request.restype = ctypes.c_int
+    self._lib.atap_host_set_ca_response.argtypes = [
+        device_p, buffer_p, ctypes.c_uint32]
+    self._lib.atap_host_set_ca_response.restype = ctypes.c_int
+    self._lib.atap_host_get_hex_uuid.argtypes = [device_p, buffer_p]
+    self._lib.atap_host_get_hex_uuid.restype = ctypes.c_int
+    self._lib.atap_host_get_attestation_key_count.argtypes = [device_p]
+    self._lib.atap_host_get_attestation_key_count.restype = ctypes.c_uint32
+    self._lib.atap_host_free.argtypes = [ctypes.c_void_p]
+    self._lib.atap_host_free.restype = None
+
+  def NewDevice(self, product_id, soc_global_key=None):
+    """Create the libatap state of a device.
+
+    Args:
+      product_id: The PRODUCT_ID_LEN bytes product ID.
+      soc_global_key: The SOC_GLOBAL_KEY_LEN bytes key for the
+        ISSUE_ENCRYPTED operation, None if not supported.
+    Returns:
+      The device handle, to be freed with FreeDevice.
+    """
+    if len(product_id) != PRODUCT_ID_LEN:
+      raise ValueError('Product ID must be %d bytes' % PRODUCT_ID_LEN)
+    if soc_global_key is not None and (
+        len(soc_global_key) != SOC_GLOBAL_KEY_LEN):
+      raise ValueError('SoC global key must be %d bytes' % SOC_GLOBAL_KEY_LEN)
+    handle = self._lib.atap_host_device_new(
+        bytes(product_id),
+        None if soc_global_key is None else bytes(soc_global_key))
+    if not handle:
+      raise MemoryError()
+    return handle
+
+  def FreeDevice(self, handle):
+    self._lib.atap_host_device_free(handle)
+
+  def GetCaRequest(self, handle, operation_start):
+    """Run atap_get_ca_request on a device.
+
+    Args:
+      handle: The device handle.
+      operation_start: The Operation Start message.
+    Returns:
+      The CA Request message.
+    Raises:
+      AtapError: If libatap fails.
+    """
+    ca_request = ctypes.POINTER(ctypes.c_uint8)()
+    ca_request_size = ctypes.c_uint32()
+    operation_start = bytes(operation_start)
+    result = self._lib.atap_host_get_ca_request(
+        handle, operation_start, len(operation_start),
+        ctypes.byref(ca_request), ctypes.byref(ca_request_size))
+    if result:
+      raise AtapError('atap_get_ca_request', result)
+    try:
+      return ctypes.string_at(ca_request, ca_request_size.value)
+    finally:
+      self._lib.atap_host_free(ca_request)
+
+  def SetCaResponse(self, handle, ca_response):
+    """Run atap_set_ca_response on a device.
+
+    Args:
+      handle: The device handle.
+      ca_response: The CA Response message.
+    Raises:
+      AtapError: If libatap fails.
+    """
+    ca_response = bytes(ca_response)
+    result = self._lib.atap_host_set_ca_response(
+        handle, ca_response, len(ca_response))
+    if result:
+      raise AtapError('atap_set_ca_response', result)
+
+  def GetHexUuid(self, handle):
+    """Get the hex UUID written to a device, None if not provisioned."""
+    hex_uuid = ctypes.create_string_buffer(HEX_UUID_LEN)
+    if not self._lib.atap_host_get_hex_uuid(handle, hex_uuid):
+      return None
+    return hex_uuid.raw
+
+  def GetAttestationKeyCount(self, handle):
+    return self._lib.atap_host_get_attestation_key_count(handle)
+
+
+_test_ca_modules = {}
+_test_ca_lock = threading.Lock()
+
+
+def _LoadTestCa(partner_tools_dir):
+  with _test_ca_lock:
+    if partner_tools_dir in _test_ca_modules:
+      return _test_ca_modules[partner_tools_dir]
+    # provision-test.py imports its helper modules from its directory.
+    if partner_tools_dir not in sys.path:
+      sys.path.append(partner_tools_dir)
+    try:
+      module = imp.load_source(
+          'provision_test', os.path.join(partner_tools_dir,
+                                         'provision-test.py'))
+    except IOError as e:
+      raise ImportError(str(e))
+    # The keyset paths are relative to the partner-tools directory.
+    keyset_files = dict(
+        (operation, os.path.join(partner_tools_dir, path))
+        for (operation, path) in module._KEYSET_FILES.iteritems())
+    module._keyset_cache = module._KeysetCache(keyset_files)
+    _test_ca_modules[partner_tools_dir] = module
+    return module
+
+
+class TestCa(object):
+  """The test CA of partner-tools/provision-test.py.
+
+  Every session keeps its own ECDHE key, so that several ATFAs may run
+  sessions at the same time. The test CA is loaded once per process, its
+  ephemeral key pool is shared by all the TestCa objects.
+  """
+
+  def __init__(self, partner_tools_dir=None, key_pool_depth=0,
+               crypto_mode='inline', crypto_workers=None):
+    """Load the test CA.
+
+    Args:
+      partner_tools_dir: The directory of provision-test.py and its keysets.
+      key_pool_depth: The number of session keys to pre-generate per curve,
+        0 to generate them at the session start.
+      crypto_mode: Where the CA Response crypto runs: 'inline', 'thread' or
+        'process'.
+      crypto_workers: The number of crypto threads or processes, the number
+        of CPUs if None.
+    Raises:
+      ImportError: If the test CA or its dependencies can not be loaded.
+    """
+    partner_tools_dir = os.path.abspath(partner_tools_dir or PARTNER_TOOLS_DIR)
+    self._ca = _LoadTestCa(partner_tools_dir)
+    # The worker processes are forked before the key pool holds any key.
+    self._executor = self._ca._CryptoExecutor(crypto_mode, crypto_workers)
+    if key_pool_depth:
+      self._ca._start_key_pool(key_pool_depth)
+
+  def Close(self):
+    """Stop the crypto workers and the key pool, zero the keys not used."""
+    self._ca._stop_key_pool()
+    self._executor.close()
+
+  def StartSession(self, algorithm, operation=OPERATION_ISSUE):
+    """Start a provisioning session.
+
+    Args:
+      algorithm: ALGORITHM_P256 or ALGORITHM_CURVE25519.
+      operation: OPERATION_ISSUE or OPERATION_ISSUE_ENCRYPTED.
+    Returns:
+      A (session, operation_start) tuple.
+    """
+    return self._ca._new_session(algorithm, operation)
+
+  def GetCaResponse(self, session, ca_request):
+    """Get the CA Response message for a CA Request message.
+
+    Args:
+      session: The session from StartSession.
+      ca_request: The CA Request message.
+    Returns:
+      The CA Response message.
+    Raises:
+      ValueError: If the CA Request message is not accepted.
+    """
+    return self._executor.make_ca_response(bytearray(ca_request), session)
+
+
+class _SimulatedDevice(object):
+  """The state shared by a simulated target device and ATFA."""
+
+  def __init__(self, serial_number):
+    self.serial_number = serial_number
+    self.staged = ''
+    # A device runs one command at a time.
+    self.lock = threading.Lock()
+
+  def Oem(self, oem_command):
+    raise FastbootFailure(
+        'FAILED (remote: unknown command oem %s)' % oem_command)
+
+  def GetVar(self, var):
+    return ''
+
+
+class SimulatedTarget(_SimulatedDevice):
+  """A simulated Android Things device.
+
+  Attributes:
+    bootloader_locked: Whether the vboot key is fused.
+    avb_perm_attr_set: Whether the permanent attributes are fused.
+    avb_locked: Whether AVB is locked.
+  """
+
+  def __init__(self, serial_number, library, product_id, soc_global_key=None,
+               algorithms=(ALGORITHM_P256, ALGORITHM_CURVE25519)):
+    _SimulatedDevice.__init__(self, serial_number)
+    self._library = library
+    self._handle = library.NewDevice(product_id, soc_global_key)
+    self._algorithms = algorithms
+    self.bootloader_locked = False
+    self.avb_perm_attr_set = False
+    self.avb_locked = False
+
+  def Free(self):
+    if self._handle:
+      self._library.FreeDevice(self._handle)
+      self._handle = None
+
+  def GetUuid(self):
+    """Get the stored attestation UUID, None if not provisioned."""
+    return self._library.GetHexUuid(self._handle)
+
+  def GetAttestationKeyCount(self):
+    return self._library.GetAttestationKeyCount(self._handle)
+
+  def _Fuse(self, name, expected_len=None):
+    if not self.staged or (
+        expected_len is not None and len(self.staged) != expected_len):
+      raise FastbootFailure('FAILED (remote: invalid %s)' % name)
+
+  def Oem(self, oem_command):
+    if oem_command == 'at-get-ca-request':
+      try:
+        self.staged = self._library.GetCaRequest(self._handle, self.staged)
+      except AtapError as e:
+        raise FastbootFailure('FAILED (remote: %s)' % e)
+    elif oem_command == 'at-set-ca-response':
+      try:
+        self._library.SetCaResponse(self._handle, self.staged)
+      except AtapError as e:
+        raise FastbootFailure('FAILED (remote: %s)' % e)
+    elif oem_command == 'fuse at-bootloader-vboot-key':
+      self._Fuse('vboot key')
+      self.bootloader_locked = True
+    elif oem_command == 'fuse at-perm-attr':
+      self._Fuse('permanent attributes', PERM_ATTR_LEN)
+      self.avb_perm_attr_set = True
+    elif oem_command == 'at-lock-vboot':
+      if not self.avb_perm_attr_set:
+        raise FastbootFailure('FAILED (remote: permanent attributes not set)')
+      self.avb_locked = True
+    else:
+      return _SimulatedDevice.Oem(self, oem_command)
+    return 'OKAY'
+
+  def GetVar(self, var):
+    if var == 'at-attest-uuid':
+      return self.GetUuid() or ''
+    if var == 'at-vboot-state':
+      lines = [
+          ('bootloader-locked', int(self.bootloader_locked)),
+          ('bootloader-min-versions', '-1,0,3'),
+          ('avb-perm-attr-set', int(self.avb_perm_attr_set)),
+          ('avb-locked', int(self.avb_locked)),
+          ('avb-unlock-disabled', 0),
+          ('avb-min-versions', '0:1,1:1,2:1,4097 :2,4098:2'),
+      ]
+      return ''.join('%s%s: %s\n' % (BOOTLOADER_STRING, key, value)
+                     for (key, value) in lines)
+    if var == 'at-attest-dh':
+      names = {ALGORITHM_P256: 'p256', ALGORITHM_CURVE25519: 'curve25519'}
+      return ','.join('%d:%s' % (algorithm, names[algorithm])
+                      for algorithm in self._algorithms)
+    if var == 'max-download-size':
+      return '0x10000000'
+    return _SimulatedDevice.GetVar(self, var)
+
+
+class SimulatedAtfa(_SimulatedDevice):
+  """A simulated ATFA issuing keys from a CA.
+
+  Attributes:
+    keys_left: The number of keys left to issue.
+    os: The host OS set on the ATFA.
+  """
+
+  def __init__(self, serial_number, ca, keys_left=1000, os_version='Linux',
+               operation=OPERATION_ISSUE):
+    _SimulatedDevice.__init__(self, serial_number)
+    self._ca = ca
+    self._operation = operation
+    self._session = None
+    self.keys_left = keys_left
+    self.os = os_version
+
+  def Oem(self, oem_command):
+    if oem_command.startswith('atfa-start-provisioning '):
+      algorithm = int(oem_command.split(' ', 1)[1])
+      (self._session, self.staged) = self._ca.StartSession(
+          algorithm, self._operation)
+    elif oem_command == 'atfa-finish-provisioning':
+      if self._session is None:
+        raise FastbootFailure('FAILED (remote: no provisioning session)')
+      if self.keys_left <= 0:
+        raise FastbootFailure('FAILED (remote: no keys left)')
+      try:
+        self.staged = self._ca.GetCaResponse(self._session, self.staged)
+      except ValueError as e:
+        raise FastbootFailure('FAILED (remote: %s)' % e)
+      finally:
+        self._session = None
+      self.keys_left -= 1
+    elif oem_command.startswith('num-keys '):
+      return '%s%d\nOKAY' % (BOOTLOADER_STRING, self.keys_left)
+    elif oem_command == 'get-os':
+      return '%s%s\nOKAY' % (BOOTLOADER_STRING, self.os)
+    elif oem_command.startswith('set-os '):
+      self.os = oem_command.split(' ', 1)[1]
+    elif oem_command.startswith('set-date '):
+      pass
+    else:
+      return _SimulatedDevice.Oem(self, oem_command)
+    return 'OKAY'
+
+
+class _SimulatedFastbootDevice(object):
+  """The FastbootDevice interface of a simulated device."""
+
+  def __init__(self, fleet, device):
+    self._fleet = fleet
+    self._device = device
+    self.serial_number = device.serial_number
+
+  def _Run(self, func, *args):
+    with self._device.lock:
+      if self._fleet.command_latency:
+        time.sleep(self._fleet.command_latency)
+      return func(*args)
+
+  def Reboot(self):
+    return self._Run(lambda: 'OKAY')
+
+  def Oem(self, oem_command, err_to_out):
+    return self._Run(self._device.Oem, oem_command)
+
+  def Flash(self, partition, file_path):
+    return self._Run(lambda: 'OKAY')
+
+  def Upload(self, file_path):
+    def Upload():
+      with open(file_path, 'wb') as upload_file:
+        upload_file.write(self._device.staged)
+    return self._Run(Upload)
+
+  def Download(self, file_path):
+    def Download():
+      with open(file_path, 'rb') as download_file:
+        self._device.staged = download_file.read()
+    return self._Run(Download)
+
+  def GetVar(self, var):
+    return self._Run(self._device.GetVar, var)
+
+  def GetHostOs(self):
+    return self._fleet.GetHostOs()
+
+  def Disconnect(self):
+    pass
+
+
+class SimulatedFleet(object):
+  """A fastboot device controller for simulated devices.
+
+  Used in place of the FastbootDevice class: calling it creates a device.
+  """
+
+  def __init__(self, library=None, ca=None, command_latency=0.0,
+               host_os='Linux'):
+    """Initialize the fleet.
+
+    Args:
+      library: The AtapHostLibrary, loaded from the default path if None.
+      ca: The CA used by the ATFAs, the TestCa if None.
+      command_latency: The time in seconds every command takes.
+      host_os: The host OS reported to AtftManager.
+    """
+    self._library = library
+    self._ca = ca
+    self.command_latency = command_latency
+    self._host_os = host_os
+    self._lock = threading.Lock()
+    self._devices = {}
+    self._next_index = 0
+
+  def _Add(self, device):
+    with self._lock:
+      self._devices[device.serial_number] = device
+    return device
+
+  def _NextSerial(self, prefix):
+    with self._lock:
+      self._next_index += 1
+      return '%s%06d' % (prefix, self._next_index)
+
+  def AddTarget(self, serial_number=None, product_id=None, provisioned_to=0,
+                **kwargs):
+    """Add a simulated target device.
+
+    Args:
+      serial_number: The serial number, generated if None.
+      product_id: The product ID, all zero bytes if None.
+      provisioned_to: The number of steps already done on the device: 1 to
+        fuse the vboot key, 2 to also fuse the permanent attributes, 3 to
+        also lock AVB.
+      **kwargs: The other SimulatedTarget arguments.
+    Returns:
+      The SimulatedTarget.
+    """
+    if self._library is None:
+      self._library = AtapHostLibrary()
+    target = SimulatedTarget(
+        serial_number or self._NextSerial('SIM'), self._library,
+        product_id or '\0' * PRODUCT_ID_LEN, **kwargs)
+    target.bootloader_locked = provisioned_to >= 1
+    target.avb_perm_attr_set = provisioned_to >= 2
+    target.avb_locked = provisioned_to >= 3
+    return self._Add(target)
+
+  def AddAtfa(self, serial_number=None, **kwargs):
+    """Add a simulated ATFA.
+
+    Args:
+      serial_number: The serial number, generated if None.
+      **kwargs: The other SimulatedAtfa arguments.
+    Returns:
+      The SimulatedAtfa.
+    """
+    if self._ca is None:
+      self._ca = TestCa()
+    kwargs.setdefault('os_version', self._host_os)
+    return self._Add(SimulatedAtfa(
+        serial_number or self._NextSerial('ATFASIM'), self._ca, **kwargs))
+
+  def Remove(self, serial_number):
+    """Unplug a simulated device."""
+    with self._lock:
+      device = self._devices.pop(serial_number, None)
+    if isinstance(device, SimulatedTarget):
+      with device.lock:
+        device.Free()
+
+  def GetDevice(self, serial_number):
+    with self._lock:
+      return self._devices.get(serial_number)
+
+  def __call__(self, serial_number):
+    device = self.GetDevice(serial_number)
+    if device is None:
+      raise FastbootFailure('< waiting for %s >' % serial_number)
+    return _SimulatedFastbootDevice(self, device)
+
+  def ListDevices(self):
+    with self._lock:
+      return sorted(self._devices.keys())
+
+  def GetHostOs(self):
+    return self._host_os
+
+  def CreateSerialMapper(self):
+    """Get a serial mapper factory placing the devices on simulated ports."""
+    return lambda: _SimulatedSerialMapper(self)
+
+
+class _SimulatedSerialMapper(object):
+
+  def __init__(self, fleet):
+    self._fleet = fleet
+
+  def refresh_serial_map(self):
+    pass
+
+  def get_location(self, serial):
+    if self._fleet.GetDevice(serial) is None:
+      return None
+    return 'sim-' + serial
@@ -0,0 +1,163 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the simulated devices.
+
+Needs libatap_host.so ($ make -C ../atap/host) and the dependencies of the
+test CA in partner-tools, the tests are skipped otherwise.
+"""
+import unittest
+
+import atftman
+from atftman import ProvisionStatus
+from fastboot_exceptions import FastbootFailure
+import simdevice
+
+try:
+  _LIBRARY = simdevice.AtapHostLibrary()
+  _CA = simdevice.TestCa()
+  _SKIP_REASON = None
+except (OSError, ImportError) as e:
+  _LIBRARY = None
+  _CA = None
+  _SKIP_REASON = 'Simulated devices not available: %s' % e
+
+
+class _TamperingCa(object):
+  """A CA flipping one byte of its CA Response messages."""
+
+  def StartSession(self, algorithm, operation):
+    return _CA.StartSession(algorithm, operation)
+
+  def GetCaResponse(self, session, ca_request):
+    ca_response = bytearray(_CA.GetCaResponse(session, ca_request))
+    ca_response[-1] ^= 1
+    return bytes(ca_response)
+
+
+@unittest.skipIf(_SKIP_REASON, _SKIP_REASON)
+class SimulatedDeviceTest(unittest.TestCase):
+
+  def _CreateManager(self, ca=None, targets=1, provisioned_to=3, **kwargs):
+    self.fleet = simdevice.SimulatedFleet(_LIBRARY, ca or _CA)
+    self.atfa = self.fleet.AddAtfa()
+    for _ in range(targets):
+      self.fleet.AddTarget(provisioned_to=provisioned_to, **kwargs)
+    manager = atftman.AtftManager(
+        self.fleet, self.fleet.CreateSerialMapper(), None)
+    manager.product_info = atftman.ProductInfo(
+        '0' * 32, 'simulated', bytearray(simdevice.PERM_ATTR_LEN),
+        bytearray(1024))
+    # A device is added once it is listed twice.
+    manager.ListDevices()
+    manager.ListDevices()
+    return manager
+
+  # Test the provisioning handshake
+  def testProvision(self):
+    manager = self._CreateManager(targets=2)
+    self.assertEqual(self.atfa.serial_number, manager.atfa_dev.serial_number)
+    for target in manager.target_devs:
+      manager.Provision(target)
+      self.assertEqual(ProvisionStatus.PROVISION_SUCCESS,
+                       target.provision_status)
+      device = self.fleet.GetDevice(target.serial_number)
+      self.assertEqual(simdevice.HEX_UUID_LEN, len(device.GetUuid()))
+      self.assertTrue(device.GetAttestationKeyCount() > 0)
+    self.assertEqual(998, self.atfa.keys_left)
+
+  def testProvisionP256(self):
+    manager = self._CreateManager(algorithms=(simdevice.ALGORITHM_P256,))
+    manager.Provision(manager.target_devs[0])
+    self.assertTrue(manager.target_devs[0].provision_state.provisioned)
+
+  def testTamperedCaResponse(self):
+    manager = self._CreateManager(ca=_TamperingCa())
+    target = manager.target_devs[0]
+    with self.assertRaises(FastbootFailure):
+      manager.Provision(target)
+    self.assertEqual(ProvisionStatus.PROVISION_FAILED, target.provision_status)
+    self.assertIsNone(self.fleet.GetDevice(target.serial_number).GetUuid())
+
+  def testInterleavedSessions(self):
+    # Every device keeps its own libatap session.
+    fleet = simdevice.SimulatedFleet(_LIBRARY, _CA)
+    targets = [fleet.AddTarget() for _ in range(2)]
+    sessions = []
+    for target in targets:
+      (session, target.staged) = _CA.StartSession(
+          simdevice.ALGORITHM_CURVE25519)
+      target.Oem('at-get-ca-request')
+      sessions.append(session)
+    for (target, session) in reversed(zip(targets, sessions)):
+      target.staged = _CA.GetCaResponse(session, target.staged)
+      target.Oem('at-set-ca-response')
+      self.assertIsNotNone(target.GetUuid())
+
+  def testKeyPool(self):
+    ca = simdevice.TestCa(key_pool_depth=2)
+    self.addCleanup(ca.Close)
+    manager = self._CreateManager(ca=ca, targets=3)
+    for target in manager.target_devs:
+      manager.Provision(target)
+      self.assertTrue(target.provision_state.provisioned)
+
+  def testProcessCrypto(self):
+    ca = simdevice.TestCa(crypto_mode='process', crypto_workers=2)
+    self.addCleanup(ca.Close)
+    manager = self._CreateManager(ca=ca, targets=2)
+    for target in manager.target_devs:
+      manager.Provision(target)
+      self.assertTrue(target.provision_state.provisioned)
+
+  def testSessionKeyUsedOnce(self):
+    target = simdevice.SimulatedFleet(_LIBRARY, _CA).AddTarget()
+    (session, target.staged) = _CA.StartSession(simdevice.ALGORITHM_P256)
+    target.Oem('at-get-ca-request')
+    ca_request = target.staged
+    _CA.GetCaResponse(session, ca_request)
+    self.assertEqual(bytearray(len(session.private_key)), session.private_key)
+    with self.assertRaises(ValueError):
+      _CA.GetCaResponse(session, ca_request)
+
+  # Test the other provision steps
+  def testFuseAndLock(self):
+    manager = self._CreateManager(provisioned_to=0)
+    target = manager.target_devs[0]
+    self.assertEqual(ProvisionStatus.IDLE, target.provision_status)
+    manager.FuseVbootKey(target)
+    manager.FusePermAttr(target)
+    manager.LockAvb(target)
+    self.assertEqual(ProvisionStatus.LOCKAVB_SUCCESS, target.provision_status)
+
+  def testLockBeforeFuse(self):
+    manager = self._CreateManager(provisioned_to=1)
+    with self.assertRaises(FastbootFailure):
+      manager.LockAvb(manager.target_devs[0])
+
+  # Test SimulatedFleet
+  def testRemove(self):
+    manager = self._CreateManager(targets=2)
+    serial = manager.target_devs[0].serial_number
+    self.fleet.Remove(serial)
+    self.assertNotIn(serial, self.fleet.ListDevices())
+    manager.ListDevices()
+    self.assertEqual(1, len(manager.target_devs))
+    with self.assertRaises(FastbootFailure):
+      self.fleet(serial)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,338 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Android sparse image encoding for flashing large raw images."""
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+SPARSE_HEADER_MAGIC = 0xED26FF3A
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+BLOCK_SIZE = 4096
+
+# magic, major_version, minor_version, file_hdr_sz, chunk_hdr_sz, blk_sz,
+# total_blks, total_chunks, image_checksum
+_FILE_HEADER = struct.Struct('<IHHHHIIII')
+# chunk_type, reserved, chunk_sz (in blocks), total_sz (in bytes)
+_CHUNK_HEADER = struct.Struct('<HHII')
+
+# The number of blocks read from the image at a time while scanning.
+_SCAN_BATCH_BLOCKS = 256
+
+
+class Chunk(object):
+  """A run of blocks in a sparse image.
+
+  Attributes:
+    chunk_type: CHUNK_TYPE_RAW, CHUNK_TYPE_FILL or CHUNK_TYPE_DONT_CARE.
+    start_block: The first block of the run in the image.
+    num_blocks: The number of blocks in the run.
+    fill: The 4 byte fill pattern for a FILL chunk.
+  """
+
+  def __init__(self, chunk_type, start_block, num_blocks, fill=None):
+    self.chunk_type = chunk_type
+    self.start_block = start_block
+    self.num_blocks = num_blocks
+    self.fill = fill
+
+  def DataSize(self, block_size=BLOCK_SIZE):
+    """The size of the chunk data following the chunk header."""
+    if self.chunk_type == CHUNK_TYPE_RAW:
+      return self.num_blocks * block_size
+    if self.chunk_type == CHUNK_TYPE_FILL:
+      return len(self.fill)
+    return 0
+
+  def TotalSize(self, block_size=BLOCK_SIZE):
+    """The size of the chunk in the sparse image including the header."""
+    return _CHUNK_HEADER.size + self.DataSize(block_size)
+
+
+class SparseScan(object):
+  """The chunks found in a raw image.
+
+  Attributes:
+    chunks: The list of Chunk objects covering the whole image.
+    total_blocks: The number of blocks in the image, the last one may be
+      partial in the raw file and is padded with zeros.
+    raw_size: The size of the raw image in bytes.
+  """
+
+  def __init__(self, chunks, total_blocks, raw_size):
+    self.chunks = chunks
+    self.total_blocks = total_blocks
+    self.raw_size = raw_size
+
+  def SparseSize(self):
+    """The size of the image encoded as a single sparse image."""
+    return _FILE_HEADER.size + sum(chunk.TotalSize() for chunk in self.chunks)
+
+
+def IsSparseImage(file_path):
+  """Check whether a file is already an Android sparse image.
+
+  Args:
+    file_path: The path of the image file.
+  Returns:
+    Whether the file starts with the sparse image magic.
+  """
+  with open(file_path, 'rb') as image_file:
+    magic = image_file.read(4)
+  return len(magic) == 4 and struct.unpack('<I', magic)[0] == (
+      SPARSE_HEADER_MAGIC)
+
+
+def _GetFill(block, zero_block):
+  """Get the fill pattern if a block repeats one 4 byte pattern.
+
+  Args:
+    block: The block data.
+    zero_block: A block of zeros of the same size.
+  Returns:
+    The 4 byte pattern, None if the block is not a fill block.
+  """
+  if block == zero_block:
+    return zero_block[:4]
+  pattern = block[:4]
+  # Reject most data blocks before building the full pattern.
+  if block[4:8] != pattern or block[-4:] != pattern:
+    return None
+  if block == pattern * (len(block) / 4):
+    return pattern
+  return None
+
+
+def ScanImage(file_path, block_size=BLOCK_SIZE):
+  """Split a raw image into runs of raw and fill blocks.
+
+  The image is read in batches, and a batch of zeros is detected with a
+  single comparison so that mostly empty images are scanned quickly.
+
+  Args:
+    file_path: The path of the raw image file.
+    block_size: The block size of the sparse image.
+  Returns:
+    The SparseScan object.
+  """
+  chunks = []
+  zero_block = '\0' * block_size
+  zero_batch = zero_block * _SCAN_BATCH_BLOCKS
+  block_index = 0
+  raw_size = 0
+
+  def _Append(chunk_type, num_blocks, fill=None):
+    last = chunks[-1] if chunks else None
+    if (last and last.chunk_type == chunk_type and last.fill == fill and
+        last.start_block + last.num_blocks == block_index):
+      last.num_blocks += num_blocks
+    else:
+      chunks.append(Chunk(chunk_type, block_index, num_blocks, fill))
+
+  with open(file_path, 'rb') as image_file:
+    while True:
+      batch = image_file.read(block_size * _SCAN_BATCH_BLOCKS)
+      if not batch:
+        break
+      raw_size += len(batch)
+      if batch == zero_batch:
+        _Append(CHUNK_TYPE_FILL, _SCAN_BATCH_BLOCKS, zero_block[:4])
+        block_index += _SCAN_BATCH_BLOCKS
+        continue
+      if len(batch) % block_size:
+        batch += '\0' * (block_size - len(batch) % block_size)
+      for offset in xrange(0, len(batch), block_size):
+        fill = _GetFill(batch[offset:offset + block_size], zero_block)
+        if fill is None:
+          _Append(CHUNK_TYPE_RAW, 1)
+        else:
+          _Append(CHUNK_TYPE_FILL, 1, fill)
+        block_index += 1
+  return SparseScan(chunks, block_index, raw_size)
+
+
+def SplitChunks(scan, max_size, block_size=BLOCK_SIZE):
+  """Split the chunks of an image into sparse images no larger than max_size.
+
+  Every part covers the whole image: the blocks written by other parts are
+  DONT_CARE chunks, so flashing the parts one after another writes the
+  complete image.
+
+  Args:
+    scan: The SparseScan object of the image.
+    max_size: The maximum size in bytes of one sparse image, None for one
+      part.
+    block_size: The block size of the sparse image.
+  Returns:
+    A list of chunk lists, one per part.
+  Raises:
+    ValueError: If max_size cannot hold even one block.
+  """
+  # Each part has a file header and at most two DONT_CARE chunks around the
+  # blocks it writes.
+  overhead = _FILE_HEADER.size + 2 * _CHUNK_HEADER.size
+  if max_size is None:
+    budget = None
+  else:
+    budget = max_size - overhead
+    if budget < _CHUNK_HEADER.size + block_size:
+      raise ValueError('max download size %d too small' % max_size)
+
+  parts = []
+  current = []
+  used = 0
+  for chunk in scan.chunks:
+    remaining = chunk
+    while remaining:
+      size = remaining.TotalSize(block_size)
+      if budget is None or used + size <= budget:
+        current.append(remaining)
+        used += size
+        break
+      if remaining.chunk_type == CHUNK_TYPE_RAW:
+        fit_blocks = (budget - used - _CHUNK_HEADER.size) / block_size
+        if fit_blocks > 0:
+          current.append(Chunk(CHUNK_TYPE_RAW, remaining.start_block,
+                               fit_blocks))
+          remaining = Chunk(CHUNK_TYPE_RAW, remaining.start_block + fit_blocks,
+                            remaining.num_blocks - fit_blocks)
+      parts.append(current)
+      current = []
+      used = 0
+  if current or not parts:
+    parts.append(current)
+
+  padded_parts = []
+  for part in parts:
+    padded = []
+    start = part[0].start_block if part else scan.total_blocks
+    end = part[-1].start_block + part[-1].num_blocks if part else start
+    if start > 0:
+      padded.append(Chunk(CHUNK_TYPE_DONT_CARE, 0, start))
+    padded.extend(part)
+    if end < scan.total_blocks:
+      padded.append(
+          Chunk(CHUNK_TYPE_DONT_CARE, end, scan.total_blocks - end))
+    padded_parts.append(padded)
+  return padded_parts
+
+
+def WriteSparseImage(source_path, chunks, total_blocks, output_path,
+                     block_size=BLOCK_SIZE):
+  """Write chunks of a raw image as a sparse image.
+
+  Args:
+    source_path: The path of the raw image the RAW chunks are read from.
+    chunks: The chunks covering all total_blocks blocks.
+    total_blocks: The number of blocks in the image.
+    output_path: The path of the sparse image to write.
+    block_size: The block size of the sparse image.
+  """
+  with open(source_path, 'rb') as source, open(output_path, 'wb') as output:
+    output.write(_FILE_HEADER.pack(
+        SPARSE_HEADER_MAGIC, 1, 0, _FILE_HEADER.size, _CHUNK_HEADER.size,
+        block_size, total_blocks, len(chunks), 0))
+    for chunk in chunks:
+      output.write(_CHUNK_HEADER.pack(chunk.chunk_type, 0, chunk.num_blocks,
+                                      chunk.TotalSize(block_size)))
+      if chunk.chunk_type == CHUNK_TYPE_FILL:
+        output.write(chunk.fill)
+      elif chunk.chunk_type == CHUNK_TYPE_RAW:
+        source.seek(chunk.start_block * block_size)
+        remaining = chunk.num_blocks * block_size
+        while remaining:
+          data = source.read(min(remaining, 1024 * 1024))
+          if not data:
+            # The last block of the image is partial.
+            data = '\0' * remaining
+          output.write(data)
+          remaining -= len(data)
+
+
+class SparseImageCache(object):
+  """Converts raw images to sparse images to flash and caches the result.
+
+  The scan of an image and the sparse images written for it are kept per
+  image digest, so an image is only converted once for all devices.
+  """
+
+  def __init__(self, cache_dir):
+    """Initialize the cache.
+
+    Args:
+      cache_dir: The directory to store the sparse images in.
+    """
+    self.cache_dir = cache_dir
+    self._lock = threading.Lock()
+    self._scans = {}
+    self._key_locks = {}
+
+  def _GetKeyLock(self, key):
+    with self._lock:
+      if key not in self._key_locks:
+        self._key_locks[key] = threading.Lock()
+      return self._key_locks[key]
+
+  def _GetScan(self, file_path, digest):
+    with self._GetKeyLock(digest):
+      if digest not in self._scans:
+        self._scans[digest] = ScanImage(file_path)
+      return self._scans[digest]
+
+  def GetFlashFiles(self, file_path, digest, max_download_size=None):
+    """Get the files to flash for an image.
+
+    The raw image is used as it is if it is already sparse, or if it fits in
+    max_download_size and encoding would not make it smaller.
+
+    Args:
+      file_path: The path of the image file.
+      digest: The hex SHA-256 digest of the image file.
+      max_download_size: The max-download-size of the device in bytes, None
+        if unknown.
+    Returns:
+      The list of file paths to be flashed to the partition in order.
+    """
+    if IsSparseImage(file_path):
+      return [file_path]
+    scan = self._GetScan(file_path, digest)
+    fits = max_download_size is None or scan.raw_size <= max_download_size
+    if fits and scan.SparseSize() >= scan.raw_size:
+      return [file_path]
+
+    key = '%s_%s' % (digest, max_download_size or 'all')
+    part_dir = os.path.join(self.cache_dir, key)
+    with self._GetKeyLock(key):
+      if not os.path.isdir(part_dir):
+        if not os.path.isdir(self.cache_dir):
+          os.makedirs(self.cache_dir)
+        # Write into a temporary directory first so that an interrupted
+        # conversion is never used.
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        try:
+          parts = SplitChunks(scan, max_download_size)
+          for (index, chunks) in enumerate(parts):
+            WriteSparseImage(file_path, chunks, scan.total_blocks,
+                             os.path.join(tmp_dir, '%04d.simg' % index))
+          os.rename(tmp_dir, part_dir)
+        except:
+          shutil.rmtree(tmp_dir, ignore_errors=True)
+          raise
+      return [os.path.join(part_dir, name)
+              for name in sorted(os.listdir(part_dir))]
@@ -0,0 +1,151 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the sparse image encoder."""
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import sparseimage
+from sparseimage import BLOCK_SIZE
+
+from mock import patch
+
+
+class SparseImageTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+  def _WriteImage(self, data, name='raw.img'):
+    file_path = os.path.join(self.tmp_dir, name)
+    with open(file_path, 'wb') as image_file:
+      image_file.write(data)
+    return file_path
+
+  @staticmethod
+  def _Expand(file_paths, output_size):
+    """Decode sparse images flashed one after another into a raw image."""
+    output = bytearray(output_size)
+    for file_path in file_paths:
+      with open(file_path, 'rb') as sparse_file:
+        data = sparse_file.read()
+      header = struct.unpack('<IHHHHIIII', data[:28])
+      (block_size, total_blocks, total_chunks) = header[5:8]
+      offset = 28
+      block = 0
+      for _ in range(total_chunks):
+        (chunk_type, _, num_blocks, total_size) = struct.unpack(
+            '<HHII', data[offset:offset + 12])
+        payload = data[offset + 12:offset + total_size]
+        start = block * block_size
+        end = start + num_blocks * block_size
+        if chunk_type == sparseimage.CHUNK_TYPE_RAW:
+          output[start:end] = payload
+        elif chunk_type == sparseimage.CHUNK_TYPE_FILL:
+          output[start:end] = payload * (num_blocks * block_size / 4)
+        block += num_blocks
+        offset += total_size
+      assert block == total_blocks
+    return str(output)
+
+  # Test ScanImage
+  def testScanImage(self):
+    data = ('\0' * BLOCK_SIZE * 3 + 'abcd' * (BLOCK_SIZE / 4) +
+            os.urandom(BLOCK_SIZE * 2) + '\0' * 100)
+    scan = sparseimage.ScanImage(self._WriteImage(data))
+    self.assertEqual(7, scan.total_blocks)
+    self.assertEqual(len(data), scan.raw_size)
+    self.assertEqual(
+        [(sparseimage.CHUNK_TYPE_FILL, 0, 3, '\0\0\0\0'),
+         (sparseimage.CHUNK_TYPE_FILL, 3, 1, 'abcd'),
+         (sparseimage.CHUNK_TYPE_RAW, 4, 2, None),
+         (sparseimage.CHUNK_TYPE_FILL, 6, 1, '\0\0\0\0')],
+        [(chunk.chunk_type, chunk.start_block, chunk.num_blocks, chunk.fill)
+         for chunk in scan.chunks])
+
+  def testScanImageZeroBatches(self):
+    data = '\0' * BLOCK_SIZE * 600
+    scan = sparseimage.ScanImage(self._WriteImage(data))
+    self.assertEqual(1, len(scan.chunks))
+    self.assertEqual(600, scan.chunks[0].num_blocks)
+    self.assertEqual(28 + 12 + 4, scan.SparseSize())
+
+  # Test SplitChunks and WriteSparseImage
+  def testSplitRoundTrip(self):
+    data = (os.urandom(BLOCK_SIZE * 5) + '\0' * BLOCK_SIZE * 10 +
+            os.urandom(BLOCK_SIZE * 3 + 10))
+    source = self._WriteImage(data)
+    scan = sparseimage.ScanImage(source)
+    max_size = 28 + 24 + 12 + BLOCK_SIZE * 3
+    parts = sparseimage.SplitChunks(scan, max_size)
+    self.assertEqual(4, len(parts))
+    file_paths = []
+    for (index, chunks) in enumerate(parts):
+      file_path = os.path.join(self.tmp_dir, '%d.simg' % index)
+      sparseimage.WriteSparseImage(source, chunks, scan.total_blocks,
+                                   file_path)
+      self.assertTrue(os.path.getsize(file_path) <= max_size)
+      self.assertTrue(sparseimage.IsSparseImage(file_path))
+      file_paths.append(file_path)
+    expanded = self._Expand(file_paths, scan.total_blocks * BLOCK_SIZE)
+    self.assertEqual(data, expanded[:len(data)])
+
+  def testSplitTooSmall(self):
+    scan = sparseimage.ScanImage(self._WriteImage(os.urandom(BLOCK_SIZE)))
+    with self.assertRaises(ValueError):
+      sparseimage.SplitChunks(scan, 1000)
+
+  # Test SparseImageCache
+  def testCacheSmallImageUsesRaw(self):
+    cache = sparseimage.SparseImageCache(os.path.join(self.tmp_dir, 'cache'))
+    source = self._WriteImage('boot')
+    self.assertEqual([source], cache.GetFlashFiles(source, 'digest', 4096))
+
+  def testCacheSparseImageUsesSource(self):
+    cache = sparseimage.SparseImageCache(os.path.join(self.tmp_dir, 'cache'))
+    source = self._WriteImage(struct.pack('<I', 0xED26FF3A) + '\0' * 100)
+    self.assertEqual([source], cache.GetFlashFiles(source, 'digest'))
+
+  def testCacheEmptyImage(self):
+    cache = sparseimage.SparseImageCache(os.path.join(self.tmp_dir, 'cache'))
+    data = os.urandom(BLOCK_SIZE) + '\0' * BLOCK_SIZE * 1000
+    source = self._WriteImage(data)
+    file_paths = cache.GetFlashFiles(source, 'digest', 1024 * 1024)
+    self.assertEqual(1, len(file_paths))
+    self.assertTrue(os.path.getsize(file_paths[0]) < BLOCK_SIZE * 2)
+    self.assertEqual(data, self._Expand(file_paths, len(data)))
+    # The encoded image is reused for the same digest.
+    with patch('sparseimage.ScanImage') as mock_scan, patch(
+        'sparseimage.WriteSparseImage') as mock_write:
+      self.assertEqual(file_paths,
+                       cache.GetFlashFiles(source, 'digest', 1024 * 1024))
+      mock_scan.assert_not_called()
+      mock_write.assert_not_called()
+
+  def testCacheLargeImageSplit(self):
+    cache = sparseimage.SparseImageCache(os.path.join(self.tmp_dir, 'cache'))
+    data = os.urandom(BLOCK_SIZE * 8)
+    source = self._WriteImage(data)
+    file_paths = cache.GetFlashFiles(source, 'digest', BLOCK_SIZE * 3)
+    self.assertEqual(4, len(file_paths))
+    self.assertEqual(data, self._Expand(file_paths, len(data)))
+
+
+if __name__ == '__main__':
+  unittest.main()
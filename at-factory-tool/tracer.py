@@ -0,0 +1,243 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Timeline tracing of the provisioning stages and the fastboot commands.
+
+The trace is saved in the Chrome trace event format, which can be loaded in
+Perfetto (ui.perfetto.dev) or about:tracing. Every span is shown on the track
+of the thread that ran it. Commands are also shown on the track of the device
+while the device runs them, and queued tasks on the track of their worker
+pool, so that the time a thread waits for a device or a pool is visible.
+
+Tracing is off unless a Tracer is started, and costs one check per span when
+off.
+"""
+import collections
+import functools
+import json
+import os
+import tempfile
+import thread
+import threading
+import time
+
+CATEGORY_STAGE = 'stage'
+CATEGORY_COMMAND = 'command'
+CATEGORY_TASK = 'task'
+
+# The trace processes grouping the tracks.
+_THREADS_PID = 1
+_DEVICES_PID = 2
+_POOLS_PID = 3
+_PROCESS_NAMES = {
+    _THREADS_PID: 'Threads',
+    _DEVICES_PID: 'Devices',
+    _POOLS_PID: 'Worker pools',
+}
+
+_tracer = None
+
+
+def Start(tracer):
+  """Start recording spans into a tracer.
+
+  Args:
+    tracer: The Tracer object.
+  """
+  global _tracer
+  _tracer = tracer
+
+
+def Stop():
+  """Stop recording spans.
+
+  Returns:
+    The Tracer object that was recording, None if none.
+  """
+  global _tracer
+  tracer = _tracer
+  _tracer = None
+  return tracer
+
+
+def GetTracer():
+  """Get the recording Tracer object, None if tracing is off."""
+  return _tracer
+
+
+class Tracer(object):
+  """Records complete events, optionally in a bounded ring buffer."""
+
+  def __init__(self, max_events=None):
+    """Initialize the tracer.
+
+    Args:
+      max_events: The number of most recent events to keep, None to keep all
+        the events.
+    """
+    self._events = collections.deque(maxlen=max_events or None)
+    self._lock = threading.Lock()
+    self._start_time = time.time()
+    self._recorded = 0
+    # Maps (pid, track key) to (tid, track name).
+    self._tracks = {}
+
+  def _GetTid(self, pid, key, name):
+    track = self._tracks.get((pid, key))
+    if track is None:
+      track = (len(self._tracks) + 1, name)
+      self._tracks[(pid, key)] = track
+    return track[0]
+
+  def _Add(self, pid, tid, name, category, start_time, end_time, args):
+    # Kept as tuples so that a long running ring buffer stays small.
+    self._events.append((
+        pid, tid, name, category,
+        int((start_time - self._start_time) * 1e6),
+        max(0, int((end_time - start_time) * 1e6)), args))
+    self._recorded += 1
+
+  def AddSpan(self, name, category, start_time, end_time, device=None,
+              args=None, on_thread=True, on_device=False, pool=None):
+    """Record a span.
+
+    Args:
+      name: The name of the span.
+      category: The category of the span.
+      start_time: The start time from time.time().
+      end_time: The end time from time.time().
+      device: The serial number of the device the span is for.
+      args: A map of extra information shown for the span.
+      on_thread: Whether to show the span on the current thread's track.
+      on_device: Whether to show the span on the device's track.
+      pool: The name of the worker pool track to show the span on.
+    """
+    if device is not None:
+      args = dict(args or {}, device=device)
+    with self._lock:
+      if on_thread:
+        current = threading.current_thread()
+        tid = self._GetTid(_THREADS_PID, thread.get_ident(), current.name)
+        self._Add(_THREADS_PID, tid, name, category, start_time, end_time,
+                  args)
+      if on_device and device is not None:
+        tid = self._GetTid(_DEVICES_PID, device, device)
+        self._Add(_DEVICES_PID, tid, name, category, start_time, end_time,
+                  args)
+      if pool is not None:
+        tid = self._GetTid(_POOLS_PID, pool, pool)
+        self._Add(_POOLS_PID, tid, name, category, start_time, end_time, args)
+
+  def GetEvents(self):
+    """Get the trace in the Chrome trace event format.
+
+    Returns:
+      A map with the 'traceEvents' list.
+    """
+    with self._lock:
+      events = list(self._events)
+      tracks = self._tracks.items()
+      dropped = self._recorded - len(events)
+    trace_events = []
+    for (pid, name) in sorted(_PROCESS_NAMES.iteritems()):
+      trace_events.append({'ph': 'M', 'name': 'process_name', 'pid': pid,
+                           'args': {'name': name}})
+    for ((pid, _), (tid, name)) in tracks:
+      trace_events.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                           'tid': tid, 'args': {'name': name}})
+    for (pid, tid, name, category, ts, dur, args) in events:
+      event = {'ph': 'X', 'pid': pid, 'tid': tid, 'name': name,
+               'cat': category, 'ts': ts, 'dur': dur}
+      if args:
+        event['args'] = args
+      trace_events.append(event)
+    return {
+        'traceEvents': trace_events,
+        'displayTimeUnit': 'ms',
+        'otherData': {'dropped_events': dropped}
+    }
+
+  def Save(self, file_path):
+    """Write the trace to a JSON file.
+
+    The file is replaced at once so that a reader never sees a partial trace.
+
+    Args:
+      file_path: The path of the trace file.
+    """
+    trace = self.GetEvents()
+    directory = os.path.dirname(os.path.abspath(file_path))
+    (handle, tmp_path) = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as trace_file:
+      json.dump(trace, trace_file, separators=(',', ':'), default=str)
+    if os.path.exists(file_path):
+      # os.rename does not replace an existing file on Windows.
+      os.remove(file_path)
+    os.rename(tmp_path, file_path)
+
+
+class Span(object):
+  """Context manager recording a span if tracing is on."""
+
+  def __init__(self, name, category=CATEGORY_STAGE, device=None, args=None,
+               on_thread=True, on_device=False):
+    self._name = name
+    self._category = category
+    self._device = device
+    self._args = args
+    self._on_thread = on_thread
+    self._on_device = on_device
+    self._start_time = None
+
+  def __enter__(self):
+    if _tracer is not None:
+      self._start_time = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    tracer = _tracer
+    if tracer is not None and self._start_time is not None:
+      args = self._args
+      if exc_type is not None:
+        args = dict(args or {}, error=exc_type.__name__)
+      tracer.AddSpan(self._name, self._category, self._start_time,
+                     time.time(), self._device, args, self._on_thread,
+                     self._on_device)
+
+
+def Traced(name=None, category=CATEGORY_STAGE):
+  """Decorator recording every call of a method as a span.
+
+  The device is taken from the serial_number of the first argument after
+  self, if any.
+
+  Args:
+    name: The name of the span, the function name if None.
+    category: The category of the span.
+  Returns:
+    The decorator.
+  """
+  def Decorator(func):
+    span_name = name or func.__name__
+
+    @functools.wraps(func)
+    def Wrapper(self, *args, **kwargs):
+      if _tracer is None:
+        return func(self, *args, **kwargs)
+      device = getattr(args[0], 'serial_number', None) if args else None
+      with Span(span_name, category, device):
+        return func(self, *args, **kwargs)
+    return Wrapper
+  return Decorator
@@ -0,0 +1,132 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the timeline tracer."""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import atftman
+import tracer
+from workerpool import WorkerPool
+
+from mock import MagicMock
+
+
+class TracedObject(object):
+
+  @tracer.Traced()
+  def Stage(self, device):
+    return device.serial_number
+
+  @tracer.Traced('Failing')
+  def Fail(self):
+    raise ValueError()
+
+
+class TracerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tracer = tracer.Tracer()
+    tracer.Start(self.tracer)
+    self.addCleanup(tracer.Stop)
+
+  def _Spans(self, trace=None):
+    trace = trace or self.tracer.GetEvents()
+    names = {}
+    for event in trace['traceEvents']:
+      if event['ph'] == 'M' and event['name'] == 'thread_name':
+        names[(event['pid'], event['tid'])] = event['args']['name']
+    return [(names[(event['pid'], event['tid'])], event['name'],
+             event.get('args', {}))
+            for event in trace['traceEvents'] if event['ph'] == 'X']
+
+  # Test Span and Traced
+  def testTraced(self):
+    device = MagicMock()
+    device.serial_number = 'serial1'
+    traced = TracedObject()
+    self.assertEqual('serial1', traced.Stage(device))
+    with self.assertRaises(ValueError):
+      traced.Fail()
+    spans = self._Spans()
+    self.assertEqual(2, len(spans))
+    self.assertEqual(('Stage', {'device': 'serial1'}), spans[0][1:])
+    self.assertEqual(('Failing', {'error': 'ValueError'}), spans[1][1:])
+
+  def testOff(self):
+    tracer.Stop()
+    with tracer.Span('Stage'):
+      pass
+    self.assertEqual([], self._Spans())
+
+  # Test the ring buffer
+  def testRingBuffer(self):
+    ring = tracer.Tracer(max_events=3)
+    tracer.Start(ring)
+    for i in range(5):
+      with tracer.Span('span%d' % i):
+        pass
+    trace = ring.GetEvents()
+    self.assertEqual(['span2', 'span3', 'span4'],
+                     [span[1] for span in self._Spans(trace)])
+    self.assertEqual(2, trace['otherData']['dropped_events'])
+
+  # Test the device command tracks
+  def testDeviceCommands(self):
+    controller = MagicMock()
+    controller.GetVar.return_value = 'value'
+    device = atftman.DeviceInfo(controller, 'serial1')
+    device.Oem('at-get-ca-request')
+    device.GetVar('at-attest-uuid')
+    spans = [(track, name, args) for (track, name, args) in self._Spans()]
+    # Each command is shown on the device track and on the thread track.
+    self.assertIn(('serial1', 'Oem', {'device': 'serial1',
+                                      'arg': 'at-get-ca-request'}), spans)
+    self.assertEqual(2, len([span for span in spans if span[0] == 'serial1']))
+    self.assertEqual(4, len(spans))
+
+  # Test the worker pool tracks
+  def testWorkerPool(self):
+    pool = WorkerPool(1, 'TracedPool')
+
+    def Task():
+      pass
+
+    pool.Submit(Task).Wait()
+    pool.Shutdown(wait=True)
+    spans = self._Spans()
+    self.assertIn(('TracedPool', 'Task (queued)', {}), spans)
+    self.assertIn(('TracedPool-0', 'Task', {}), spans)
+
+  # Test Tracer.Save
+  def testSave(self):
+    tmp_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmp_dir)
+    file_path = os.path.join(tmp_dir, 'trace.json')
+    with tracer.Span('Stage', device='serial1'):
+      pass
+    self.tracer.Save(file_path)
+    self.tracer.Save(file_path)
+    with open(file_path, 'r') as trace_file:
+      trace = json.load(trace_file)
+    self.assertEqual(1, len(self._Spans(trace)))
+    self.assertEqual(['trace.json'], os.listdir(tmp_dir))
+
+
+if __name__ == '__main__':
+  unittest.main()
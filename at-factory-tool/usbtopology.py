@@ -0,0 +1,283 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""USB topology aware scheduling of data transfers to devices."""
+import itertools
+import re
+import threading
+import time
+
+# Linux sysfs location: bus-port[.port.port], e.g. '1-2.3.4'.
+_LINUX_LOCATION_PATTERN = re.compile(r'^(\d+)-(\d+(?:\.\d+)*)$')
+# Windows location information, e.g. 'Port_#0001.Hub_#0004'.
+_WINDOWS_LOCATION_PATTERN = re.compile(r'^Port_#(\d+)\.Hub_#(\d+)$')
+
+
+class UsbLocation(object):
+  """The physical location of a USB device in the bus/hub tree.
+
+  Attributes:
+    bus: The root bus identifier.
+    ports: The tuple of port numbers from the root hub to the device.
+  """
+
+  def __init__(self, bus, ports):
+    self.bus = bus
+    self.ports = tuple(ports)
+
+  @property
+  def root_port(self):
+    """The key for the port on the root hub the device is connected under."""
+    return (self.bus, self.ports[:1])
+
+  @property
+  def hub(self):
+    """The key for the hub the device is directly connected to."""
+    return (self.bus, self.ports[:-1])
+
+  def __eq__(self, other):
+    return self.bus == other.bus and self.ports == other.ports
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __str__(self):
+    return '%s-%s' % (self.bus, '.'.join(str(port) for port in self.ports))
+
+
+def ParseLocation(location):
+  """Parse a location string from the SerialMapper.
+
+  Args:
+    location: The location string in Linux sysfs or Windows format.
+  Returns:
+    The UsbLocation object, None if the location is unknown or not parsable.
+  """
+  if not location or not isinstance(location, basestring):
+    return None
+  match = _LINUX_LOCATION_PATTERN.match(location)
+  if match:
+    ports = [int(port) for port in match.group(2).split('.')]
+    return UsbLocation(int(match.group(1)), ports)
+  match = _WINDOWS_LOCATION_PATTERN.match(location)
+  if match:
+    # Windows only tells the hub, use the hub as the bus so that devices on
+    # the same hub still share their limits.
+    return UsbLocation('hub' + str(int(match.group(2))),
+                       [int(match.group(1))])
+  return None
+
+
+def OrderByBus(items, get_location):
+  """Order items so that consecutive items are on different buses.
+
+  Items are taken round robin from each root bus, and inside a bus round robin
+  from each hub, keeping the original order for the same hub.
+
+  Args:
+    items: The list of items to order.
+    get_location: A function to get the location string for an item.
+  Returns:
+    The reordered list.
+  """
+  buses = {}
+  bus_order = []
+  for item in items:
+    usb_location = ParseLocation(get_location(item))
+    if usb_location:
+      bus, hub = usb_location.bus, usb_location.hub
+    else:
+      bus, hub = None, None
+    if bus not in buses:
+      buses[bus] = ({}, [])
+      bus_order.append(bus)
+    hubs, hub_order = buses[bus]
+    if hub not in hubs:
+      hubs[hub] = []
+      hub_order.append(hub)
+    hubs[hub].append(item)
+
+  missing = object()
+
+  def _RoundRobin(queues):
+    for group in itertools.izip_longest(*queues, fillvalue=missing):
+      for item in group:
+        if item is not missing:
+          yield item
+
+  bus_queues = []
+  for bus in bus_order:
+    hubs, hub_order = buses[bus]
+    bus_queues.append(list(_RoundRobin([hubs[hub] for hub in hub_order])))
+  return list(_RoundRobin(bus_queues))
+
+
+class _Transfer(object):
+  """A transfer slot held or requested in a TransferScheduler."""
+
+  def __init__(self, usb_location, sequence):
+    self.usb_location = usb_location
+    self.sequence = sequence
+
+
+class TransferScheduler(object):
+  """Limits the concurrent transfers per USB hub and per root port.
+
+  A device with unknown location is only limited by max_total. When a slot
+  frees up, the waiting transfer whose bus has the fewest running transfers
+  goes first, so that the load is spread across the buses.
+  """
+
+  def __init__(self, max_per_hub=None, max_per_root_port=None,
+               max_total=None):
+    """Initialize the scheduler.
+
+    Args:
+      max_per_hub: The maximum transfers on one hub, None for no limit.
+      max_per_root_port: The maximum transfers under one root hub port, None
+        for no limit.
+      max_total: The maximum transfers in total, None for no limit.
+    """
+    self.max_per_hub = max_per_hub
+    self.max_per_root_port = max_per_root_port
+    self.max_total = max_total
+    self._condition = threading.Condition()
+    self._sequence = itertools.count()
+    self._waiting = []
+    self._total = 0
+    self._per_hub = {}
+    self._per_root_port = {}
+    self._per_bus = {}
+
+  def _CanStart(self, transfer):
+    if self.max_total and self._total >= self.max_total:
+      return False
+    usb_location = transfer.usb_location
+    if not usb_location:
+      return True
+    if (self.max_per_hub and
+        self._per_hub.get(usb_location.hub, 0) >= self.max_per_hub):
+      return False
+    if (self.max_per_root_port and
+        self._per_root_port.get(usb_location.root_port, 0) >=
+        self.max_per_root_port):
+      return False
+    return True
+
+  def _BusLoad(self, transfer):
+    if not transfer.usb_location:
+      return 0
+    return self._per_bus.get(transfer.usb_location.bus, 0)
+
+  def _IsNext(self, transfer):
+    """Whether the transfer is the best waiting transfer that can start."""
+    if not self._CanStart(transfer):
+      return False
+    load = (self._BusLoad(transfer), transfer.sequence)
+    for other in self._waiting:
+      if (other is not transfer and self._CanStart(other) and
+          (self._BusLoad(other), other.sequence) < load):
+        return False
+    return True
+
+  def _Update(self, transfer, delta):
+    self._total += delta
+    usb_location = transfer.usb_location
+    if not usb_location:
+      return
+    for counts, key in ((self._per_hub, usb_location.hub),
+                        (self._per_root_port, usb_location.root_port),
+                        (self._per_bus, usb_location.bus)):
+      counts[key] = counts.get(key, 0) + delta
+      if not counts[key]:
+        del counts[key]
+
+  def Acquire(self, location, timeout=None):
+    """Wait for a transfer slot for a device.
+
+    Args:
+      location: The location string of the device.
+      timeout: The maximum time to wait in seconds, None to wait forever.
+    Returns:
+      The transfer object to be passed to Release, None if timeout.
+    """
+    transfer = _Transfer(ParseLocation(location), next(self._sequence))
+    deadline = None if timeout is None else time.time() + timeout
+    with self._condition:
+      self._waiting.append(transfer)
+      try:
+        while not self._IsNext(transfer):
+          if deadline is None:
+            self._condition.wait()
+            continue
+          remaining = deadline - time.time()
+          if remaining <= 0:
+            return None
+          self._condition.wait(remaining)
+      finally:
+        self._waiting.remove(transfer)
+        # Another waiter may be the best one now.
+        self._condition.notify_all()
+      self._Update(transfer, 1)
+      return transfer
+
+  def Release(self, transfer):
+    """Release a transfer slot.
+
+    Args:
+      transfer: The object returned by Acquire.
+    """
+    with self._condition:
+      self._Update(transfer, -1)
+      self._condition.notify_all()
+
+  def Transfer(self, location):
+    """Get a context manager that holds a transfer slot for a device.
+
+    Args:
+      location: The location string of the device.
+    Returns:
+      The context manager.
+    """
+    return _TransferContext(self, location)
+
+  def GetStats(self):
+    """Get the running transfers for monitoring.
+
+    Returns:
+      A map with the number of 'waiting' and 'running' transfers and the
+      'per_bus' map from bus to running transfers.
+    """
+    with self._condition:
+      return {
+          'waiting': len(self._waiting),
+          'running': self._total,
+          'per_bus': dict(self._per_bus)
+      }
+
+
+class _TransferContext(object):
+
+  def __init__(self, scheduler, location):
+    self._scheduler = scheduler
+    self._location = location
+    self._transfer = None
+
+  def __enter__(self):
+    self._transfer = self._scheduler.Acquire(self._location)
+    return self._transfer
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._scheduler.Release(self._transfer)
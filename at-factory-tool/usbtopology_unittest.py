@@ -0,0 +1,123 @@
+# !/usr/bin/python
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the USB topology aware transfer scheduler."""
+import threading
+import unittest
+
+import usbtopology
+
+
+class UsbTopologyTest(unittest.TestCase):
+
+  # Test ParseLocation
+  def testParseLinuxLocation(self):
+    location = usbtopology.ParseLocation('1-2.3.4')
+    self.assertEqual(1, location.bus)
+    self.assertEqual((2, 3, 4), location.ports)
+    self.assertEqual((1, (2,)), location.root_port)
+    self.assertEqual((1, (2, 3)), location.hub)
+    self.assertEqual('1-2.3.4', str(location))
+
+  def testParseLinuxRootPortLocation(self):
+    location = usbtopology.ParseLocation('3-1')
+    self.assertEqual((3, (1,)), location.root_port)
+    self.assertEqual((3, ()), location.hub)
+
+  def testParseWindowsLocation(self):
+    location = usbtopology.ParseLocation('Port_#0002.Hub_#0004')
+    self.assertEqual('hub4', location.bus)
+    self.assertEqual((2,), location.ports)
+
+  def testParseInvalidLocation(self):
+    self.assertEqual(None, usbtopology.ParseLocation(None))
+    self.assertEqual(None, usbtopology.ParseLocation(''))
+    self.assertEqual(None, usbtopology.ParseLocation('1-2:1.0'))
+    self.assertEqual(None, usbtopology.ParseLocation('usb1'))
+
+  # Test OrderByBus
+  def testOrderByBus(self):
+    locations = ['1-1.1', '1-1.2', '1-2.1', '2-1', '2-2', None]
+    ordered = usbtopology.OrderByBus(locations, lambda location: location)
+    self.assertEqual(['1-1.1', '2-1', None, '1-2.1', '2-2', '1-1.2'], ordered)
+
+  def testOrderByBusEmpty(self):
+    self.assertEqual([], usbtopology.OrderByBus([], lambda item: item))
+
+  # Test TransferScheduler
+  def testHubLimit(self):
+    scheduler = usbtopology.TransferScheduler(max_per_hub=2)
+    first = scheduler.Acquire('1-1.1')
+    second = scheduler.Acquire('1-1.2')
+    self.assertEqual(None, scheduler.Acquire('1-1.3', timeout=0.01))
+    # Another hub is not affected.
+    other = scheduler.Acquire('1-2.1', timeout=0.01)
+    self.assertNotEqual(None, other)
+    scheduler.Release(first)
+    third = scheduler.Acquire('1-1.3', timeout=0.01)
+    self.assertNotEqual(None, third)
+    for transfer in (second, other, third):
+      scheduler.Release(transfer)
+    self.assertEqual(0, scheduler.GetStats()['running'])
+
+  def testRootPortLimit(self):
+    scheduler = usbtopology.TransferScheduler(max_per_root_port=1)
+    transfer = scheduler.Acquire('1-1.1')
+    self.assertEqual(None, scheduler.Acquire('1-1.2.1', timeout=0.01))
+    self.assertNotEqual(None, scheduler.Acquire('1-2.1', timeout=0.01))
+    self.assertNotEqual(None, scheduler.Acquire('2-1.1', timeout=0.01))
+    scheduler.Release(transfer)
+
+  def testUnknownLocation(self):
+    scheduler = usbtopology.TransferScheduler(max_per_hub=1, max_total=2)
+    scheduler.Acquire(None)
+    scheduler.Acquire(None)
+    self.assertEqual(None, scheduler.Acquire(None, timeout=0.01))
+
+  def testBusBalancing(self):
+    scheduler = usbtopology.TransferScheduler(max_total=2)
+    running = [scheduler.Acquire('1-1'), scheduler.Acquire('2-1')]
+    order = []
+
+    def Worker(location):
+      with scheduler.Transfer(location):
+        order.append(location)
+
+    threads = []
+    for location in ('1-2', '1-3', '2-2'):
+      thread = threading.Thread(target=Worker, args=(location,))
+      thread.start()
+      threads.append(thread)
+      while scheduler.GetStats()['waiting'] < len(threads):
+        threading.Event().wait(0.001)
+
+    # Bus 1 is still busy, so the transfer on bus 2 should go first even
+    # though it came last.
+    scheduler.Release(running[1])
+    for thread in threads:
+      thread.join(5)
+    self.assertEqual(['2-2', '1-2', '1-3'], order)
+    scheduler.Release(running[0])
+
+  def testTransferContextReleases(self):
+    scheduler = usbtopology.TransferScheduler(max_per_hub=1)
+    with self.assertRaises(ValueError):
+      with scheduler.Transfer('1-1'):
+        raise ValueError('test')
+    self.assertEqual(0, scheduler.GetStats()['running'])
+
+
+if __name__ == '__main__':
+  unittest.main()
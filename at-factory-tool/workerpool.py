@@ -0,0 +1,398 @@
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A bounded pool of worker threads and a single thread timer scheduler."""
+import heapq
+import itertools
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+from tracer import CATEGORY_TASK
+from tracer import GetTracer
+
+
+class Task(object):
+  """A function call submitted to a WorkerPool.
+
+  Attributes:
+    submit_time: The time when the task was submitted.
+    start_time: The time when a worker started the task, None if not started.
+    end_time: The time when the task finished, None if not finished.
+  """
+
+  def __init__(self, func, args):
+    self._func = func
+    self._args = args
+    self._started = threading.Event()
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+    self.submit_time = time.time()
+    self.start_time = None
+    self.end_time = None
+
+  def Run(self, finish_callback=None):
+    """Run the task in the current thread and store the result.
+
+    Args:
+      finish_callback: Called with the task after the function returns but
+        before waiters are woken up.
+    """
+    self.start_time = time.time()
+    self._started.set()
+    try:
+      self._result = self._func(*self._args)
+    except Exception:  # pylint: disable=broad-except
+      self._exc_info = sys.exc_info()
+    finally:
+      self.end_time = time.time()
+      if finish_callback:
+        finish_callback(self)
+      self._done.set()
+
+  def IsStarted(self):
+    return self._started.is_set()
+
+  def IsDone(self):
+    return self._done.is_set()
+
+  def WaitStarted(self, timeout=None):
+    """Wait until a worker picks up the task.
+
+    Args:
+      timeout: The maximum time to wait in seconds, None to wait forever.
+    Returns:
+      Whether the task has started.
+    """
+    self._started.wait(timeout)
+    return self._started.is_set()
+
+  def Wait(self, timeout=None):
+    """Wait until the task finishes.
+
+    Args:
+      timeout: The maximum time to wait in seconds, None to wait forever.
+    Returns:
+      Whether the task has finished.
+    """
+    self._done.wait(timeout)
+    return self._done.is_set()
+
+  def Result(self):
+    """Get the return value of the finished task.
+
+    Returns:
+      The return value of the function.
+    Raises:
+      The exception raised by the function, if any.
+    """
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class WorkerPool(object):
+  """Runs submitted tasks on at most max_workers threads.
+
+  Worker threads are created on demand and are reused for later tasks. Tasks
+  that are submitted while all the workers are busy wait in a FIFO queue.
+  """
+
+  def __init__(self, max_workers, name='WorkerPool'):
+    """Initialize the pool.
+
+    Args:
+      max_workers: The maximum number of worker threads.
+      name: The prefix for the worker thread names.
+    """
+    if max_workers < 1:
+      raise ValueError('max_workers must be at least 1')
+    self.max_workers = max_workers
+    self.name = name
+    self._queue = Queue.Queue()
+    self._lock = threading.Lock()
+    self._workers = []
+    self._idle_workers = 0
+    # The tasks not yet picked up by a worker. Unlike the queue size, this is
+    # updated together with _idle_workers, so a worker that has just taken a
+    # task is never mistaken for an idle one.
+    self._pending = 0
+    self._shutdown = False
+    # Statistics for monitoring.
+    self._submitted = 0
+    self._completed = 0
+    self._total_wait = 0.0
+    self._max_wait = 0.0
+    self._total_run = 0.0
+
+  def Submit(self, func, *args):
+    """Submit a function call to the pool.
+
+    Args:
+      func: The function to run.
+      *args: The arguments for the function.
+    Returns:
+      The Task object.
+    Raises:
+      RuntimeError: If the pool is shut down.
+    """
+    task = Task(func, args)
+    with self._lock:
+      if self._shutdown:
+        raise RuntimeError('Cannot submit to a shut down pool')
+      self._queue.put(task)
+      self._submitted += 1
+      self._pending += 1
+      if (self._idle_workers < self._pending and
+          len(self._workers) < self.max_workers):
+        self._StartWorker()
+    return task
+
+  def GetStats(self):
+    """Get the statistics of the pool for monitoring.
+
+    Returns:
+      A map with the following keys:
+        queue_depth: The number of tasks waiting for a worker.
+        active_workers: The number of workers running a task.
+        workers: The number of worker threads.
+        submitted: The number of tasks submitted.
+        completed: The number of tasks finished.
+        avg_wait: The average time in seconds a finished task waited in queue.
+        max_wait: The longest time in seconds a task waited in queue.
+        avg_run: The average time in seconds a finished task ran.
+    """
+    with self._lock:
+      completed = self._completed
+      return {
+          'queue_depth': self._pending,
+          'active_workers': len(self._workers) - self._idle_workers,
+          'workers': len(self._workers),
+          'submitted': self._submitted,
+          'completed': completed,
+          'avg_wait': self._total_wait / completed if completed else 0.0,
+          'max_wait': self._max_wait,
+          'avg_run': self._total_run / completed if completed else 0.0
+      }
+
+  def Shutdown(self, wait=False):
+    """Stop the workers once the queued tasks are done.
+
+    Args:
+      wait: Whether to block until all the workers exit.
+    """
+    with self._lock:
+      if self._shutdown:
+        return
+      self._shutdown = True
+      workers = self._workers[:]
+      for _ in workers:
+        self._queue.put(None)
+    if wait:
+      for worker in workers:
+        worker.join()
+
+  def _StartWorker(self):
+    worker = threading.Thread(
+        target=self._WorkerLoop,
+        name='%s-%d' % (self.name, len(self._workers)))
+    worker.setDaemon(True)
+    self._workers.append(worker)
+    self._idle_workers += 1
+    worker.start()
+
+  def _WorkerLoop(self):
+    while True:
+      task = self._queue.get()
+      if task is None:
+        return
+      with self._lock:
+        self._idle_workers -= 1
+        self._pending -= 1
+      task.Run(self._TaskFinished)
+
+  def _TaskFinished(self, task):
+    tracer = GetTracer()
+    if tracer:
+      name = getattr(task._func, '__name__', 'task')
+      # The time in the queue is shown on the track of the pool.
+      tracer.AddSpan(name + ' (queued)', CATEGORY_TASK, task.submit_time,
+                     task.start_time, on_thread=False, pool=self.name)
+      tracer.AddSpan(name, CATEGORY_TASK, task.start_time, task.end_time)
+    with self._lock:
+      self._idle_workers += 1
+      self._completed += 1
+      wait = task.start_time - task.submit_time
+      self._total_wait += wait
+      self._max_wait = max(self._max_wait, wait)
+      self._total_run += task.end_time - task.start_time
+
+
+class ScheduledCall(object):
+  """A function call scheduled in a Scheduler.
+
+  Attributes:
+    when: The time when the call should run.
+  """
+
+  def __init__(self, when, func, args):
+    self.when = when
+    self._func = func
+    self._args = args
+    self.cancelled = False
+
+  def Cancel(self):
+    """Prevent the call from running if it has not run yet."""
+    self.cancelled = True
+
+  def Run(self):
+    self._func(*self._args)
+
+
+class Scheduler(object):
+  """Runs delayed function calls on one shared thread.
+
+  The calls run on the scheduler thread one after another, so they should be
+  short. Long operations should be submitted to a WorkerPool from the call.
+  """
+
+  def __init__(self, name='Scheduler'):
+    self.name = name
+    self._heap = []
+    # Breaks ties between calls with the same time so they run in FIFO order.
+    self._sequence = itertools.count()
+    self._condition = threading.Condition()
+    self._thread = None
+    self._shutdown = False
+
+  def CallLater(self, delay, func, *args):
+    """Schedule a function call.
+
+    Args:
+      delay: The time to wait in seconds before running the call.
+      func: The function to run.
+      *args: The arguments for the function.
+    Returns:
+      The ScheduledCall object which can be used to cancel the call.
+    Raises:
+      RuntimeError: If the scheduler is shut down.
+    """
+    call = ScheduledCall(time.time() + delay, func, args)
+    with self._condition:
+      if self._shutdown:
+        raise RuntimeError('Cannot schedule on a shut down scheduler')
+      heapq.heappush(self._heap, (call.when, next(self._sequence), call))
+      if not self._thread:
+        self._thread = threading.Thread(target=self._Loop, name=self.name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+      self._condition.notify()
+    return call
+
+  def GetPendingCount(self):
+    """Get the number of calls that are scheduled and not cancelled."""
+    with self._condition:
+      return len([entry for entry in self._heap if not entry[2].cancelled])
+
+  def Shutdown(self):
+    """Stop the scheduler thread, pending calls would not run.
+
+    Waits for the call being run to return, unless called from that call.
+    """
+    with self._condition:
+      self._shutdown = True
+      self._condition.notify()
+      thread = self._thread
+    if thread and thread is not threading.current_thread():
+      thread.join()
+
+  def IsShutdown(self):
+    """Check whether the scheduler is shut down."""
+    with self._condition:
+      return self._shutdown
+
+  def _NextCall(self):
+    """Wait for the next call that is due.
+
+    Returns:
+      The ScheduledCall to run, None if the scheduler is shut down.
+    """
+    with self._condition:
+      while not self._shutdown:
+        if not self._heap:
+          self._condition.wait()
+          continue
+        call = self._heap[0][2]
+        if call.cancelled:
+          heapq.heappop(self._heap)
+          continue
+        delay = call.when - time.time()
+        if delay <= 0:
+          heapq.heappop(self._heap)
+          return call
+        self._condition.wait(delay)
+      return None
+
+  def _Loop(self):
+    while True:
+      call = self._NextCall()
+      if not call:
+        return
+      try:
+        call.Run()
+      except Exception:  # pylint: disable=broad-except
+        # Same as an uncaught exception in a thread, the scheduler keeps going.
+        traceback.print_exc()
+
+
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def GetScheduler():
+  """Get the scheduler shared by the whole process.
+
+  A new scheduler replaces the shared one once it is shut down.
+  """
+  global _default_scheduler
+  with _default_scheduler_lock:
+    if not _default_scheduler or _default_scheduler.IsShutdown():
+      _default_scheduler = Scheduler()
+    return _default_scheduler
+
+
+class ScheduledTimer(object):
+  """A replacement for threading.Timer that does not create a thread.
+
+  The function runs on the shared scheduler thread.
+  """
+
+  def __init__(self, interval, function, args=None, scheduler=None):
+    self.interval = interval
+    self.function = function
+    self.args = args or []
+    self._scheduler = scheduler
+    self._call = None
+
+  def start(self):
+    scheduler = self._scheduler or GetScheduler()
+    self._call = scheduler.CallLater(
+        self.interval, self.function, *self.args)
+
+  def cancel(self):
+    if self._call:
+      self._call.Cancel()
@@ -0,0 +1,193 @@
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit test for the worker pool and the scheduler."""
+import threading
+import time
+import unittest
+
+import workerpool
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+  def testSubmitResult(self):
+    pool = workerpool.WorkerPool(2)
+    task = pool.Submit(lambda x, y: x + y, 1, 2)
+    self.assertTrue(task.Wait(5))
+    self.assertEqual(3, task.Result())
+    self.assertTrue(task.IsStarted())
+    self.assertTrue(task.end_time >= task.start_time >= task.submit_time)
+    pool.Shutdown(True)
+
+  def testSubmitException(self):
+    pool = workerpool.WorkerPool(1)
+
+    def Fail():
+      raise ValueError('test')
+
+    task = pool.Submit(Fail)
+    self.assertTrue(task.Wait(5))
+    with self.assertRaises(ValueError):
+      task.Result()
+    pool.Shutdown(True)
+
+  def testMaxWorkers(self):
+    pool = workerpool.WorkerPool(2)
+    block = threading.Event()
+    tasks = [pool.Submit(block.wait) for _ in range(0, 5)]
+    self.assertTrue(tasks[0].WaitStarted(5))
+    self.assertTrue(tasks[1].WaitStarted(5))
+    self.assertFalse(tasks[2].WaitStarted(0.05))
+    self.assertEqual(2, len(pool._workers))
+    block.set()
+    for task in tasks:
+      self.assertTrue(task.Wait(5))
+    self.assertEqual(2, len(pool._workers))
+    pool.Shutdown(True)
+
+  def testNewWorkerWhileTaskStarting(self):
+    # A worker that has just taken a blocking task must not be counted as
+    # idle for the next task.
+    for _ in range(0, 50):
+      pool = workerpool.WorkerPool(2)
+      block = threading.Event()
+      pool.Submit(block.wait)
+      task = pool.Submit(lambda: None)
+      self.assertTrue(task.Wait(5))
+      block.set()
+      pool.Shutdown(True)
+
+  def testWorkerReused(self):
+    pool = workerpool.WorkerPool(4)
+    for _ in range(0, 10):
+      self.assertTrue(pool.Submit(lambda: None).Wait(5))
+    self.assertEqual(1, len(pool._workers))
+    pool.Shutdown(True)
+
+  def testSubmitAfterShutdown(self):
+    pool = workerpool.WorkerPool(1)
+    pool.Shutdown()
+    with self.assertRaises(RuntimeError):
+      pool.Submit(lambda: None)
+
+  def testInvalidMaxWorkers(self):
+    with self.assertRaises(ValueError):
+      workerpool.WorkerPool(0)
+
+  def testGetStats(self):
+    pool = workerpool.WorkerPool(1)
+    block = threading.Event()
+    first = pool.Submit(block.wait)
+    second = pool.Submit(lambda: None)
+    self.assertTrue(first.WaitStarted(5))
+    stats = pool.GetStats()
+    self.assertEqual(1, stats['queue_depth'])
+    self.assertEqual(1, stats['active_workers'])
+    self.assertEqual(2, stats['submitted'])
+    self.assertEqual(0, stats['completed'])
+    block.set()
+    self.assertTrue(second.Wait(5))
+    stats = pool.GetStats()
+    self.assertEqual(0, stats['queue_depth'])
+    self.assertEqual(0, stats['active_workers'])
+    self.assertEqual(2, stats['completed'])
+    self.assertTrue(stats['max_wait'] >= second.start_time - second.submit_time)
+    pool.Shutdown(True)
+
+
+class SchedulerTest(unittest.TestCase):
+
+  def setUp(self):
+    self.scheduler = workerpool.Scheduler()
+    self.calls = []
+    self.done = threading.Event()
+
+  def tearDown(self):
+    self.scheduler.Shutdown()
+
+  def Record(self, value):
+    self.calls.append(value)
+
+  def testCallLaterOrder(self):
+    self.scheduler.CallLater(0.1, self.Record, 3)
+    self.scheduler.CallLater(0.05, self.Record, 2)
+    self.scheduler.CallLater(0, self.Record, 1)
+    self.scheduler.CallLater(0.1, self.done.set)
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual([1, 2, 3], self.calls)
+
+  def testCancel(self):
+    call = self.scheduler.CallLater(0.05, self.Record, 1)
+    self.scheduler.CallLater(0.05, self.Record, 2)
+    self.assertEqual(2, self.scheduler.GetPendingCount())
+    call.Cancel()
+    self.assertEqual(1, self.scheduler.GetPendingCount())
+    self.scheduler.CallLater(0.1, self.done.set)
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual([2], self.calls)
+
+  def testExceptionDoesNotStopScheduler(self):
+    def Fail():
+      raise ValueError('test')
+
+    self.scheduler.CallLater(0, Fail)
+    self.scheduler.CallLater(0.01, self.done.set)
+    self.assertTrue(self.done.wait(5))
+
+  def testSingleThread(self):
+    threads = set()
+    for delay in (0, 0.01, 0.02):
+      self.scheduler.CallLater(
+          delay, lambda: threads.add(threading.current_thread()))
+    self.scheduler.CallLater(0.05, self.done.set)
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual(1, len(threads))
+
+  def testScheduledTimer(self):
+    start = time.time()
+    timer = workerpool.ScheduledTimer(
+        0.05, self.Record, [1], scheduler=self.scheduler)
+    timer.start()
+    cancelled = workerpool.ScheduledTimer(
+        0.05, self.Record, [2], scheduler=self.scheduler)
+    cancelled.start()
+    cancelled.cancel()
+    self.scheduler.CallLater(0.1, self.done.set)
+    self.assertTrue(self.done.wait(5))
+    self.assertEqual([1], self.calls)
+    self.assertTrue(time.time() - start >= 0.05)
+
+  def testShutdown(self):
+    self.scheduler.CallLater(0, self.done.set)
+    self.assertTrue(self.done.wait(5))
+    thread = self.scheduler._thread
+    self.scheduler.Shutdown()
+    self.assertFalse(thread.is_alive())
+    self.assertTrue(self.scheduler.IsShutdown())
+    with self.assertRaises(RuntimeError):
+      self.scheduler.CallLater(0, self.Record, 1)
+
+  def testGetSchedulerAfterShutdown(self):
+    scheduler = workerpool.GetScheduler()
+    self.assertIs(scheduler, workerpool.GetScheduler())
+    scheduler.Shutdown()
+    new_scheduler = workerpool.GetScheduler()
+    self.assertIsNot(scheduler, new_scheduler)
+    new_scheduler.CallLater(0, self.done.set)
+    self.assertTrue(self.done.wait(5))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,461 @@
+/*
+ * Copyright 2017 The Android Open Source Project
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+/* Host build of libatap for simulated devices.
+ *
+ * Implements the AtapOps with the OpenSSL 1.1 (or later) EVP APIs and keeps
+ * the provisioned state of each simulated device in memory. The functions
+ * exported at the end of this file take plain pointers and integers so that
+ * they can be called through Python ctypes.
+ *
+ * libatap keeps the session of a device, which lasts from
+ * atap_get_ca_request() to atap_set_ca_response(), in static variables, since
+ * a real device only runs one session. atap_commands.c is compiled into this
+ * file so that the session of each simulated device can be swapped in and
+ * out of those variables around every call.
+ */
+
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include <openssl/ec.h>
+#include <openssl/ecdh.h>
+#include <openssl/evp.h>
+#include <openssl/kdf.h>
+#include <openssl/obj_mac.h>
+#include <openssl/rand.h>
+
+#include "../libatap/atap_commands.c"
+
+#define ATAP_HOST_X25519_KEY_LEN 32
+
+typedef struct {
+  AtapOps ops;
+  uint8_t product_id[ATAP_PRODUCT_ID_LEN];
+  uint8_t soc_global_key[ATAP_AES_128_KEY_LEN];
+  int has_soc_global_key;
+  uint8_t hex_uuid[ATAP_HEX_UUID_LEN];
+  int has_hex_uuid;
+  uint32_t attestation_keys;
+  /* The libatap session of this device. */
+  uint8_t session_shared_secret[ATAP_ECDH_SHARED_SECRET_LEN];
+  uint8_t session_key[ATAP_AES_128_KEY_LEN];
+  AtapOperation operation;
+} AtapHostDevice;
+
+/* Guards the libatap session variables. */
+static pthread_mutex_t session_lock = PTHREAD_MUTEX_INITIALIZER;
+
+static AtapHostDevice* get_device(AtapOps* ops) {
+  return (AtapHostDevice*)ops->user_data;
+}
+
+static AtapResult host_read_product_id(
+    AtapOps* ops, uint8_t product_id[ATAP_PRODUCT_ID_LEN]) {
+  atap_memcpy(product_id, get_device(ops)->product_id, ATAP_PRODUCT_ID_LEN);
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_get_auth_key_type(AtapOps* ops, AtapKeyType* key_type) {
+  /* The test CA does not support SOM authentication. */
+  *key_type = ATAP_KEY_TYPE_NONE;
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_read_auth_key_cert_chain(AtapOps* ops,
+                                                AtapCertChain* cert_chain) {
+  return ATAP_RESULT_ERROR_UNSUPPORTED_OPERATION;
+}
+
+static AtapResult host_write_attestation_key(AtapOps* ops,
+                                             AtapKeyType key_type,
+                                             const AtapBlob* key,
+                                             const AtapCertChain* cert_chain) {
+  get_device(ops)->attestation_keys++;
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_read_attestation_public_key(
+    AtapOps* ops,
+    AtapKeyType key_type,
+    uint8_t pubkey[ATAP_KEY_LEN_MAX],
+    uint32_t* pubkey_len) {
+  return ATAP_RESULT_ERROR_UNSUPPORTED_OPERATION;
+}
+
+static AtapResult host_read_soc_global_key(
+    AtapOps* ops, uint8_t global_key[ATAP_AES_128_KEY_LEN]) {
+  AtapHostDevice* device = get_device(ops);
+  if (!device->has_soc_global_key) {
+    return ATAP_RESULT_ERROR_UNSUPPORTED_OPERATION;
+  }
+  atap_memcpy(global_key, device->soc_global_key, ATAP_AES_128_KEY_LEN);
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_write_hex_uuid(AtapOps* ops,
+                                      const uint8_t uuid[ATAP_HEX_UUID_LEN]) {
+  AtapHostDevice* device = get_device(ops);
+  atap_memcpy(device->hex_uuid, uuid, ATAP_HEX_UUID_LEN);
+  device->has_hex_uuid = 1;
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_get_random_bytes(AtapOps* ops,
+                                        uint8_t* buf,
+                                        uint32_t buf_size) {
+  if (RAND_bytes(buf, buf_size) != 1) {
+    atap_error("Error getting random bytes");
+    return ATAP_RESULT_ERROR_IO;
+  }
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_auth_key_sign(AtapOps* ops,
+                                     const uint8_t* nonce,
+                                     uint32_t nonce_len,
+                                     uint8_t sig[ATAP_SIGNATURE_LEN_MAX],
+                                     uint32_t* sig_len) {
+  return ATAP_RESULT_ERROR_UNSUPPORTED_OPERATION;
+}
+
+static AtapResult x25519_shared_secret_compute(
+    const uint8_t other_public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t shared_secret[ATAP_ECDH_SHARED_SECRET_LEN]) {
+  AtapResult result = ATAP_RESULT_ERROR_CRYPTO;
+  EVP_PKEY_CTX* ctx = NULL;
+  EVP_PKEY* pkey = NULL;
+  EVP_PKEY* other_pkey = NULL;
+  size_t len = ATAP_HOST_X25519_KEY_LEN;
+
+  ctx = EVP_PKEY_CTX_new_id(EVP_PKEY_X25519, NULL);
+  if (!ctx || EVP_PKEY_keygen_init(ctx) != 1 ||
+      EVP_PKEY_keygen(ctx, &pkey) != 1) {
+    atap_error("Error generating X25519 key");
+    goto out;
+  }
+  /* The X25519 public key is padded to the length of a P256 public key. */
+  atap_memset(public_key, 0, ATAP_ECDH_KEY_LEN);
+  if (EVP_PKEY_get_raw_public_key(pkey, public_key, &len) != 1) {
+    atap_error("Error serializing X25519 public key");
+    goto out;
+  }
+  other_pkey = EVP_PKEY_new_raw_public_key(
+      EVP_PKEY_X25519, NULL, other_public_key, ATAP_HOST_X25519_KEY_LEN);
+  if (!other_pkey) {
+    atap_error("Error deserializing other X25519 public key");
+    goto out;
+  }
+  EVP_PKEY_CTX_free(ctx);
+  ctx = EVP_PKEY_CTX_new(pkey, NULL);
+  len = ATAP_ECDH_SHARED_SECRET_LEN;
+  if (!ctx || EVP_PKEY_derive_init(ctx) != 1 ||
+      EVP_PKEY_derive_set_peer(ctx, other_pkey) != 1 ||
+      EVP_PKEY_derive(ctx, shared_secret, &len) != 1) {
+    atap_error("Error computing X25519 shared secret");
+    goto out;
+  }
+  result = ATAP_RESULT_OK;
+
+out:
+  EVP_PKEY_CTX_free(ctx);
+  EVP_PKEY_free(pkey);
+  EVP_PKEY_free(other_pkey);
+  return result;
+}
+
+static AtapResult p256_shared_secret_compute(
+    const uint8_t other_public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t shared_secret[ATAP_ECDH_SHARED_SECRET_LEN]) {
+  AtapResult result = ATAP_RESULT_ERROR_CRYPTO;
+  EC_KEY* pkey = EC_KEY_new_by_curve_name(NID_X9_62_prime256v1);
+  const EC_GROUP* group = NULL;
+  EC_POINT* other_point = NULL;
+
+  if (!pkey || !EC_KEY_generate_key(pkey)) {
+    atap_error("Error generating P256 key");
+    goto out;
+  }
+  group = EC_KEY_get0_group(pkey);
+  other_point = EC_POINT_new(group);
+  if (!other_point ||
+      !EC_POINT_oct2point(
+          group, other_point, other_public_key, ATAP_ECDH_KEY_LEN, NULL)) {
+    atap_error("Error deserializing other P256 public key");
+    goto out;
+  }
+  if (!EC_POINT_point2oct(group,
+                          EC_KEY_get0_public_key(pkey),
+                          POINT_CONVERSION_COMPRESSED,
+                          public_key,
+                          ATAP_ECDH_KEY_LEN,
+                          NULL)) {
+    atap_error("Error serializing P256 public key");
+    goto out;
+  }
+  if (ECDH_compute_key(shared_secret,
+                       ATAP_ECDH_SHARED_SECRET_LEN,
+                       other_point,
+                       pkey,
+                       NULL) != ATAP_ECDH_SHARED_SECRET_LEN) {
+    atap_error("Error computing P256 shared secret");
+    goto out;
+  }
+  result = ATAP_RESULT_OK;
+
+out:
+  EC_POINT_free(other_point);
+  EC_KEY_free(pkey);
+  return result;
+}
+
+static AtapResult host_ecdh_shared_secret_compute(
+    AtapOps* ops,
+    AtapCurveType curve,
+    const uint8_t other_public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t public_key[ATAP_ECDH_KEY_LEN],
+    uint8_t shared_secret[ATAP_ECDH_SHARED_SECRET_LEN]) {
+  if (curve == ATAP_CURVE_TYPE_X25519) {
+    return x25519_shared_secret_compute(
+        other_public_key, public_key, shared_secret);
+  }
+  if (curve == ATAP_CURVE_TYPE_P256) {
+    return p256_shared_secret_compute(
+        other_public_key, public_key, shared_secret);
+  }
+  return ATAP_RESULT_ERROR_UNSUPPORTED_ALGORITHM;
+}
+
+static AtapResult host_aes_gcm_128_encrypt(
+    AtapOps* ops,
+    const uint8_t* plaintext,
+    uint32_t len,
+    const uint8_t iv[ATAP_GCM_IV_LEN],
+    const uint8_t key[ATAP_AES_128_KEY_LEN],
+    uint8_t* ciphertext,
+    uint8_t tag[ATAP_GCM_TAG_LEN]) {
+  AtapResult result = ATAP_RESULT_ERROR_CRYPTO;
+  EVP_CIPHER_CTX* ctx = EVP_CIPHER_CTX_new();
+  int out_len = 0;
+
+  if (!ctx ||
+      EVP_EncryptInit_ex(ctx, EVP_aes_128_gcm(), NULL, NULL, NULL) != 1 ||
+      EVP_CIPHER_CTX_ctrl(
+          ctx, EVP_CTRL_GCM_SET_IVLEN, ATAP_GCM_IV_LEN, NULL) != 1 ||
+      EVP_EncryptInit_ex(ctx, NULL, NULL, key, iv) != 1 ||
+      EVP_EncryptUpdate(ctx, ciphertext, &out_len, plaintext, len) != 1 ||
+      EVP_EncryptFinal_ex(ctx, ciphertext + out_len, &out_len) != 1 ||
+      EVP_CIPHER_CTX_ctrl(
+          ctx, EVP_CTRL_GCM_GET_TAG, ATAP_GCM_TAG_LEN, tag) != 1) {
+    atap_error("Error encrypting");
+    goto out;
+  }
+  result = ATAP_RESULT_OK;
+
+out:
+  EVP_CIPHER_CTX_free(ctx);
+  return result;
+}
+
+static AtapResult host_aes_gcm_128_decrypt(
+    AtapOps* ops,
+    const uint8_t* ciphertext,
+    uint32_t len,
+    const uint8_t iv[ATAP_GCM_IV_LEN],
+    const uint8_t key[ATAP_AES_128_KEY_LEN],
+    const uint8_t tag[ATAP_GCM_TAG_LEN],
+    uint8_t* plaintext) {
+  AtapResult result = ATAP_RESULT_ERROR_CRYPTO;
+  EVP_CIPHER_CTX* ctx = EVP_CIPHER_CTX_new();
+  int out_len = 0;
+
+  if (!ctx ||
+      EVP_DecryptInit_ex(ctx, EVP_aes_128_gcm(), NULL, NULL, NULL) != 1 ||
+      EVP_CIPHER_CTX_ctrl(
+          ctx, EVP_CTRL_GCM_SET_IVLEN, ATAP_GCM_IV_LEN, NULL) != 1 ||
+      EVP_DecryptInit_ex(ctx, NULL, NULL, key, iv) != 1 ||
+      EVP_DecryptUpdate(ctx, plaintext, &out_len, ciphertext, len) != 1 ||
+      EVP_CIPHER_CTX_ctrl(
+          ctx, EVP_CTRL_GCM_SET_TAG, ATAP_GCM_TAG_LEN, (void*)tag) != 1 ||
+      EVP_DecryptFinal_ex(ctx, plaintext + out_len, &out_len) != 1) {
+    atap_error("Error decrypting");
+    goto out;
+  }
+  result = ATAP_RESULT_OK;
+
+out:
+  EVP_CIPHER_CTX_free(ctx);
+  return result;
+}
+
+static AtapResult host_sha256(AtapOps* ops,
+                              const uint8_t* input,
+                              uint32_t input_len,
+                              uint8_t hash[ATAP_SHA256_DIGEST_LEN]) {
+  if (EVP_Digest(input, input_len, hash, NULL, EVP_sha256(), NULL) != 1) {
+    atap_error("Error computing SHA256");
+    return ATAP_RESULT_ERROR_CRYPTO;
+  }
+  return ATAP_RESULT_OK;
+}
+
+static AtapResult host_hkdf_sha256(AtapOps* ops,
+                                   const uint8_t* salt,
+                                   uint32_t salt_len,
+                                   const uint8_t* ikm,
+                                   uint32_t ikm_len,
+                                   const uint8_t* info,
+                                   uint32_t info_len,
+                                   uint8_t* okm,
+                                   uint32_t okm_len) {
+  AtapResult result = ATAP_RESULT_ERROR_CRYPTO;
+  EVP_PKEY_CTX* ctx = EVP_PKEY_CTX_new_id(EVP_PKEY_HKDF, NULL);
+  size_t out_len = okm_len;
+
+  if (!ctx || EVP_PKEY_derive_init(ctx) != 1 ||
+      EVP_PKEY_CTX_set_hkdf_md(ctx, EVP_sha256()) != 1 ||
+      EVP_PKEY_CTX_set1_hkdf_salt(ctx, salt, salt_len) != 1 ||
+      EVP_PKEY_CTX_set1_hkdf_key(ctx, ikm, ikm_len) != 1 ||
+      EVP_PKEY_CTX_add1_hkdf_info(ctx, info, info_len) != 1 ||
+      EVP_PKEY_derive(ctx, okm, &out_len) != 1 || out_len != okm_len) {
+    atap_error("Error computing HKDF");
+    goto out;
+  }
+  result = ATAP_RESULT_OK;
+
+out:
+  EVP_PKEY_CTX_free(ctx);
+  return result;
+}
+
+static void swap_session_in(AtapHostDevice* device) {
+  pthread_mutex_lock(&session_lock);
+  atap_memcpy(session_shared_secret,
+              device->session_shared_secret,
+              ATAP_ECDH_SHARED_SECRET_LEN);
+  atap_memcpy(session_key, device->session_key, ATAP_AES_128_KEY_LEN);
+  operation = device->operation;
+}
+
+static void swap_session_out(AtapHostDevice* device) {
+  atap_memcpy(device->session_shared_secret,
+              session_shared_secret,
+              ATAP_ECDH_SHARED_SECRET_LEN);
+  atap_memcpy(device->session_key, session_key, ATAP_AES_128_KEY_LEN);
+  device->operation = operation;
+  atap_memset(session_shared_secret, 0, ATAP_ECDH_SHARED_SECRET_LEN);
+  atap_memset(session_key, 0, ATAP_AES_128_KEY_LEN);
+  operation = ATAP_OPERATION_NONE;
+  pthread_mutex_unlock(&session_lock);
+}
+
+/* Creates a simulated device with the ATAP_PRODUCT_ID_LEN bytes of
+ * |product_id|. If |soc_global_key| is not NULL, the device supports the
+ * ISSUE_ENCRYPTED operation with this ATAP_AES_128_KEY_LEN bytes key. Returns
+ * NULL if out of memory.
+ */
+AtapHostDevice* atap_host_device_new(const uint8_t* product_id,
+                                     const uint8_t* soc_global_key) {
+  AtapHostDevice* device = (AtapHostDevice*)calloc(1, sizeof(AtapHostDevice));
+  if (!device) {
+    return NULL;
+  }
+  device->ops.user_data = device;
+  device->ops.read_product_id = host_read_product_id;
+  device->ops.get_auth_key_type = host_get_auth_key_type;
+  device->ops.read_auth_key_cert_chain = host_read_auth_key_cert_chain;
+  device->ops.write_attestation_key = host_write_attestation_key;
+  device->ops.read_attestation_public_key = host_read_attestation_public_key;
+  device->ops.read_soc_global_key = host_read_soc_global_key;
+  device->ops.write_hex_uuid = host_write_hex_uuid;
+  device->ops.get_random_bytes = host_get_random_bytes;
+  device->ops.auth_key_sign = host_auth_key_sign;
+  device->ops.ecdh_shared_secret_compute = host_ecdh_shared_secret_compute;
+  device->ops.aes_gcm_128_encrypt = host_aes_gcm_128_encrypt;
+  device->ops.aes_gcm_128_decrypt = host_aes_gcm_128_decrypt;
+  device->ops.sha256 = host_sha256;
+  device->ops.hkdf_sha256 = host_hkdf_sha256;
+  atap_memcpy(device->product_id, product_id, ATAP_PRODUCT_ID_LEN);
+  if (soc_global_key) {
+    atap_memcpy(
+        device->soc_global_key, soc_global_key, ATAP_AES_128_KEY_LEN);
+    device->has_soc_global_key = 1;
+  }
+  return device;
+}
+
+/* Frees a device created by atap_host_device_new(). */
+void atap_host_device_free(AtapHostDevice* device) {
+  if (device) {
+    atap_memset(device, 0, sizeof(AtapHostDevice));
+    free(device);
+  }
+}
+
+/* Runs atap_get_ca_request() on |device|. The CA Request message returned in
+ * |*ca_request_p| must be freed with atap_host_free().
+ */
+int atap_host_get_ca_request(AtapHostDevice* device,
+                             const uint8_t* operation_start,
+                             uint32_t operation_start_size,
+                             uint8_t** ca_request_p,
+                             uint32_t* ca_request_size_p) {
+  AtapResult result;
+  swap_session_in(device);
+  result = atap_get_ca_request(&device->ops,
+                               operation_start,
+                               operation_start_size,
+                               ca_request_p,
+                               ca_request_size_p);
+  swap_session_out(device);
+  return result;
+}
+
+/* Runs atap_set_ca_response() on |device|. */
+int atap_host_set_ca_response(AtapHostDevice* device,
+                              const uint8_t* ca_response,
+                              uint32_t ca_response_size) {
+  AtapResult result;
+  swap_session_in(device);
+  result = atap_set_ca_response(&device->ops, ca_response, ca_response_size);
+  swap_session_out(device);
+  return result;
+}
+
+/* Writes the ATAP_HEX_UUID_LEN bytes of the hex UUID stored on |device| to
+ * |hex_uuid|. Returns 0 if no UUID has been stored yet.
+ */
+int atap_host_get_hex_uuid(AtapHostDevice* device,
+                           uint8_t hex_uuid[ATAP_HEX_UUID_LEN]) {
+  if (!device->has_hex_uuid) {
+    return 0;
+  }
+  atap_memcpy(hex_uuid, device->hex_uuid, ATAP_HEX_UUID_LEN);
+  return 1;
+}
+
+/* Returns the number of attestation keys written to |device|. */
+uint32_t atap_host_get_attestation_key_count(AtapHostDevice* device) {
+  return device->attestation_keys;
+}
+
+/* Frees memory allocated by libatap. */
+void atap_host_free(void* ptr) {
+  atap_free(ptr);
+}
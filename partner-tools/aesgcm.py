@@ -20,18 +20,102 @@ Class to organize GCM-related functions
 
 import os
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import aead
 from cryptography.hazmat.primitives.ciphers import algorithms
 from cryptography.hazmat.primitives.ciphers import Cipher
 from cryptography.hazmat.primitives.ciphers import modes
 
 
+_IV_LEN = 12
+_TAG_LEN = 16
+
+
 class AESGCM(object):
-  """Contains static methods for AES GCM operations.
+  """AES GCM operations.
+
+  The static methods encrypt and decrypt take the key on every call. When many
+  messages are processed with the same key, create an instance bound to the
+  key instead. The instance keeps one AEAD context for its lifetime and
+  supports batch operations.
 
   Attributes:
     None
   """
 
+  def __init__(self, key):
+    """Creates an AES-GCM context bound to key.
+
+    Args:
+      key: The AES-GCM key
+    """
+    self._aead = aead.AESGCM(bytes(key))
+
+  def encrypt_message(self, plaintext, associated_data=''):
+    """Encrypts provided plaintext with the bound key.
+
+    Args:
+      plaintext: The plaintext to be encrypted
+      associated_data: Associated data (optional)
+
+    Returns:
+      iv: The IV
+      ciphertext: The ciphertext
+      tag: The GCM TAG
+    """
+    iv = os.urandom(_IV_LEN)
+    sealed = self._aead.encrypt(iv, bytes(plaintext), associated_data)
+    return (iv, sealed[:-_TAG_LEN], sealed[-_TAG_LEN:])
+
+  def decrypt_message(self, ciphertext, iv, tag, associated_data=''):
+    """Decrypts provided ciphertext with the bound key.
+
+    Args:
+      ciphertext: The ciphertext
+      iv: The IV
+      tag: The GCM Tag
+      associated_data: Associated data (optional)
+
+    Returns:
+      The plaintext
+
+    Raises:
+      cryptography.exceptions.InvalidTag
+    """
+    return self._aead.decrypt(bytes(iv), bytes(ciphertext) + bytes(tag),
+                              associated_data)
+
+  def encrypt_many(self, plaintexts, associated_data=''):
+    """Encrypts a batch of plaintexts with the bound key.
+
+    Every plaintext gets its own random IV.
+
+    Args:
+      plaintexts: Iterable of plaintexts to be encrypted
+      associated_data: Associated data used for every message (optional)
+
+    Returns:
+      A list of (iv, ciphertext, tag) tuples in input order.
+    """
+    return [self.encrypt_message(plaintext, associated_data)
+            for plaintext in plaintexts]
+
+  def decrypt_many(self, messages, associated_data=''):
+    """Decrypts a batch of messages with the bound key.
+
+    Args:
+      messages: Iterable of (ciphertext, iv, tag) tuples
+      associated_data: Associated data used for every message (optional)
+
+    Returns:
+      A list of plaintexts in input order.
+
+    Raises:
+      cryptography.exceptions.InvalidTag: Any of the messages fails to
+        authenticate.
+    """
+    return [self.decrypt_message(ciphertext, iv, tag, associated_data)
+            for (ciphertext, iv, tag) in messages]
+
   @staticmethod
   def encrypt(plaintext, key, associated_data=''):
     """Encrypts provided plaintext using AES-GCM.
@@ -53,7 +137,7 @@ class AESGCM(object):
       None
     """
 
-    iv = os.urandom(12)
+    iv = os.urandom(_IV_LEN)
 
     encryptor = Cipher(
         algorithms.AES(key), modes.GCM(iv),
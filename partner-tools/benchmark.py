@@ -0,0 +1,296 @@
+#!/usr/bin/python
+
+#
+# Copyright 2017 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Microbenchmarks for the test CA crypto helpers.
+
+Usage:
+
+./benchmark.py [-n ITERATIONS] [--key-pool-depth DEPTH] [--write-corpus DIR]
+               [BENCHMARK ...]
+
+Runs all benchmarks if none is specified.
+"""
+
+import argparse
+import imp
+import os
+import random
+import struct
+import time
+import timeit
+
+from aesgcm import AESGCM
+import ec_helper
+
+
+def _report(name, seconds, iterations):
+  """Prints one benchmark result line.
+
+  Args:
+    name: The name of the measured operation.
+    seconds: Total time spent for all iterations.
+    iterations: Number of iterations measured.
+  """
+  print '%-48s %10.1f us/op' % (name, seconds * 1e6 / iterations)
+
+
+def bench_ec_helper(results):
+  """Compares the P256 key generation and ECDH backends of ec_helper."""
+  iterations = results.iterations
+  print 'ec_helper backends: %s (selected: %s)' % (
+      ', '.join(ec_helper.available_backends()), ec_helper.get_backend())
+  for name in ec_helper.available_backends():
+    backend = ec_helper._backends[name]  # pylint: disable=protected-access
+    [private_key, _] = backend.generate_p256_key()
+    [_, peer_public_key] = backend.generate_p256_key()
+    _report('%s generate_p256_key' % name,
+            timeit.timeit(backend.generate_p256_key, number=iterations),
+            iterations)
+    _report('%s compute_p256_shared_secret' % name,
+            timeit.timeit(
+                lambda: backend.compute_p256_shared_secret(  # pylint: disable=cell-var-from-loop
+                    private_key, peer_public_key),
+                number=iterations),
+            iterations)
+
+
+def bench_aesgcm(results):
+  """Compares the static AESGCM path with a key-bound AESGCM instance."""
+  iterations = results.iterations
+  key = os.urandom(16)
+  context = AESGCM(key)
+  batch_size = 64
+  for size in (64, 1024, 16384):
+    plaintext = os.urandom(size)
+    (iv, ciphertext, tag) = AESGCM.encrypt(plaintext, key)
+    messages = [(ciphertext, iv, tag)] * batch_size
+    _report('static encrypt %d bytes' % size,
+            timeit.timeit(lambda: AESGCM.encrypt(plaintext, key),  # pylint: disable=cell-var-from-loop
+                          number=iterations),
+            iterations)
+    _report('instance encrypt %d bytes' % size,
+            timeit.timeit(lambda: context.encrypt_message(plaintext),  # pylint: disable=cell-var-from-loop
+                          number=iterations),
+            iterations)
+    _report('instance encrypt_many %d bytes' % size,
+            timeit.timeit(
+                lambda: context.encrypt_many([plaintext] * batch_size),  # pylint: disable=cell-var-from-loop
+                number=max(1, iterations / batch_size)),
+            max(1, iterations / batch_size) * batch_size)
+    _report('static decrypt %d bytes' % size,
+            timeit.timeit(
+                lambda: AESGCM.decrypt(ciphertext, key, iv, tag),  # pylint: disable=cell-var-from-loop
+                number=iterations),
+            iterations)
+    _report('instance decrypt_many %d bytes' % size,
+            timeit.timeit(lambda: context.decrypt_many(messages),  # pylint: disable=cell-var-from-loop
+                          number=max(1, iterations / batch_size)),
+            max(1, iterations / batch_size) * batch_size)
+
+
+def _load_provision_test():
+  return imp.load_source(
+      'provision_test',
+      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   'provision-test.py'))
+
+
+def bench_session_start(results):
+  """Compares session starts with and without the ephemeral key pool."""
+  provision_test = _load_provision_test()
+  iterations = results.iterations
+  depth = results.key_pool_depth
+  for (name, algorithm) in sorted(provision_test._ALGORITHMS.iteritems()):  # pylint: disable=protected-access
+    _report('%s session start' % name,
+            timeit.timeit(
+                lambda: provision_test._new_session(algorithm, 2),  # pylint: disable=protected-access,cell-var-from-loop
+                number=iterations),
+            iterations)
+    provision_test._start_key_pool(depth)  # pylint: disable=protected-access
+    pool = provision_test._key_pool  # pylint: disable=protected-access
+    # Measure the draws from a full pool, the refill runs in between.
+    while pool.size(algorithm) < depth:
+      time.sleep(0.01)
+    draws = min(iterations, depth)
+    _report('%s session start, key pool depth %d' % (name, depth),
+            timeit.timeit(
+                lambda: provision_test._new_session(algorithm, 2),  # pylint: disable=protected-access,cell-var-from-loop
+                number=draws),
+            draws)
+    provision_test._stop_key_pool()  # pylint: disable=protected-access
+
+
+def _make_fuzz_corpus(provision_test, seed=0):
+  """Generates malformed X25519 CA Request messages.
+
+  The base message is structurally valid but carries a random ciphertext, so
+  only the GCM decrypt rejects it. The mutations of it are deterministic for a
+  seed.
+
+  Args:
+    provision_test: The loaded provision-test module.
+    seed: The seed of the mutations.
+
+  Returns:
+    A list of (name, message) tuples, the base message first.
+  """
+  # pylint: disable=protected-access
+  rand = random.Random(seed)
+
+  def Random(length):
+    return bytearray(rand.getrandbits(8) for _ in range(length))
+
+  def Message(pub_key, enc_len=None, version=1, reserved=0, len_delta=0):
+    inner_len = provision_test._INNER_CA_REQUEST_MIN_LEN
+    body = pub_key + Random(provision_test._GCM_IV_LEN)
+    body += struct.pack('<I', inner_len if enc_len is None else enc_len)
+    body += Random(inner_len + provision_test._GCM_TAG_LEN)
+    header = struct.pack('<4B I', version, reserved, 0, 0,
+                         len(body) + len_delta)
+    return bytearray(header) + body
+
+  # X25519 public keys are padded with a zero byte.
+  x25519_key = Random(32) + bytearray(1)
+  base = Message(x25519_key)
+  corpus = [('valid-structure', base)]
+  for length in sorted(set(rand.randrange(len(base)) for _ in range(16))):
+    corpus.append(('truncated-%d' % length, base[:length]))
+  corpus.append(('trailing-bytes', base + Random(7)))
+  corpus.append(('bad-version', Message(x25519_key, version=2)))
+  corpus.append(('reserved-set', Message(x25519_key, reserved=1)))
+  for delta in (-1, 1, 1 << 20):
+    corpus.append(('message-len%+d' % delta,
+                   Message(x25519_key, len_delta=delta)))
+  inner_len = provision_test._INNER_CA_REQUEST_MIN_LEN
+  for enc_len in (0, inner_len - 1, inner_len + 1, 0xffffffff):
+    corpus.append(('enc-len-%d' % enc_len, Message(x25519_key, enc_len)))
+  corpus.append(('p256-key', Message(bytearray([2]) + Random(32))))
+  for length in (0, 64, 129, 4096):
+    corpus.append(('random-%d' % length, Random(length)))
+  for _ in range(32):
+    message = bytearray(base)
+    bit = rand.randrange(provision_test._CA_REQUEST_FIXED_LEN * 8)
+    message[bit / 8] ^= 1 << (bit % 8)
+    corpus.append(('bit-flip-%d' % bit, message))
+  return corpus
+
+
+def _reject_all(provision_test, messages, session_params):
+  """Passes every message to the test CA, all of them must be rejected.
+
+  Returns:
+    A list of (message index, error) tuples for the messages that were not
+    rejected with a ValueError.
+  """
+  failures = []
+  for (index, message) in enumerate(messages):
+    try:
+      provision_test._issue_ca_response(message, session_params, False)  # pylint: disable=protected-access
+      failures.append((index, 'accepted'))
+    except ValueError:
+      pass
+    except Exception as e:  # pylint: disable=broad-except
+      failures.append((index, repr(e)))
+  return failures
+
+
+def bench_validate(results):
+  """Compares CA Requests rejected before the crypto with the decrypt path."""
+  provision_test = _load_provision_test()
+  corpus = _make_fuzz_corpus(provision_test)
+  if results.write_corpus:
+    if not os.path.isdir(results.write_corpus):
+      os.makedirs(results.write_corpus)
+    for (index, (name, message)) in enumerate(corpus):
+      path = os.path.join(results.write_corpus, '%03d-%s.bin' % (index, name))
+      with open(path, 'wb') as f:
+        f.write(message)
+    print 'Wrote %d CA Requests to %s' % (len(corpus), results.write_corpus)
+
+  # The session is not ended, so that it can be reused for every message.
+  (session_params, _) = provision_test._new_session(  # pylint: disable=protected-access
+      provision_test._ALGORITHMS['x25519'], 2)  # pylint: disable=protected-access
+  names = [name for (name, _) in corpus]
+  messages = [message for (_, message) in corpus]
+  failures = _reject_all(provision_test, messages, session_params)
+  print 'Fuzz corpus: %d CA Requests, %d not rejected' % (len(corpus),
+                                                         len(failures))
+  for (index, error) in failures:
+    print '  %s: %s' % (names[index], error)
+
+  groups = {'before crypto': [], 'after crypto': []}
+  for message in messages:
+    try:
+      provision_test._validate_ca_request(message, session_params.algorithm)  # pylint: disable=protected-access
+      groups['after crypto'].append(message)
+    except ValueError:
+      groups['before crypto'].append(message)
+  iterations = max(1, results.iterations / len(messages))
+  for (name, group) in sorted(groups.iteritems(), reverse=True):
+    if not group:
+      continue
+    _report('reject %d CA Requests %s' % (len(group), name),
+            timeit.timeit(
+                lambda: _reject_all(provision_test, group, session_params),  # pylint: disable=cell-var-from-loop
+                number=iterations),
+            iterations * len(group))
+
+
+_BENCHMARKS = {
+    'aesgcm': bench_aesgcm,
+    'ec_helper': bench_ec_helper,
+    'session_start': bench_session_start,
+    'validate': bench_validate,
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Microbenchmarks for the test CA crypto helpers.')
+  parser.add_argument(
+      '-n',
+      '--iterations',
+      type=int,
+      default=1000,
+      dest='iterations',
+      help='Number of iterations per measured operation')
+  parser.add_argument(
+      '--key-pool-depth',
+      type=int,
+      default=100,
+      dest='key_pool_depth',
+      help='Number of pre-generated session keys per curve')
+  parser.add_argument(
+      '--write-corpus',
+      dest='write_corpus',
+      metavar='DIR',
+      help='Write the fuzz corpus of the validate benchmark to DIR')
+  parser.add_argument(
+      'benchmarks',
+      nargs='*',
+      help='Benchmarks to run: %s' % ', '.join(sorted(_BENCHMARKS.keys())))
+
+  results = parser.parse_args()
+  for name in results.benchmarks:
+    if name not in _BENCHMARKS:
+      parser.error('Unknown benchmark: %s' % name)
+  for name in results.benchmarks or sorted(_BENCHMARKS.keys()):
+    _BENCHMARKS[name](results)
+
+
+if __name__ == '__main__':
+  main()
@@ -13,11 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-"""Methods to call native OpenSSL APIs to support P256 with compression.
+"""Methods to support P256 ECDH with X9.62 point compression.
 
-Since there are no Python crypto libraries that support P256 EC keys with
-with X9.62 compression, this module uses the native OpenSSL APIs to support
-key generation and deriving a shared secret using generated P256 EC keys.
+Two interchangeable backends are provided:
+
+  cryptography: Uses the python cryptography library (version 2.5 or later)
+      to generate keys and to derive shared secrets.
+  native: Calls the native OpenSSL APIs through ec_helper_native.so, which
+      needs to be built in this directory ($ make ec_helper_native).
+
+Both backends produce DER-encoded (SEC1) private keys and 33 byte X9.62
+compressed public keys, so keys generated by one backend can be used by the
+other. The fastest available backend is selected at import time. The selection
+can be overridden with the EC_HELPER_BACKEND environment variable or by calling
+set_backend().
 """
 
 from ctypes import byref
@@ -28,19 +37,206 @@ from ctypes import cdll
 from ctypes import create_string_buffer
 from ctypes import POINTER
 from ctypes.util import find_library
+import os
+import timeit
+
+try:
+  from cryptography.hazmat.backends import default_backend
+  from cryptography.hazmat.primitives import serialization
+  from cryptography.hazmat.primitives.asymmetric import ec
+except ImportError:
+  ec = None
 
 _ECDH_KEY_LEN = 33
+_ECDH_SHARED_SECRET_LEN = 32
+
+BACKEND_CRYPTOGRAPHY = 'cryptography'
+BACKEND_NATIVE = 'native'
+
+# Number of key generation and shared secret rounds used to compare backends.
+_PROBE_ROUNDS = 3
+
+
+class _CryptographyBackend(object):
+  """P256 operations implemented with the python cryptography library."""
+
+  name = BACKEND_CRYPTOGRAPHY
+
+  def __init__(self):
+    if ec is None:
+      raise RuntimeError('cryptography library not available')
+    if not hasattr(ec.EllipticCurvePublicKey, 'from_encoded_point'):
+      raise RuntimeError('cryptography library too old, need version 2.5+')
+    self._backend = default_backend()
+
+  def generate_p256_key(self):
+    private_key = ec.generate_private_key(ec.SECP256R1(), self._backend)
+    private_der = private_key.private_bytes(
+        serialization.Encoding.DER,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption())
+    public_key = private_key.public_key().public_bytes(
+        serialization.Encoding.X962,
+        serialization.PublicFormat.CompressedPoint)
+    return [private_der, public_key]
+
+  def compute_p256_shared_secret(self, private_key, device_public_key):
+    try:
+      private = serialization.load_der_private_key(
+          bytes(private_key), None, self._backend)
+      public = ec.EllipticCurvePublicKey.from_encoded_point(
+          ec.SECP256R1(), bytes(device_public_key))
+      return private.exchange(ec.ECDH(), public)
+    except ValueError:
+      raise RuntimeError('Failed to compute P256 shared secret')
+
+
+class _NativeBackend(object):
+  """P256 operations implemented by the ec_helper_native library."""
+
+  name = BACKEND_NATIVE
+
+  def __init__(self):
+    cdll.LoadLibrary(find_library('crypto'))
+    cdll.LoadLibrary(find_library('ssl'))
+    library_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'ec_helper_native.so')
+    try:
+      ec_helper = cdll.LoadLibrary(library_path)
+    except OSError as e:
+      raise RuntimeError('Failed to load %s: %s' % (library_path, e))
+
+    self._generate_p256_key = ec_helper.generate_p256_key
+    self._generate_p256_key.argtypes = [
+        POINTER(POINTER(c_ubyte)),
+        POINTER(c_uint),
+        POINTER(c_ubyte)
+    ]
+    self._generate_p256_key.restype = c_int
+
+    self._shared_secret_compute = ec_helper.shared_secret_compute
+    self._shared_secret_compute.argtypes = [
+        POINTER(c_ubyte), c_uint,
+        POINTER(c_ubyte),
+        POINTER(c_ubyte)
+    ]
+    self._shared_secret_compute.restype = c_int
+
+  def generate_p256_key(self):
+    pub_key = (c_ubyte * _ECDH_KEY_LEN).from_buffer(bytearray(_ECDH_KEY_LEN))
+    pub_key_ptr = POINTER(c_ubyte)(pub_key)
+    priv_key = POINTER(c_ubyte)()
+    priv_key_len = c_uint(0)
+    res = self._generate_p256_key(
+        byref(priv_key), byref(priv_key_len), pub_key_ptr)
+    if res != 0:
+      raise RuntimeError('Failed to generate EC key')
+    private_key = bytes(bytearray(priv_key[:priv_key_len.value]))
+    public_key = bytes(bytearray(pub_key[0:_ECDH_KEY_LEN]))
+    return [private_key, public_key]
+
+  def compute_p256_shared_secret(self, private_key, device_public_key):
+    shared_secret = (c_ubyte * _ECDH_SHARED_SECRET_LEN).from_buffer(
+        bytearray(_ECDH_SHARED_SECRET_LEN))
+    shared_secret_ptr = POINTER(c_ubyte)(shared_secret)
+    device_public_key_ptr = POINTER(c_ubyte)(
+        create_string_buffer(bytes(device_public_key)))
+    private_key_ptr = POINTER(c_ubyte)(create_string_buffer(bytes(private_key)))
+    res = self._shared_secret_compute(private_key_ptr,
+                                      len(private_key), device_public_key_ptr,
+                                      shared_secret_ptr)
+    if res != 0:
+      raise RuntimeError('Failed to compute P256 shared secret')
+    return bytes(bytearray(shared_secret[0:_ECDH_SHARED_SECRET_LEN]))
+
+
+_BACKEND_CLASSES = (_CryptographyBackend, _NativeBackend)
+
+_backends = {}
+_backend = None
+
 
+def _load_backends():
+  """Instantiates every backend that can be loaded in this environment."""
+  for backend_class in _BACKEND_CLASSES:
+    try:
+      _backends[backend_class.name] = backend_class()
+    except (RuntimeError, OSError, TypeError):
+      # TypeError: find_library() returned None and LoadLibrary rejected it.
+      pass
 
-def _ec_helper_native():
-  """Loads the ec_helper_native library.
+
+def _probe(backend):
+  """Measures one P256 key generation and ECDH round trip on backend.
+
+  Args:
+    backend: The backend to measure.
+
+  Returns:
+    The best time of _PROBE_ROUNDS rounds, in seconds.
+  """
+  def round_trip():
+    [private_key, _] = backend.generate_p256_key()
+    [_, peer_public_key] = backend.generate_p256_key()
+    backend.compute_p256_shared_secret(private_key, peer_public_key)
+  return min(timeit.repeat(round_trip, repeat=_PROBE_ROUNDS, number=1))
+
+
+def _select_backend():
+  """Selects the backend to use for the module level functions.
 
   Returns:
-    The ctypes ec_helper_native library.
+    The requested backend if EC_HELPER_BACKEND is set and available, otherwise
+    the fastest available backend. None if no backend is available.
   """
-  cdll.LoadLibrary(find_library('crypto'))
-  cdll.LoadLibrary(find_library('ssl'))
-  return cdll.LoadLibrary('./ec_helper_native.so')
+  requested = os.environ.get('EC_HELPER_BACKEND')
+  if requested in _backends:
+    return _backends[requested]
+  if len(_backends) < 2:
+    return next(iter(_backends.values()), None)
+  timings = []
+  for backend in _backends.values():
+    try:
+      timings.append((_probe(backend), backend.name))
+    except RuntimeError:
+      pass
+  if not timings:
+    return None
+  return _backends[min(timings)[1]]
+
+
+def available_backends():
+  """Returns the names of the backends that can be used."""
+  return sorted(_backends.keys())
+
+
+def get_backend():
+  """Returns the name of the backend in use, or None if none is available."""
+  if _backend is None:
+    return None
+  return _backend.name
+
+
+def set_backend(name):
+  """Selects the backend used by generate_p256_key/compute_p256_shared_secret.
+
+  Args:
+    name: BACKEND_CRYPTOGRAPHY or BACKEND_NATIVE.
+
+  Raises:
+    ValueError: The backend is not available.
+  """
+  global _backend
+  if name not in _backends:
+    raise ValueError('EC backend %s not available' % name)
+  _backend = _backends[name]
+
+
+def _get_backend():
+  if _backend is None:
+    raise RuntimeError('No P256 backend available, install cryptography 2.5+ '
+                       'or build ec_helper_native.so')
+  return _backend
 
 
 def generate_p256_key():
@@ -53,25 +249,7 @@ def generate_p256_key():
     A tuple containing the der-encoded private key and the X9.62 compressed
     public key.
   """
-  ec_helper = _ec_helper_native()
-  native_generate_p256_key = ec_helper.generate_p256_key
-  native_generate_p256_key.argtypes = [
-      POINTER(POINTER(c_ubyte)),
-      POINTER(c_uint),
-      POINTER(c_ubyte)
-  ]
-  native_generate_p256_key.restype = c_int
-  pub_key = (c_ubyte * _ECDH_KEY_LEN).from_buffer(bytearray(_ECDH_KEY_LEN))
-  pub_key_ptr = POINTER(c_ubyte)(pub_key)
-  priv_key = POINTER(c_ubyte)()
-  priv_key_len = c_uint(0)
-  res = native_generate_p256_key(
-      byref(priv_key), byref(priv_key_len), pub_key_ptr)
-  if res != 0:
-    raise RuntimeError('Failed to generate EC key')
-  private_key = bytes(bytearray(priv_key[:priv_key_len.value]))
-  public_key = bytes(bytearray(pub_key[0:_ECDH_KEY_LEN]))
-  return [private_key, public_key]
+  return _get_backend().generate_p256_key()
 
 
 def compute_p256_shared_secret(private_key, device_public_key):
@@ -87,22 +265,9 @@ def compute_p256_shared_secret(private_key, device_public_key):
   Returns:
     The shared secret.
   """
-  ec_helper = _ec_helper_native()
-  shared_secret_compute = ec_helper.shared_secret_compute
-  shared_secret_compute.argtypes = [
-      POINTER(c_ubyte), c_uint,
-      POINTER(c_ubyte),
-      POINTER(c_ubyte)
-  ]
-  shared_secret_compute.restype = c_int
-  shared_secret = (c_ubyte * 32).from_buffer(bytearray(32))
-  shared_secret_ptr = POINTER(c_ubyte)(shared_secret)
-  device_public_key_ptr = POINTER(c_ubyte)(
-      create_string_buffer(device_public_key))
-  private_key_ptr = POINTER(c_ubyte)(create_string_buffer(private_key))
-  res = shared_secret_compute(private_key_ptr,
-                              len(private_key), device_public_key_ptr,
-                              shared_secret_ptr)
-  if res != 0:
-    raise RuntimeError('Failed to compute P256 shared secret')
-  return bytes(bytearray(shared_secret[0:32]))
+  return _get_backend().compute_p256_shared_secret(private_key,
+                                                   device_public_key)
+
+
+_load_backends()
+_backend = _select_backend()
@@ -23,9 +23,13 @@ Appliance (ATFA).
 """
 
 import argparse
+from collections import deque
 from collections import namedtuple
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import os
 import struct
+import threading
 
 from aesgcm import AESGCM
 import cryptography.exceptions
@@ -35,7 +39,8 @@ from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import curve25519
 import ec_helper
 
-_ATAPSessionParameters = namedtuple('_AtapSessionParameters', [
+# The type name matches the module attribute so that sessions can be pickled.
+_ATAPSessionParameters = namedtuple('_ATAPSessionParameters', [
     'algorithm', 'operation', 'private_key', 'public_key'
 ])
 
@@ -44,13 +49,235 @@ _OPERATIONS = {'ISSUE': 2, 'ISSUE_ENC': 3}
 _ALGORITHMS = {'p256': 1, 'x25519': 2}
 _ECDH_KEY_LEN = 33
 
+_KEYSET_FILES = {
+    _OPERATIONS['ISSUE']: 'keysets/unencrypted.keyset',
+    _OPERATIONS['ISSUE_ENC']: 'keysets/encrypted.keyset'
+}
+_GCM_IV_LEN = 12
+_GCM_TAG_LEN = 16
+_HEADER_LEN = 8
+_VAR_LEN = 4
+_PRODUCT_ID_HASH_LEN = 32
+
+# The CA Request message without the encrypted Inner CA Request.
+_CA_REQUEST_FIXED_LEN = (_HEADER_LEN + _ECDH_KEY_LEN + _GCM_IV_LEN + _VAR_LEN +
+                         _GCM_TAG_LEN)
+# An Inner CA Request with all the variable fields empty.
+_INNER_CA_REQUEST_MIN_LEN = _HEADER_LEN + 5 * _VAR_LEN + _PRODUCT_ID_HASH_LEN
+
+_InnerCaRequestLayout = namedtuple('_InnerCaRequestLayout', [
+    'som_chain_len', 'som_signature_len', 'prod_id_hash_start', 'rsa_len',
+    'ecdsa_len', 'eddsa_len'
+])
+
+_CRYPTO_MODES = ('inline', 'thread', 'process')
+
 _session_params = _ATAPSessionParameters(0, 0, bytes(), bytes())
 
 
-def _write_operation_start(algorithm, operation):
-  """Writes a fresh Operation Start message to tmp/operation_start.bin.
+def _generate_key_pair(algorithm):
+  """Generates an ECDHE key pair.
+
+  Args:
+    algorithm: Integer specifying the curve. 1: P256, 2: X25519
+
+  Returns:
+    A (private_key, public_key) tuple. The private key is a bytearray so that
+    it can be zeroed after use.
+  """
+  if algorithm == _ALGORITHMS['x25519']:
+    private_key = curve25519.genkey()
+    # Make 33 bytes to match P256
+    public_key = curve25519.public(private_key) + '\0'
+  else:
+    [private_key, public_key] = ec_helper.generate_p256_key()
+  return (bytearray(private_key), public_key)
+
+
+def _zero(private_key):
+  """Overwrites a private key bytearray with zeros in place."""
+  private_key[:] = bytearray(len(private_key))
+
+
+class _EphemeralKeyPool(object):
+  """Pre-generated ECDHE key pairs for the session starts.
+
+  A daemon thread keeps up to <depth> key pairs per curve ready, so that a
+  session start takes one in constant time instead of generating it. Every
+  key pair is taken once. If the pool of a curve runs dry, the key pair is
+  generated on the spot.
+  """
+
+  def __init__(self, depth):
+    """Starts filling the pool.
+
+    Args:
+      depth: The number of key pairs to keep ready per curve.
+    """
+    self._depth = depth
+    self._pools = dict(
+        (algorithm, deque()) for algorithm in _ALGORITHMS.values())
+    self._wakeup = threading.Event()
+    self._stopped = False
+    self._thread = threading.Thread(target=self._refill, name='KeyPoolRefill')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _refill(self):
+    while not self._stopped:
+      self._wakeup.clear()
+      # Fill the curves in turn so that none of them waits for the others.
+      short = True
+      while short and not self._stopped:
+        short = False
+        for (algorithm, pool) in self._pools.iteritems():
+          if len(pool) < self._depth:
+            pool.append(_generate_key_pair(algorithm))
+            short = True
+      self._wakeup.wait()
+
+  def take(self, algorithm):
+    """Takes a key pair for a session.
+
+    Args:
+      algorithm: Integer specifying the curve. 1: P256, 2: X25519
+
+    Returns:
+      A (private_key, public_key) tuple, see _generate_key_pair.
+    """
+    try:
+      key_pair = self._pools[algorithm].popleft()
+    except IndexError:
+      key_pair = None
+    self._wakeup.set()
+    return key_pair or _generate_key_pair(algorithm)
+
+  def size(self, algorithm):
+    """Returns the number of key pairs ready for a curve."""
+    return len(self._pools[algorithm])
+
+  def stop(self):
+    """Stops the refill thread and zeroes the key pairs not taken."""
+    self._stopped = True
+    self._wakeup.set()
+    self._thread.join()
+    for pool in self._pools.values():
+      while pool:
+        _zero(pool.popleft()[0])
+
+
+_key_pool = None
+
+
+def _start_key_pool(depth):
+  """Starts drawing the session keys from a pre-generated key pool.
+
+  Args:
+    depth: The number of key pairs to keep ready per curve.
+  """
+  global _key_pool
+  _stop_key_pool()
+  _key_pool = _EphemeralKeyPool(depth)
+
+
+def _stop_key_pool():
+  """Stops the key pool, sessions generate their own keys again."""
+  global _key_pool
+  if _key_pool:
+    _key_pool.stop()
+    _key_pool = None
+
+
+class _ResponseTemplate(object):
+  """Precomputed CA Response message for a keyset of a fixed length.
+
+  The header and the encrypted message length only depend on the keyset
+  length, so they are packed once. Only the GCM IV, the encrypted keyset and
+  the GCM tag are filled in per request.
+  """
+
+  def __init__(self, keyset_len):
+    # "CA Response" Header
+    header = (_MESSAGE_VERSION, 0, 0, 0,
+              _GCM_IV_LEN + 4 + keyset_len + _GCM_TAG_LEN)
+    self._header = struct.pack('<4B I', *header)
+    self._keyset_len = keyset_len
+    self._encrypted_len = struct.pack('<I', keyset_len)
+
+  def fill(self, gcm_iv, encrypted_keyset, gcm_tag):
+    """Assembles a CA Response message.
+
+    Args:
+      gcm_iv: The GCM IV used to encrypt the keyset.
+      encrypted_keyset: The encrypted keyset.
+      gcm_tag: The GCM tag.
+
+    Raises:
+      ValueError: A field does not match the template lengths.
+
+    Returns:
+      The CA Response message.
+    """
+    if (len(gcm_iv) != _GCM_IV_LEN or len(gcm_tag) != _GCM_TAG_LEN or
+        len(encrypted_keyset) != self._keyset_len):
+      raise ValueError('CA Response field length mismatch')
+    return b''.join((self._header, gcm_iv, self._encrypted_len,
+                     encrypted_keyset, gcm_tag))
+
+
+_CachedKeyset = namedtuple('_CachedKeyset', [
+    'mtime', 'size', 'keyset', 'response_template'
+])
+
 
-  Generates an ECDHE key specified by <algorithm> and writes an Operation
+class _KeysetCache(object):
+  """Caches keyset payloads and their CA Response templates.
+
+  Entries are immutable and replaced when the keyset file's modification time
+  or size changes, so updated keysets are picked up without a restart.
+  """
+
+  def __init__(self, keyset_files):
+    """Initializes the cache.
+
+    Args:
+      keyset_files: Map of operation to keyset file path.
+    """
+    self._keyset_files = keyset_files
+    self._entries = {}
+
+  def get(self, operation):
+    """Returns the _CachedKeyset for operation, loading it if needed.
+
+    Args:
+      operation: The session operation, ISSUE or ISSUE_ENC.
+
+    Raises:
+      ValueError: The operation has no keyset.
+      IOError: The keyset file cannot be read.
+    """
+    if operation not in self._keyset_files:
+      raise ValueError('No keyset for operation %d' % operation)
+    path = self._keyset_files[operation]
+    stat = os.stat(path)
+    entry = self._entries.get(operation)
+    if (entry is None or entry.mtime != stat.st_mtime or
+        entry.size != stat.st_size):
+      with open(path, 'rb') as infile:
+        keyset = bytes(infile.read())
+      entry = _CachedKeyset(stat.st_mtime, stat.st_size, keyset,
+                            _ResponseTemplate(len(keyset)))
+      self._entries[operation] = entry
+    return entry
+
+
+_keyset_cache = _KeysetCache(_KEYSET_FILES)
+
+
+def _new_session(algorithm, operation):
+  """Starts a new provisioning session.
+
+  Generates an ECDHE key specified by <algorithm> and creates an Operation
   Start message for executing <operation> on the device.
 
   Args:
@@ -60,9 +287,10 @@ def _write_operation_start(algorithm, operation):
 
   Raises:
     ValueError: algorithm or operation is is invalid.
-  """
 
-  global _session_params
+  Returns:
+    A (_ATAPSessionParameters, operation_start) tuple.
+  """
 
   if algorithm > 2 or algorithm < 1:
     raise ValueError('Invalid algorithm value.')
@@ -70,16 +298,15 @@ def _write_operation_start(algorithm, operation):
   if operation > 3 or operation < 1:
     raise ValueError('Invalid operation value.')
 
-  # Generate new key for each provisioning session
-  if algorithm == _ALGORITHMS['x25519']:
-    private_key = curve25519.genkey()
-    # Make 33 bytes to match P256
-    public_key = curve25519.public(private_key) + '\0'
-  elif algorithm == _ALGORITHMS['p256']:
-    [private_key, public_key] = ec_helper.generate_p256_key()
+  # Use a new key for each provisioning session
+  key_pool = _key_pool
+  if key_pool:
+    (private_key, public_key) = key_pool.take(algorithm)
+  else:
+    (private_key, public_key) = _generate_key_pair(algorithm)
 
-  _session_params = _ATAPSessionParameters(algorithm, operation, private_key,
-                                           public_key)
+  session_params = _ATAPSessionParameters(algorithm, operation, private_key,
+                                          public_key)
 
   # "Operation Start" Header
   # +2 for algo and operation bytes
@@ -90,6 +317,25 @@ def _write_operation_start(algorithm, operation):
   op_start = (algorithm, operation, public_key)
   operation_start.extend(struct.pack('<2B 33s', *op_start))
 
+  return (session_params, operation_start)
+
+
+def _write_operation_start(algorithm, operation):
+  """Writes a fresh Operation Start message to tmp/operation_start.bin.
+
+  Args:
+    algorithm: Integer specifying the curve to use for the session key.
+        1: P256, 2: X25519
+    operation: Specifies the operation. 1: Certify, 2: Issue, 3: Issue Encrypted
+
+  Raises:
+    ValueError: algorithm or operation is is invalid.
+  """
+
+  global _session_params
+
+  (_session_params, operation_start) = _new_session(algorithm, operation)
+
   with open('tmp/operation_start.bin', 'wb') as f:
     f.write(operation_start)
 
@@ -97,17 +343,40 @@ def _write_operation_start(algorithm, operation):
 def _get_ca_response(ca_request):
   """Writes a CA Response message to tmp/ca_response.bin.
 
+  Args:
+    ca_request: The CA Request message from the device.
+
+  Raises:
+    ValueError: ca_request is malformed.
+  """
+  ca_response = _make_ca_response(ca_request, _session_params, verbose=True)
+
+  with open('tmp/ca_response.bin', 'wb') as f:
+    f.write(ca_response)
+
+
+def _make_ca_response(ca_request, session_params, verbose=False):
+  """Creates the CA Response message for a CA Request message.
+
   Parses the CA Request message at ca_request. Computes the session key from
   the ca_request, decrypts the inner request, verifies the SOM key signature,
   and issues or certifies attestation keys as applicable. The CA Response
-  message containing test keys is written to ca_response.bin.
+  message containing test keys is returned.
+
+  The session ends with this call: its private key is zeroed whether the CA
+  Request message is accepted or not.
 
   Args:
     ca_request: The CA Request message from the device.
+    session_params: The _ATAPSessionParameters from _new_session.
+    verbose: Whether to print the product ID hash.
 
   Raises:
     ValueError: ca_request is malformed.
 
+  Returns:
+    The CA Response message.
+
   CA Request message format for reference, sizes in bytes
 
   cleartext header                            8
@@ -122,154 +391,252 @@ def _get_ca_response(ca_request):
   encrypted edDSA public key                  variable
   cleartext GCM tag                           16
   """
+  if not any(session_params.private_key):
+    raise ValueError('No session or session already ended')
+  try:
+    return _issue_ca_response(ca_request, session_params, verbose)
+  finally:
+    # Each session key is used exactly once.
+    _zero(session_params.private_key)
+
+
+class _CryptoExecutor(object):
+  """Runs the per-request crypto of the CA Response messages.
+
+  The modes are:
+    inline: In the caller's thread.
+    thread: In a pool of threads. The crypto itself releases the GIL, but the
+        Python glue around it does not.
+    process: In a pool of worker processes, so that the requests from many
+        threads use several cores. The session, with its private key, is
+        passed to the worker explicitly; the caller's copy of the key is
+        zeroed once the response is back.
+
+  The worker processes are forked when the executor is created, create it
+  before starting the key pool so that they hold no pooled keys.
+  """
 
-  var_len = 4
-  header_len = 8
-  pub_key_len = _ECDH_KEY_LEN
-  gcm_iv_len = 12
-  prod_id_hash_len = 32
-  gcm_tag_len = 16
+  def __init__(self, mode='inline', workers=None):
+    """Starts the workers.
+
+    Args:
+      mode: One of _CRYPTO_MODES.
+      workers: The number of worker threads or processes, the number of CPUs
+          if None.
+
+    Raises:
+      ValueError: mode is invalid.
+    """
+    if mode not in _CRYPTO_MODES:
+      raise ValueError('Invalid crypto mode %s' % mode)
+    self.mode = mode
+    self._pool = None
+    if mode == 'thread':
+      self._pool = ThreadPool(workers or multiprocessing.cpu_count())
+    elif mode == 'process':
+      self._pool = multiprocessing.Pool(workers)
+
+  def make_ca_response(self, ca_request, session_params):
+    """Creates the CA Response message, see _make_ca_response.
+
+    Args:
+      ca_request: The CA Request message from the device.
+      session_params: The _ATAPSessionParameters from _new_session.
+
+    Raises:
+      ValueError: ca_request is malformed.
+
+    Returns:
+      The CA Response message.
+    """
+    if self._pool is None:
+      return _make_ca_response(ca_request, session_params)
+    try:
+      return self._pool.apply_async(
+          _make_ca_response, (bytearray(ca_request), session_params)).get()
+    finally:
+      _zero(session_params.private_key)
+
+  def close(self):
+    """Stops the workers once the submitted requests are done."""
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+
+def _check_header(data, name):
+  """Checks a message header, the message length must match exactly.
 
-  min_message_length = (
-      header_len + pub_key_len + gcm_iv_len + header_len + var_len + var_len +
-      prod_id_hash_len + var_len + var_len + var_len + gcm_tag_len)
+  Args:
+    data: The message starting with the header.
+    name: The name of the message for the error messages.
 
-  if len(ca_request) < min_message_length:
+  Raises:
+    ValueError: The header is malformed.
+  """
+  (version, res1, res2, res3, message_len) = struct.unpack_from('<4B I', data)
+  if version != _MESSAGE_VERSION:
+    raise ValueError('Malformed message: Incorrect %s version' % name)
+  if res1 or res2 or res3:
+    raise ValueError('Malformed message: Reserved values set')
+  if message_len != len(data) - _HEADER_LEN:
+    raise ValueError('Malformed message: Incorrect %s length' % name)
+
+
+def _validate_ca_request(ca_request, algorithm):
+  """Checks the structure of a CA Request message before any crypto.
+
+  Modeled on validate_encrypted_message of libatap: every length field must
+  match the message size exactly. Reads the fields in place.
+
+  Args:
+    ca_request: The CA Request message.
+    algorithm: The curve of the session. 1: P256, 2: X25519
+
+  Raises:
+    ValueError: ca_request is malformed.
+
+  Returns:
+    The length of the encrypted Inner CA Request.
+  """
+  if len(ca_request) < _CA_REQUEST_FIXED_LEN + _INNER_CA_REQUEST_MIN_LEN:
     raise ValueError('Malformed message: Length invalid')
+  _check_header(ca_request, 'device message')
 
-  # Unpack Request header
-  end = header_len
-  ca_req_start = ca_request[:end]
-  (device_message_version, res1, res2, res3,
-   device_message_len) = struct.unpack('<4B I', ca_req_start)
+  # The device ephemeral public key must be a key on the session curve.
+  (first, last) = struct.unpack_from('<B %dx B' % (_ECDH_KEY_LEN - 2),
+                                     ca_request, _HEADER_LEN)
+  if algorithm == _ALGORITHMS['x25519']:
+    # X25519 public keys are padded with a zero byte.
+    if last != 0:
+      raise ValueError('Malformed message: Invalid X25519 public key')
+  elif first not in (2, 3):
+    # P256 public keys are compressed points.
+    raise ValueError('Malformed message: Invalid P256 public key')
 
-  if device_message_version != _MESSAGE_VERSION:
-    raise ValueError('Malformed message: Incorrect message version')
+  enc_message_len = _get_var_len(
+      ca_request, _HEADER_LEN + _ECDH_KEY_LEN + _GCM_IV_LEN)
+  if enc_message_len != len(ca_request) - _CA_REQUEST_FIXED_LEN:
+    raise ValueError('Malformed message: Incorrect encrypted message length')
+  return enc_message_len
 
-  if res1 or res2 or res3:
-    raise ValueError('Malformed message: Reserved values set')
 
-  if device_message_len > len(ca_request) - header_len:
-    raise ValueError('Malformed message: Incorrect device message length')
+def _validate_inner_ca_request(data):
+  """Checks the structure of a decrypted Inner CA Request in one pass.
+
+  Walks the variable length fields in order, each must fit in the rest of
+  the message and the last one must end the message. Reads the fields in
+  place.
+
+  Args:
+    data: The Inner CA Request.
+
+  Raises:
+    ValueError: data is malformed.
+
+  Returns:
+    An _InnerCaRequestLayout.
+  """
+  if len(data) < _INNER_CA_REQUEST_MIN_LEN:
+    raise ValueError('Malformed message: Inner message length invalid')
+  _check_header(data, 'inner message')
+
+  lengths = []
+  offset = _HEADER_LEN
+  for field in ('SOM key certificate chain',
+                'SOM key authentication signature', None, 'RSA public key',
+                'ECDSA public key', 'edDSA public key'):
+    if field is None:
+      # The product ID hash has a fixed length.
+      lengths.append(offset)
+      offset += _PRODUCT_ID_HASH_LEN
+      continue
+    if offset + _VAR_LEN > len(data):
+      raise ValueError('Malformed message: %s missing' % field)
+    field_len = _get_var_len(data, offset)
+    offset += _VAR_LEN
+    if field_len > len(data) - offset:
+      raise ValueError('Malformed message: %s too long' % field)
+    lengths.append(field_len)
+    offset += field_len
+  if offset != len(data):
+    raise ValueError('Malformed message: Trailing bytes in inner message')
+  return _InnerCaRequestLayout(*lengths)
+
+
+def _issue_ca_response(ca_request, session_params, verbose):
+  """Creates the CA Response message, see _make_ca_response."""
+
+  enc_message_len = _validate_ca_request(ca_request, session_params.algorithm)
 
   # Extract AT device ephemeral public key
-  start = header_len
-  end = start + pub_key_len
+  start = _HEADER_LEN
+  end = start + _ECDH_KEY_LEN
   device_pub_key = bytes(ca_request[start:end])
 
-  # Generate shared_key
-  salt = _session_params.public_key + device_pub_key
-  shared_key = _get_shared_key(_session_params.algorithm, device_pub_key, salt)
-
-  # Decrypt AES-128-GCM message using the shared_key
   # Extract the GCM IV
-  start = header_len + pub_key_len
-  end = start + gcm_iv_len
+  start = end
+  end = start + _GCM_IV_LEN
   gcm_iv = bytes(ca_request[start:end])
 
   # Extract the encrypted message
-  start = header_len + pub_key_len + gcm_iv_len
-  enc_message_len = _get_var_len(ca_request, start)
-
-  if enc_message_len > len(ca_request) - gcm_tag_len - start - var_len:
-    raise ValueError('Encrypted message size %d too large' % enc_message_len)
-
-  start += var_len
+  start = end + _VAR_LEN
   end = start + enc_message_len
   enc_message = bytes(ca_request[start:end])
 
   # Extract the GCM Tag
-  gcm_tag = bytes(ca_request[-gcm_tag_len:])
+  gcm_tag = bytes(ca_request[end:])
+
+  # Generate shared_key
+  salt = session_params.public_key + device_pub_key
+  shared_key = _get_shared_key(session_params, device_pub_key, salt)
+  # The same session key decrypts the request and encrypts the response.
+  cipher = AESGCM(shared_key)
 
-  # Decrypt message
+  # Decrypt AES-128-GCM message using the shared_key
   try:
-    data = AESGCM.decrypt(enc_message, shared_key, gcm_iv, gcm_tag)
+    data = cipher.decrypt_message(enc_message, gcm_iv, gcm_tag)
   except cryptography.exceptions.InvalidTag:
     raise ValueError('Malformed message: GCM decrypt failed')
 
-  # Unpack Inner header
-  end = header_len
-  ca_req_inner_header = data[:end]
-  (device_message_version, res1, res2, res3, inner_message_len) = struct.unpack(
-      '<4B I', ca_req_inner_header)
-
-  if device_message_version != _MESSAGE_VERSION:
-    raise ValueError('Malformed message: Incorrect inner message version')
-
-  if res1 or res2 or res3:
-    raise ValueError('Malformed message: Reserved values set')
-
-  remaining_bytes = len(ca_request) - header_len - pub_key_len
-  remaining_bytes = remaining_bytes - gcm_iv_len - gcm_tag_len
-  if inner_message_len > remaining_bytes:
-    raise ValueError('Malformed message: Incorrect device inner message length')
+  layout = _validate_inner_ca_request(data)
 
-  # SOM key certificate chain
-  som_chain_start = header_len
-  som_chain_len = _get_var_len(data, som_chain_start)
-  if som_chain_len > 0:
+  if layout.som_chain_len > 0:
     raise ValueError(
         'SOM authentication not yet supported, set cert chain length to zero')
 
-  # SOM key authentication signature
-  som_key_start = som_chain_start + var_len + som_chain_len
-  som_len = _get_var_len(data, som_key_start)
-  if som_len > 0:
+  if layout.som_signature_len > 0:
     raise ValueError(
         'SOM authentication not yet supported, set signature length to zero')
 
-  # Product ID SHA-256 hash
-  prod_id_start = som_key_start + var_len + som_len
-  prod_id_end = prod_id_start + prod_id_hash_len
-  prod_id_hash = data[prod_id_start:prod_id_end]
-  print 'product_id hash:' + prod_id_hash.encode('hex')
+  if verbose:
+    prod_id_hash = data[layout.prod_id_hash_start:layout.prod_id_hash_start +
+                        _PRODUCT_ID_HASH_LEN]
+    print 'product_id hash:' + prod_id_hash.encode('hex')
 
-  # RSA public key to certify
-  rsa_start = prod_id_start + prod_id_hash_len
-  rsa_len = _get_var_len(data, rsa_start)
-  if rsa_len > 0:
+  if layout.rsa_len > 0:
     raise ValueError(
         'Certify operation not supported, set RSA public key length to zero')
 
-  # ECDSA public key to certify
-  ecdsa_start = rsa_start + var_len + rsa_len
-  ecdsa_len = _get_var_len(data, ecdsa_start)
-  if ecdsa_len > 0:
+  if layout.ecdsa_len > 0:
     raise ValueError(
         'Certify operation not supported, set ECDSA public key length to zero')
 
-  # edDSA public key to certify
-  eddsa_start = prod_id_start + var_len + prod_id_hash_len
-  eddsa_len = _get_var_len(data, eddsa_start)
-  if eddsa_len > 0:
+  if layout.eddsa_len > 0:
     raise ValueError(
         'Certify operation not supported, set edDSA public key length to zero')
 
   # ATFA treats ISSUE and ISSUE_ENCRYPTED operations the same
-  if _session_params.operation == _OPERATIONS['ISSUE']:
-    with open('keysets/unencrypted.keyset', 'rb') as infile:
-      inner_ca_response = bytes(infile.read())
-  elif _session_params.operation == _OPERATIONS['ISSUE_ENC']:
-    with open('keysets/encrypted.keyset', 'rb') as infile:
-      inner_ca_response = bytes(infile.read())
-
-  (gcm_iv, encrypted_keyset, gcm_tag) = AESGCM.encrypt(inner_ca_response,
-                                                       shared_key)
-
-  # "CA Response" Header
-  # +2 for algo and operation bytes
-  header = (_MESSAGE_VERSION, 0, 0, 0, 12 + 4 + len(encrypted_keyset) + 16)
-  ca_response = bytearray(struct.pack('<4B I', *header))
-
-  struct_fmt = '12s I %ds 16s' % len(inner_ca_response)
-  message = (gcm_iv, len(encrypted_keyset), encrypted_keyset, gcm_tag)
-  ca_response.extend(struct.pack(struct_fmt, *message))
+  cached_keyset = _keyset_cache.get(session_params.operation)
 
-  with open('tmp/ca_response.bin', 'wb') as f:
-    f.write(ca_response)
+  (gcm_iv, encrypted_keyset, gcm_tag) = cipher.encrypt_message(
+      cached_keyset.keyset)
+  return cached_keyset.response_template.fill(gcm_iv, encrypted_keyset,
+                                              gcm_tag)
 
 
-def _get_shared_key(algorithm,
+def _get_shared_key(session_params,
                     device_pub_key,
                     hkdf_salt,
                     hkdf_info='KEY',
@@ -279,7 +646,7 @@ def _get_shared_key(algorithm,
   Uses a particular ECDH algorithm and HKDF-SHA256 to create a shared key
 
   Args:
-    algorithm: p256 or curve25519
+    session_params: The _ATAPSessionParameters of the session
     device_pub_key: ephemeral public key from the AT device
     hkdf_salt: salt to use in the HKDF operation
     hkdf_info: info value to use in the HKDF operation
@@ -292,14 +659,14 @@ def _get_shared_key(algorithm,
     The shared key.
   """
 
-  if algorithm == _ALGORITHMS['p256']:
+  if session_params.algorithm == _ALGORITHMS['p256']:
     ecdhe_shared_secret = ec_helper.compute_p256_shared_secret(
-        _session_params.private_key, device_pub_key)
+        bytes(session_params.private_key), device_pub_key)
 
-  elif algorithm == _ALGORITHMS['x25519']:
+  elif session_params.algorithm == _ALGORITHMS['x25519']:
     device_pub_key = device_pub_key[:-1]
-    ecdhe_shared_secret = curve25519.shared(_session_params.private_key,
-                                            device_pub_key)
+    ecdhe_shared_secret = curve25519.shared(
+        bytes(session_params.private_key), device_pub_key)
 
   hkdf = HKDF(
       algorithm=hashes.SHA256(),